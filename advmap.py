@@ -27,6 +27,13 @@ parser = argparse.ArgumentParser(description='Adventure Game Mapper')
 parser.add_argument('-r', '--readonly',
         action='store_true',
         help='Start the editor in readonly mode')
+parser.add_argument('-c', '--cache',
+        action='store_true',
+        help='Keep parsed copies of opened files, so they reopen faster')
+parser.add_argument('--cache-dir',
+        type=str,
+        metavar='dirname',
+        help='Directory to keep the cache in (implies --cache; defaults to ~/.cache/advmap)')
 parser.add_argument('filename',
         type=str,
         nargs='?',
@@ -36,6 +43,14 @@ parser.add_argument('filename',
 # Parse arguments
 args = parser.parse_args()
 
+# An empty cache directory means the default one
+if args.cache_dir:
+    cachedir = args.cache_dir
+elif args.cache:
+    cachedir = ''
+else:
+    cachedir = None
+
 # Run the GUI
-gui = Application(args.filename, args.readonly)
+gui = Application(args.filename, args.readonly, cachedir)
 sys.exit(gui.exec_())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Adventure Game Mapper
+# Copyright (C) 2010-2022 CJ Kucera
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Loads (and so validates) lots of savefiles at once, spread across
+# several processes.  Can be used from the commandline:
+#
+#   $ python -m advmap.batch data/*.adv
+#
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from advmap.data import Game, GameInfo, MapInfo
+
+__all__ = [ 'LoadResult', 'load_one', 'load_many' ]
+
+class LoadResult(object):
+    """
+    The result of loading a single file with `load_one`.  If the load
+    worked, `info` will be a GameInfo object describing what was loaded,
+    and `error` will be `None`.  Otherwise, `info` will be `None` and
+    `error` will be a description of what went wrong.  `seconds` is how
+    long the load took.
+    """
+
+    def __init__(self, filename, info=None, error=None, seconds=0):
+        self.filename = filename
+        self.info = info
+        self.error = error
+        self.seconds = seconds
+
+    def ok(self):
+        """
+        Returns `True` if the file loaded successfully
+        """
+        return self.error is None
+
+def load_one(filename, validate=True):
+    """
+    Fully loads the given filename (including every map in it), and
+    returns a LoadResult.  Never raises an exception for a bad file;
+    the error is reported in the result instead.
+    """
+    start = time.perf_counter()
+    try:
+        game = Game.load(filename, readonly=True, validate=validate)
+        info = GameInfo(game.name, game.version, game.format)
+        for mapobj in game.maps:
+            mapobj.materialize()
+            info.maps.append(MapInfo(mapobj.name, mapobj.w, mapobj.h,
+                len(mapobj.rooms), len(mapobj.conns), len(mapobj.groups)))
+    except Exception as e:
+        return LoadResult(filename, error='{}: {}'.format(type(e).__name__, e),
+                seconds=time.perf_counter()-start)
+    return LoadResult(filename, info=info, seconds=time.perf_counter()-start)
+
+def load_many(filenames, max_workers=None, validate=True):
+    """
+    Loads all the given filenames with `load_one`, using a pool of up
+    to `max_workers` processes (defaulting to one per CPU).  Returns a
+    list of LoadResults, in the same order as `filenames`.  Passing
+    `max_workers` = 1 loads everything in the current process instead.
+    """
+    filenames = list(filenames)
+    if max_workers == 1 or len(filenames) < 2:
+        return [load_one(filename, validate) for filename in filenames]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    # Hand out files a few at a time, so that lots of small files don't
+    # spend all their time on the trip to the worker and back.
+    chunksize = max(1, len(filenames) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(load_one, filenames,
+            [validate]*len(filenames), chunksize=chunksize))
+
+def main(argv=None):
+    """
+    Commandline interface: loads all the specified files, printing a
+    summary line for each.  Returns 0 if everything loaded, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Load and validate Adventure Game Mapper files')
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=None,
+            help='Number of processes to use (defaults to one per CPU)')
+    parser.add_argument('--no-validate',
+            dest='validate',
+            action='store_false',
+            help='Skip checking the consistency of connections while loading')
+    parser.add_argument('filenames',
+            type=str,
+            nargs='+',
+            metavar='filename',
+            help='Files to load')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = load_many(args.filenames, max_workers=args.jobs, validate=args.validate)
+    elapsed = time.perf_counter() - start
+
+    errors = 0
+    for result in results:
+        if result.ok():
+            info = result.info
+            if info.version is None:
+                version = info.format
+            else:
+                version = 'v{}'.format(info.version)
+            print('{}: {} "{}", {} maps, {} rooms, {} connections, {} groups ({:.1f}ms)'.format(
+                result.filename, version, info.name, len(info.maps),
+                sum(m.num_rooms for m in info.maps),
+                sum(m.num_conns for m in info.maps),
+                sum(m.num_groups for m in info.maps),
+                result.seconds*1000))
+        else:
+            errors += 1
+            print('{}: ERROR: {}'.format(result.filename, result.error))
+    print('Loaded {} files ({} errors) in {:.1f}ms'.format(len(results), errors, elapsed*1000))
+    if errors:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
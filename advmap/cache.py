@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Adventure Game Mapper
+# Copyright (C) 2010-2022 CJ Kucera
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import marshal
+import hashlib
+import tempfile
+from advmap.data import Game, Map, SAVEFILE_VER
+from advmap.file import BufferedSavefile, MmapSavefile, LoadException, file_key
+from advmap.jsonfile import JsonSavefile
+from advmap.sqlitefile import SqliteSavefile
+
+__all__ = [ 'GameCache' ]
+
+# Bump this whenever the layout of a cache entry (or of `Map.to_records`)
+# changes, so that old entries get ignored rather than misread.
+CACHE_VER = 3
+
+def hash_file(df):
+    """
+    Returns a hash of the contents of the open file `df`, read in chunks
+    so that big files don't have to be read into memory all at once
+    """
+    hasher = hashlib.blake2b()
+    for chunk in iter(lambda: df.read(1024*1024), b''):
+        hasher.update(chunk)
+    return hasher.digest()
+
+class GameCache(object):
+    """
+    An on-disk cache of already-parsed games, so that reopening a file
+    which hasn't changed doesn't have to go through `Map.load` again.
+
+    Each entry holds the game's name and savefile version, each map's name
+    and where its data is in the savefile, and the marshalled flat
+    representation (see `Map.to_records`) of every map which has been
+    parsed so far, along with the path, `file_key` and a hash of the
+    contents of the savefile it came from.  An entry is only looked at
+    if the path and `file_key` still match, and only then does the file
+    get hashed to make sure.  A hit doesn't have to read the savefile's
+    header or index at all.  Maps are still lazy whether or not they're
+    in the cache: a map only gets added to its entry once it's been parsed
+    because something actually used it, and the marshalled data for each
+    map is only turned back into a Map the first time it's used.
+
+    Entries are kept in memory as maps get added to them, and only written
+    out by `flush`, which the next `load` calls too.  Binary savefiles in
+    any version get cached; JSON ones and SQLite databases always go
+    through the real parser.  Once the cache grows past `max_bytes`, the
+    least-recently-used entries are thrown away.  Problems reading or
+    writing the cache are never fatal; we just fall back to parsing the
+    file.
+    """
+
+    DEFAULT_MAX_BYTES = 64*1024*1024
+
+    def __init__(self, dirname=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Sets up a cache in `dirname`, which defaults to `advmap` inside
+        `$XDG_CACHE_HOME` (or `~/.cache`).  Nothing is read or written
+        until a game is loaded.
+        """
+        if dirname is None:
+            base = os.environ.get('XDG_CACHE_HOME')
+            if not base:
+                base = os.path.join(os.path.expanduser('~'), '.cache')
+            dirname = os.path.join(base, 'advmap')
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.pending = []
+
+    def entry_filename(self, filename):
+        """
+        Returns the filename of the cache entry for the given savefile
+        """
+        path = os.path.abspath(filename)
+        key = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.dirname, '{}.cache'.format(key))
+
+    def load(self, filename, readonly=False, validate=True):
+        """
+        Loads a game from a filename, using the cache for any maps we've
+        got a current entry for.  Returns the Game object, exactly as
+        `Game.load` would, including memory-mapping the file if `readonly`
+        is `True` and it has to be parsed.  `validate` only applies to maps
+        which actually have to be parsed; cached data was already validated
+        when it was stored.
+        """
+        self.flush()
+        path = os.path.abspath(filename)
+        if JsonSavefile.is_json_file(path) or SqliteSavefile.is_sqlite_file(path):
+            return Game.load(path, readonly, validate)
+        key = file_key(os.stat(path))
+        entry = CacheEntry.read(self, path, key)
+        if entry is not None:
+            return entry.get_game(validate)
+
+        if readonly:
+            df = MmapSavefile(path)
+        else:
+            df = BufferedSavefile(path)
+        df.open_r()
+        try:
+            (version, name, num_maps, index) = Game._read_header(df)
+            game = Game(name)
+            game.format = 'binary'
+            game.version = version
+            if index is not None:
+                maps = Game._read_lazy_maps(df, version, index, validate)
+            else:
+                maps = [Map.load(df, version, validate) for i in range(num_maps)]
+            key = df.key
+        finally:
+            df.close()
+
+        entry = CacheEntry(self, path, key, name, version)
+        if index is None:
+            # Older files have to be parsed all at once anyway, so the
+            # entry is complete already
+            for mapobj in maps:
+                entry.add_map(mapobj.name, None, marshal.dumps(mapobj.to_records()))
+            game.replace_maps(maps)
+            self._store_entry(entry)
+            return game
+
+        deferred = []
+        for (idx, (mapobj, (map_name, offset, length))) in enumerate(zip(maps, index)):
+            entry.add_map(mapobj.name, (offset, length), None)
+            (loader, args) = mapobj._pending
+            data = args[0]
+            deferred.append(Map.deferred(mapobj.name, mapobj.savedata and data,
+                mapobj.source and mapobj.source[1:],
+                entry.parse_map, idx, data, validate))
+        game.replace_maps(deferred)
+        return game
+
+    @staticmethod
+    def load_map(blob):
+        """
+        Builds a map out of the marshalled data stored in a cache entry
+        """
+        return Map.from_records(marshal.loads(blob))
+
+    def flush(self):
+        """
+        Writes out every cache entry which has had maps added to it since
+        it was last written, and then trims the cache back down to size if
+        need be.
+        """
+        pending = self.pending
+        self.pending = []
+        for entry in pending:
+            self._store_entry(entry)
+
+    def _store_entry(self, entry):
+        """
+        Writes out the cache entry `entry`, if its savefile hasn't changed
+        since it was loaded.  The savefile only gets hashed here if it
+        wasn't already when the entry was looked up.
+        """
+        try:
+            if entry.digest is None:
+                with open(entry.path, 'rb') as df:
+                    if file_key(os.fstat(df.fileno())) != entry.key:
+                        return
+                    digest = hash_file(df)
+                entry.digest = digest
+            data = marshal.dumps(entry.to_tuple())
+            os.makedirs(self.dirname, exist_ok=True)
+            try:
+                old_size = os.path.getsize(entry.filename)
+            except OSError:
+                old_size = 0
+            (handle, tmpname) = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as df:
+                    df.write(data)
+                os.replace(tmpname, entry.filename)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+        except OSError:
+            return
+        if self.total_bytes is None:
+            self.evict()
+        else:
+            self.total_bytes += len(data) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes the least-recently-used cache entries until the whole
+        cache takes up no more than `max_bytes`.  This has to look at
+        every entry, so we keep a running total in `total_bytes` and only
+        come here once that goes over.
+        """
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.dirname)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.cache'):
+                continue
+            pathname = os.path.join(self.dirname, name)
+            try:
+                stat = os.stat(pathname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, pathname))
+            total += stat.st_size
+        entries.sort()
+        for (mtime, size, pathname) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(pathname)
+            except OSError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    def clear(self):
+        """
+        Removes every entry from the cache, including any which haven't
+        been written out yet
+        """
+        self.pending = []
+        max_bytes = self.max_bytes
+        self.max_bytes = 0
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+
+class CacheEntry(object):
+    """
+    The cache entry for a single game loaded by `GameCache.load`.  For
+    each map we have its name, its (offset, length) in the savefile (or
+    `None` for older files without a map index), and its marshalled data
+    in `blobs`, or `None` if it hasn't been parsed yet.  As maps get
+    parsed, they're added to `blobs`, and the entry is queued up to be
+    written out by `GameCache.flush`.
+    """
+
+    def __init__(self, cache, path, key, name, version, digest=None):
+        self.cache = cache
+        self.filename = cache.entry_filename(path)
+        self.path = path
+        self.key = key
+        self.digest = digest
+        self.name = name
+        self.version = version
+        self.map_names = []
+        self.places = []
+        self.blobs = []
+
+    def add_map(self, name, place, blob):
+        """
+        Adds a map to the end of our list
+        """
+        self.map_names.append(name)
+        self.places.append(place)
+        self.blobs.append(blob)
+
+    def to_tuple(self):
+        """
+        Returns everything we store, as a tuple which can be marshalled
+        """
+        return (CACHE_VER, self.path, self.key, self.digest, self.name,
+                self.version, self.map_names, self.places, self.blobs)
+
+    @staticmethod
+    def read(cache, path, key):
+        """
+        Reads the entry for the savefile `path` out of `cache`, so long as
+        it was stored with the same `key` (see `file_key`) and the file's
+        contents still hash the same.  Returns `None` if the entry is
+        missing, stale or unreadable.
+        """
+        entry = CacheEntry(cache, path, key, None, None)
+        try:
+            with open(entry.filename, 'rb') as df:
+                (cache_ver, entry_path, entry_key, digest, name, version,
+                        map_names, places, blobs) = marshal.load(df)
+            if (cache_ver, entry_path, entry_key) != (CACHE_VER, path, key):
+                return None
+            if not (len(map_names) == len(places) == len(blobs)):
+                return None
+            with open(path, 'rb') as df:
+                if hash_file(df) != digest:
+                    return None
+            os.utime(entry.filename)
+        except Exception:
+            return None
+        entry.digest = digest
+        entry.name = name
+        entry.version = version
+        entry.map_names = map_names
+        entry.places = places
+        entry.blobs = blobs
+        return entry
+
+    def get_game(self, validate=True):
+        """
+        Returns a Game made of lazy maps out of our data, without reading
+        the savefile.  Maps which haven't been cached yet get read out of
+        the savefile and parsed when they're used.
+        """
+        game = Game(self.name)
+        game.format = 'binary'
+        game.version = self.version
+        maps = []
+        for (idx, (name, place, blob)) in enumerate(zip(self.map_names, self.places, self.blobs)):
+            if place is not None and self.version == SAVEFILE_VER:
+                source = (self.path, self.key) + tuple(place)
+            else:
+                source = None
+            if blob is None:
+                maps.append(Map.deferred(name, None, source, self.parse_map,
+                    idx, None, validate))
+            else:
+                maps.append(Map.deferred(name, None, source, GameCache.load_map, blob))
+        game.replace_maps(maps)
+        return game
+
+    def read_map_data(self, idx):
+        """
+        Reads map number `idx`'s data back in from the savefile.  Raises a
+        LoadException if the file has changed since it was cached.
+        """
+        (offset, length) = self.places[idx]
+        try:
+            with open(self.path, 'rb') as df:
+                if file_key(os.fstat(df.fileno())) == self.key:
+                    df.seek(offset)
+                    data = df.read(length)
+                    if len(data) == length:
+                        return data
+        except OSError as e:
+            raise LoadException('Error reading map "%s": %s' % (self.map_names[idx], e), e)
+        raise LoadException('Error reading map "%s": the file has changed since it was opened' % (self.map_names[idx]))
+
+    def parse_map(self, idx, data=None, validate=True):
+        """
+        Loads map number `idx` from its savefile data (read back in from
+        the savefile if `data` isn't given), just as `Map.lazy` would, and
+        adds it to the cache.  Problems parsing the map are left for the
+        caller, as usual.
+        """
+        if data is None:
+            data = self.read_map_data(idx)
+        mapobj = Map.load_data(data, self.version, validate)
+        self.blobs[idx] = marshal.dumps(mapobj.to_records())
+        if self not in self.cache.pending:
+            self.cache.pending.append(self)
+        return mapobj
@@ -18,7 +18,20 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import os
+import sys
+import asyncio
+import inspect
+import heapq
+import operator
+import itertools
+from struct import Struct
+from collections import namedtuple, deque
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from advmap.file import *
+from advmap.jsonfile import JsonSavefile
+from advmap.sqlitefile import SqliteSavefile
 
 #
 # So.
@@ -34,9 +47,12 @@ from advmap.file import *
 # (which is nice while saving/loading).
 #
 
-__all__ = [ 'Room', 'Connection', 'ConnectionEnd', 'Map', 'Game', 'Group', 'Clipboard',
+__all__ = [ 'Room', 'RoomConns', 'RoomLoopbacks', 'Connection', 'ConnectionEnd', 'IndexedList',
+        'RoomGrid', 'Map', 'Game', 'Group', 'Clipboard', 'GameInfo', 'MapInfo', 'GameHeader', 'MapHeader', 'RoomRecord',
+        'ConnRecord', 'ConnEndRecord', 'GroupRecord', 'MapSnapshot',
         'DIR_N', 'DIR_NE', 'DIR_E', 'DIR_SE', 'DIR_S', 'DIR_SW', 'DIR_W', 'DIR_NW',
-        'DIR_LIST', 'DIR_OPP', 'TXT_2_DIR', 'DIR_2_TXT' ]
+        'DIR_LIST', 'DIR_BIT', 'DIR_SET', 'DIR_OPP', 'DIR_DELTA', 'DIR_MIRROR_X', 'DIR_MIRROR_Y',
+        'DIR_CW', 'DIR_CCW', 'TXT_2_DIR', 'DIR_2_TXT' ]
 
 DIR_N = 0
 DIR_NE = 1
@@ -49,6 +65,13 @@ DIR_NW = 7
 
 DIR_LIST = [DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW]
 
+# The bit for each direction in a Room's direction masks (which is also
+# how loopbacks are stored in the savefile)
+DIR_BIT = [1 << direction for direction in DIR_LIST]
+
+# For checking whether something's a valid direction
+DIR_SET = frozenset(DIR_LIST)
+
 DIR_OPP = []
 DIR_OPP.append(DIR_S)
 DIR_OPP.append(DIR_SW)
@@ -59,6 +82,16 @@ DIR_OPP.append(DIR_NE)
 DIR_OPP.append(DIR_E)
 DIR_OPP.append(DIR_SE)
 
+# How far each direction takes us along x and y
+DIR_DELTA = [(0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)]
+
+# Where each direction ends up when rooms are mirrored left-to-right or
+# top-to-bottom, or rotated a quarter turn clockwise or anticlockwise
+DIR_MIRROR_X = [(8 - direction) % 8 for direction in DIR_LIST]
+DIR_MIRROR_Y = [(12 - direction) % 8 for direction in DIR_LIST]
+DIR_CW = [(direction + 2) % 8 for direction in DIR_LIST]
+DIR_CCW = [(direction + 6) % 8 for direction in DIR_LIST]
+
 TXT_2_DIR = {
         'n': DIR_N,
         'ne': DIR_NE,
@@ -81,7 +114,204 @@ DIR_2_TXT = {
         DIR_NW: 'NW'
     }
 
-SAVEFILE_VER = 9
+SAVEFILE_VER = 12
+
+# Precompiled layouts for the fixed-size chunks of our savefile records,
+# so that loading can decode several fields with a single call.  As of
+# v12, most numeric fields are stored as varints instead, so several of
+# these are only used for loading older savefiles.
+MAP_HEAD = Struct('<BBHHH')
+ROOM_HEAD = Struct('<HBB')
+ROOM_TYPE_COLOR = Struct('BB')
+ROOM_FLAGS_LOOPBACKS = Struct('BB')
+ROOM_RECORD = Struct('<HBBHBBHHHHHBB')
+CONN_HEAD = Struct('<HBHB')
+CONN_PASSAGE_FLAGS = Struct('BB')
+CONN_END = Struct('BBBB')
+GROUP_HEAD = Struct('<HB')
+MAP_INDEX = Struct('<II')
+
+# Flat records describing the contents of a savefile, as yielded by
+# `Game.iter_records`.  The various `read_record` methods return plain
+# tuples with these same fields, which the `load` methods then build the
+# real objects out of, so that all the version handling lives in one
+# place.  Room text is stored as the actual strings, even in versions
+# which use a string table.  Each ConnRecord is followed by the
+# ConnEndRecords for its ends, starting with all the ends attached to
+# room `id1`.
+GameHeader = namedtuple('GameHeader', ['name', 'version', 'num_maps'])
+MapHeader = namedtuple('MapHeader', ['name', 'w', 'h', 'num_rooms', 'num_conns', 'num_groups'])
+RoomRecord = namedtuple('RoomRecord', ['idnum', 'x', 'y', 'name', 'type', 'color',
+    'up', 'down', 'door_in', 'door_out', 'notes', 'flagbits', 'loopbackbits'])
+ConnRecord = namedtuple('ConnRecord', ['id1', 'dir1', 'id2', 'dir2', 'passage', 'symmetric',
+    'num_ends1', 'num_ends2'])
+ConnEndRecord = namedtuple('ConnEndRecord', ['idnum', 'direction', 'conn_type',
+    'render_type', 'stub_length'])
+GroupRecord = namedtuple('GroupRecord', ['style', 'room_ids'])
+
+class MapSnapshot(object):
+    """
+    A point in a map's history which it can be put back to, for undo (see
+    `Map.snapshot` and `Map.restore`).  Rather than a copy of the whole
+    map, this just has the map's own fields as they were, and a note of
+    everything which has changed since: `rooms` is a dict of the record
+    each changed room had (by ID), and `conns` and `groups` are dicts of
+    the record each changed Connection or Group object had.  A record of
+    `None` means the thing didn't exist yet.  Only the first change to
+    each thing gets noted, and only until the map's next snapshot is
+    taken, which `next_snapshot` then points to.
+    """
+
+    __slots__ = ('name', 'w', 'h', 'cur_id', 'free_ids', 'rooms', 'conns',
+            'groups', 'next_snapshot')
+
+    def __init__(self, name, w, h, cur_id, free_ids):
+        self.name = name
+        self.w = w
+        self.h = h
+        self.cur_id = cur_id
+        self.free_ids = free_ids
+        self.rooms = {}
+        self.conns = {}
+        self.groups = {}
+        self.next_snapshot = None
+
+class IndexedList(object):
+    """
+    A list which can only hold each object once, used for a map's
+    connections and groups, and a group's rooms.  Things stay in the
+    order they were added (which is the order they get saved in), but
+    `remove` and `in` take constant time rather than having to search
+    the whole list.  Behind the scenes this is a dict mapping each object
+    to a serial number which only ever goes up, so `sorted` can put any
+    handful of our objects back into list order without having to walk
+    through all of them.
+
+    Looking things up by position uses a plain list of our items, which
+    is built the first time it's needed and then kept up to date by
+    `append`.  `remove` throws it away again, so the next lookup after a
+    removal has to rebuild it.
+    """
+
+    __slots__ = ('serials', 'next_serial', 'items')
+
+    def __init__(self, items=()):
+        self.serials = {}
+        self.next_serial = 0
+        self.items = None
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        """
+        Adds `item` to the end of the list.  Raises a ValueError if it's
+        already in here.
+        """
+        if item in self.serials:
+            raise ValueError('Item is already in the list')
+        self.serials[item] = self.next_serial
+        self.next_serial += 1
+        if self.items is not None:
+            self.items.append(item)
+
+    def remove(self, item):
+        """
+        Removes `item` from the list.  Raises a ValueError if it's not in
+        here.
+        """
+        try:
+            del self.serials[item]
+        except KeyError:
+            raise ValueError('Item is not in the list')
+        self.items = None
+
+    def sorted(self, items):
+        """
+        Returns a list of the given items (all of which must be in here)
+        in the order they're in within this list.
+        """
+        return sorted(items, key=self.serials.__getitem__)
+
+    def __len__(self):
+        return len(self.serials)
+
+    def __iter__(self):
+        return iter(self.serials)
+
+    def __contains__(self, item):
+        return item in self.serials
+
+    def __getitem__(self, index):
+        items = self.items
+        if items is None:
+            items = self.items = list(self.serials)
+        return items[index]
+
+class RoomGrid(object):
+    """
+    Keeps track of which room is at each position on a map, using memory
+    in proportion to the number of rooms rather than the size of the map.
+    The grid is stored in chunks of one row each, and only rows which
+    have rooms in them are stored at all: `rows` maps each of those row
+    numbers to a dict of the rooms in that row, by column.  (Square chunks
+    would pack a bit tighter, but working out which chunk a position is in
+    costs more than the lookups themselves.)  We also count the rooms in
+    each column, so that checking whether an edge of the map is empty
+    doesn't have to look at every space along it.
+
+    This doesn't know how big the map is, so growing or shrinking the map
+    doesn't involve us at all; bounds checking is left to `Map`.
+    """
+
+    __slots__ = ('rows', 'col_counts')
+
+    def __init__(self):
+        self.rows = {}
+        self.col_counts = {}
+
+    def get(self, x, y):
+        """
+        Returns the room at (x, y), or `None`
+        """
+        row = self.rows.get(y)
+        if row is None:
+            return None
+        return row.get(x)
+
+    def add(self, room):
+        """
+        Puts `room` at its own position, which must be empty
+        """
+        row = self.rows.get(room.y)
+        if row is None:
+            row = self.rows[room.y] = {}
+        row[room.x] = room
+        self.col_counts[room.x] = self.col_counts.get(room.x, 0) + 1
+
+    def remove(self, room):
+        """
+        Clears out the position `room` is at, which it must be in
+        """
+        row = self.rows[room.y]
+        del row[room.x]
+        if not row:
+            del self.rows[room.y]
+        if self.col_counts[room.x] == 1:
+            del self.col_counts[room.x]
+        else:
+            self.col_counts[room.x] -= 1
+
+    def row_is_empty(self, y):
+        """
+        Returns `True` if there are no rooms in row `y`
+        """
+        return y not in self.rows
+
+    def col_is_empty(self, x):
+        """
+        Returns `True` if there are no rooms in column `x`
+        """
+        return x not in self.col_counts
 
 class Group(object):
     """
@@ -89,8 +319,13 @@ class Group(object):
     adventure games which have multiple "levels" with their own
     connections, which nevertheless all take up one screen.
     (Could also be used for other purposes as well, of course)
+
+    Changing our style or rooms lets the map our rooms are on know about
+    it (see `Room.changed`).
     """
 
+    __slots__ = ('rooms', '_style')
+
     # Style constants
     STYLE_MAX = 9
     (STYLE_NORMAL,
@@ -107,16 +342,35 @@ class Group(object):
     def __init__(self, room1, room2):
         if room1 == room2:
             raise Exception('Cannot create a group with only one room')
-        self.rooms = []
+        self.rooms = IndexedList()
         self.add_room(room1)
         self.add_room(room2)
-        self.style = self.STYLE_NORMAL
+        self._style = self.STYLE_NORMAL
+
+    def changed(self):
+        """
+        Called just before we're changed, to let our map know (see
+        `Map.log_group`)
+        """
+        for room in self.rooms:
+            if room.mapobj is not None:
+                room.mapobj.log_group(self)
+            break
+
+    @property
+    def style(self):
+        return self._style
+
+    @style.setter
+    def style(self, style):
+        self.changed()
+        self._style = style
 
     def get_rooms(self):
         """
         Returns a list of all rooms in this group
         """
-        return self.rooms
+        return list(self.rooms)
 
     def has_room(self, room):
         """
@@ -130,6 +384,7 @@ class Group(object):
         Adds a room to the group.
         """
         if (room not in self.rooms):
+            self.changed()
             self.rooms.append(room)
             room.group = self
 
@@ -138,11 +393,10 @@ class Group(object):
         Removes a room from the group.  Will return True if
         this group should be deleted afterwards or not.
         """
-        try:
+        if room in self.rooms:
+            self.changed()
             self.rooms.remove(room)
             room.group = None
-        except ValueError:
-            pass
         return (len(self.rooms) < 2)
 
     def increment_style(self):
@@ -155,43 +409,246 @@ class Group(object):
         """
         Saves ourself to the given filehandle
         """
-        if (len(self.get_rooms()) < 2):
+        if (len(self.rooms) < 2):
             raise Exception('Warning: a group cannot consist of only one room')
-        df.writeshort(len(self.get_rooms()))
-        df.writeuchar(self.style)
-        for room in self.get_rooms():
-            df.writeshort(room.idnum)
+        df.writevarints(len(self.rooms), self.style,
+                *[room.idnum for room in self.rooms])
 
     @staticmethod
-    def load(df, mapobj, version):
+    def read_record(df, version):
         """
-        Loads ourself, given a map object (to do room lookups) and a filehandle
+        Reads a group from the given filehandle, returning a tuple with
+        the fields of a GroupRecord
         """
-        num_rooms = df.readshort()
+        if version >= 12:
+            (num_rooms, style) = df.readvarints(2)
+        elif version >= 6:
+            (num_rooms, style) = df.readstruct(GROUP_HEAD)
+        else:
+            num_rooms = df.readshort()
+            style = Group.STYLE_NORMAL
         if (num_rooms < 2):
             raise LoadException('Group stated it had only %d rooms' % (num_rooms))
-        if version >= 6:
-            style = df.readuchar()
+        if version >= 12:
+            identifiers = df.readvarints(num_rooms)
         else:
-            style = Group.STYLE_NORMAL
-        rooms = []
-        for i in range(num_rooms):
-            identifier = df.readshort()
+            identifiers = [df.readshort() for i in range(num_rooms)]
+        return (style, tuple(identifiers))
+
+    def to_record(self):
+        """
+        Returns a tuple with the fields of a GroupRecord describing us
+        """
+        return (self.style, tuple([room.idnum for room in self.rooms]))
+
+    @staticmethod
+    def load(df, mapobj, version):
+        """
+        Loads ourself, given a map object (to do room lookups) and a filehandle
+        """
+        return Group.from_record(mapobj, Group.read_record(df, version))
+
+    @staticmethod
+    def from_record(mapobj, record):
+        """
+        Builds a group out of a GroupRecord (or a tuple with the same
+        fields), given a map object to do room lookups
+        """
+        group = Group.__new__(Group)
+        group.set_record(mapobj, record)
+        return group
+
+    def set_record(self, mapobj, record):
+        """
+        Sets our style and rooms from a GroupRecord (or a tuple with the
+        same fields), given a map object to do room lookups.  Any rooms we
+        had before are just forgotten about, so they should have been
+        taken out of the group already.
+        """
+        (style, identifiers) = record
+        rooms = IndexedList()
+        for identifier in identifiers:
             room = mapobj.get_room(identifier)
             if (room is None):
                 raise LoadException('Room %d does not exist while loading group' % (identifier))
-            rooms.append(room)
-        group = Group(rooms[0], rooms[1])
-        group.style = style
-        for room in rooms[2:]:
-            group.add_room(room)
-        return group
+            if room not in rooms:
+                rooms.append(room)
+        self.rooms = rooms
+        self._style = style
+        for room in rooms:
+            room.group = self
+
+    @staticmethod
+    def skip(df, version):
+        """
+        Skips over a group in the given filehandle without decoding it
+        """
+        if version >= 12:
+            (num_rooms, style) = df.readvarints(2)
+            df.readvarints(num_rooms)
+        else:
+            if version >= 6:
+                (num_rooms, style) = df.readstruct(GROUP_HEAD)
+            else:
+                num_rooms = df.readshort()
+            df.skip(num_rooms * SHORT.size)
+
+class RoomField(object):
+    """
+    Descriptor for one of the attributes of a Room which get saved, and
+    which are normally changed just by assigning to them.  The value is
+    stored in an underscore-prefixed attribute, and assigning to it lets
+    the room's map know about the change first (see `Room.changed`).
+    """
+
+    __slots__ = ('attr',)
+
+    def __init__(self, name):
+        self.attr = '_' + name
+
+    def __get__(self, room, owner=None):
+        if room is None:
+            return self
+        return getattr(room, self.attr)
+
+    def __set__(self, room, value):
+        room.changed()
+        setattr(room, self.attr, value)
+
+class RoomText(RoomField):
+    """
+    Descriptor for one of a Room's text fields.  The value is stored in
+    an underscore-prefixed attribute, and may be left there as the raw
+    UTF-8 data from a savefile (bytes, or a memoryview; see
+    `BufferedSavefile.readvarbytes`), in which case it's only decoded the
+    first time it's read.  Until then, saving writes that data back out
+    as-is.  Assigning a str works as usual.
+    """
+
+    __slots__ = ()
+
+    def __get__(self, room, owner=None):
+        if room is None:
+            return self
+        value = getattr(room, self.attr)
+        if type(value) is not str:
+            try:
+                value = sys.intern(str(value, 'utf-8'))
+            except UnicodeDecodeError:
+                # Show what we can, but keep the original bytes, so they
+                # still get saved as they were unless the field's changed
+                return str(value, 'utf-8', 'replace')
+            setattr(room, self.attr, value)
+        return value
+
+class RoomConns(Mapping):
+    """
+    A live, read-only view of a room's `conn_array`, as a mapping of each
+    direction which has a connection to its Connection object.  This is
+    what `Room.conns` returns; nothing gets copied, so it's cheap to use,
+    but `Room.conn_array` or `Room.get_conn` are quicker still.
+    """
+
+    __slots__ = ('room',)
+
+    def __init__(self, room):
+        self.room = room
+
+    def __getitem__(self, direction):
+        if direction not in self:
+            raise KeyError(direction)
+        return self.room.conn_array[direction]
+
+    def __contains__(self, direction):
+        return direction in DIR_SET and self.room.conn_array[direction] is not None
+
+    def __iter__(self):
+        for (direction, conn) in enumerate(self.room.conn_array):
+            if conn is not None:
+                yield direction
+
+    def __len__(self):
+        return len(self.room.conn_array) - self.room.conn_array.count(None)
+
+class RoomLoopbacks(MutableMapping):
+    """
+    A live view of a room's `loopback_mask`, as a mapping with a `True`
+    value for each direction which has a loopback.  This is what
+    `Room.loopbacks` returns.  Setting a direction (to anything) adds a
+    loopback there, and deleting it takes the loopback away again.
+    """
+
+    __slots__ = ('room',)
+
+    def __init__(self, room):
+        self.room = room
+
+    def __getitem__(self, direction):
+        if direction not in self:
+            raise KeyError(direction)
+        return True
+
+    def __setitem__(self, direction, value):
+        if direction not in DIR_SET:
+            raise KeyError(direction)
+        bit = DIR_BIT[direction]
+        room = self.room
+        room.changed()
+        room.loopback_mask |= bit
+        room.dir_mask |= bit
+
+    def __delitem__(self, direction):
+        if direction not in self:
+            raise KeyError(direction)
+        bit = DIR_BIT[direction]
+        room = self.room
+        room.changed()
+        room.loopback_mask &= ~bit
+        if room.conn_array[direction] is None:
+            room.dir_mask &= ~bit
+
+    def __contains__(self, direction):
+        return direction in DIR_SET and (self.room.loopback_mask & DIR_BIT[direction]) != 0
+
+    def __iter__(self):
+        loopback_mask = self.room.loopback_mask
+        for direction in DIR_LIST:
+            if loopback_mask & DIR_BIT[direction]:
+                yield direction
+
+    def __len__(self):
+        return bin(self.room.loopback_mask).count('1')
 
 class Room(object):
     """
-    A single room
+    A single room.  Which of our eight directions are in use is tracked
+    in `dir_mask`, with a bit set (see `DIR_BIT`) for each direction which
+    has either a connection or a loopback, so that checking whether a
+    direction is free is a single bit test.  `loopback_mask` has the bits
+    for just the loopbacks, and `conn_array` holds the Connection in each
+    direction (or `None`), indexed by direction.  Rooms without any
+    connections all share the same empty `conn_array`, which gets replaced
+    by a list of their own when they're first connected; use `set_conn`
+    and `clear_conn` rather than changing any of these directly.  The
+    `conns` and `loopbacks` mappings are views onto the same data, which
+    are only created the first time they're asked for.
+
+    While we're on a map, `mapobj` points back at it, and anything about
+    us which gets saved calls `changed` before it changes, so the map
+    always knows when it needs saving (and what undo has to put back).
+    That also throws away the record kept by `get_record`.  Our text fields, type, color and
+    offsets can just be assigned to; our position should only be changed
+    through the map (which has its own bookkeeping to do anyway).
     """
 
+    __slots__ = ('idnum', 'x', 'y', '_name', '_notes', 'dir_mask',
+            'loopback_mask', 'conn_array', '_up', '_down', '_door_in',
+            '_door_out', '_type', '_color', '_offset_x', '_offset_y', 'group',
+            'mapobj', '_record', '_conns_view', '_loopbacks_view')
+
+    # The `conn_array` for rooms which have never been connected
+    NO_CONNS = (None,) * len(DIR_LIST)
+
     # Type constants
     TYPE_MAX = 5
     (TYPE_NORMAL,
@@ -237,23 +694,51 @@ class Room(object):
     # Magic string indicating we're unexplored
     unexplored_text = '(unexplored)'
 
+    # Text fields, in the order in which they're saved
+    TEXT_FIELDS = ('name', 'up', 'down', 'door_in', 'door_out', 'notes')
+    name = RoomText('name')
+    up = RoomText('up')
+    down = RoomText('down')
+    door_in = RoomText('door_in')
+    door_out = RoomText('door_out')
+    notes = RoomText('notes')
+
+    # Other fields which can be assigned to directly
+    type = RoomField('type')
+    color = RoomField('color')
+    offset_x = RoomField('offset_x')
+    offset_y = RoomField('offset_y')
+
     def __init__(self, idnum, x, y):
         self.idnum = idnum
         self.x = x
         self.y = y
-        self.name = ''
-        self.notes = ''
-        self.conns = {}
-        self.loopbacks = {}
-        self.up = ''
-        self.down = ''
-        self.door_in = ''
-        self.door_out = ''
-        self.type = self.TYPE_NORMAL
-        self.color = self.COLOR_BW
-        self.offset_x = False
-        self.offset_y = False
+        self._name = ''
+        self._notes = ''
+        self.dir_mask = 0
+        self.loopback_mask = 0
+        self.conn_array = self.NO_CONNS
+        self._up = ''
+        self._down = ''
+        self._door_in = ''
+        self._door_out = ''
+        self._type = self.TYPE_NORMAL
+        self._color = self.COLOR_BW
+        self._offset_x = False
+        self._offset_y = False
         self.group = None
+        self.mapobj = None
+        self._record = None
+
+    def changed(self):
+        """
+        Called just before anything about us which gets saved is changed,
+        to let our map know (see `Map.log_room`)
+        """
+        mapobj = self.mapobj
+        if mapobj is not None:
+            mapobj.log_room(self)
+        self._record = None
 
     def duplicate(self):
         """
@@ -262,20 +747,97 @@ class Room(object):
         the Map object
         """
         newroom = Room(self.idnum, self.x, self.y)
-        newroom.name = self.name
-        newroom.notes = self.notes
-        newroom.up = self.up
-        newroom.down = self.down
-        newroom.door_in = self.door_in
-        newroom.door_out = self.door_out
-        newroom.type = self.type
-        newroom.color = self.color
-        newroom.offset_x = self.offset_x
-        newroom.offset_y = self.offset_y
-        for direction, value in self.loopbacks.items():
-            newroom.loopbacks[direction] = value
+        # Copy our text as it's stored, so that anything we haven't
+        # decoded yet doesn't have to be
+        newroom._name = self._name
+        newroom._notes = self._notes
+        newroom._up = self._up
+        newroom._down = self._down
+        newroom._door_in = self._door_in
+        newroom._door_out = self._door_out
+        newroom._type = self._type
+        newroom._color = self._color
+        newroom._offset_x = self._offset_x
+        newroom._offset_y = self._offset_y
+        newroom.loopback_mask = self.loopback_mask
+        newroom.dir_mask = self.loopback_mask
         return newroom
 
+    @property
+    def conns(self):
+        """
+        A read-only mapping of each direction which has a connection to
+        its Connection object (see RoomConns)
+        """
+        try:
+            return self._conns_view
+        except AttributeError:
+            self._conns_view = RoomConns(self)
+            return self._conns_view
+
+    @property
+    def loopbacks(self):
+        """
+        A mapping with a `True` value for each direction which has a
+        loopback (see RoomLoopbacks)
+        """
+        try:
+            return self._loopbacks_view
+        except AttributeError:
+            self._loopbacks_view = RoomLoopbacks(self)
+            return self._loopbacks_view
+
+    def dir_in_use(self, direction):
+        """
+        Returns True if there's a connection or loopback at the given
+        direction, False otherwise.
+        """
+        return (self.dir_mask & DIR_BIT[direction]) != 0
+
+    def set_conn(self, direction, conn):
+        """
+        Records `conn` as our connection at the given direction.  This
+        doesn't check for anything already there, or touch the connection
+        itself.
+        """
+        if type(self.conn_array) is tuple:
+            self.conn_array = list(self.NO_CONNS)
+        self.conn_array[direction] = conn
+        self.dir_mask |= DIR_BIT[direction]
+
+    def clear_conn(self, direction):
+        """
+        Forgets about our connection at the given direction, if any.  This
+        doesn't touch the connection itself.
+        """
+        if self.conn_array[direction] is not None:
+            self.conn_array[direction] = None
+            self.dir_mask = (self.dir_mask & ~DIR_BIT[direction]) | self.loopback_mask
+
+    def remap_directions(self, dir_map):
+        """
+        Moves our connection and loopback in each direction `d` over to
+        direction `dir_map[d]`, for when we're being mirrored or rotated.
+        `dir_map` has to be a rearrangement of `DIR_LIST` (such as
+        `DIR_CW`).  The connections themselves need to be told separately,
+        with `Connection.remap_directions`.
+        """
+        self.changed()
+        conn_array = self.conn_array
+        if conn_array is not self.NO_CONNS:
+            self.conn_array = [None]*len(DIR_LIST)
+            for direction in DIR_LIST:
+                self.conn_array[dir_map[direction]] = conn_array[direction]
+        dir_mask = 0
+        loopback_mask = 0
+        for direction in DIR_LIST:
+            if self.dir_mask & DIR_BIT[direction]:
+                dir_mask |= DIR_BIT[dir_map[direction]]
+            if self.loopback_mask & DIR_BIT[direction]:
+                loopback_mask |= DIR_BIT[dir_map[direction]]
+        self.dir_mask = dir_mask
+        self.loopback_mask = loopback_mask
+
     def name_sort_key(self):
         """
         A method which can be used to sort a list of rooms by name first,
@@ -293,8 +855,10 @@ class Room(object):
         """
         Sets a loopback at the given direction
         """
-        if direction not in self.conns:
-            self.loopbacks[direction] = True
+        if self.conn_array[direction] is None:
+            self.changed()
+            self.loopback_mask |= DIR_BIT[direction]
+            self.dir_mask |= DIR_BIT[direction]
 
     def connect(self, direction, other_room, direction2=None):
         """
@@ -306,9 +870,7 @@ class Room(object):
         """
         if direction2 is None:
             direction2 = DIR_OPP[direction]
-        if direction in self.conns or direction in self.loopbacks:
-            return None
-        if direction2 in other_room.conns or direction2 in other_room.loopbacks:
+        if self.dir_mask & DIR_BIT[direction] or other_room.dir_mask & DIR_BIT[direction2]:
             return None
         return Connection(self, direction, other_room, direction2)
 
@@ -321,28 +883,29 @@ class Room(object):
         method, or `False` if it should be kept alive.
         """
         # First do a couple sanity checks
-        if direction not in self.conns and direction not in self.loopbacks:
+        bit = DIR_BIT[direction]
+        if not self.dir_mask & bit:
             raise Exception('No connections or loopbacks to detach')
 
         # Set a default return val
         retval = False
 
         # Process
-        if direction in self.conns:
+        conn_var = self.conn_array[direction]
+        if conn_var is not None:
             # Now see if we have more than one connection on this end.
             # If so, just trim the ends dict.
-            conn_var = self.conns[direction]
             (primary_dir, ends_dict) = conn_var.get_primary_ends_dict(self)
             if len(ends_dict) == 1:
-                conn = self.conns[direction]
-                (other, other_dirs) = conn.get_opposite(self)
-                del self.conns[direction]
+                (other, other_dirs) = conn_var.get_opposite(self)
+                self.clear_conn(direction)
                 for other_dir in other_dirs:
-                    del other.conns[other_dir]
+                    other.clear_conn(other_dir)
                 retval = True
             else:
+                conn_var.forget_record()
                 del ends_dict[direction]
-                del self.conns[direction]
+                self.clear_conn(direction)
                 # Set a new primary, if we just deleted the primary
                 if direction == primary_dir:
                     if self.idnum == conn_var.r1.idnum:
@@ -351,8 +914,10 @@ class Room(object):
                         conn_var.dir2 = next(iter(ends_dict.keys()))
 
         # Get rid of any loopbacks which we might have
-        if direction in self.loopbacks:
-            del self.loopbacks[direction]
+        if self.loopback_mask & bit:
+            self.changed()
+            self.loopback_mask &= ~bit
+            self.dir_mask &= ~bit
 
         # And return
         return retval
@@ -362,17 +927,26 @@ class Room(object):
         Returns True if there's a loopback at the given direction,
         False otherwise.
         """
-        return (direction in self.loopbacks)
+        return (self.loopback_mask & DIR_BIT[direction]) != 0
 
     def get_conn(self, direction):
         """
         Returns the Connection object at our given direction, if
         we can.  Returns None otherwise.
         """
-        if direction in self.conns:
-            return self.conns[direction]
-        else:
-            return None
+        return self.conn_array[direction]
+
+    def get_conns(self):
+        """
+        Returns a list of all the Connections touching us, each listed
+        once (a connection can have more than one end on the same room),
+        in order of the first direction they take up.
+        """
+        conns = []
+        for conn in self.conn_array:
+            if conn is not None and conn not in conns:
+                conns.append(conn)
+        return conns
 
     def in_group_with(self, room):
         """
@@ -396,47 +970,66 @@ class Room(object):
         """
         self.color = (self.color + 1) % self.COLOR_MAX
 
-    def save(self, df):
+    def get_strings(self):
         """
-        Writes ourself to the given filehandle
+        Returns a tuple of all our text fields, in the order in which
+        they're saved.
         """
-        flagbits = 0
-        if (self.offset_x):
-            flagbits = flagbits | 0x2
-        if (self.offset_y):
-            flagbits = flagbits | 0x1
-        df.writeshort(self.idnum)
-        df.writeuchar(self.x)
-        df.writeuchar(self.y)
-        df.writestr(self.name)
-        df.writeuchar(self.type)
-        df.writeuchar(self.color)
-        df.writestr(self.up)
-        df.writestr(self.down)
-        df.writestr(self.door_in)
-        df.writestr(self.door_out)
-        df.writestr(self.notes)
-        df.writeuchar(flagbits)
-        loopbackbits = 0
-        for direction in DIR_LIST:
-            if direction in self.loopbacks:
-                compvar = 1 << direction
-                loopbackbits |= compvar
-        df.writeuchar(loopbackbits)
+        return (self.name, self.up, self.down, self.door_in, self.door_out, self.notes)
+
+    def get_raw_strings(self):
+        """
+        Returns a tuple of all our text fields as UTF-8 bytes (or
+        memoryviews), in the order in which they're saved.  Fields which
+        were loaded from a savefile and never read since are returned
+        exactly as they were loaded, without being decoded and re-encoded.
+        """
+        return tuple([text.encode('utf-8') if type(text) is str else text
+            for text in (self._name, self._up, self._down,
+                self._door_in, self._door_out, self._notes)])
+
+    def save(self, df, strings):
+        """
+        Writes ourself to the given filehandle.  As of v11, our text fields
+        are stored as indexes into a per-map string table; `strings` is a
+        dict mapping the UTF-8 encoding of each string to its index.  As of
+        v12, everything but the bitfields is written as a varint.
+        """
+        (flagbits, loopbackbits) = self.get_flagbits()
+        (name, up, down, door_in, door_out, notes) = self.get_raw_strings()
+        df.writevarints(self.idnum, self.x, self.y,
+                strings[name], self.type, self.color,
+                strings[up], strings[down],
+                strings[door_in], strings[door_out],
+                strings[notes])
+        df.writestruct(ROOM_FLAGS_LOOPBACKS, flagbits, loopbackbits)
 
     @staticmethod
-    def load(df, version):
+    def read_record(df, version, strings=None):
         """
-        Loads a room from the given filehandle
+        Reads a room from the given filehandle, returning a tuple with the
+        fields of a RoomRecord.  For v11 and up, `strings` must be the list
+        of strings from the map's string table.
         """
-        idnum = df.readshort()
-        x = df.readuchar()
-        y = df.readuchar()
-        room = Room(idnum, x, y)
-        room.name = df.readstr()
+        if version >= 11:
+            if version >= 12:
+                (idnum, x, y, name, room_type, color, up, down, door_in,
+                        door_out, notes) = df.readvarints(11)
+                (flagbits, loopbackbits) = df.readstruct(ROOM_FLAGS_LOOPBACKS)
+            else:
+                (idnum, x, y, name, room_type, color, up, down, door_in, door_out,
+                        notes, flagbits, loopbackbits) = df.readstruct(ROOM_RECORD)
+            try:
+                return (idnum, x, y, strings[name], room_type, color,
+                        strings[up], strings[down], strings[door_in],
+                        strings[door_out], strings[notes], flagbits, loopbackbits)
+            except IndexError:
+                raise LoadException('Room %d refers to an unknown string' % (idnum))
+
+        (idnum, x, y) = df.readstruct(ROOM_HEAD)
+        name = df.readstr()
         if version >= 8:
-            room.type = df.readuchar()
-            room.color = df.readuchar()
+            (room_type, color) = df.readstruct(ROOM_TYPE_COLOR)
         else:
             # v8 split off type+color for much better room flexibility.
             # This means we've got to do a mapping for previous revs, though!
@@ -454,30 +1047,127 @@ class Room(object):
                     9: (3, 0),  # Dark
                 }
             if previous_type in mapping:
-                room.type = mapping[previous_type][0]
-                room.color = mapping[previous_type][1]
+                (room_type, color) = mapping[previous_type]
             else:
                 # Shouldn't really ever be able to get here
-                room.type = Room.TYPE_NORMAL
-                room.color = Room.COLOR_BW
-        room.up = df.readstr()
-        room.down = df.readstr()
-        room.door_in = df.readstr()
-        room.door_out = df.readstr()
-        room.notes = df.readstr()
-        flagbits = df.readuchar()
-        if ((flagbits & 0x01) == 0x01):
-            room.offset_y = True
-        if ((flagbits & 0x02) == 0x02):
-            room.offset_x = True
+                room_type = Room.TYPE_NORMAL
+                color = Room.COLOR_BW
+        up = df.readstr()
+        down = df.readstr()
+        door_in = df.readstr()
+        door_out = df.readstr()
+        notes = df.readstr()
         if version >= 3:
-            loopbackbits = df.readuchar()
-            for direction in DIR_LIST:
-                compvar = 1 << direction
-                if ((loopbackbits & compvar) == compvar):
-                    room.loopbacks[direction] = True
+            (flagbits, loopbackbits) = df.readstruct(ROOM_FLAGS_LOOPBACKS)
+        else:
+            flagbits = df.readuchar()
+            loopbackbits = 0
+        return (idnum, x, y, name, room_type, color,
+                up, down, door_in, door_out, notes, flagbits, loopbackbits)
+
+    def to_record(self):
+        """
+        Returns a tuple with the fields of a RoomRecord describing us
+        """
+        (flagbits, loopbackbits) = self.get_flagbits()
+        return (self.idnum, self.x, self.y, self.name, self.type, self.color,
+                self.up, self.down, self.door_in, self.door_out, self.notes,
+                flagbits, loopbackbits)
+
+    def get_record(self):
+        """
+        Returns the same as `to_record`, but the record is kept until
+        we're changed, so asking again without anything changing just
+        returns the same one.
+        """
+        if self._record is None:
+            self._record = self.to_record()
+        return self._record
+
+    @staticmethod
+    def load(df, version, strings=None):
+        """
+        Loads a room from the given filehandle.  For v11 and up, `strings`
+        must be the list of strings from the map's string table, which may
+        be left as undecoded bytes (see `Map.load_strings`).
+        """
+        return Room.from_record(Room.read_record(df, version, strings))
+
+    @staticmethod
+    def from_record(record):
+        """
+        Builds a room out of a RoomRecord (or a tuple with the same fields).
+        Text fields may be given as UTF-8 bytes (or memoryviews), which will
+        be decoded when they're first used.
+        """
+        room = Room(record[0], record[1], record[2])
+        room.set_record(record)
         return room
 
+    def set_record(self, record):
+        """
+        Sets everything about us which gets saved from a RoomRecord (or a
+        tuple with the same fields), apart from our ID, which has to stay
+        the same.  Our connections are left alone.
+        """
+        (idnum, self.x, self.y, self._name, self._type, self._color,
+                self._up, self._down, self._door_in, self._door_out,
+                self._notes, flagbits, loopbackbits) = record
+        self._offset_x = ((flagbits & 0x02) == 0x02)
+        self._offset_y = ((flagbits & 0x01) == 0x01)
+        self.dir_mask = (self.dir_mask & ~self.loopback_mask) | loopbackbits
+        self.loopback_mask = loopbackbits
+
+    @staticmethod
+    def skip(df, version):
+        """
+        Skips over a room in the given filehandle without decoding any
+        of its strings.
+        """
+        if version >= 12:
+            df.readvarints(11)
+            df.skip(ROOM_FLAGS_LOOPBACKS.size)
+        elif version >= 11:
+            df.skip(ROOM_RECORD.size)
+        else:
+            df.skip(ROOM_HEAD.size)
+            df.skipstr()
+            if version >= 8:
+                df.skip(ROOM_TYPE_COLOR.size)
+            else:
+                df.skip(1)
+            for i in range(5):
+                df.skipstr()
+            if version >= 3:
+                df.skip(ROOM_FLAGS_LOOPBACKS.size)
+            else:
+                df.skip(1)
+
+    def get_flagbits(self):
+        """
+        Returns a tuple of our offsets and loopbacks as the bitfields
+        stored in the savefile.
+        """
+        flagbits = 0
+        if (self.offset_x):
+            flagbits = flagbits | 0x2
+        if (self.offset_y):
+            flagbits = flagbits | 0x1
+        return (flagbits, self.loopback_mask)
+
+    def set_flagbits(self, flagbits, loopbackbits):
+        """
+        Sets our offsets and loopbacks from the bitfields stored in
+        the savefile.
+        """
+        self.changed()
+        if ((flagbits & 0x01) == 0x01):
+            self.offset_y = True
+        if ((flagbits & 0x02) == 0x02):
+            self.offset_x = True
+        self.loopback_mask |= loopbackbits
+        self.dir_mask |= loopbackbits
+
 class ConnectionEnd(object):
     """
     An object describing one end of a connection.  This is, essentially, a
@@ -491,6 +1181,8 @@ class ConnectionEnd(object):
            orientations)
     """
 
+    __slots__ = ('room', 'direction', 'style')
+
     CONN_REGULAR = 0
     CONN_LADDER = 1
     CONN_DOTTED = 2
@@ -502,25 +1194,62 @@ class ConnectionEnd(object):
     STUB_REGULAR = 1
     STUB_MAX = 3
 
+    # Every (conn_type, render_type, stub_length) tuple in use.  There are
+    # only a few dozen possible combinations, so rather than each end
+    # holding onto its own three attributes, ends which look the same
+    # share a single tuple from here, as their `style`.
+    styles = {}
+
     def __init__(self, room, direction, conn_type=0, render_type=0, stub_length=1):
         self.room = room
         self.direction = direction
-        self.conn_type = conn_type
-        self.render_type = render_type
-        self.stub_length = stub_length
-        if self.stub_length < self.STUB_REGULAR:
-            self.stub_length = self.STUB_REGULAR
-        elif self.stub_length > self.STUB_MAX:
-            self.stub_length = self.STUB_MAX
+        if stub_length < self.STUB_REGULAR:
+            stub_length = self.STUB_REGULAR
+        elif stub_length > self.STUB_MAX:
+            stub_length = self.STUB_MAX
+        self.style = self.get_style(conn_type, render_type, stub_length)
+
+    @staticmethod
+    def get_style(conn_type, render_type, stub_length):
+        """
+        Returns the shared `style` tuple for the given attributes
+        """
+        style = (conn_type, render_type, stub_length)
+        return ConnectionEnd.styles.setdefault(style, style)
+
+    @property
+    def conn_type(self):
+        return self.style[0]
+
+    @conn_type.setter
+    def conn_type(self, conn_type):
+        self.style = self.get_style(conn_type, self.style[1], self.style[2])
+
+    @property
+    def render_type(self):
+        return self.style[1]
+
+    @render_type.setter
+    def render_type(self, render_type):
+        self.style = self.get_style(self.style[0], render_type, self.style[2])
+
+    @property
+    def stub_length(self):
+        return self.style[2]
+
+    @stub_length.setter
+    def stub_length(self, stub_length):
+        self.style = self.get_style(self.style[0], self.style[1], stub_length)
 
     def copy_with_new_room(self, room):
         """
         Returns a copy of ourself, using the given room object instead of our own.
         """
-        return ConnectionEnd(room, self.direction,
-                conn_type=self.conn_type,
-                render_type=self.render_type,
-                stub_length=self.stub_length)
+        newend = ConnectionEnd.__new__(ConnectionEnd)
+        newend.room = room
+        newend.direction = self.direction
+        newend.style = self.style
+        return newend
 
     def set_regular(self):
         self.conn_type = self.CONN_REGULAR
@@ -578,10 +1307,7 @@ class ConnectionEnd(object):
         """
         Saves ourself to a filehandle
         """
-        df.writeuchar(self.direction)
-        df.writeuchar(self.conn_type)
-        df.writeuchar(self.render_type)
-        df.writeuchar(self.stub_length)
+        df.writestruct(CONN_END, self.direction, *self.style)
 
 class Connection(object):
     """
@@ -590,8 +1316,14 @@ class Connection(object):
     Note that while we have a save() method here, like the other objects,
     loading is actually done inside the Map object, since it makes more
     sense in there.
+
+    We hang on to our record (see `get_record`) until we change, so any
+    method which changes us (or our ends) has to call `forget_record`.
     """
 
+    __slots__ = ('r1', 'dir1', 'ends1', 'r2', 'dir2', 'ends2', 'passage', 'symmetric',
+            '_record')
+
     PASS_TWOWAY = 0
     PASS_ONEWAY_A = 1
     PASS_ONEWAY_B = 2
@@ -635,11 +1367,12 @@ class Connection(object):
             )}
         self.passage = passage
         self.symmetric = True
+        self._record = None
 
         # Update a couple of Room vars here, while we're at it.
         if update_room_vars:
-            self.r1.conns[self.dir1] = self
-            self.r2.conns[self.dir2] = self
+            self.r1.set_conn(self.dir1, self)
+            self.r2.set_conn(self.dir2, self)
 
     def copy_with_new_rooms(self, r1, r2, update_room_vars=False):
         """
@@ -661,7 +1394,7 @@ class Connection(object):
             for (direction, end) in curends.items():
                 newends[direction] = end.copy_with_new_room(room)
                 if update_room_vars:
-                    room.conns[direction] = newconn
+                    room.set_conn(direction, newconn)
         return newconn
 
     def set_symmetric(self, symmetric=True, room=None, direction=None):
@@ -676,6 +1409,7 @@ class Connection(object):
         be the primary ConnectionEnd on that room's side.  if both `room` and
         `direction` are specified, we'll chose that particular End.
         """
+        self.forget_record()
         if symmetric:
 
             # Don't do any work if we're already set True
@@ -789,13 +1523,10 @@ class Connection(object):
         else:
             raise Exception('Specified room %s is not part of Connection %s' % (room.idnum, self))
         
-        if (direction not in room.loopbacks and direction not in room.conns and
-                direction not in endsvar):
-            room.conns[direction] = self
-            endsvar[direction] = ConnectionEnd(room, direction,
-                conn_type=attribute_end.conn_type,
-                render_type=attribute_end.render_type,
-                stub_length=attribute_end.stub_length)
+        if not room.dir_mask & DIR_BIT[direction] and direction not in endsvar:
+            self.forget_record()
+            room.set_conn(direction, self)
+            endsvar[direction] = ConnectionEnd(room, direction, *attribute_end.style)
             return endsvar[direction]
         
         return None
@@ -823,7 +1554,7 @@ class Connection(object):
             raise Exception('Given from_room does not involve this connection')
 
         # Make sure the destination is open
-        if room_to.get_loopback(direction_to) or room_to.get_conn(direction_to):
+        if room_to.dir_mask & DIR_BIT[direction_to]:
             return False
 
         # Figure out what side of the connection we're operating on
@@ -853,7 +1584,8 @@ class Connection(object):
                 return False
 
         # So - if we got here, we're good to go!
-        del room_from.conns[direction_from]
+        self.forget_record()
+        room_from.clear_conn(direction_from)
         if update_primary_dir:
             if unchanged_room == self.r1:
                 self.r2 = room_to
@@ -861,7 +1593,7 @@ class Connection(object):
             else:
                 self.r1 = room_to
                 self.dir1 = direction_to
-        room_to.conns[direction_to] = self
+        room_to.set_conn(direction_to, self)
         if direction_from != direction_to:
             ends[direction_to] = ends[direction_from]
             del ends[direction_from]
@@ -887,6 +1619,7 @@ class Connection(object):
         """
         end = self.get_end(room, direction)
         if end:
+            self.forget_record()
             if room == self.r1:
                 self.dir1 = direction
                 self.ends2[self.dir2].render_type = self.ends1[self.dir1].render_type
@@ -895,14 +1628,17 @@ class Connection(object):
                 self.ends1[self.dir1].render_type = self.ends2[self.dir2].render_type
 
     def set_regular(self, room, direction):
+        self.forget_record()
         for end in self.get_end_list(room, direction):
             end.set_regular()
 
     def set_ladder(self, room, direction):
+        self.forget_record()
         for end in self.get_end_list(room, direction):
             end.set_ladder()
 
     def set_dotted(self, room, direction):
+        self.forget_record()
         for end in self.get_end_list(room, direction):
             end.set_dotted()
 
@@ -937,14 +1673,17 @@ class Connection(object):
                 return []
 
     def set_render_regular(self, room, direction):
+        self.forget_record()
         for end in self.get_render_type_change_endlist(room, direction):
             end.set_render_regular()
 
     def set_render_midpoint_a(self, room, direction):
+        self.forget_record()
         for end in self.get_render_type_change_endlist(room, direction):
             end.set_render_midpoint_a()
 
     def set_render_midpoint_b(self, room, direction):
+        self.forget_record()
         for end in self.get_render_type_change_endlist(room, direction):
             end.set_render_midpoint_b()
 
@@ -962,20 +1701,25 @@ class Connection(object):
                 self.set_render_regular(room, direction)
 
     def set_stub_length(self, room, direction, stub_length=ConnectionEnd.STUB_REGULAR):
+        self.forget_record()
         for end in self.get_end_list(room, direction):
             end.set_stub_length(stub_length)
 
     def increment_stub_length(self, room, direction):
+        self.forget_record()
         for end in self.get_end_list(room, direction):
             end.increment_stub_length()
 
     def set_twoway(self):
+        self.forget_record()
         self.passage = self.PASS_TWOWAY
 
     def set_oneway_a(self):
+        self.forget_record()
         self.passage = self.PASS_ONEWAY_A
 
     def set_oneway_b(self):
+        self.forget_record()
         self.passage = self.PASS_ONEWAY_B
 
     def cycle_passage(self):
@@ -1016,6 +1760,31 @@ class Connection(object):
                 ', '.join([DIR_2_TXT[d] for d in self.ends2.keys()]),
                 )
 
+    def remap_directions(self, room, dir_map):
+        """
+        Moves all of our ends on `room` from each direction `d` over to
+        direction `dir_map[d]`, to match `Room.remap_directions`.
+        """
+        self.forget_record()
+        if self.r1 is room:
+            self.dir1 = dir_map[self.dir1]
+            self.ends1 = self.remap_ends(self.ends1, dir_map)
+        if self.r2 is room:
+            self.dir2 = dir_map[self.dir2]
+            self.ends2 = self.remap_ends(self.ends2, dir_map)
+
+    @staticmethod
+    def remap_ends(ends, dir_map):
+        """
+        Returns a new dict of the ConnectionEnds in `ends`, with their
+        directions changed according to `dir_map`
+        """
+        new_ends = {}
+        for end in ends.values():
+            end.direction = dir_map[end.direction]
+            new_ends[end.direction] = end
+        return new_ends
+
     def get_opposite(self, room):
         """
         Given a room, return a tuple of (room, dirs) corresponding
@@ -1037,12 +1806,8 @@ class Connection(object):
         if (self.symmetric):
             flagbits = flagbits | 0x1
 
-        df.writeshort(self.r1.idnum)
-        df.writeuchar(self.dir1)
-        df.writeshort(self.r2.idnum)
-        df.writeuchar(self.dir2)
-        df.writeuchar(self.passage)
-        df.writeuchar(flagbits)
+        df.writevarints(self.r1.idnum, self.dir1, self.r2.idnum, self.dir2,
+                self.passage, flagbits)
 
         # We're going to go ahead and sort the ends that we write
         # out, so that there's no chance of functionally-identical
@@ -1050,45 +1815,436 @@ class Connection(object):
         # diff map files without having to take internal ordering
         # into account.
 
-        df.writeuchar(len(self.ends1))
+        df.writevarint(len(self.ends1))
         for direction in sorted(self.ends1.keys()):
             self.ends1[direction].save(df)
 
-        df.writeuchar(len(self.ends2))
+        df.writevarint(len(self.ends2))
         for direction in sorted(self.ends2.keys()):
             self.ends2[direction].save(df)
 
-class Map(object):
-    """
-    One map, or a collection of rooms
-    """
+    @staticmethod
+    def skip(df, version):
+        """
+        Skips over a connection (and all its ends) in the given filehandle
+        without decoding it
+        """
+        if version >= 12:
+            df.readvarints(6)
+            for i in range(2):
+                df.skip(df.readvarint() * CONN_END.size)
+        elif version >= 7:
+            df.skip(CONN_HEAD.size + CONN_PASSAGE_FLAGS.size)
+            for i in range(2):
+                df.skip(df.readuchar() * CONN_END.size)
+        else:
+            # Connection type, followed by fields added in v2, v4 and v5
+            length = CONN_HEAD.size + 1
+            for added in [2, 4, 5]:
+                if version >= added:
+                    length += 1
+            df.skip(length)
+
+    @staticmethod
+    def read_record(df, version):
+        """
+        Reads a connection from the given filehandle.  Returns a tuple of
+        the ConnRecord fields and a list of ConnEndRecord field tuples for
+        all its ends (the ends on room `id1` first).  Connections from
+        before v7 only have their primary ends, and those get filled in
+        from the single set of attributes stored for the whole connection.
+        """
+        if version >= 12:
+            (id1, dir1, id2, dir2, passage, flagbits) = df.readvarints(6)
+        elif version >= 7:
+            (id1, dir1, id2, dir2) = df.readstruct(CONN_HEAD)
+            (passage, flagbits) = df.readstruct(CONN_PASSAGE_FLAGS)
+        if version >= 7:
+            if version >= 12:
+                readcount = df.readvarint
+            else:
+                readcount = df.readuchar
+            num_ends1 = readcount()
+            ends = [(id1,) + df.readstruct(CONN_END) for j in range(num_ends1)]
+            num_ends2 = readcount()
+            ends.extend([(id2,) + df.readstruct(CONN_END) for j in range(num_ends2)])
+            record = (id1, dir1, id2, dir2, passage,
+                    (flagbits & 0x01) == 0x01, num_ends1, num_ends2)
+        else:
+            (id1, dir1, id2, dir2) = df.readstruct(CONN_HEAD)
+            conn_type = df.readuchar()
+            passage = Connection.PASS_TWOWAY
+            render_type = ConnectionEnd.RENDER_REGULAR
+            stub_length = ConnectionEnd.STUB_REGULAR
+            if version >= 2:
+                passage = df.readuchar()
+            if version >= 4:
+                render_type = df.readuchar()
+            if version >= 5:
+                stub_length = df.readuchar()
+            ends = [(id1, dir1, conn_type, render_type, stub_length),
+                    (id2, dir2, conn_type, render_type, stub_length)]
+            record = (id1, dir1, id2, dir2, passage, True, 1, 1)
+            num_ends1 = 1
+
+        # Prior to v9, our "midpoint" render_types turned out to accidentally be
+        # dependent on the order in which rooms were returned from Room.roomlist(),
+        # which due to implementation chance happened to be consistent, but we
+        # shouldn't have been relying on it.  During the port to PyQt, our rendering
+        # methods have changed, which broke that consistency.  So, this fixes the
+        # render_type where appropriate, so it's consistent for all future versions.
+        if version < 9 and id2 < id1:
+            primary = [i for i in range(num_ends1) if ends[i][1] == dir1]
+            if primary:
+                if ends[primary[0]][3] == ConnectionEnd.RENDER_MIDPOINT_A:
+                    render_type = ConnectionEnd.RENDER_MIDPOINT_B
+                elif ends[primary[0]][3] == ConnectionEnd.RENDER_MIDPOINT_B:
+                    render_type = ConnectionEnd.RENDER_MIDPOINT_A
+                else:
+                    render_type = None
+                if render_type is not None:
+                    primary.extend([i for i in range(num_ends1, len(ends))
+                        if ends[i][1] == dir2])
+                    for i in primary:
+                        (idnum, direction, conn_type, old_type, stub_length) = ends[i]
+                        ends[i] = (idnum, direction, conn_type, render_type, stub_length)
+
+        return (record, ends)
+
+    def to_record(self):
+        """
+        Returns the same thing as `read_record`, but describing us: a tuple
+        of the ConnRecord fields and a list of ConnEndRecord field tuples
+        (sorted in the same order as they're saved).
+        """
+        id1 = self.r1.idnum
+        id2 = self.r2.idnum
+        ends = [(id1, direction) + end.style
+                for (direction, end) in sorted(self.ends1.items())]
+        ends.extend([(id2, direction) + end.style
+                for (direction, end) in sorted(self.ends2.items())])
+        record = (id1, self.dir1, id2, self.dir2, self.passage,
+                self.symmetric, len(self.ends1), len(self.ends2))
+        return (record, ends)
+
+    def get_record(self):
+        """
+        Returns the same as `to_record`, but with the ends as a tuple,
+        so it can't be changed.  The record is kept until `forget_record`
+        is called, so asking again without anything changing just
+        returns the same one.
+        """
+        if self._record is None:
+            (record, ends) = self.to_record()
+            self._record = (record, tuple(ends))
+        return self._record
+
+    def forget_record(self):
+        """
+        Throws away the record kept by `get_record`, since we're being
+        changed, and lets our map know about the change (see
+        `Map.log_conn`)
+        """
+        mapobj = self.r1.mapobj
+        if mapobj is not None:
+            mapobj.log_conn(self)
+        self._record = None
+
+    @staticmethod
+    def from_record(room1, room2, record, end_records):
+        """
+        Builds a connection between `room1` and `room2` out of the tuples
+        returned by `read_record`, and hooks it into the rooms' `conns`.
+        This trusts the data completely - nothing is checked for conflicts
+        with existing connections.  Make sure to keep this in sync with
+        `__init__`.
+        """
+        conn = Connection.__new__(Connection)
+        conn.set_record(room1, room2, record, end_records)
+        return conn
+
+    def set_record(self, room1, room2, record, end_records):
+        """
+        Sets everything about us from the tuples returned by `read_record`,
+        as `from_record` does, and hooks us into the rooms' `conns`.  If
+        we were already hooked into any rooms, `clear_room_vars` should
+        be called first.
+        """
+        (id1, dir1, id2, dir2, passage, symmetric, num_ends1, num_ends2) = record
+        self.r1 = room1
+        self.dir1 = dir1
+        self.r2 = room2
+        self.dir2 = dir2
+        self.passage = passage
+        self.symmetric = symmetric
+        self._record = None
+        self.ends1 = ends1 = {}
+        self.ends2 = ends2 = {}
+        try:
+            for (idnum, direction, conn_type, render_type, stub_length) in end_records[:num_ends1]:
+                ends1[direction] = ConnectionEnd(room1, direction, conn_type, render_type, stub_length)
+                room1.set_conn(direction, self)
+            for (idnum, direction, conn_type, render_type, stub_length) in end_records[num_ends1:]:
+                ends2[direction] = ConnectionEnd(room2, direction, conn_type, render_type, stub_length)
+                room2.set_conn(direction, self)
+
+            # The primary ends are always saved, but make sure they exist anyway
+            if dir1 not in ends1:
+                ends1[dir1] = ConnectionEnd(room1, dir1)
+                room1.set_conn(dir1, self)
+            if dir2 not in ends2:
+                ends2[dir2] = ConnectionEnd(room2, dir2)
+                room2.set_conn(dir2, self)
+        except IndexError:
+            raise LoadException('Connection between rooms %d and %d has an invalid direction' % (id1, id2))
+
+    def clear_room_vars(self):
+        """
+        Unhooks us from the `conns` of the rooms at each of our ends,
+        leaving the rest of us alone.
+        """
+        for (room, ends) in [(self.r1, self.ends1), (self.r2, self.ends2)]:
+            for direction in ends:
+                if room.conn_array[direction] is self:
+                    room.clear_conn(direction)
+
+class Map(object):
+    """
+    One map, or a collection of rooms.
+
+    Maps read from a sectioned (v10+) savefile start out "lazy" - all we
+    know is the name, plus the raw savefile data for the map.  The data
+    only gets parsed the first time anything else about the map is looked
+    at (see `__getattr__`), so opening a game with lots of maps doesn't
+    have to parse every one of them up-front.
+
+    Saving reuses the savefile data for any map which hasn't changed since
+    it was last loaded or saved, rather than re-encoding it.  Until a lazy
+    map is loaded, that data is the `savedata` it's going to be loaded
+    from.  Once it's loaded, we let go of the data, and just remember
+    where it is in the savefile, in `source`, so that it can be read back
+    in from there when we're saved (unless the file has changed since).
+    Any change to the map, or to its rooms, connections or groups, sets
+    `dirty` (see `mark_dirty`), which stops the old data being reused.
+    Changes to rooms, connections and groups also get noted down in our
+    latest snapshot, if we have one, for undo (see `snapshot`).
+    """
 
     # TODO: we're hardcoding 9x9 at the moment
     def __init__(self, name):
         self.name = name
+        self.savedata = None
+        self.source = None
+        self.last_snapshot = None
         self.set_map_size(9, 9)
 
+    @staticmethod
+    def lazy(name, data, version, validate=True, source=None):
+        """
+        Returns a new Map object named `name` which will be loaded from the
+        savefile chunk `data` (in savefile version `version`) the first time
+        it's actually used.  `validate` gets passed along to `load`.  See
+        `deferred` for `source`.
+        """
+        if version == SAVEFILE_VER:
+            savedata = data
+        else:
+            savedata = None
+            source = None
+        return Map.deferred(name, savedata, source, Map.load_data, data, version, validate)
+
+    @staticmethod
+    def deferred(name, savedata, source, loader, *args):
+        """
+        Returns a new Map object named `name` which will be replaced by
+        the result of `loader(*args)` the first time it's actually used.
+        `savedata` is the map's current savefile data, if known, or `None`.
+        `source` says where that data can be found again once we've let go
+        of it: a tuple of the filename, its `file_key`, and the offset and
+        length of the data in the file (or `None`, if it's not in a file).
+        """
+        mapobj = Map.__new__(Map)
+        mapobj.name = name
+        mapobj._pending = (loader, args)
+        mapobj.dirty = False
+        if savedata is None:
+            mapobj.savedata = None
+        else:
+            mapobj.savedata = (name, savedata)
+        if source is None:
+            mapobj.source = None
+        else:
+            mapobj.source = (name,) + tuple(source)
+        return mapobj
+
+    def __getattr__(self, attr):
+        """
+        This only gets called for attributes which don't exist, which for
+        a lazy map means that we haven't been loaded yet.  Load ourselves
+        and try again.
+        """
+        if '_pending' not in self.__dict__:
+            raise AttributeError(attr)
+        self.materialize()
+        return getattr(self, attr)
+
+    def is_loaded(self):
+        """
+        Returns `True` if our data has been loaded, or `False` if we're
+        a lazy map which hasn't been looked at yet.
+        """
+        return '_pending' not in self.__dict__
+
+    def materialize(self):
+        """
+        If we're a lazy map which hasn't been loaded yet, load ourselves.
+        Any name change made in the meantime is kept.  Our `savedata` is
+        dropped (so that, for instance, a memory-mapped file doesn't stay
+        mapped); from now on, saving reads it back from our `source`.
+        """
+        if self.is_loaded():
+            return
+        (loader, args) = self.__dict__['_pending']
+        loaded = loader(*args)
+        del self.__dict__['_pending']
+        (name, dirty, source) = (self.name, self.dirty, self.source)
+        self.__dict__.update(loaded.__dict__)
+        self.name = name
+        self.dirty = dirty
+        self.savedata = None
+        self.source = source
+        for room in self.rooms.values():
+            room.mapobj = self
+
+    def mark_dirty(self):
+        """
+        Flags that we've been changed since we were last loaded or saved,
+        so our saved data can no longer be reused.
+        """
+        self.dirty = True
+
+    def log_room(self, room):
+        """
+        Called just before `room` is added to us, taken off us, or changed
+        in any way which gets saved (see `Room.changed`).  Marks us dirty,
+        and if it's the first change to that room ID since our latest
+        snapshot, notes down what it was like beforehand, for `restore`.
+        """
+        self.dirty = True
+        snapshot = self.last_snapshot
+        if snapshot is not None and room.idnum not in snapshot.rooms:
+            if self.rooms.get(room.idnum) is room:
+                snapshot.rooms[room.idnum] = room.get_record()
+            else:
+                snapshot.rooms[room.idnum] = None
+
+    def log_conn(self, conn):
+        """
+        The same as `log_room`, for Connection objects (see
+        `Connection.forget_record`).
+        """
+        self.dirty = True
+        snapshot = self.last_snapshot
+        if snapshot is not None and conn not in snapshot.conns:
+            if conn in self.conns:
+                snapshot.conns[conn] = conn.get_record()
+            else:
+                snapshot.conns[conn] = None
+
+    def log_group(self, group):
+        """
+        The same as `log_room`, for Group objects (see `Group.changed`).
+        """
+        self.dirty = True
+        snapshot = self.last_snapshot
+        if snapshot is not None and group not in snapshot.groups:
+            if group in self.groups:
+                snapshot.groups[group] = group.to_record()
+            else:
+                snapshot.groups[group] = None
+
+    def is_dirty(self):
+        """
+        Returns `True` if we've been changed since we were last loaded
+        or saved (or never have been).
+        """
+        if self.dirty:
+            return True
+        saved = self.savedata
+        if saved is None:
+            saved = self.source
+        return saved is None or saved[0] != self.name
+
+    def read_source(self):
+        """
+        Reads our savefile data back in from our `source`.  Returns `None`
+        if the file has changed since we were loaded from (or saved to) it,
+        or can't be read.
+        """
+        (name, filename, key, offset, length) = self.source
+        try:
+            with open(filename, 'rb') as df:
+                if file_key(os.fstat(df.fileno())) != key:
+                    return None
+                df.seek(offset)
+                data = df.read(length)
+        except OSError:
+            return None
+        if len(data) != length:
+            return None
+        return data
+
+    def get_savedata(self):
+        """
+        Returns our savefile representation as bytes.  If we haven't
+        changed since we were last loaded or saved, that data is reused
+        (from `savedata` or `source`); otherwise we're re-encoded.
+        """
+        if not self.is_dirty():
+            if self.savedata is not None:
+                return self.savedata[1]
+            data = self.read_source()
+            if data is not None:
+                return data
+        df = BufferedSavefile('', in_memory=True)
+        self.save(df)
+        return df.getvalue()
+
+    def mark_saved(self, filename, key, offset, length):
+        """
+        Records that we've just been saved to `filename` (whose `file_key`
+        is now `key`), at the given offset and length, so we're not dirty
+        any more.
+        """
+        self.dirty = False
+        self.source = (self.name, filename, key, offset, length)
+
     def set_map_size(self, w, h):
         """
         Sets a new map size; note that this will completely wipe the map.
         """
+        self.mark_dirty()
+        if self.last_snapshot is not None:
+            for room in self.rooms.values():
+                self.log_room(room)
+            for conn in self.conns:
+                self.log_conn(conn)
+            for group in self.groups:
+                self.log_group(group)
         self.w = w
         self.h = h
 
         # Populate rooms
         self.cur_id = 0
+        self.free_ids = []
         self.rooms = {}
-        self.roomxy = []
-        for y in range(self.h):
-            self.roomxy.append([])
-            for x in range(self.w):
-                self.roomxy[-1].append(None)
+        self.grid = RoomGrid()
 
         # ... and wipe our collection of conns
-        self.conns = []
+        self.conns = IndexedList()
 
         # ... and our groups
-        self.groups = []
+        self.groups = IndexedList()
 
     def duplicate(self, newname=None):
         """
@@ -1102,6 +2258,8 @@ class Map(object):
         for room in self.roomlist():
             newroom = room.duplicate()
             newmap.inject_room_obj(newroom)
+        newmap.cur_id = self.cur_id
+        newmap.free_ids = list(self.free_ids)
         for conn in self.conns:
             newconn = newmap.connect_id(conn.r1.idnum, conn.dir1, conn.r2.idnum, conn.dir2)
             newconn.passage = conn.passage
@@ -1115,16 +2273,13 @@ class Map(object):
                             ce = new_ends[orig_end.direction]
                         else:
                             raise Exception('Unable to get ConnectionEnd for duplicated Map')
-                    ce.conn_type = orig_end.conn_type
-                    ce.render_type = orig_end.render_type
-                    ce.stub_length = orig_end.stub_length
+                    ce.style = orig_end.style
         for group in self.groups:
-            r1 = newmap.get_room(group.rooms[0].idnum)
-            r2 = newmap.get_room(group.rooms[1].idnum)
-            newmap.group_rooms(r1, r2)
-            r1.group.style = group.style
-            for room in group.rooms[2:]:
-                newmap.group_rooms(newmap.get_room(room.idnum), r1)
+            rooms = [newmap.get_room(room.idnum) for room in group.rooms]
+            newmap.group_rooms(rooms[0], rooms[1])
+            rooms[0].group.style = group.style
+            for room in rooms[2:]:
+                newmap.group_rooms(room, rooms[0])
         return newmap
 
     def roomlist(self):
@@ -1135,47 +2290,81 @@ class Map(object):
 
     def grab_id(self):
         """
-        Returns the next available ID
-        """
-        looped = False
-        while (self.cur_id in self.rooms):
-            self.cur_id += 1
-            if (self.cur_id == 65536):
-                self.cur_id = 0
-                if looped:
-                    raise Exception('No free room IDs!')
-                looped = True
+        Returns the next available ID.  IDs given up by `del_room` are kept
+        in `free_ids` (a heap) and handed out again lowest first, so they
+        stay small; otherwise we move `cur_id` on to the next ID that
+        isn't in use.  `cur_id` never goes backwards, so handing out IDs
+        only takes constant time on average, however many have been used.
+        The ID isn't reserved until a room with it is actually added, so
+        calling this twice in a row returns the same ID.
+        """
+        rooms = self.rooms
+        free_ids = self.free_ids
+        while free_ids:
+            if free_ids[0] not in rooms:
+                return free_ids[0]
+            heapq.heappop(free_ids)
+        self.cur_id = next(itertools.filterfalse(rooms.__contains__, itertools.count(self.cur_id)))
         return self.cur_id
 
+    def release_id(self, idnum):
+        """
+        Makes the given room ID available to `grab_id` again.  IDs from
+        `cur_id` onwards get found anyway, so only earlier ones need to
+        be remembered.
+        """
+        if idnum < self.cur_id:
+            heapq.heappush(self.free_ids, idnum)
+
+    def claim_id(self, idnum):
+        """
+        Takes `idnum` back out of `free_ids`, when a room is added with it,
+        so that deleting that room again doesn't queue it up twice.  Rooms
+        added with `grab_id` always have the lowest free ID, so that's the
+        only one which normally needs checking.
+        """
+        free_ids = self.free_ids
+        if free_ids:
+            if free_ids[0] == idnum:
+                heapq.heappop(free_ids)
+            elif idnum < self.cur_id and idnum in free_ids:
+                free_ids.remove(idnum)
+                heapq.heapify(free_ids)
+
     def inject_room_obj(self, room):
         """
         Injects a room object.  Make sure to keep this in
         sync with add_room_at.
         """
-        if self.roomxy[room.y][room.x]:
+        if self.get_room_at(room.x, room.y):
             raise Exception('Attempt to overwrite existing room at (%d, %d)' % (room.x+1, room.y+1))
         if (room.idnum in self.rooms):
             raise Exception('Room ID %d already exists' % (room.idnum))
+        self.log_room(room)
+        self.claim_id(room.idnum)
         self.rooms[room.idnum] = room
-        self.roomxy[room.y][room.x] = room
+        room.mapobj = self
+        self.grid.add(room)
 
     def add_room_at(self, x, y, name):
         """
         Adds a new room at (x, y), with no connections.
         Make sure to keep this in sync with inject_room_obj
         """
-        if (len(self.rooms) >= 65535):
-            raise Exception('Can only have 65535 rooms on a map currently; sorry...')
-        if self.roomxy[y][x]:
+        if self.get_room_at(x, y):
             raise Exception('A room already exists at (%d, %d)' % (x+1, y+1))
         idnum = self.grab_id()
         if idnum in self.rooms: # pragma: nocover
             # There's really no conceivable way we could ever get here
             raise Exception('A room already exists with ID %d' % (idnum))
-        self.rooms[idnum] = Room(idnum, x, y)
-        self.rooms[idnum].name = name
-        self.roomxy[y][x] = self.rooms[idnum]
-        return self.rooms[idnum]
+        room = Room(idnum, x, y)
+        room.name = name
+        self.log_room(room)
+        self.claim_id(idnum)
+        self.rooms[idnum] = room
+        room.mapobj = self
+        self.grid.add(room)
+        return room
 
     def get_room(self, idnum):
         """
@@ -1188,9 +2377,12 @@ class Map(object):
 
     def get_room_at(self, x, y):
         """
-        Gets the specified room
+        Gets the room at the given coordinates, or `None` if there isn't
+        one.  Raises an IndexError if the coordinates are off the map.
         """
-        return self.roomxy[y][x]
+        if 0 <= x < self.w and 0 <= y < self.h:
+            return self.grid.get(x, y)
+        raise IndexError('(%d, %d) is off the map' % (x+1, y+1))
 
     def connect(self, room1, dir1, room2, dir2=None):
         """
@@ -1199,16 +2391,21 @@ class Map(object):
         the connection will be symmetrical.  Returns the new
         connection, or None if something got in the way
         """
-        if len(self.conns) >= 65535:
-            raise Exception('Can only have 65535 connections on a map currently; sorry')
         if dir2 is None:
             dir2 = DIR_OPP[dir1]
-        if dir1 in room1.conns or dir1 in room1.loopbacks:
+        if room1.dir_mask & DIR_BIT[dir1] or room2.dir_mask & DIR_BIT[dir2]:
             return None
-        if dir2 in room2.conns or dir2 in room2.loopbacks:
-            return None
-        self.conns.append(room1.connect(dir1, room2, dir2))
-        return self.conns[-1]
+        conn = room1.connect(dir1, room2, dir2)
+        self.inject_conn_obj(conn)
+        return conn
+
+    def inject_conn_obj(self, conn):
+        """
+        Adds a Connection object to our list.  It should already be
+        hooked into its rooms, which have to be on this map.
+        """
+        self.log_conn(conn)
+        self.conns.append(conn)
 
     def connect_id(self, id1, dir1, id2, dir2=None):
         """
@@ -1224,8 +2421,11 @@ class Map(object):
         """
         Detaches two rooms
         """
-        conn = room.get_conn(direction)
-        if conn or room.get_loopback(direction):
+        if room.dir_in_use(direction):
+            conn = room.get_conn(direction)
+            self.mark_dirty()
+            if conn is not None:
+                self.log_conn(conn)
             delete_conn = room.detach(direction)
             if delete_conn and conn:
                 self.conns.remove(conn)
@@ -1246,14 +2446,17 @@ class Map(object):
         if necessary.
         """
         idnum = room.idnum
-        x = room.x
-        y = room.y
+        self.mark_dirty()
         if room.group:
             self.remove_room_from_group(room)
-        for direction in list(room.conns.keys()):
-            self.detach(room, direction)
+        for direction in DIR_LIST:
+            if room.conn_array[direction] is not None:
+                self.detach(room, direction)
+        self.log_room(room)
         del self.rooms[idnum]
-        self.roomxy[y][x] = None
+        room.mapobj = None
+        self.release_id(idnum)
+        self.grid.remove(room)
 
     def dir_coord(self, room, direction, allow_invalid=False):
         """
@@ -1296,49 +2499,121 @@ class Map(object):
         new_room = self.get_room_at(*new_coords)
         if new_room:
             return False
-        self.roomxy[room.y][room.x] = None
+        self.mark_dirty()
+        room.changed()
+        self.grid.remove(room)
         room.x = new_coords[0]
         room.y = new_coords[1]
-        self.roomxy[room.y][room.x] = room
+        self.grid.add(room)
+        return True
+
+    def move_rooms(self, moves, dir_map=None):
+        """
+        Moves a batch of rooms all at once.  `moves` is a list of
+        (room, x, y) tuples giving the new position for each room.  The
+        new positions all have to be on the map, and either empty or being
+        moved out of at the same time, otherwise nothing is changed.  If
+        `dir_map` is given, every direction on the rooms (and on the ends
+        of any connections attached to them) is changed to match, as in
+        `Room.remap_directions`.  This only looks at the rooms being moved,
+        so it takes the same time however big the map is.
+
+        Returns True if the rooms were moved, or False otherwise.
+        """
+        if len(moves) == 0:
+            return False
+
+        # Make sure everything has somewhere to go first
+        moving = set([room for (room, x, y) in moves])
+        targets = set()
+        for (room, x, y) in moves:
+            if x < 0 or y < 0 or x >= self.w or y >= self.h or (x, y) in targets:
+                return False
+            targets.add((x, y))
+            occupant = self.grid.get(x, y)
+            if occupant is not None and occupant not in moving:
+                return False
+
+        # ... and then move them all in one go
+        self.mark_dirty()
+        grid = self.grid
+        for (room, x, y) in moves:
+            room.changed()
+            grid.remove(room)
+        for (room, x, y) in moves:
+            room.x = x
+            room.y = y
+            grid.add(room)
+        if dir_map is not None:
+            for room in moving:
+                for conn in room.get_conns():
+                    conn.remap_directions(room, dir_map)
+                room.remap_directions(dir_map)
         return True
 
-    def nudge(self, direction, roomset=None):
+    def nudge(self, direction, roomset=None, steps=1):
         """
         Attempts to "nudge" a map in the given direction, optionally
-        only acting on a set of passed-in rooms.  Will return
-        True/False depending on success
+        only acting on a set of passed-in rooms, and optionally by more
+        than one space.  Will return True/False depending on success
         """
 
         # Operate on all rooms if we weren't told otherwise
         if roomset is None:
             roomset = set(self.roomlist())
 
-        # Sanity check
+        (dx, dy) = DIR_DELTA[direction]
+        dx *= steps
+        dy *= steps
+        return self.move_rooms([(room, room.x+dx, room.y+dy) for room in roomset])
+
+    @staticmethod
+    def get_bounds(roomset):
+        """
+        Returns the (min_x, min_y, max_x, max_y) coordinates of the given
+        rooms
+        """
+        xs = [room.x for room in roomset]
+        ys = [room.y for room in roomset]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def mirror(self, roomset, vertical=False):
+        """
+        Mirrors the given rooms left-to-right within the space they take
+        up, or top-to-bottom if `vertical` is `True`, turning their
+        connections around to match.  Returns True/False depending on
+        success
+        """
         if len(roomset) == 0:
             return False
+        (min_x, min_y, max_x, max_y) = self.get_bounds(roomset)
+        if vertical:
+            moves = [(room, room.x, min_y + max_y - room.y) for room in roomset]
+            return self.move_rooms(moves, DIR_MIRROR_Y)
+        else:
+            moves = [(room, min_x + max_x - room.x, room.y) for room in roomset]
+            return self.move_rooms(moves, DIR_MIRROR_X)
 
-        # Loop through and make sure that we're capable of nudging
-        # the specified rooms.  If the edge of the map or another
-        # room not in our passed-in set is blocking, return False
-        # right away.
-        for room in roomset:
-            adj_dir = self.dir_coord(room, direction)
-            if not adj_dir:
-                return False
-            adj_room = self.get_room_at(*adj_dir)
-            if adj_room and adj_room not in roomset:
-                return False
-
-        if (direction in [DIR_W, DIR_NW, DIR_N, DIR_NE]):
-            for y in range(len(self.roomxy)):
-                for x in range(len(self.roomxy[y])):
-                    if self.roomxy[y][x] and self.roomxy[y][x] in roomset:
-                        self.move_room(self.roomxy[y][x], direction)
+    def rotate(self, roomset, clockwise=True):
+        """
+        Rotates the given rooms a quarter turn, keeping the top-left corner
+        of the space they take up in the same place, and turning their
+        connections around to match.  The rooms' horizontal and vertical
+        offsets get swapped.  Returns True/False depending on success
+        """
+        if len(roomset) == 0:
+            return False
+        (min_x, min_y, max_x, max_y) = self.get_bounds(roomset)
+        if clockwise:
+            moves = [(room, min_x + (max_y - room.y), min_y + (room.x - min_x)) for room in roomset]
+            dir_map = DIR_CW
         else:
-            for y in range(len(self.roomxy)-1, -1, -1):
-                for x in range(len(self.roomxy[y])-1, -1, -1):
-                    if self.roomxy[y][x] and self.roomxy[y][x] in roomset:
-                        self.move_room(self.roomxy[y][x], direction)
+            moves = [(room, min_x + (room.y - min_y), min_y + (max_x - room.x)) for room in roomset]
+            dir_map = DIR_CCW
+        if not self.move_rooms(moves, dir_map):
+            return False
+        for room in roomset:
+            (room.offset_x, room.offset_y) = (room.offset_y, room.offset_x)
         return True
 
     def resize(self, direction):
@@ -1346,41 +2621,28 @@ class Map(object):
         Resizes the map, if possible
         """
         if (direction == DIR_E):
-            # Limitations in W/H are due to storing these
-            # as chars in the savefile.  And also because
-            # seriously, what are you doing with a map that big?
-            if (self.w == 255):
-                return False
             self.w += 1
-            for row in self.roomxy:
-                row.append(None)
+            self.mark_dirty()
             return True
         elif (direction == DIR_S):
-            if (self.h == 255):
-                return False
             self.h += 1
-            self.roomxy.append([])
-            for x in range(self.w):
-                self.roomxy[-1].append(None)
+            self.mark_dirty()
             return True
         elif (direction == DIR_W):
             if (self.w == 1):
                 return False
-            for row in self.roomxy:
-                if row[-1]:
-                    return False
+            if not self.grid.col_is_empty(self.w-1):
+                return False
             self.w -= 1
-            for row in self.roomxy:
-                row.pop()
+            self.mark_dirty()
             return True
         elif (direction == DIR_N):
             if (self.h == 1):
                 return False
-            for room in self.roomxy[-1]:
-                if room:
-                    return False
+            if not self.grid.row_is_empty(self.h-1):
+                return False
             self.h -= 1
-            self.roomxy.pop()
+            self.mark_dirty()
             return True
         else:
             return False
@@ -1392,6 +2654,7 @@ class Map(object):
         """
         group = room.group
         if group:
+            self.mark_dirty()
             to_delete = group.del_room(room)
             if (to_delete):
                 for other_room in group.get_rooms():
@@ -1417,125 +2680,450 @@ class Map(object):
             return False
         elif not room1.group and not room2.group:
             if room1 != room2:
-                self.groups.append(Group(room1, room2))
+                self.mark_dirty()
+                group = Group(room1, room2)
+                self.log_group(group)
+                self.groups.append(group)
                 return True
             else:
                 return False
         else:
+            self.mark_dirty()
             if room1.group:
                 room1.group.add_room(room2)
             else:
                 room2.group.add_room(room1)
             return True
 
-    def save(self, df):
+    def group_room_list(self, rooms, group=None):
         """
-        Saves the map to the given filehandle
+        Puts all of the given `rooms` which aren't already in a group into
+        `group`, or into a new group if `group` is `None` (so long as there
+        are at least two of them).  Takes time proportional to the number
+        of rooms, however big the group gets.
+
+        Returns True if we changed anything, or False otherwise.
         """
-        df.writestr(self.name)
-        df.writeuchar(self.w)
-        df.writeuchar(self.h)
-        df.writeshort(len(self.rooms))
-        df.writeshort(len(self.conns))
-        df.writeshort(len(self.groups))
-        for room in self.roomlist():
-            room.save(df)
+        rooms = [room for room in rooms if not room.group]
+        if group is None:
+            if len(rooms) < 2:
+                return False
+            group = Group(rooms[0], rooms[1])
+            self.log_group(group)
+            self.groups.append(group)
+            rooms = rooms[2:]
+        elif not rooms:
+            return False
+        self.mark_dirty()
+        for room in rooms:
+            group.add_room(room)
+        return True
+
+    def save(self, df):
+        """
+        Saves the map to the given filehandle.  As of v11, all the text
+        from our rooms is stored just once, in a string table after the
+        map header, and rooms refer to the strings by index.  As of v12,
+        sizes, counts and string lengths are all varints, so none of them
+        have a fixed upper limit.
+        """
+        rooms = self.roomlist()
+        strings = {}
+        for room in rooms:
+            for text in room.get_raw_strings():
+                if text not in strings:
+                    strings[text] = len(strings)
+        df.writevarstr(self.name)
+        df.writevarints(self.w, self.h, len(self.rooms),
+                len(self.conns), len(self.groups), len(strings))
+        for text in strings:
+            df.writevarbytes(text)
+        for room in rooms:
+            room.save(df, strings)
         for conn in self.conns:
             conn.save(df)
         for group in self.groups:
             group.save(df)
 
     @staticmethod
-    def load(df, version):
+    def load_header(df, version):
+        """
+        Reads just the header of a map from the given filehandle, leaving
+        it positioned at the start of the string table (or the rooms, for
+        versions without one).  Returns a tuple of (name, w, h, num_rooms,
+        num_conns, num_groups, num_strings); `num_strings` will be `None`
+        for maps without a string table.
+        """
+        if version >= 12:
+            name = df.readvarstr()
+            return (name, *df.readvarints(6))
+        name = df.readstr()
+        (w, h, num_rooms, num_conns, num_groups) = df.readstruct(MAP_HEAD)
+        if version >= 11:
+            num_strings = df.readshort()
+        else:
+            num_strings = None
+        return (name, w, h, num_rooms, num_conns, num_groups, num_strings)
+
+    @staticmethod
+    def peek(df, version):
+        """
+        Reads the header of a map from the given filehandle and skips
+        over the rest of it, without decoding any rooms, connections or
+        groups.  Returns a MapInfo object.
+        """
+        (name, w, h, num_rooms, num_conns, num_groups, num_strings) = Map.load_header(df, version)
+        if version >= 12:
+            for i in range(num_strings):
+                df.skipvarstr()
+        elif version >= 11:
+            for i in range(num_strings):
+                df.skipstr()
+        for i in range(num_rooms):
+            Room.skip(df, version)
+        for i in range(num_conns):
+            Connection.skip(df, version)
+        for i in range(num_groups):
+            Group.skip(df, version)
+        return MapInfo(name, w, h, num_rooms, num_conns, num_groups)
+
+    @staticmethod
+    def load_strings(df, version, num_strings, raw=False):
+        """
+        Reads a map's string table (which directly follows the header),
+        returning a list of strings, or `None` for maps without a string
+        table.  Interning the strings means that all the rooms which use
+        the same text (such as empty strings, or the unexplored-room text)
+        share the same object.  For v12, `raw` = `True` returns the
+        strings as undecoded UTF-8 data instead (see `Savefile.readvarbytes`),
+        which rooms can keep until their text is actually needed.
+        """
+        if version >= 12:
+            if raw:
+                return [df.readvarbytes() for i in range(num_strings)]
+            return [sys.intern(df.readvarstr()) for i in range(num_strings)]
+        elif version >= 11:
+            return [sys.intern(df.readstr()) for i in range(num_strings)]
+        else:
+            return None
+
+    @staticmethod
+    def iter_records(df, version):
         """
-        Loads a map from the given filehandle
+        Reads a map from the given filehandle, yielding a flat series of
+        records (a MapHeader, then RoomRecords, ConnRecords each followed
+        by their ConnEndRecords, and GroupRecords) rather than building
+        up a Map object.  None of the connection-level validation which
+        `load` does happens here.
         """
-        advmap = Map(df.readstr())
-        advmap.set_map_size(df.readuchar(), df.readuchar())
-        num_rooms = df.readshort()
-        num_conns = df.readshort()
-        num_groups = df.readshort()
+        (name, w, h, num_rooms, num_conns, num_groups, num_strings) = Map.load_header(df, version)
+        yield MapHeader(name, w, h, num_rooms, num_conns, num_groups)
+        strings = Map.load_strings(df, version, num_strings)
+        for i in range(num_rooms):
+            yield RoomRecord._make(Room.read_record(df, version, strings))
+        for i in range(num_conns):
+            (record, end_records) = Connection.read_record(df, version)
+            yield ConnRecord._make(record)
+            for end_record in end_records:
+                yield ConnEndRecord._make(end_record)
+        for i in range(num_groups):
+            yield GroupRecord._make(Group.read_record(df, version))
+
+    def validate(self):
+        """
+        Checks that our connections are consistent with each other: every
+        end of every connection has to be on one of our rooms, and no two
+        ends (or an end and a loopback) can share the same direction on
+        a room.  `load` builds connections without checking any of that as
+        it goes, and calls this afterwards unless told not to.  Raises a
+        LoadException if there's a problem.
+        """
+        rooms = self.rooms
+        for conn in self.conns:
+            for (room, ends) in ((conn.r1, conn.ends1), (conn.r2, conn.ends2)):
+                if rooms.get(room.idnum) is not room:
+                    raise LoadException('Connection refers to room %d, which is not on the map' % (room.idnum))
+                # Every end claims its direction in the room's `conn_array`,
+                # so if anything else claimed the same one, one of them will
+                # have lost out.
+                conn_array = room.conn_array
+                loopback_mask = room.loopback_mask
+                for direction in ends:
+                    if conn_array[direction] is not conn or loopback_mask & DIR_BIT[direction]:
+                        raise LoadException('Found an existing ConnectionEnd where we shouldn\'t')
+            if conn.r1 is conn.r2 and not conn.ends1.keys().isdisjoint(conn.ends2):
+                raise LoadException('Found an existing ConnectionEnd where we shouldn\'t')
+
+    @staticmethod
+    def load(df, version, validate=True):
+        """
+        Loads a map from the given filehandle.  Connections are built
+        directly from the savefile data, without going through `connect`
+        and its checks, so by default we then run `validate` over the
+        result.  Pass `validate` = `False` to skip that for data which is
+        known to be good.
+        """
+        (name, w, h, num_rooms, num_conns, num_groups, num_strings) = Map.load_header(df, version)
+        advmap = Map(name)
+        advmap.set_map_size(w, h)
+        strings = Map.load_strings(df, version, num_strings, raw=True)
 
         # Load rooms
         for i in range(num_rooms):
-            advmap.inject_room_obj(Room.load(df, version))
+            advmap.inject_room_obj(Room.load(df, version, strings))
 
         # Now load connections
+        rooms = advmap.rooms
+        conns = advmap.conns
         for i in range(num_conns):
-            conn = advmap.connect_id(df.readshort(), df.readuchar(), df.readshort(), df.readuchar())
-            if version >= 7:
-                conn.passage = df.readuchar()
-                flagbits = df.readuchar()
-                if ((flagbits & 0x01) == 0x01):
-                    conn.symmetric = True
-                else:
-                    conn.symmetric = False
-                for (room, primary_dir, ends) in [(conn.r1, conn.dir1, conn.ends1),
-                        (conn.r2, conn.dir2, conn.ends2)]:
-                    num_ends = df.readuchar()
-                    for j in range(num_ends):
-                        direction = df.readuchar()
-                        conn_type = df.readuchar()
-                        render_type = df.readuchar()
-                        stub_length = df.readuchar()
-                        ce = conn.connect_extra(room, direction)
-                        if ce is None:
-                            if direction == primary_dir:
-                                ce = ends[direction]
-                            else:
-                                raise LoadException('Found an existing ConnectionEnd where we shouldn\'t')
-                        ce.conn_type = conn_type
-                        ce.render_type = render_type
-                        ce.stub_length = stub_length
-            else:
-                ends = conn.get_all_ends()
-                conn_type = df.readuchar()
-                for end in ends:
-                    end.conn_type = conn_type
-                if version >= 2:
-                    conn.passage = df.readuchar()
-                if version >= 4:
-                    render_type = df.readuchar()
-                    for end in ends:
-                        end.render_type = render_type
-                if version >= 5:
-                    stub_length = df.readuchar()
-                    for end in ends:
-                        end.stub_length = stub_length
-
-            # Prior to v9, our "midpoint" render_types turned out to accidentally be
-            # dependent on the order in which rooms were returned from Room.roomlist(),
-            # which due to implementation chance happened to be consistent, but we
-            # shouldn't have been relying on it.  During the port to PyQt, our rendering
-            # methods have changed, which broke that consistency.  So, this fixes the
-            # render_type where appropriate, so it's consistent for all future versions.
-            if version < 9:
-                if conn.r2.idnum < conn.r1.idnum:
-                    end1 = conn.ends1[conn.dir1]
-                    end2 = conn.ends2[conn.dir2]
-                    if end1.is_render_midpoint_a():
-                        end1.set_render_midpoint_b()
-                        end2.set_render_midpoint_b()
-                    elif end1.is_render_midpoint_b():
-                        end1.set_render_midpoint_a()
-                        end2.set_render_midpoint_a()
+            (record, end_records) = Connection.read_record(df, version)
+            room1 = rooms.get(record[0])
+            room2 = rooms.get(record[2])
+            if room1 is None or room2 is None:
+                raise LoadException('Connection refers to room %d, which is not on the map' %
+                        (record[0] if room1 is None else record[2]))
+            conns.append(Connection.from_record(room1, room2, record, end_records))
 
         # Now load groups
         for i in range(num_groups):
             advmap.groups.append(Group.load(df, advmap, version))
 
+        if validate:
+            advmap.validate()
+
         # ... and return our object.
         return advmap
 
+    @staticmethod
+    def load_data(data, version, validate=True):
+        """
+        Loads a map from a chunk of savefile data, in savefile version
+        `version`.
+        """
+        return Map.load(BufferedSavefile('', data=data), version, validate)
+
+    def to_records(self):
+        """
+        Returns a flat representation of the map, made only of tuples,
+        lists, strings and numbers (so it can be marshalled): a tuple of
+        (name, w, h, rooms, conns, groups), where the last three are lists
+        of the same tuples that `Room.read_record`, `Connection.read_record`
+        and `Group.read_record` return.  A lazy map which hasn't been
+        loaded yet is only loaded temporarily, to get its records.
+        """
+        if not self.is_loaded():
+            (loader, args) = self._pending
+            return (self.name,) + loader(*args).to_records()[1:]
+        return (self.name, self.w, self.h,
+                [room.to_record() for room in self.roomlist()],
+                [conn.to_record() for conn in self.conns],
+                [group.to_record() for group in self.groups])
+
+    @staticmethod
+    def from_records(records, validate=False):
+        """
+        Builds a map out of the flat representation returned by
+        `to_records`.  Rooms have to be on the map, and every record has
+        to have the right shape, or a LoadException is raised, just as
+        when loading a savefile.  The connections between rooms are
+        normally known to be good, so they're not validated unless
+        `validate` is `True`.
+        """
+        try:
+            (name, w, h, room_records, conn_records, group_records) = records
+        except (TypeError, ValueError):
+            raise LoadException('Invalid map record')
+        advmap = Map(name)
+        advmap.set_map_size(w, h)
+        try:
+            rooms = advmap.rooms
+            grid = advmap.grid
+            for record in room_records:
+                room = Room.from_record(record)
+                (idnum, x, y) = (room.idnum, room.x, room.y)
+                if not (0 <= x < w and 0 <= y < h):
+                    raise LoadException('Room %d is off the map, at (%d, %d)' % (idnum, x+1, y+1))
+                if idnum in rooms:
+                    raise LoadException('Room ID %d already exists' % (idnum))
+                if grid.get(x, y):
+                    raise LoadException('Room %d overlaps another room at (%d, %d)' % (idnum, x+1, y+1))
+                advmap.inject_room_obj(room)
+            conns = advmap.conns
+            for (record, end_records) in conn_records:
+                room1 = rooms.get(record[0])
+                room2 = rooms.get(record[2])
+                if room1 is None or room2 is None:
+                    raise LoadException('Connection refers to room %d, which is not on the map' %
+                            (record[0] if room1 is None else record[2]))
+                conns.append(Connection.from_record(room1, room2, record, end_records))
+            for record in group_records:
+                if len(record[1]) < 2:
+                    raise LoadException('Group stated it had only %d rooms' % (len(record[1])))
+                advmap.groups.append(Group.from_record(advmap, record))
+        except (TypeError, ValueError, IndexError) as e:
+            raise LoadException('Invalid records for map "%s": %s' % (name, e), e)
+        if validate:
+            advmap.validate()
+        return advmap
+
+    def snapshot(self):
+        """
+        Returns a MapSnapshot of how we look right now, which `restore`
+        can put us back to (this is what undo uses).  Taking one just
+        copies our own few fields; after that, each room, connection and
+        group notes down its record in here the first time it changes (see
+        `log_room`), until the next snapshot is taken.  Records are shared
+        with the objects they came from wherever they can be (see
+        `Room.get_record` and `Connection.get_record`), so none of this
+        depends on how many rooms there are which haven't changed.
+        """
+        snapshot = MapSnapshot(self.name, self.w, self.h, self.cur_id,
+                tuple(self.free_ids))
+        if self.last_snapshot is not None:
+            self.last_snapshot.next_snapshot = snapshot
+        self.last_snapshot = snapshot
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+        Puts us back the way we were when `snapshot` was taken (this is
+        what undo and redo use).  Everything which has changed since then
+        is noted down in that snapshot or the ones after it, and only
+        those rooms, connections and groups are touched, so this takes
+        time in proportion to how much has changed rather than how big
+        we are.  Connections and groups which were deleted in the meantime
+        go back in at the end of `conns` or `groups`.
+
+        Our changes here get noted down like any others, so a snapshot
+        taken just beforehand can be used to redo them.
+        """
+        snapshots = []
+        while snapshot is not None:
+            snapshots.append(snapshot)
+            snapshot = snapshot.next_snapshot
+        if snapshots[-1] is not self.last_snapshot:
+            raise ValueError('Snapshot was not taken from this map')
+
+        # Work out what everything has to go back to, which is whatever
+        # was noted down for it first
+        rooms = {}
+        conns = {}
+        groups = {}
+        for later in reversed(snapshots):
+            rooms.update(later.rooms)
+            conns.update(later.conns)
+            groups.update(later.groups)
+
+        # Take apart everything which has changed...
+        for (conn, record) in conns.items():
+            if conn in self.conns:
+                self.log_conn(conn)
+                conn.clear_room_vars()
+                if record is None:
+                    self.conns.remove(conn)
+        for (group, record) in groups.items():
+            if group in self.groups:
+                self.log_group(group)
+                for room in group.rooms:
+                    if room.group is group:
+                        room.group = None
+                if record is None:
+                    self.groups.remove(group)
+        for (idnum, record) in rooms.items():
+            room = self.rooms.get(idnum)
+            if room is not None:
+                self.log_room(room)
+                self.grid.remove(room)
+                if record is None:
+                    del self.rooms[idnum]
+                    room.mapobj = None
+
+        # ... and put it back together again
+        for (idnum, record) in rooms.items():
+            if record is None:
+                continue
+            room = self.rooms.get(idnum)
+            if room is None:
+                room = Room.from_record(record)
+                self.log_room(room)
+                self.rooms[idnum] = room
+                room.mapobj = self
+            else:
+                room.set_record(record)
+            room._record = record
+            self.grid.add(room)
+        for (conn, record) in conns.items():
+            if record is None:
+                continue
+            (conn_record, end_records) = record
+            conn.set_record(self.rooms[conn_record[0]], self.rooms[conn_record[2]],
+                    conn_record, end_records)
+            conn._record = record
+            if conn not in self.conns:
+                self.inject_conn_obj(conn)
+        for (group, record) in groups.items():
+            if record is None:
+                continue
+            group.set_record(self, record)
+            if group not in self.groups:
+                self.log_group(group)
+                self.groups.append(group)
+
+        self.mark_dirty()
+        self.name = snapshots[0].name
+        self.w = snapshots[0].w
+        self.h = snapshots[0].h
+        self.cur_id = snapshots[0].cur_id
+        self.free_ids = list(snapshots[0].free_ids)
+
+class WorkerThread(object):
+    """
+    Runs blocking calls on a private worker thread, for the async methods
+    on Game.  There's only the one thread, so the calls run in the order
+    they were made and never overlap.  In particular, a clean-up call made
+    after the task awaiting an earlier call was cancelled will wait for
+    that earlier call to finish.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='advmap')
+
+    def run(self, func, *args):
+        """
+        Calls `func(*args)` on our thread, returning a future for the result
+        """
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def report(self, progress, done, total):
+        """
+        Calls the `progress` callback, if there is one, and awaits its
+        result if that's awaitable
+        """
+        if progress is not None:
+            result = progress(done, total)
+            if inspect.isawaitable(result):
+                await result
+
+    def close(self):
+        """
+        Shuts down our thread once it's done with anything still running
+        """
+        self.executor.shutdown(wait=False)
+
 class Game(object):
     """
     Data for a single game - Games are actually collections
-    of Maps, which are themselves collections of rooms
+    of Maps, which are themselves collections of rooms.  For games which
+    were loaded from a file, `format` and `version` describe that file,
+    as in GameInfo; for new games, they're both `None`.
     """
 
     def __init__(self, name):
         self.name = name
         self.maps = []
+        self.format = None
+        self.version = None
 
     def add_map_obj(self, mapobj):
         """
@@ -1561,32 +3149,123 @@ class Game(object):
         """
         self.maps = maps
 
-    def _save(self, df):
+    def _save(self, df, sections=None):
         """
-        Save ourselves to a Savefile object
+        Save ourselves to a Savefile object.  As of v10, the header is
+        followed by an index of map names, along with the offset and
+        length of each map's data, so that maps can be loaded
+        independently of each other.  As of v12, the index just stores
+        each map's length as a varint; the maps follow the index in order,
+        so their offsets are implied.  The fixed-size header at the very
+        start stays the same so that the file is still easy to identify.
+
+        `sections` is each map's savefile data, if the caller already has
+        it (see `Map.get_savedata`).  Returns a list of the offset and
+        length each map's data was written at.
         """
         df.write(b'ADVMAP')
         df.writeshort(SAVEFILE_VER)
         df.writestr(self.name)
-        df.writeshort(len(self.maps))
-        for mapobj in self.maps:
-            mapobj.save(df)
+        df.writevarint(len(self.maps))
+        if sections is None:
+            sections = [mapobj.get_savedata() for mapobj in self.maps]
+        for (mapobj, data) in zip(self.maps, sections):
+            df.writevarstr(mapobj.name)
+            df.writevarint(len(data))
+        places = []
+        for data in sections:
+            places.append((df.tell(), len(data)))
+            df.write(data)
+        return places
+
+    def _write(self, filename, sections=None):
+        """
+        Writes ourselves out to `filename` in our own binary format (see
+        `_save`), and then tells each map where its data ended up, so
+        that it's no longer dirty and can read that data back in next time
+        we're saved (see `Map.mark_saved`).
+        """
+        df = BufferedSavefile(filename)
+        df.open_w()
+        places = self._save(df, sections)
+        df.close()
+        try:
+            key = file_key(os.stat(filename))
+        except OSError:
+            return
+        filename = os.path.abspath(filename)
+        for (mapobj, (offset, length)) in zip(self.maps, places):
+            mapobj.mark_saved(filename, key, offset, length)
 
     def save(self, filename):
         """
         Saves the game maps to a filename.  This is the main
         routine that the GUI will end up calling - the heavy lifting
-        is actually done in the internal `_save` routine.
+        is actually done in the internal `_save` routine.  The whole
+        file is built up in memory and written out in one go.
+
+        Filenames ending in `JSON_EXTENSION` are saved as gzipped JSON
+        instead (see `JsonSavefile`), one map at a time, and filenames
+        ending in `SQLITE_EXTENSION` are saved to an SQLite database (see
+        `SqliteSavefile`), changing only the rows which need it.
         """
-        df = Savefile(filename)
-        df.open_w()
-        self._save(df)
-        df.close()
+        savefile = Game._records_savefile(filename)
+        if savefile is not None:
+            savefile.write(self.name, (mapobj.to_records() for mapobj in self.maps))
+            return
+        self._write(filename)
+
+    async def save_async(self, filename, progress=None):
+        """
+        Coroutine version of `save`, for use from asyncio code.  Each map
+        is encoded on a worker thread, one at a time, and then the file is
+        written out in one go, also on the worker thread.  If `progress`
+        is given, it's called with (maps_done, total_maps) after each map
+        is encoded (and awaited, if it returns an awaitable).  Cancelling
+        the task before all the maps are encoded leaves the file untouched.
+        The game mustn't be changed until this has finished.
+        """
+        savefile = Game._records_savefile(filename)
+        maps = list(self.maps)
+        worker = WorkerThread()
+        try:
+            records = []
+            sections = []
+            for (idx, mapobj) in enumerate(maps):
+                if savefile is None:
+                    sections.append(await worker.run(mapobj.get_savedata))
+                else:
+                    records.append(await worker.run(mapobj.to_records))
+                await worker.report(progress, idx+1, len(maps))
+            if savefile is None:
+                await worker.run(self._write, filename, sections)
+            else:
+                await worker.run(savefile.write, self.name, records)
+        finally:
+            worker.close()
 
     @staticmethod
-    def _load(df):
+    def _records_savefile(filename):
         """
-        Loads ourselves from a Savefile object.  Returns the Game object.
+        Returns the savefile object which should be used to save `filename`
+        as map records (see `Map.to_records`), going by its extension: a
+        JsonSavefile or SqliteSavefile.  Returns `None` for our own binary
+        format.
+        """
+        if JsonSavefile.is_json_filename(filename):
+            return JsonSavefile(filename)
+        if SqliteSavefile.is_sqlite_filename(filename):
+            return SqliteSavefile(filename)
+        return None
+
+    @staticmethod
+    def _read_header(df):
+        """
+        Reads the header (and map index, if there is one) from a Savefile
+        object.  Returns a tuple of (version, name, num_maps, index).  For
+        v10 and up, `index` is a list of (map_name, offset, length) tuples;
+        for earlier versions it's `None`, and `df` is left positioned at
+        the start of the first map.
         """
         openstr = df.read(6)
         if (openstr != b'ADVMAP'):
@@ -1595,23 +3274,301 @@ class Game(object):
         if (version > SAVEFILE_VER):
             raise LoadException('Map file is version %d, we can only open versions %d and lower' % (version, SAVEFILE_VER))
         name = df.readstr()
-        game = Game(name)
-        num_maps = df.readshort()
-        for i in range(num_maps):
-            game.add_map_obj(Map.load(df, version))
-        return game
+        if version >= 12:
+            num_maps = df.readvarint()
+            lengths = []
+            for i in range(num_maps):
+                map_name = df.readvarstr()
+                lengths.append((map_name, df.readvarint()))
+            index = []
+            offset = df.tell()
+            for (map_name, length) in lengths:
+                index.append((map_name, offset, length))
+                offset += length
+        elif version >= 10:
+            num_maps = df.readshort()
+            index = []
+            for i in range(num_maps):
+                map_name = df.readstr()
+                (offset, length) = df.readstruct(MAP_INDEX)
+                index.append((map_name, offset, length))
+        else:
+            num_maps = df.readshort()
+            index = None
+        return (version, name, num_maps, index)
 
     @staticmethod
-    def load(filename):
+    def _load(df, validate=True):
         """
-        Loads a game from a filename.  Returns the Game object
+        Loads ourselves from a Savefile object.  Returns the Game object.
         """
-        df = Savefile(filename)
+        (version, name, num_maps, index) = Game._read_header(df)
+        game = Game(name)
+        game.format = 'binary'
+        game.version = version
+        if index is not None:
+            game.replace_maps(Game._read_lazy_maps(df, version, index, validate))
+        else:
+            for i in range(num_maps):
+                game.add_map_obj(Map.load(df, version, validate))
+        return game
+
+    @staticmethod
+    def _read_lazy_maps(df, version, index, validate=True):
+        """
+        Reads the data for each map in the `index` returned by
+        `_read_header` out of a Savefile object, returning a list of lazy
+        Map objects (see `Map.lazy`).
+        """
+        maps = []
+        for (map_name, offset, length) in index:
+            df.seek(offset)
+            data = df.readchunk(length)
+            if len(data) != length:
+                raise LoadException('Error reading map "%s", expected %d bytes, read %d' % (map_name, length, len(data)))
+            if df.key is None:
+                source = None
+            else:
+                source = (os.path.abspath(df.filename), df.key, offset, length)
+            maps.append(Map.lazy(map_name, data, version, validate, source))
+        return maps
+
+    @staticmethod
+    def load(filename, readonly=False, validate=True):
+        """
+        Loads a game from a filename.  Returns the Game object.  Pass in
+        `readonly` = `True` if the caller doesn't intend to save the game
+        back out, in which case the file will be memory-mapped rather than
+        read in.  Pass in `validate` = `False` to skip checking the
+        consistency of each map's connections (see `Map.validate`), for
+        files which are known to be good.  Gzipped JSON savefiles and
+        SQLite databases are recognized automatically, and loaded with
+        `_load_records`.
+        """
+        if JsonSavefile.is_json_file(filename):
+            return Game._load_records(JsonSavefile(filename), 'json', validate)
+        if SqliteSavefile.is_sqlite_file(filename):
+            return Game._load_records(SqliteSavefile(filename), 'sqlite', validate)
+        if readonly:
+            df = MmapSavefile(filename)
+        else:
+            df = BufferedSavefile(filename)
         df.open_r()
-        game = Game._load(df)
+        game = Game._load(df, validate)
         df.close()
         return game
 
+    @staticmethod
+    async def load_async(filename, validate=True, progress=None):
+        """
+        Coroutine version of `load`, for use from asyncio code.  All the
+        file I/O and parsing happens on a worker thread, a map at a time,
+        so the event loop is never held up for more than the time it takes
+        to hand each map back.  Unlike with `load`, every map is fully
+        loaded (rather than on first use) by the time the game is returned.
+        If `progress` is given, it's called with (maps_loaded, total_maps)
+        after each map (and awaited, if it returns an awaitable); the total
+        is `None` for JSON savefiles and SQLite databases, where it isn't
+        known up front.  Cancelling the task stops loading at the next map
+        boundary: the map being parsed at the time is finished off in the
+        background and thrown away, and the file gets closed.
+        """
+        worker = WorkerThread()
+        steps = Game._load_steps(filename, validate)
+        try:
+            (game, total) = await worker.run(next, steps)
+            done = 0
+            while await worker.run(next, steps, False):
+                done += 1
+                await worker.report(progress, done, total)
+            return game
+        finally:
+            worker.run(steps.close)
+            worker.close()
+
+    @staticmethod
+    def _load_steps(filename, validate=True):
+        """
+        Loads a game a map at a time, for `load_async`.  This generator
+        first yields a tuple of the Game object (whose maps aren't loaded
+        yet) and the number of maps (or `None`, if that's not known), and
+        then yields `True` after each map is loaded.  The file stays open
+        until the generator is exhausted or closed.
+        """
+        if JsonSavefile.is_json_file(filename):
+            (records, format) = (JsonSavefile(filename).read(), 'json')
+        elif SqliteSavefile.is_sqlite_file(filename):
+            (records, format) = (SqliteSavefile(filename).read(), 'sqlite')
+        else:
+            records = None
+        if records is not None:
+            try:
+                game = Game(next(records))
+                game.format = format
+                yield (game, None)
+                for map_records in records:
+                    game.add_map_obj(Map.from_records(map_records, validate))
+                    yield True
+            finally:
+                records.close()
+            return
+
+        df = BufferedSavefile(filename)
+        df.open_r()
+        try:
+            (version, name, num_maps, index) = Game._read_header(df)
+            game = Game(name)
+            game.format = 'binary'
+            game.version = version
+            if index is not None:
+                game.replace_maps(Game._read_lazy_maps(df, version, index, validate))
+                df.close()
+                yield (game, num_maps)
+                for mapobj in game.maps:
+                    mapobj.materialize()
+                    yield True
+            else:
+                yield (game, num_maps)
+                for i in range(num_maps):
+                    game.add_map_obj(Map.load(df, version, validate))
+                    yield True
+        finally:
+            df.close()
+
+    @staticmethod
+    def _load_records(savefile, format, validate=True):
+        """
+        Loads a game a map at a time from a savefile object which provides
+        map records (a JsonSavefile or SqliteSavefile), whose format is
+        `format` ('json' or 'sqlite').  Returns the Game object.  These
+        maps always need re-encoding before being saved in our binary
+        format, so they start out dirty.
+        """
+        records = savefile.read()
+        try:
+            game = Game(next(records))
+            game.format = format
+            for map_records in records:
+                game.add_map_obj(Map.from_records(map_records, validate))
+        finally:
+            records.close()
+        return game
+
+    @staticmethod
+    def _peek(df):
+        """
+        Reads summary information about a game from a Savefile object,
+        without loading any of its maps.  Returns a GameInfo object.
+        """
+        (version, name, num_maps, index) = Game._read_header(df)
+        info = GameInfo(name, version)
+        if index is not None:
+            # We only need the header at the start of each map
+            for (map_name, offset, length) in index:
+                df.seek(offset)
+                (stored_name, w, h, num_rooms, num_conns, num_groups,
+                        num_strings) = Map.load_header(df, version)
+                info.maps.append(MapInfo(map_name, w, h, num_rooms, num_conns, num_groups))
+        else:
+            for i in range(num_maps):
+                info.maps.append(Map.peek(df, version))
+        return info
+
+    @staticmethod
+    def peek(filename):
+        """
+        Returns a GameInfo object describing the game in the given filename
+        (its name, savefile version, and the names and sizes of its maps),
+        without actually loading it.  For indexed savefiles (v10 and up),
+        only the header of each map is read at all; for older ones, the
+        rest of each map gets skipped over without being decoded.  The
+        file is memory-mapped, so the parts we skip over don't even need
+        to be read from disk.  For gzipped JSON savefiles, every map does
+        have to be decoded; SQLite databases just get asked.  `version`
+        will be `None` for both.
+        """
+        if JsonSavefile.is_json_file(filename):
+            records = JsonSavefile(filename).read()
+            try:
+                info = GameInfo(next(records), None, 'json')
+                for (name, w, h, rooms, conns, groups) in records:
+                    info.maps.append(MapInfo(name, w, h, len(rooms), len(conns), len(groups)))
+            finally:
+                records.close()
+            return info
+        if SqliteSavefile.is_sqlite_file(filename):
+            (name, maps) = SqliteSavefile(filename).peek()
+            info = GameInfo(name, None, 'sqlite')
+            for row in maps:
+                info.maps.append(MapInfo(*row))
+            return info
+        df = MmapSavefile(filename)
+        df.open_r()
+        try:
+            return Game._peek(df)
+        finally:
+            df.close()
+
+    @staticmethod
+    def _iter_records(df):
+        """
+        Reads a game from a Savefile object, yielding a GameHeader and then
+        the records from `Map.iter_records` for each map in turn.
+        """
+        (version, name, num_maps, index) = Game._read_header(df)
+        yield GameHeader(name, version, num_maps)
+        if index is not None:
+            for (map_name, offset, length) in index:
+                df.seek(offset)
+                yield from Map.iter_records(df, version)
+        else:
+            for i in range(num_maps):
+                yield from Map.iter_records(df, version)
+
+    @staticmethod
+    def iter_records(filename):
+        """
+        Reads the game in the given filename as a stream of flat records
+        (see `Map.iter_records`), without building any Map, Room or
+        Connection objects, so that even very large files can be processed
+        in constant memory.  The file is memory-mapped, and stays open
+        until the generator is exhausted or closed.
+        """
+        df = MmapSavefile(filename)
+        df.open_r()
+        try:
+            yield from Game._iter_records(df)
+        finally:
+            df.close()
+
+class GameInfo(object):
+    """
+    Summary information about a game savefile, as returned by `Game.peek`.
+    `maps` is a list of MapInfo objects.  `format` is one of 'binary',
+    'json' or 'sqlite', and `version` is the savefile version for the
+    binary format, or `None` for the others.
+    """
+
+    def __init__(self, name, version, format='binary'):
+        self.name = name
+        self.version = version
+        self.format = format
+        self.maps = []
+
+class MapInfo(object):
+    """
+    Summary information about a single map in a savefile, as returned
+    by `Game.peek`.
+    """
+
+    def __init__(self, name, w, h, num_rooms, num_conns, num_groups):
+        self.name = name
+        self.w = w
+        self.h = h
+        self.num_rooms = num_rooms
+        self.num_conns = num_conns
+        self.num_groups = num_groups
+
 class Clipboard(object):
     """
     A clipboard class, to assist with copy+paste.  This is probably only
@@ -1680,23 +3637,30 @@ class Clipboard(object):
             self.rooms.add(newroom)
             room_map[room] = newroom
 
-        # Loop through connections to see which ones we'll have to keep
-        for conn in mapobj.conns:
-            if conn.r1 in roomset and conn.r2 in roomset:
-                self.conns.append(conn.copy_with_new_rooms(
-                    room_map[conn.r1],
-                    room_map[conn.r2],
-                    ))
-
-        # Loop through our groups to see which ones we'll have to keep.
-        # There must be at least two rooms being copied in the same group.
-        for group in mapobj.groups:
-            foundrooms = []
-            for room in group.get_rooms():
-                if room in roomset:
-                    foundrooms.append(room_map[room])
+        # Find the connections we'll have to keep, by looking at the ones
+        # touching each room, and keep them in the map's order
+        conns = set()
+        for room in roomset:
+            for conn in room.get_conns():
+                if conn.r1 in roomset and conn.r2 in roomset:
+                    conns.add(conn)
+        for conn in mapobj.conns.sorted(conns):
+            self.conns.append(conn.copy_with_new_rooms(
+                room_map[conn.r1],
+                room_map[conn.r2],
+                ))
+
+        # Find the groups we'll have to keep, by looking at the group of
+        # each room.  There must be at least two rooms being copied in the
+        # same group.  Again, keep the map's order, and each group's.
+        group_rooms = {}
+        for room in roomset:
+            if room.group:
+                group_rooms.setdefault(room.group, []).append(room)
+        for group in mapobj.groups.sorted(group_rooms):
+            foundrooms = group_rooms[group]
             if len(foundrooms) > 1:
-                self.groups.append((group, foundrooms))
+                self.groups.append((group, [room_map[room] for room in group.rooms.sorted(foundrooms)]))
 
     def will_fit(self, mapobj, x, y):
         """
@@ -1714,6 +3678,99 @@ class Clipboard(object):
                 return False
         return True
 
+    def get_footprint(self):
+        """
+        Returns a list of `(x, y, width, height)` rectangles which exactly
+        cover the spaces our rooms take up: each run of rooms along a row
+        is a rectangle, extended downwards through any rows below which
+        have exactly the same run.
+        """
+        rows = {}
+        for room in self.rooms:
+            rows.setdefault(room.y, []).append(room.x)
+        rects = []
+        above = {}
+        for y in range(self.height):
+            current = {}
+            xs = sorted(rows.get(y, []))
+            for (offset, run) in itertools.groupby(enumerate(xs), lambda pair: pair[1] - pair[0]):
+                run = list(run)
+                span = (run[0][1], len(run))
+                if span in above:
+                    rect = above[span]
+                    rect[3] += 1
+                else:
+                    rect = [span[0], y, span[1], 1]
+                    rects.append(rect)
+                current[span] = rect
+            above = current
+        return [tuple(rect) for rect in rects]
+
+    def find_spot(self, mapobj):
+        """
+        Returns the first `(x, y)` (scanning along each row, from the top)
+        where we will fit in `mapobj`, or `None` if there's nowhere.
+
+        Rather than trying `will_fit` everywhere, this keeps a running
+        summed-area table of which map spaces have rooms in them.  From
+        that we get the number of map rooms inside each rectangle of our
+        footprint (see `get_footprint`) at every spot along a row in one
+        go, and we fit wherever they all come to zero.  Only the last
+        `height` rows of the table are kept.
+        """
+        if not self.has_data:
+            return None
+        width = self.width
+        height = self.height
+        map_w = mapobj.w
+        if width > map_w or height > mapobj.h:
+            return None
+        spots = map_w - width + 1
+        rects = self.get_footprint()
+        rows = mapobj.grid.rows
+
+        # Each table row holds, for every column, the number of rooms
+        # above and to the left of it
+        table = deque([[0]*(map_w+1)], height+1)
+        for map_y in range(mapobj.h):
+            above = table[-1]
+            row = rows.get(map_y)
+            if row is None:
+                table.append(above)
+            else:
+                cells = [0]*map_w
+                for map_x in row:
+                    cells[map_x] = 1
+                table.append(list(map(operator.add, above,
+                    itertools.chain((0,), itertools.accumulate(cells)))))
+            if map_y + 1 < height:
+                continue
+
+            # table[0] is now the row `height` rows up, where we'd be
+            # pasting, so total up the rooms under each rectangle at each
+            # spot along it
+            top_y = map_y + 1 - height
+            if table[-1][-1] == table[0][-1]:
+                return (0, top_y)
+            totals = [0]*spots
+            bands = {}
+            for (rect_x, rect_y, rect_w, rect_h) in rects:
+                band = bands.get((rect_y, rect_h))
+                if band is None:
+                    rect_top = table[rect_y]
+                    rect_bottom = table[rect_y+rect_h]
+                    if rect_top[-1] == rect_bottom[-1]:
+                        band = ()
+                    else:
+                        band = list(map(operator.sub, rect_bottom, rect_top))
+                    bands[(rect_y, rect_h)] = band
+                if band:
+                    totals = list(map(operator.add, totals,
+                        map(operator.sub, band[rect_x+rect_w:rect_x+rect_w+spots], band[rect_x:])))
+            if 0 in totals:
+                return (totals.index(0), top_y)
+        return None
+
     def paste(self, mapobj, x=None, y=None):
         """
         Pastes ourself into the given `mapobj`, optionally at `x`,`y`.  If
@@ -1728,19 +3785,10 @@ class Clipboard(object):
         # If we're not hovering over a room spot, loop through the
         # map to try and find an open spot
         if x is None or y is None:
-            x = None
-            y = None
-            for map_y in range(mapobj.h - self.height + 1):
-                if x is not None:
-                    break
-                for map_x in range(mapobj.w - self.width + 1):
-                    if x is not None:
-                        break
-                    if self.will_fit(mapobj, map_x, map_y):
-                        x = map_x
-                        y = map_y
-            if x is None:
+            spot = self.find_spot(mapobj)
+            if spot is None:
                 return False
+            (x, y) = spot
         else:
             # Double check that we'll fit if we WERE hovering over a
             # room spot
@@ -1759,7 +3807,7 @@ class Clipboard(object):
 
         # Add in any connections we copied
         for conn in self.conns:
-            mapobj.conns.append(conn.copy_with_new_rooms(
+            mapobj.inject_conn_obj(conn.copy_with_new_rooms(
                 room_map[conn.r1],
                 room_map[conn.r2],
                 update_room_vars=True,
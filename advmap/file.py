@@ -20,9 +20,72 @@
 
 import io
 import os
-from struct import pack, unpack
+import mmap
+import stat
+import tempfile
+from struct import Struct, pack, unpack
 
-__all__ = [ 'LoadException', 'Savefile' ]
+__all__ = [ 'LoadException', 'Savefile', 'BufferedSavefile', 'MmapSavefile',
+        'CHAR', 'UCHAR', 'SHORT', 'INT', 'FLOAT', 'pack_varints', 'write_atomically',
+        'file_key' ]
+
+# Precompiled layouts for our basic datatypes.  Record-level layouts
+# (which combine several of these) live alongside the objects which
+# use them, over in advmap.data.
+CHAR = Struct('b')
+UCHAR = Struct('B')
+SHORT = Struct('<H')
+INT = Struct('<I')
+FLOAT = Struct('d')
+
+def pack_varints(values):
+    """
+    Encodes the given non-negative integers as unsigned LEB128 varints:
+    seven bits per byte, least-significant group first, with the high bit
+    set on every byte but the last.  Values below 128 take a single byte.
+    """
+    out = bytearray()
+    for value in values:
+        if value < 0:
+            raise IOError('Cannot write negative value %d as a varint' % (value))
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+def file_key(st):
+    """
+    Returns a tuple identifying one particular version of a file, given
+    its `os.stat` result.  If a file still has the same key later on, it
+    hasn't been replaced or (as far as we can tell) changed since.
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def write_atomically(filename, writer):
+    """
+    Replaces `filename` with whatever `writer` writes to the binary file
+    object it's called with.  The data goes to a temporary file in the
+    same directory first, which is then renamed over the original (keeping
+    its permissions), so we never leave a half-written file behind.
+    """
+    target = os.path.realpath(filename)
+    if os.path.exists(target):
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    (handle, tempname) = tempfile.mkstemp(dir=os.path.dirname(target),
+            prefix='.{}.'.format(os.path.basename(target)))
+    try:
+        with os.fdopen(handle, 'wb') as df:
+            writer(df)
+        os.chmod(tempname, mode)
+        os.replace(tempname, target)
+    except:
+        os.unlink(tempname)
+        raise
 
 class LoadException(Exception):
 
@@ -43,9 +106,11 @@ class Savefile(object):
         will be completely ignored in that case, and no changes will be
         written to disk, though calling `close`, `open_r` or `open_w` may
         end up overwriting that state.  `in_memory` is basically just designed
-        to be used with our unit tests.
+        to be used with our unit tests.  Once we've been opened for
+        reading, `key` is the `file_key` of the file we read.
         """
         self.filename = filename
+        self.key = None
         if in_memory:
             self.df = io.BytesIO()
             self.opened_r = True
@@ -71,6 +136,7 @@ class Savefile(object):
         if (self.opened_r or self.opened_w):
             raise IOError('File is already open')
         self.df = open(self.filename, 'rb')
+        self.key = file_key(os.fstat(self.df.fileno()))
         self.opened_r = True
 
     def open_w(self):
@@ -108,6 +174,14 @@ class Savefile(object):
         """ Read the rest of the file from the handle. """
         return self.df.read(length)
 
+    def readchunk(self, length):
+        """
+        Reads a `length`-byte chunk to be kept around for later, such as
+        the data for a lazy map.  This is the same as `read`, but see
+        `MmapSavefile.readchunk`.
+        """
+        return self.read(length)
+
     def readchar(self):
         """ Read a signed character (1-byte) "integer" from the savefile. """
         if (not self.opened_r):
@@ -187,6 +261,110 @@ class Savefile(object):
         self.readchar()
         return string
 
+    def skip(self, length):
+        """ Skip over `length` bytes of the savefile. """
+        self.df.seek(length, os.SEEK_CUR)
+
+    def skipstr(self):
+        """ Skip over a string in the savefile without decoding it. """
+        self.skip(self.readshort() + 1)
+
+    def skipvarstr(self):
+        """ Skip over a varint-prefixed string without decoding it. """
+        self.skip(self.readvarint())
+
+    def readstruct(self, layout):
+        """
+        Read a whole precompiled `struct.Struct` layout from the savefile
+        at once, returning the tuple of unpacked values.
+        """
+        if (not self.opened_r):
+            raise IOError('File is not open for reading')
+        return layout.unpack(self.df.read(layout.size))
+
+    def writestruct(self, layout, *values):
+        """
+        Write a whole precompiled `struct.Struct` layout to the savefile
+        at once.
+        """
+        if (not self.opened_w):
+            raise IOError('File is not open for writing')
+        self.df.write(layout.pack(*values))
+
+    def readvarint(self):
+        """ Read an unsigned LEB128 varint from the savefile. """
+        if (not self.opened_r):
+            raise IOError('File is not open for reading')
+        value = 0
+        shift = 0
+        while True:
+            byteval = self.df.read(1)
+            if (len(byteval) == 0):
+                raise LoadException('Error reading varint, hit end of file')
+            value |= (byteval[0] & 0x7F) << shift
+            if byteval[0] < 0x80:
+                return value
+            shift += 7
+
+    def readvarints(self, count):
+        """ Read `count` varints from the savefile, returned as a list. """
+        return [self.readvarint() for i in range(count)]
+
+    def writevarint(self, intval):
+        """ Write an unsigned LEB128 varint to the savefile. """
+        if (not self.opened_w):
+            raise IOError('File is not open for writing')
+        self.df.write(pack_varints((intval,)))
+
+    def writevarints(self, *values):
+        """ Write a series of varints to the savefile at once. """
+        if (not self.opened_w):
+            raise IOError('File is not open for writing')
+        self.df.write(pack_varints(values))
+
+    def readvarstr(self):
+        """
+        Read a varint-prefixed string from the savefile.  Unlike `readstr`,
+        there's no length limit and no trailing NULL.
+        """
+        length = self.readvarint()
+        if (length == 0):
+            return ''
+        byteval = self.df.read(length)
+        if (len(byteval) != length):
+            raise LoadException('Error reading string, expected %d, read %d' % (length, len(byteval)))
+        return byteval.decode('utf-8')
+
+    def readvarbytes(self):
+        """
+        Read a varint-prefixed string from the savefile, returning its
+        UTF-8 data as bytes rather than decoding it.
+        """
+        length = self.readvarint()
+        byteval = self.df.read(length)
+        if (len(byteval) != length):
+            raise LoadException('Error reading string, expected %d, read %d' % (length, len(byteval)))
+        return byteval
+
+    def writevarstr(self, strval):
+        """
+        Write a string to the savefile, prepended by its byte length as
+        a varint.
+        """
+        if (not self.opened_w):
+            raise IOError('File is not open for writing')
+        self.writevarbytes(strval.encode('utf-8'))
+
+    def writevarbytes(self, byteval):
+        """
+        Write already-encoded string data to the savefile, in the same
+        format as `writevarstr`.
+        """
+        if (not self.opened_w):
+            raise IOError('File is not open for writing')
+        self.df.write(pack_varints((len(byteval),)))
+        self.df.write(byteval)
+
     def writestr(self, strval):
         """
         Write a string to the savefile, prepended by the byte length.
@@ -204,3 +382,381 @@ class Savefile(object):
         self.writeshort(len(byteval))
         self.df.write(byteval)
         self.df.write(b"\0")
+
+class BufferedSavefile(Savefile):
+    """
+    A Savefile which does all of its work against an in-memory buffer.
+
+    When opened for reading, the entire file is pulled into memory at once,
+    and fields are decoded straight out of that buffer using precompiled
+    `Struct` layouts at a moving offset.  This avoids a `read()` call (and
+    an open-check) for every single field, which is where most of our load
+    time used to go.
+
+    When opened for writing, the whole savefile is built up in a `bytearray`
+    and only hits the disk on `close()`, in a single write to a temporary
+    file which then gets renamed over the real one.  Writes always append
+    to the end of the buffer.
+    """
+
+    # Shorter strings than this are cheaper to copy than to make a
+    # memoryview of; see `readvarbytes`
+    VIEW_MIN_LENGTH = 256
+
+    def __init__(self, filename, in_memory=False, data=None):
+        """
+        Empty object.  Pass in `data` to decode from an existing bytes-like
+        object rather than reading from `filename`.  Pass in `in_memory` =
+        `True` to get an empty buffer open for both reading and writing,
+        which will never be written to disk; the result can be retrieved
+        with `getvalue`.  Once we've read a file, `key` is its `file_key`.
+        """
+        self.filename = filename
+        self.key = None
+        self.df = None
+        self.in_memory = in_memory
+        self.pos = 0
+        self.buf = None
+        self.opened_r = False
+        self.opened_w = False
+        if in_memory:
+            self.buf = bytearray()
+            self.opened_r = True
+            self.opened_w = True
+        elif data is not None:
+            self.buf = data
+            self.opened_r = True
+
+    def close(self):
+        """
+        Releases our buffer.  If we were opened for writing, this is where
+        the data actually gets written out.
+        """
+        if self.opened_w and not self.in_memory:
+            self.flush()
+        self.buf = None
+        self.pos = 0
+        self.opened_r = False
+        self.opened_w = False
+
+    def open_r(self):
+        """ Reads the whole file into memory.  Throws IOError if unavailable """
+        if (self.opened_r or self.opened_w):
+            raise IOError('File is already open')
+        with open(self.filename, 'rb') as df:
+            self.key = file_key(os.fstat(df.fileno()))
+            self.buf = df.read()
+        self.pos = 0
+        self.opened_r = True
+
+    def open_w(self):
+        """ Starts a new empty buffer to write into. """
+        if (self.opened_r or self.opened_w):
+            raise IOError('File is already open')
+        self.buf = bytearray()
+        self.pos = 0
+        self.opened_w = True
+
+    def getvalue(self):
+        """ Returns the current contents of our buffer, as bytes. """
+        return bytes(self.buf)
+
+    def flush(self):
+        """
+        Writes our buffer out to `filename`.  The data goes to a temporary
+        file in the same directory first, which is then renamed over the
+        original, so we never leave a half-written savefile behind.
+        """
+        write_atomically(self.filename, lambda df: df.write(self.buf))
+
+    def eof(self):
+        """ Test to see if we're at EOF. """
+        return self.pos >= len(self.buf)
+
+    def seek(self, offset, whence=0):
+        """ Moves our current offset into the buffer. """
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.buf)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        """ Returns our current offset into the buffer. """
+        return self.pos
+
+    def read(self, length=-1):
+        """ Read `length` bytes (or the rest of the buffer). """
+        start = self.pos
+        if length < 0:
+            self.pos = len(self.buf)
+        else:
+            self.pos = min(start + length, len(self.buf))
+        return bytes(self.buf[start:self.pos])
+
+    def skip(self, length):
+        """ Skip over `length` bytes of the buffer. """
+        self.pos += length
+
+    def skipstr(self):
+        """ Skip over a string in the buffer without decoding it. """
+        self.pos += SHORT.unpack_from(self.buf, self.pos)[0] + 3
+
+    def readstruct(self, layout):
+        """
+        Read a whole precompiled `struct.Struct` layout from the buffer at
+        once, returning the tuple of unpacked values.
+        """
+        values = layout.unpack_from(self.buf, self.pos)
+        self.pos += layout.size
+        return values
+
+    def readchar(self):
+        """ Read a signed character (1-byte) "integer" from the buffer. """
+        value = CHAR.unpack_from(self.buf, self.pos)[0]
+        self.pos += 1
+        return value
+
+    def readuchar(self):
+        """ Read an unsigned character (1-byte) "integer" from the buffer. """
+        value = UCHAR.unpack_from(self.buf, self.pos)[0]
+        self.pos += 1
+        return value
+
+    def readshort(self):
+        """ Read a short (2-byte) integer from the buffer. """
+        value = SHORT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 2
+        return value
+
+    def readint(self):
+        """ Read an integer from the buffer. """
+        value = INT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def readfloat(self):
+        """ Read a float (actually a double) from the buffer. """
+        value = FLOAT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 8
+        return value
+
+    def readstr(self):
+        """
+        Read a string from the buffer.  Same format as `Savefile.readstr`:
+        the byte length, the UTF-8 data, and a trailing NULL.
+        """
+        length = SHORT.unpack_from(self.buf, self.pos)[0]
+        start = self.pos + 2
+        end = start + length
+        if end > len(self.buf):
+            raise LoadException('Error reading string, expected %d, read %d' % (length, len(self.buf) - start))
+        # Skip the NULL byte
+        self.pos = end + 1
+        if length == 0:
+            return ''
+        return str(self.buf[start:end], 'utf-8')
+
+    def readvarint(self):
+        """ Read an unsigned LEB128 varint from the buffer. """
+        buf = self.buf
+        pos = self.pos
+        try:
+            byteval = buf[pos]
+            if byteval < 0x80:
+                self.pos = pos + 1
+                return byteval
+            value = byteval & 0x7F
+            shift = 7
+            while True:
+                pos += 1
+                byteval = buf[pos]
+                value |= (byteval & 0x7F) << shift
+                if byteval < 0x80:
+                    self.pos = pos + 1
+                    return value
+                shift += 7
+        except IndexError:
+            raise LoadException('Error reading varint, hit end of file')
+
+    def readvarints(self, count):
+        """ Read `count` varints from the buffer, returned as a list. """
+        readvarint = self.readvarint
+        return [readvarint() for i in range(count)]
+
+    def readvarstr(self):
+        """
+        Read a varint-prefixed string from the buffer.  Same format as
+        `Savefile.readvarstr`.
+        """
+        length = self.readvarint()
+        start = self.pos
+        end = start + length
+        if end > len(self.buf):
+            raise LoadException('Error reading string, expected %d, read %d' % (length, len(self.buf) - start))
+        self.pos = end
+        if length == 0:
+            return ''
+        return str(self.buf[start:end], 'utf-8')
+
+    def readvarbytes(self):
+        """
+        Read a varint-prefixed string from the buffer without decoding
+        it.  Same format as `Savefile.readvarbytes`.  If our buffer is an
+        immutable bytes object, strings of at least `VIEW_MIN_LENGTH`
+        bytes are returned as read-only `memoryview` slices of it rather
+        than being copied (which keeps the whole buffer alive as long as
+        the slice is).  Anything else comes back as a new bytes object.
+        """
+        buf = self.buf
+        length = self.readvarint()
+        start = self.pos
+        end = start + length
+        if end > len(buf):
+            raise LoadException('Error reading string, expected %d, read %d' % (length, len(buf) - start))
+        self.pos = end
+        if length >= self.VIEW_MIN_LENGTH and type(buf) is bytes:
+            return memoryview(buf)[start:end]
+        return bytes(buf[start:end])
+
+    def write(self, byteval):
+        """ Appends arbitrary data to the buffer. """
+        self.buf += byteval
+        self.pos = len(self.buf)
+
+    def writestruct(self, layout, *values):
+        """
+        Write a whole precompiled `struct.Struct` layout to the buffer at
+        once.
+        """
+        self.buf += layout.pack(*values)
+        self.pos = len(self.buf)
+
+    def writechar(self, charval):
+        """ Write a signed character (1-byte) "integer" to the buffer. """
+        self.buf += CHAR.pack(charval)
+        self.pos = len(self.buf)
+
+    def writeuchar(self, charval):
+        """ Write an unsigned character (1-byte) "integer" to the buffer. """
+        self.buf += UCHAR.pack(charval)
+        self.pos = len(self.buf)
+
+    def writeshort(self, shortval):
+        """ Write a short (2-byte) integer to the buffer. """
+        self.buf += SHORT.pack(shortval)
+        self.pos = len(self.buf)
+
+    def writeint(self, intval):
+        """ Write an integer to the buffer. """
+        self.buf += INT.pack(intval)
+        self.pos = len(self.buf)
+
+    def writefloat(self, floatval):
+        """ Write a float (actually a double) to the buffer. """
+        self.buf += FLOAT.pack(floatval)
+        self.pos = len(self.buf)
+
+    def writestr(self, strval):
+        """
+        Write a string to the buffer.  Same format as `Savefile.writestr`:
+        the byte length, the UTF-8 data, and a trailing NULL.
+        """
+        if (len(strval) > 65535):
+            raise IOError('Maximum string length is currently 65535')
+        byteval = strval.encode('utf-8')
+        self.buf += SHORT.pack(len(byteval))
+        self.buf += byteval
+        self.buf += b"\0"
+        self.pos = len(self.buf)
+
+    def writevarint(self, intval):
+        """ Write an unsigned LEB128 varint to the buffer. """
+        self.buf += pack_varints((intval,))
+        self.pos = len(self.buf)
+
+    def writevarints(self, *values):
+        """ Write a series of varints to the buffer at once. """
+        self.buf += pack_varints(values)
+        self.pos = len(self.buf)
+
+    def writevarstr(self, strval):
+        """
+        Write a string to the buffer.  Same format as
+        `Savefile.writevarstr`: the byte length as a varint, then the
+        UTF-8 data.
+        """
+        self.writevarbytes(strval.encode('utf-8'))
+
+    def writevarbytes(self, byteval):
+        """
+        Write already-encoded string data to the buffer.  Same format as
+        `Savefile.writevarbytes`.
+        """
+        self.buf += pack_varints((len(byteval),))
+        self.buf += byteval
+        self.pos = len(self.buf)
+
+class MmapSavefile(BufferedSavefile):
+    """
+    A read-only BufferedSavefile which memory-maps the file rather than
+    reading it into a Python bytes object.  Fields (including strings) are
+    decoded straight out of `memoryview` slices of the map, so nothing
+    gets copied apart from the decoded values themselves, and repeated
+    opens of the same file can share pages via the OS cache.
+    """
+
+    def __init__(self, filename):
+        """
+        Empty object.
+        """
+        super().__init__(filename)
+        self.mmap = None
+
+    def close(self):
+        """
+        Releases our view of the file and unmaps it.  If any chunks from
+        `readchunk` are still in use, the file stays mapped until the
+        last of them is let go of.
+        """
+        if self.opened_r:
+            if self.mmap is not None:
+                self.buf.release()
+                try:
+                    self.mmap.close()
+                except BufferError:
+                    pass
+                self.mmap = None
+        super().close()
+
+    def readchunk(self, length):
+        """
+        Returns a `length`-byte chunk as a `memoryview` straight into the
+        mapped file, rather than a copy, so that (for instance) maps which
+        are never looked at never get copied out of the file.  Chunks keep
+        the file mapped even after we're closed.
+        """
+        start = self.pos
+        self.pos = min(start + length, len(self.buf))
+        return self.buf[start:self.pos]
+
+    def open_r(self):
+        """ Maps the file into memory.  Throws IOError if unavailable """
+        if self.opened_r:
+            raise IOError('File is already open')
+        with open(self.filename, 'rb') as df:
+            st = os.fstat(df.fileno())
+            self.key = file_key(st)
+            if st.st_size == 0:
+                # mmap can't cope with zero-length files
+                self.buf = b''
+            else:
+                self.mmap = mmap.mmap(df.fileno(), 0, access=mmap.ACCESS_READ)
+                self.buf = memoryview(self.mmap)
+        self.pos = 0
+        self.opened_r = True
+
+    def open_w(self):
+        """ We don't support writing. """
+        raise IOError('MmapSavefile is read-only')
@@ -27,6 +27,9 @@ from PyQt5 import QtWidgets, QtGui, QtCore
 
 from advmap import version
 from advmap.data import *
+from advmap.cache import GameCache
+from advmap.jsonfile import JsonSavefile, JSON_EXTENSION
+from advmap.sqlitefile import SqliteSavefile, SQLITE_EXTENSION
 
 class Constants(object):
     """
@@ -894,18 +897,17 @@ class UndoAction(object):
     Simple little object to hold some information about an undo state.
     This is basically just a glorified dict which holds the index of
     the map in question (as in from the main map selection combo box),
-    and a duplicate of the map as it should be, should we revert to
+    and a snapshot of the map as it should be, should we revert to
     this state.
     """
 
-    def __init__(self, index, mapobj, description):
+    def __init__(self, index, snapshot, description):
         """
-        Initialize given a map index and a map object.  Take care that
-        the map object passed in is a duplicate of the "real" map the
-        user is working on.
+        Initialize given a map index and a map snapshot (from
+        `Map.snapshot`).
         """
         self.index = index
-        self.mapobj = mapobj
+        self.snapshot = snapshot
         self.description = description
 
 class GUI(QtWidgets.QMainWindow):
@@ -913,9 +915,9 @@ class GUI(QtWidgets.QMainWindow):
     Main application window.
     """
 
-    def __init__(self, initfile, readonly):
+    def __init__(self, initfile, readonly, cachedir=None):
         super().__init__()
-        self.initUI(initfile, readonly)
+        self.initUI(initfile, readonly, cachedir)
 
     def icon_scale(self, pixmap, size):
         """
@@ -926,7 +928,7 @@ class GUI(QtWidgets.QMainWindow):
                 QtCore.Qt.KeepAspectRatio,
                 QtCore.Qt.SmoothTransformation)
 
-    def initUI(self, initfile, readonly):
+    def initUI(self, initfile, readonly, cachedir=None):
 
         # Set up a scene object in case something is looking for it.  This'll
         # prevent AttributeErrors.
@@ -1162,6 +1164,15 @@ class GUI(QtWidgets.QMainWindow):
         self.curfile = None
         self.create_new_game()
 
+        # Games we've already parsed, so that reopening (or reverting to)
+        # a file which hasn't changed is quick.  This is only used if we've
+        # been given a directory to keep it in; an empty string means the
+        # default one (see `GameCache`).
+        if cachedir is None:
+            self.cache = None
+        else:
+            self.cache = GameCache(cachedir or None)
+
         # Set our readonly state, if we've been told to
         if readonly:
             self.toolbar.readonly_toggle.setChecked(True)
@@ -1274,6 +1285,15 @@ class GUI(QtWidgets.QMainWindow):
         """
         self.statusbar.showMessage(status_str, seconds*1000)
 
+    def load_game(self, filename):
+        """
+        Loads a game from a file, through our cache if we've got one,
+        and returns it
+        """
+        if self.cache is None:
+            return Game.load(filename, readonly=self.is_readonly())
+        return self.cache.load(filename, readonly=self.is_readonly())
+
     def load_from_file(self, filename):
         """
         Loads a game from a file.  Note that we always return
@@ -1282,7 +1302,7 @@ class GUI(QtWidgets.QMainWindow):
         the load.
         """
         # TODO: center on map
-        game = Game.load(filename)
+        game = self.load_game(filename)
         self.clear_view_memory()
         self.game = game
         self.curfile = filename
@@ -1461,7 +1481,7 @@ class GUI(QtWidgets.QMainWindow):
         seen_names = set()
         for mapobj in self.game.maps:
             seen_names.add(mapobj.name)
-        game = Game.load(filename)
+        game = self.load_game(filename)
         for mapobj in game.maps:
             base_mapname = mapobj.name
             mapname = base_mapname
@@ -1497,7 +1517,7 @@ class GUI(QtWidgets.QMainWindow):
             (filename, filefilter) = QtWidgets.QFileDialog.getOpenFileName(self,
                     'Open Game Map File...',
                     path,
-                    'Game Map Files (*.adv);;All Files (*.*)')
+                    'Game Map Files (*.adv *{} *{});;All Files (*.*)'.format(JSON_EXTENSION, SQLITE_EXTENSION))
 
             if filename and filename != '':
                 try:
@@ -1548,11 +1568,18 @@ class GUI(QtWidgets.QMainWindow):
         (filename, filefilter) = QtWidgets.QFileDialog.getSaveFileName(self,
                 'Save Game File...',
                 path,
-                'Game Map Files (*.adv);;All Files (*.*)')
+                'Game Map Files (*.adv);;Gzipped JSON Game Map Files (*{});;SQLite Game Map Databases (*{});;All Files (*.*)'.format(
+                    JSON_EXTENSION, SQLITE_EXTENSION))
 
         if filename and filename != '':
-            if filename [-4:] != '.adv':
-                filename = '{}.adv'.format(filename)
+            if (filename [-4:] != '.adv' and not JsonSavefile.is_json_filename(filename)
+                    and not SqliteSavefile.is_sqlite_filename(filename)):
+                if 'JSON' in filefilter:
+                    filename = '{}{}'.format(filename, JSON_EXTENSION)
+                elif 'SQLite' in filefilter:
+                    filename = '{}{}'.format(filename, SQLITE_EXTENSION)
+                else:
+                    filename = '{}.adv'.format(filename)
             self.curfile = filename
             self.game.save(self.curfile)
             self.set_status('Editing %s' % self.curfile)
@@ -1578,7 +1605,7 @@ class GUI(QtWidgets.QMainWindow):
             (filename, filefilter) = QtWidgets.QFileDialog.getOpenFileName(self,
                     'Import Game Map File...',
                     path,
-                    'Game Map Files (*.adv);;All Files (*.*)')
+                    'Game Map Files (*.adv *{} *{});;All Files (*.*)'.format(JSON_EXTENSION, SQLITE_EXTENSION))
             if filename and filename != '':
                 try:
                     imported = self.import_maps_from_file(filename)
@@ -1648,6 +1675,14 @@ class GUI(QtWidgets.QMainWindow):
         # Re-focus the main window
         self.activateWindow()
 
+    def closeEvent(self, event):
+        """
+        Writes out anything we've added to our cache before we go
+        """
+        if self.cache is not None:
+            self.cache.flush()
+        super().closeEvent(event)
+
     def action_quit(self):
         """
         Handle our "Quit" action.
@@ -1778,7 +1813,7 @@ class GUI(QtWidgets.QMainWindow):
         Start an undo action.  If `description` is passed in, we will
         also commit the action right away.
         """
-        self.cur_undo = self.scene.mapobj.duplicate()
+        self.cur_undo = self.scene.mapobj.snapshot()
         if description:
             self.finish_undo(description)
 
@@ -1802,9 +1837,10 @@ class GUI(QtWidgets.QMainWindow):
             undo = self.undo.pop()
             self.toolbar.mapcombo.setCurrentIndex(undo.index)
             self.redo.append(UndoAction(undo.index,
-                self.scene.mapobj.duplicate(),
+                self.scene.mapobj.snapshot(),
                 undo.description))
-            self.replace_map(undo.index, undo.mapobj.duplicate())
+            self.scene.mapobj.restore(undo.snapshot)
+            self.set_current_map(undo.index)
             self.scene.recreate()
             self.update_undo_menus()
 
@@ -1816,9 +1852,10 @@ class GUI(QtWidgets.QMainWindow):
             redo = self.redo.pop()
             self.toolbar.mapcombo.setCurrentIndex(redo.index)
             self.undo.append(UndoAction(redo.index,
-                self.scene.mapobj.duplicate(),
+                self.scene.mapobj.snapshot(),
                 redo.description))
-            self.replace_map(redo.index, redo.mapobj.duplicate())
+            self.scene.mapobj.restore(redo.snapshot)
+            self.set_current_map(redo.index)
             self.scene.recreate()
             self.update_undo_menus()
 
@@ -2087,7 +2124,7 @@ class GUIConnectionHover(HoverArea):
         self.setPos(offset_x - Constants.conn_hover_size_half, offset_y - Constants.conn_hover_size_half)
 
         # Set up a hover icon
-        if self.room.get_conn(self.direction) or self.room.get_loopback(self.direction):
+        if self.room.dir_in_use(self.direction):
             use_add_positioning = False
             pixmap = Constants.gfx_hover_edit_conn
         else:
@@ -2126,7 +2163,7 @@ class GUIConnectionHover(HoverArea):
         scene = self.scene()
         scene.hover_start(self)
         self.hover_icon.show()
-        if self.room.get_conn(self.direction) or self.room.get_loopback(self.direction):
+        if self.room.dir_in_use(self.direction):
             self.setBrush(QtGui.QBrush(Constants.c_highlight_modify))
             self.setPen(QtGui.QPen(Constants.c_highlight_modify))
         else:
@@ -5169,6 +5206,12 @@ class MapScene(QtWidgets.QGraphicsScene):
             self.multi_select_actions.add_key_action('H/V', 'toggle horiz/vert offsets',
                     ['h', 'v'], self.multi_toggle_offsets, [[False], [True]],
                     ['Toggle Rooms Horizontal Offset', 'Toggle Rooms Vertical Offset'])
+            self.multi_select_actions.add_key_action('[/]', 'rotate rooms',
+                    ['[', ']'], self.multi_rotate_rooms, [[False], [True]],
+                    ['Rotate Rooms Anticlockwise', 'Rotate Rooms Clockwise'])
+            self.multi_select_actions.add_key_action('M/F', 'mirror/flip rooms',
+                    ['m', 'f'], self.multi_mirror_rooms, [[False], [True]],
+                    ['Mirror Rooms', 'Flip Rooms'])
             self.multi_select_actions.add_key_action('T', 'change types',
                     ['t'], self.multi_change_types, [[]], ['Change Room Types'])
             self.multi_select_actions.add_key_action('R', 'change colors',
@@ -5223,6 +5266,27 @@ class MapScene(QtWidgets.QGraphicsScene):
         else:
             return False
 
+    def multi_rotate_rooms(self, clockwise):
+        """
+        Rotate our selected rooms a quarter turn
+        """
+        if self.mapobj.rotate(self.selected, clockwise):
+            self.recreate()
+            return True
+        else:
+            return False
+
+    def multi_mirror_rooms(self, vertical):
+        """
+        Mirror our selected rooms left-to-right, or flip them top-to-bottom
+        if `vertical` is `True`
+        """
+        if self.mapobj.mirror(self.selected, vertical):
+            self.recreate()
+            return True
+        else:
+            return False
+
     def multi_toggle_offsets(self, vertical=False):
         """
         Toggles x/y offsets on selected rooms, defaulting to horizontal
@@ -5316,13 +5380,7 @@ class MapScene(QtWidgets.QGraphicsScene):
         Groups the selected rooms together into the given
         group.
         """
-        if group:
-            for room in self.selected:
-                group.add_room(room)
-        else:
-            roomlist = list(self.selected)
-            for room in roomlist[1:]:
-                self.mapobj.group_rooms(roomlist[0], room)
+        self.mapobj.group_room_list(self.selected, group)
         self.recreate()
         return True
 
@@ -5368,10 +5426,10 @@ class Application(QtWidgets.QApplication):
     Our main application
     """
 
-    def __init__(self, initfile=None, readonly=False):
+    def __init__(self, initfile=None, readonly=False, cachedir=None):
         """
         Initialization
         """
         
         super().__init__([])
-        self.app = GUI(initfile=initfile, readonly=readonly)
+        self.app = GUI(initfile=initfile, readonly=readonly, cachedir=cachedir)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Adventure Game Mapper
+# Copyright (C) 2010-2022 CJ Kucera
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+import gzip
+import json
+from advmap.file import LoadException, write_atomically
+
+__all__ = [ 'JsonSavefile', 'JSON_EXTENSION', 'JSON_VER' ]
+
+# Filename extension which gets a game saved as gzipped JSON rather than
+# in the binary format.  Loading goes by the gzip magic instead.
+JSON_EXTENSION = '.json.gz'
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Version of the JSON layout itself, which is separate from SAVEFILE_VER
+JSON_VER = 1
+
+class JsonReader(object):
+    """
+    Reads JSON values one at a time from a text stream, so that a big
+    document can be handled in pieces rather than all at once.  This
+    only knows enough to walk through objects and arrays by hand; the
+    values inside them are decoded with the regular `json` module.
+    """
+
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = ''
+        self.pos = 0
+        self.at_eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size):
+        """
+        Reads at least `size` more characters into our buffer (unless we
+        hit the end of the stream).  Returns `False` if there was nothing
+        left to read.
+        """
+        if self.at_eof:
+            return False
+        data = self.stream.read(max(size, self.CHUNK_SIZE))
+        if not data:
+            self.at_eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips any whitespace and returns the next character, without
+        consuming it.  Returns an empty string at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill(self.CHUNK_SIZE):
+                return ''
+
+    def expect(self, chars):
+        """
+        Consumes the next non-whitespace character, which has to be one
+        of `chars`, and returns it.
+        """
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise LoadException('Invalid JSON savefile: expected one of "%s", found "%s"' % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes and returns the next complete JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                # If the value just runs off the end of what we've read so
+                # far, read some more and try again.  Reading at least as
+                # much again as we've already got means that a huge value
+                # only gets retried a handful of times.
+                if self.fill(len(self.buf) - self.pos):
+                    continue
+                raise LoadException('Invalid JSON savefile: {}'.format(e), e)
+            # A number could carry on into data we haven't read yet
+            if end == len(self.buf) and isinstance(value, (int, float)) and self.fill(self.CHUNK_SIZE):
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """
+        Iterates through the key/value pairs of the object which comes
+        next, yielding each key in turn.  The caller then has to consume
+        the value itself (with `value`, or `elements` for an array)
+        before asking for the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise LoadException('Invalid JSON savefile: expected a key, found "%s"' % (key))
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """
+        Iterates through the array which comes next, yielding each of its
+        values in turn.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+class JsonSavefile(object):
+    """
+    A savefile stored as gzipped JSON, as an alternative to our own
+    binary format.  The whole thing is a single JSON object:
+
+        {"format": "advmap", "version": 1, "name": "Game Name", "maps": [
+        {"name": "Map Name", "w": 9, "h": 9, "rooms": [...],
+            "connections": [...], "groups": [...]},
+        ...
+        ]}
+
+    Maps are written out and read back in one at a time, so only a single
+    map's worth of JSON needs to be in memory at once.  Maps are passed
+    in and out in the flat form used by `Map.to_records`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def is_json_filename(filename):
+        """
+        Returns `True` if the given filename should be saved as JSON
+        """
+        return filename.lower().endswith(JSON_EXTENSION)
+
+    @staticmethod
+    def is_json_file(filename):
+        """
+        Returns `True` if the given file looks like a gzipped JSON savefile
+        """
+        with open(filename, 'rb') as df:
+            return df.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+    def write(self, name, maps):
+        """
+        Writes out a game named `name`, where `maps` is an iterable of
+        map records.
+        """
+        def writer(raw):
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as gz:
+                with io.TextIOWrapper(gz, encoding='utf-8') as df:
+                    df.write('{{"format": "advmap", "version": {}, "name": {}, "maps": ['.format(
+                        JSON_VER, json.dumps(name)))
+                    separator = '\n'
+                    for records in maps:
+                        df.write(separator)
+                        df.write(json.dumps(JsonSavefile.map_to_json(records), separators=(',', ':')))
+                        separator = ',\n'
+                    df.write('\n]}\n')
+        write_atomically(self.filename, writer)
+
+    def read(self):
+        """
+        Reads the game, yielding its name followed by the records for
+        each of its maps in turn.  The file stays open until the generator
+        is exhausted or closed.
+        """
+        try:
+            with gzip.open(self.filename, 'rt', encoding='utf-8') as df:
+                reader = JsonReader(df)
+                seen = {}
+                for key in reader.items():
+                    if key == 'maps':
+                        if 'name' not in seen:
+                            raise LoadException('Invalid JSON savefile: "name" must come before "maps"')
+                        for data in reader.elements():
+                            yield JsonSavefile.map_from_json(data)
+                        seen[key] = True
+                        continue
+                    seen[key] = reader.value()
+                    if key == 'format' and seen[key] != 'advmap':
+                        raise LoadException('Invalid Map File specified')
+                    elif key == 'version':
+                        if not isinstance(seen[key], int) or seen[key] > JSON_VER:
+                            raise LoadException('JSON map file is version %s, we can only open versions %d and lower' %
+                                    (seen[key], JSON_VER))
+                    elif key == 'name':
+                        yield seen[key]
+                if reader.peek() != '':
+                    raise LoadException('Invalid JSON savefile: found extra data after the game')
+                for key in ['format', 'version', 'name', 'maps']:
+                    if key not in seen:
+                        raise LoadException('Invalid JSON savefile: missing "%s"' % (key))
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            raise LoadException('Error reading JSON savefile: {}'.format(e), e)
+
+    @staticmethod
+    def map_to_json(records):
+        """
+        Converts a map's records (see `Map.to_records`) to the dict which
+        gets stored in JSON
+        """
+        (name, w, h, room_records, conn_records, group_records) = records
+        rooms = []
+        for (idnum, x, y, room_name, room_type, color, up, down, door_in, door_out,
+                notes, flagbits, loopbackbits) in room_records:
+            rooms.append({
+                'id': idnum, 'x': x, 'y': y, 'name': room_name,
+                'type': room_type, 'color': color,
+                'up': up, 'down': down, 'in': door_in, 'out': door_out, 'notes': notes,
+                'offset_x': (flagbits & 0x2) == 0x2,
+                'offset_y': (flagbits & 0x1) == 0x1,
+                'loopbacks': [direction for direction in range(8) if loopbackbits & (1 << direction)],
+                })
+        conns = []
+        for (record, end_records) in conn_records:
+            (id1, dir1, id2, dir2, passage, symmetric, num_ends1, num_ends2) = record
+            ends = [{'dir': direction, 'type': conn_type, 'render': render_type, 'stub': stub_length}
+                    for (idnum, direction, conn_type, render_type, stub_length) in end_records]
+            conns.append({
+                'room1': id1, 'dir1': dir1, 'room2': id2, 'dir2': dir2,
+                'passage': passage, 'symmetric': symmetric,
+                'ends1': ends[:num_ends1], 'ends2': ends[num_ends1:],
+                })
+        groups = [{'style': style, 'rooms': list(room_ids)}
+                for (style, room_ids) in group_records]
+        return {'name': name, 'w': w, 'h': h,
+                'rooms': rooms, 'connections': conns, 'groups': groups}
+
+    @staticmethod
+    def map_from_json(data):
+        """
+        Converts the dict stored in JSON for a map back to its records
+        (see `Map.to_records`)
+        """
+        try:
+            room_records = []
+            for room in data['rooms']:
+                flagbits = 0
+                if room['offset_x']:
+                    flagbits |= 0x2
+                if room['offset_y']:
+                    flagbits |= 0x1
+                loopbackbits = 0
+                for direction in room['loopbacks']:
+                    loopbackbits |= 1 << direction
+                room_records.append((room['id'], room['x'], room['y'], room['name'],
+                    room['type'], room['color'], room['up'], room['down'],
+                    room['in'], room['out'], room['notes'], flagbits, loopbackbits))
+            conn_records = []
+            for conn in data['connections']:
+                (id1, id2) = (conn['room1'], conn['room2'])
+                end_records = [(id1, end['dir'], end['type'], end['render'], end['stub'])
+                        for end in conn['ends1']]
+                end_records.extend([(id2, end['dir'], end['type'], end['render'], end['stub'])
+                        for end in conn['ends2']])
+                record = (id1, conn['dir1'], id2, conn['dir2'], conn['passage'],
+                        bool(conn['symmetric']), len(conn['ends1']), len(conn['ends2']))
+                conn_records.append((record, end_records))
+            group_records = [(group['style'], tuple(group['rooms'])) for group in data['groups']]
+            return (data['name'], data['w'], data['h'], room_records, conn_records, group_records)
+        except KeyError as e:
+            raise LoadException('Invalid JSON savefile: missing %s' % (e), e)
+        except (TypeError, AttributeError) as e:
+            raise LoadException('Invalid JSON savefile: {}'.format(e), e)
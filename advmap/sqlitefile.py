@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Adventure Game Mapper
+# Copyright (C) 2010-2022 CJ Kucera
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sqlite3
+from advmap.file import LoadException
+
+__all__ = [ 'SqliteSavefile', 'SQLITE_EXTENSION', 'SQLITE_VER' ]
+
+# Filename extension which gets a game saved as an SQLite database rather
+# than in the binary format.  Loading goes by the SQLite magic instead.
+SQLITE_EXTENSION = '.sqlite'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# Version of our database schema, stored as the database's user_version
+SQLITE_VER = 1
+
+SCHEMA = """
+    CREATE TABLE game (
+        name TEXT NOT NULL
+    );
+    CREATE TABLE maps (
+        map INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        w INTEGER NOT NULL,
+        h INTEGER NOT NULL
+    );
+    CREATE TABLE rooms (
+        map INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        type INTEGER NOT NULL,
+        color INTEGER NOT NULL,
+        up TEXT NOT NULL,
+        down TEXT NOT NULL,
+        door_in TEXT NOT NULL,
+        door_out TEXT NOT NULL,
+        notes TEXT NOT NULL,
+        offset_x INTEGER NOT NULL,
+        offset_y INTEGER NOT NULL,
+        loopbacks INTEGER NOT NULL,
+        PRIMARY KEY (map, id)
+    );
+    CREATE INDEX rooms_by_position ON rooms (map, x, y);
+    CREATE INDEX rooms_by_id ON rooms (id);
+    CREATE TABLE connections (
+        map INTEGER NOT NULL,
+        room1 INTEGER NOT NULL,
+        dir1 INTEGER NOT NULL,
+        room2 INTEGER NOT NULL,
+        dir2 INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        passage INTEGER NOT NULL,
+        symmetric INTEGER NOT NULL,
+        PRIMARY KEY (map, room1, dir1)
+    );
+    CREATE TABLE connection_ends (
+        map INTEGER NOT NULL,
+        room1 INTEGER NOT NULL,
+        dir1 INTEGER NOT NULL,
+        side INTEGER NOT NULL,
+        direction INTEGER NOT NULL,
+        room INTEGER NOT NULL,
+        conn_type INTEGER NOT NULL,
+        render_type INTEGER NOT NULL,
+        stub_length INTEGER NOT NULL,
+        PRIMARY KEY (map, room1, dir1, side, direction)
+    );
+    CREATE INDEX connection_ends_by_room ON connection_ends (map, room);
+    CREATE TABLE room_groups (
+        map INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        style INTEGER NOT NULL,
+        PRIMARY KEY (map, seq)
+    );
+    CREATE TABLE room_group_members (
+        map INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        pos INTEGER NOT NULL,
+        room INTEGER NOT NULL,
+        PRIMARY KEY (map, seq, pos)
+    );
+"""
+
+ROOM_COLUMNS = 'id, seq, x, y, name, type, color, up, down, door_in, door_out, notes, offset_x, offset_y, loopbacks'
+
+class SqliteSavefile(object):
+    """
+    A game stored in an SQLite database, as an alternative to our own
+    binary format.  Each map's rooms, connections, connection ends and
+    groups get their own rows (see `SCHEMA`), so other tools can query
+    them directly - `get_room` and `get_room_at` look up a single room
+    without reading anything else.  Maps are identified by their index
+    within the game.  The database is opened as needed; use this as a
+    context manager (or call `close`) to close it again.
+
+    Maps are passed in and out in the flat form used by `Map.to_records`.
+    Writing a map only touches the rows which have actually changed since
+    it was last written, all in a single transaction, so saving a small
+    change to a big game is cheap.  `write_map` does that for just one
+    map, which is the unit the GUI's undo steps work on.
+
+    The order of rooms, connections and groups is kept (in the `seq`
+    columns) so that a game comes back out exactly as it went in.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    @staticmethod
+    def is_sqlite_filename(filename):
+        """
+        Returns `True` if the given filename should be saved as SQLite
+        """
+        return filename.lower().endswith(SQLITE_EXTENSION)
+
+    @staticmethod
+    def is_sqlite_file(filename):
+        """
+        Returns `True` if the given file looks like an SQLite database
+        """
+        with open(filename, 'rb') as df:
+            return df.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+    def open(self, create=False):
+        """
+        Opens our database, creating our tables if `create` is `True` and
+        they don't exist yet.
+        """
+        if self.db is not None:
+            return
+        if not create:
+            # Don't let sqlite create an empty database for a missing file
+            open(self.filename, 'rb').close()
+        try:
+            self.db = sqlite3.connect(self.filename, isolation_level=None)
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version == 0 and create:
+                self.db.executescript('BEGIN; {} PRAGMA user_version = {}; COMMIT;'.format(
+                    SCHEMA, SQLITE_VER))
+            elif version == 0:
+                raise LoadException('Invalid Map File specified')
+            elif version > SQLITE_VER:
+                raise LoadException('Map database is version %d, we can only open versions %d and lower' %
+                        (version, SQLITE_VER))
+        except sqlite3.DatabaseError as e:
+            self.close()
+            raise LoadException('Error reading map database: {}'.format(e), e)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Closes our database
+        """
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def transaction(self):
+        """
+        Returns a context manager wrapping a single transaction, which is
+        rolled back if anything goes wrong inside it.
+        """
+        return Transaction(self.db)
+
+    def write(self, name, maps):
+        """
+        Writes out a game named `name`, where `maps` is an iterable of
+        map records, replacing whatever was in the database before.  This
+        is all one transaction.
+        """
+        opened = self.db is None
+        self.open(create=True)
+        try:
+            with self.transaction():
+                if self.db.execute('UPDATE game SET name = ?', (name,)).rowcount == 0:
+                    self.db.execute('INSERT INTO game (name) VALUES (?)', (name,))
+                num_maps = 0
+                for (index, records) in enumerate(maps):
+                    self._write_map(index, records)
+                    num_maps += 1
+                for table in ['maps', 'rooms', 'connections', 'connection_ends',
+                        'room_groups', 'room_group_members']:
+                    self.db.execute('DELETE FROM {} WHERE map >= ?'.format(table), (num_maps,))
+        finally:
+            if opened:
+                self.close()
+
+    def write_map(self, index, records):
+        """
+        Writes out a single map as the map at `index`, in its own
+        transaction.
+        """
+        self.open(create=True)
+        with self.transaction():
+            self._write_map(index, records)
+
+    @staticmethod
+    def sequence(existing, keys):
+        """
+        Works out the `seq` to store for each of `keys` (in order), given
+        a dict `existing` of the `seq`s they were last stored with.  Rows
+        keep their old `seq` wherever that still puts them in the right
+        order, so adding or removing a row doesn't renumber the rest.
+        """
+        seqs = []
+        last = -1
+        for key in keys:
+            seq = existing.get(key)
+            if seq is None or seq <= last:
+                seq = last + 1
+            seqs.append(seq)
+            last = seq
+        return seqs
+
+    def _write_map(self, index, records):
+        """
+        Writes out a single map as the map at `index`, changing only the
+        rows which differ from what's already there.  Has to be called
+        inside a transaction.
+        """
+        db = self.db
+        (name, w, h, room_records, conn_records, group_records) = records
+
+        row = db.execute('SELECT name, w, h FROM maps WHERE map = ?', (index,)).fetchone()
+        if row is None:
+            db.execute('INSERT INTO maps (map, name, w, h) VALUES (?, ?, ?, ?)', (index, name, w, h))
+        elif row != (name, w, h):
+            db.execute('UPDATE maps SET name = ?, w = ?, h = ? WHERE map = ?', (name, w, h, index))
+
+        # Rooms
+        existing = {}
+        for row in db.execute('SELECT ' + ROOM_COLUMNS + ' FROM rooms WHERE map = ?', (index,)):
+            existing[row[0]] = row
+        seqs = self.sequence({idnum: row[1] for (idnum, row) in existing.items()},
+                [record[0] for record in room_records])
+        inserts = []
+        updates = []
+        for (record, seq) in zip(room_records, seqs):
+            (idnum, x, y, room_name, room_type, color, up, down, door_in, door_out,
+                    notes, flagbits, loopbackbits) = record
+            row = (idnum, seq, x, y, room_name, room_type, color, up, down, door_in,
+                    door_out, notes, (flagbits & 0x2) >> 1, flagbits & 0x1, loopbackbits)
+            old = existing.pop(idnum, None)
+            if old is None:
+                inserts.append((index,) + row)
+            elif old != row:
+                updates.append(row[1:] + (index, idnum))
+        db.executemany('DELETE FROM rooms WHERE map = ? AND id = ?',
+                [(index, idnum) for idnum in existing])
+        db.executemany('UPDATE rooms SET seq = ?, x = ?, y = ?, name = ?, type = ?, color = ?, '
+                'up = ?, down = ?, door_in = ?, door_out = ?, notes = ?, '
+                'offset_x = ?, offset_y = ?, loopbacks = ? WHERE map = ? AND id = ?', updates)
+        db.executemany('INSERT INTO rooms (map, ' + ROOM_COLUMNS + ') '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', inserts)
+
+        # Connections, which are identified by their first primary end,
+        # since no two connections can share that
+        existing = {}
+        for row in db.execute('SELECT room1, dir1, room2, dir2, seq, passage, symmetric '
+                'FROM connections WHERE map = ?', (index,)):
+            existing[row[:2]] = row
+        existing_ends = {}
+        for row in db.execute('SELECT room1, dir1, side, direction, conn_type, render_type, stub_length '
+                'FROM connection_ends WHERE map = ? ORDER BY room1, dir1, side, direction', (index,)):
+            existing_ends.setdefault(row[:2], []).append(row[2:])
+        seqs = self.sequence({key: row[4] for (key, row) in existing.items()},
+                [(record[0], record[1]) for (record, end_records) in conn_records])
+        inserts = []
+        updates = []
+        end_deletes = []
+        end_inserts = []
+        for ((record, end_records), seq) in zip(conn_records, seqs):
+            (id1, dir1, id2, dir2, passage, symmetric, num_ends1, num_ends2) = record
+            key = (id1, dir1)
+            row = (id1, dir1, id2, dir2, seq, passage, int(symmetric))
+            old = existing.pop(key, None)
+            if old is None:
+                inserts.append((index,) + row)
+            elif old != row:
+                updates.append(row[2:] + (index, id1, dir1))
+            ends = sorted([(0 if i < num_ends1 else 1, direction, conn_type, render_type, stub_length)
+                for (i, (idnum, direction, conn_type, render_type, stub_length)) in enumerate(end_records)])
+            old_ends = existing_ends.pop(key, [])
+            if ends != old_ends:
+                if old_ends:
+                    end_deletes.append((index, id1, dir1))
+                for (side, direction, conn_type, render_type, stub_length) in ends:
+                    end_inserts.append((index, id1, dir1, side, direction, (id1, id2)[side],
+                        conn_type, render_type, stub_length))
+        end_deletes.extend([(index,) + key for key in existing_ends])
+        db.executemany('DELETE FROM connections WHERE map = ? AND room1 = ? AND dir1 = ?',
+                [(index,) + key for key in existing])
+        db.executemany('DELETE FROM connection_ends WHERE map = ? AND room1 = ? AND dir1 = ?', end_deletes)
+        db.executemany('UPDATE connections SET room2 = ?, dir2 = ?, seq = ?, passage = ?, symmetric = ? '
+                'WHERE map = ? AND room1 = ? AND dir1 = ?', updates)
+        db.executemany('INSERT INTO connections (map, room1, dir1, room2, dir2, seq, passage, symmetric) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', inserts)
+        db.executemany('INSERT INTO connection_ends (map, room1, dir1, side, direction, room, '
+                'conn_type, render_type, stub_length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', end_inserts)
+
+        # Groups don't have anything to identify them by, and there are
+        # never many of them, so just rewrite them all if anything changed.
+        groups = [(style, tuple(room_ids)) for (style, room_ids) in group_records]
+        if groups != self._read_groups(index):
+            db.execute('DELETE FROM room_groups WHERE map = ?', (index,))
+            db.execute('DELETE FROM room_group_members WHERE map = ?', (index,))
+            db.executemany('INSERT INTO room_groups (map, seq, style) VALUES (?, ?, ?)',
+                    [(index, seq, style) for (seq, (style, room_ids)) in enumerate(groups)])
+            db.executemany('INSERT INTO room_group_members (map, seq, pos, room) VALUES (?, ?, ?, ?)',
+                    [(index, seq, pos, room_id)
+                        for (seq, (style, room_ids)) in enumerate(groups)
+                        for (pos, room_id) in enumerate(room_ids)])
+
+    def _read_groups(self, index):
+        """
+        Returns the group records for the map at `index`
+        """
+        members = {}
+        for (seq, room_id) in self.db.execute('SELECT seq, room FROM room_group_members '
+                'WHERE map = ? ORDER BY seq, pos', (index,)):
+            members.setdefault(seq, []).append(room_id)
+        return [(style, tuple(members.get(seq, ())))
+                for (seq, style) in self.db.execute('SELECT seq, style FROM room_groups '
+                    'WHERE map = ? ORDER BY seq', (index,))]
+
+    @staticmethod
+    def room_record(row):
+        """
+        Converts a row from the `rooms` table (with the columns in
+        `ROOM_COLUMNS`) to a tuple with the fields of a RoomRecord
+        """
+        (idnum, seq, x, y, name, room_type, color, up, down, door_in, door_out,
+                notes, offset_x, offset_y, loopbacks) = row
+        return (idnum, x, y, name, room_type, color, up, down, door_in, door_out,
+                notes, (0x2 if offset_x else 0) | (0x1 if offset_y else 0), loopbacks)
+
+    def read_map(self, index):
+        """
+        Reads the map at `index`, returning its records (see
+        `Map.to_records`), or `None` if there's no such map.
+        """
+        self.open()
+        db = self.db
+        row = db.execute('SELECT name, w, h FROM maps WHERE map = ?', (index,)).fetchone()
+        if row is None:
+            return None
+        (name, w, h) = row
+        room_records = [self.room_record(row) for row in
+                db.execute('SELECT ' + ROOM_COLUMNS + ' FROM rooms WHERE map = ? ORDER BY seq', (index,))]
+        ends = {}
+        for (id1, dir1, side, direction, room, conn_type, render_type, stub_length) in db.execute(
+                'SELECT room1, dir1, side, direction, room, conn_type, render_type, stub_length '
+                'FROM connection_ends WHERE map = ? ORDER BY room1, dir1, side, direction', (index,)):
+            ends.setdefault((id1, dir1), []).append(
+                    (side, (room, direction, conn_type, render_type, stub_length)))
+        conn_records = []
+        for (id1, dir1, id2, dir2, passage, symmetric) in db.execute(
+                'SELECT room1, dir1, room2, dir2, passage, symmetric '
+                'FROM connections WHERE map = ? ORDER BY seq', (index,)):
+            conn_ends = ends.get((id1, dir1), [])
+            num_ends1 = len([side for (side, end) in conn_ends if side == 0])
+            record = (id1, dir1, id2, dir2, passage, bool(symmetric),
+                    num_ends1, len(conn_ends) - num_ends1)
+            conn_records.append((record, [end for (side, end) in conn_ends]))
+        return (name, w, h, room_records, conn_records, self._read_groups(index))
+
+    def read(self):
+        """
+        Reads the game, yielding its name followed by the records for
+        each of its maps in turn.  If the database wasn't already open,
+        it's closed again once the generator is exhausted or closed.
+        """
+        opened = self.db is None
+        self.open()
+        try:
+            row = self.db.execute('SELECT name FROM game').fetchone()
+            if row is None:
+                raise LoadException('Invalid Map File specified')
+            yield row[0]
+            num_maps = self.db.execute('SELECT COUNT(*) FROM maps').fetchone()[0]
+            for index in range(num_maps):
+                records = self.read_map(index)
+                if records is None:
+                    raise LoadException('Map database is missing map %d' % (index))
+                yield records
+        except sqlite3.DatabaseError as e:
+            raise LoadException('Error reading map database: {}'.format(e), e)
+        finally:
+            if opened:
+                self.close()
+
+    def peek(self):
+        """
+        Returns a tuple of the game's name and a list of (name, w, h,
+        num_rooms, num_conns, num_groups) tuples for each map, straight
+        from the database.
+        """
+        opened = self.db is None
+        self.open()
+        try:
+            row = self.db.execute('SELECT name FROM game').fetchone()
+            if row is None:
+                raise LoadException('Invalid Map File specified')
+            maps = self.db.execute("""
+                SELECT name, w, h,
+                    (SELECT COUNT(*) FROM rooms WHERE rooms.map = maps.map),
+                    (SELECT COUNT(*) FROM connections WHERE connections.map = maps.map),
+                    (SELECT COUNT(*) FROM room_groups WHERE room_groups.map = maps.map)
+                FROM maps ORDER BY map""").fetchall()
+            return (row[0], maps)
+        except sqlite3.DatabaseError as e:
+            raise LoadException('Error reading map database: {}'.format(e), e)
+        finally:
+            if opened:
+                self.close()
+
+    def get_room(self, index, idnum):
+        """
+        Returns a tuple with the fields of a RoomRecord for the room with
+        ID `idnum` on the map at `index`, or `None` if there isn't one.
+        """
+        self.open()
+        row = self.db.execute('SELECT ' + ROOM_COLUMNS + ' FROM rooms WHERE map = ? AND id = ?',
+                (index, idnum)).fetchone()
+        if row is None:
+            return None
+        return self.room_record(row)
+
+    def get_room_at(self, index, x, y):
+        """
+        Returns a tuple with the fields of a RoomRecord for the room at
+        (`x`, `y`) on the map at `index`, or `None` if there isn't one.
+        """
+        self.open()
+        row = self.db.execute('SELECT ' + ROOM_COLUMNS + ' FROM rooms WHERE map = ? AND x = ? AND y = ?',
+                (index, x, y)).fetchone()
+        if row is None:
+            return None
+        return self.room_record(row)
+
+class Transaction(object):
+    """
+    Context manager for a single transaction on an SQLite connection
+    which is in autocommit mode
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Compares file size, save time and load time for our binary savefile
+# format against gzipped JSON, across every map in `data/`.  Loads include
+# parsing every map (binary maps are otherwise only parsed on first use),
+# and saves re-encode every map (rather than reusing unchanged data).
+# Run from the top-level project directory:
+#
+#   $ python -m bench.bench_formats
+
+import glob
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+from advmap.data import Game
+from advmap.jsonfile import JSON_EXTENSION
+
+FORMATS = [('binary', '.adv'), ('json', JSON_EXTENSION)]
+
+def load_all(filename):
+    """
+    Loads the given filename, including every map in it
+    """
+    game = Game.load(filename)
+    for mapobj in game.maps:
+        mapobj.materialize()
+    return game
+
+def save_all(game, filename):
+    """
+    Saves the given game, re-encoding every map
+    """
+    for mapobj in game.maps:
+        mapobj.mark_dirty()
+    game.save(filename)
+
+def format_row(label, results):
+    """
+    Formats a row of (size, save time, load time) results, one set per
+    format, with the sizes and times relative to the first (binary) one.
+    """
+    (base_size, base_save, base_load) = results[0]
+    row = '{:<24}'.format(label)
+    for (size, save, load) in results:
+        row += ' {:>8} ({:4.2f}x) {:>7.2f}ms ({:4.2f}x) {:>7.2f}ms ({:4.2f}x)'.format(
+            size, size/base_size, save*1000, save/base_save, load*1000, load/base_load)
+    return row
+
+def main(pattern, number):
+    filenames = sorted(glob.glob(pattern))
+    if not filenames:
+        print('No files found matching {}'.format(pattern))
+        return 1
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        totals = [[0, 0, 0] for f in FORMATS]
+        print('{:<24}'.format('File') + ''.join(
+            ' {:^50}'.format('{}: size / save / load'.format(label)) for (label, ext) in FORMATS))
+        for filename in filenames:
+            game = load_all(filename)
+            results = []
+            for (idx, (label, ext)) in enumerate(FORMATS):
+                target = os.path.join(tmpdir, 'game{}'.format(ext))
+                save = min(timeit.repeat(lambda: save_all(game, target),
+                    number=number, repeat=3)) / number
+                load = min(timeit.repeat(lambda: load_all(target),
+                    number=number, repeat=3)) / number
+                size = os.path.getsize(target)
+                results.append((size, save, load))
+                for (total_idx, value) in enumerate((size, save, load)):
+                    totals[idx][total_idx] += value
+            print(format_row(os.path.basename(filename), results))
+        print(format_row('TOTAL', totals))
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    pattern = os.path.join('data', '*.adv')
+    if len(sys.argv) > 1:
+        pattern = sys.argv[1]
+    sys.exit(main(pattern, 5))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Compares load times for our streaming `Savefile` against the
+# buffer-backed `BufferedSavefile` and `MmapSavefile`, across every map
+# in `data/`.
+# Run from the top-level project directory:
+#
+#   $ python -m bench.bench_load
+
+import glob
+import os
+import sys
+import timeit
+from advmap.data import Game
+from advmap.file import Savefile, BufferedSavefile, MmapSavefile
+
+CLASSES = [Savefile, BufferedSavefile, MmapSavefile]
+
+def load_with(savefile_class, filename):
+    """
+    Loads the given filename using the specified Savefile class
+    """
+    df = savefile_class(filename)
+    df.open_r()
+    game = Game._load(df)
+    df.close()
+    return game
+
+def summarize(game):
+    """
+    Returns a simple summary of a game, to make sure both load paths
+    agree with each other.
+    """
+    return [(m.name, len(m.rooms), len(m.conns), len(m.groups),
+        sorted((r.idnum, r.x, r.y, r.name, r.notes) for r in m.roomlist()))
+        for m in game.maps]
+
+def format_row(label, times, number):
+    """
+    Formats a row of timings, each with its speedup relative to the
+    first (streaming Savefile) column.
+    """
+    return '{:<32}'.format(label) + ''.join(
+        ' {:>9.2f}ms ({:.2f}x)'.format(t*1000/number, times[0]/t) for t in times)
+
+def main(pattern, number):
+    filenames = sorted(glob.glob(pattern))
+    if not filenames:
+        print('No files found matching {}'.format(pattern))
+        return 1
+
+    totals = [0]*len(CLASSES)
+    print('{:<32}'.format('File') + ''.join(
+        ' {:>18}'.format(c.__name__) for c in CLASSES))
+    for filename in filenames:
+        expected = summarize(load_with(Savefile, filename))
+        for savefile_class in CLASSES[1:]:
+            if summarize(load_with(savefile_class, filename)) != expected:
+                print('{}: {} disagrees with Savefile!'.format(filename, savefile_class.__name__))
+                return 1
+        times = []
+        for (idx, savefile_class) in enumerate(CLASSES):
+            elapsed = min(timeit.repeat(lambda: load_with(savefile_class, filename),
+                number=number, repeat=3))
+            totals[idx] += elapsed
+            times.append(elapsed)
+        print(format_row(os.path.basename(filename), times, number))
+    print(format_row('TOTAL', totals, number))
+    return 0
+
+if __name__ == '__main__':
+    pattern = os.path.join('data', '*.adv')
+    if len(sys.argv) > 1:
+        pattern = sys.argv[1]
+    sys.exit(main(pattern, 20))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Measures how much memory our model objects take up, using `tracemalloc`,
+# on large synthetic maps: a full grid of rooms, each connected to its
+# neighbours to the east and south, with every other pair of rooms in a
+# row grouped together.  Reports the bytes allocated per room and per
+# connection while building the map, while duplicating it (as happens for
+# every undo step), and while loading it back from its savefile data.
+# Room text is created up front, so only the objects themselves (and the
+# map's own bookkeeping for them) get counted.
+# Run from the top-level project directory:
+#
+#   $ python -m bench.bench_memory [size ...]
+
+import gc
+import sys
+import tracemalloc
+from advmap.data import Map, DIR_E, DIR_S
+
+def measure(func):
+    """
+    Calls `func`, returning a tuple of its result and the number of bytes
+    it left allocated
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (result, current)
+
+def build_rooms(size, names):
+    """
+    Returns a new `size` x `size` map full of rooms
+    """
+    mapobj = Map('Map')
+    mapobj.set_map_size(size, size)
+    for y in range(size):
+        for x in range(size):
+            mapobj.add_room_at(x, y, names[y*size + x])
+    return mapobj
+
+def connect_rooms(mapobj):
+    """
+    Connects every room in `mapobj` to its neighbours to the east and
+    south, and groups every other pair of rooms in a row
+    """
+    for y in range(mapobj.h):
+        for x in range(mapobj.w):
+            room = mapobj.get_room_at(x, y)
+            if x < mapobj.w - 1:
+                mapobj.connect(room, DIR_E, mapobj.get_room_at(x+1, y))
+            if y < mapobj.h - 1:
+                mapobj.connect(room, DIR_S, mapobj.get_room_at(x, y+1))
+            if x % 4 == 0 and x < mapobj.w - 1:
+                mapobj.group_rooms(room, mapobj.get_room_at(x+1, y))
+    return mapobj
+
+def run(size):
+    """
+    Prints memory usage for a map of the given size
+    """
+    names = ['Room {}'.format(i) for i in range(size*size)]
+    (mapobj, room_bytes) = measure(lambda: build_rooms(size, names))
+    (mapobj, conn_bytes) = measure(lambda: connect_rooms(mapobj))
+    num_rooms = len(mapobj.rooms)
+    num_conns = len(mapobj.conns)
+    (newmap, dup_bytes) = measure(mapobj.duplicate)
+    del newmap
+    data = mapobj.get_savedata()
+    (loaded, load_bytes) = measure(lambda: Map.load_data(data, 12))
+    del loaded
+    print('{:>4}x{:<4} {:>6} rooms {:>6} conns {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+        size, size, num_rooms, num_conns,
+        room_bytes/num_rooms, conn_bytes/num_conns,
+        dup_bytes/num_rooms, load_bytes/num_rooms))
+
+def main(sizes):
+    print('{:<33} {:>9} {:>9} {:>9} {:>9}'.format('Map', 'B/room', 'B/conn', 'dup B/rm', 'load B/rm'))
+    for size in sizes:
+        run(size)
+    return 0
+
+if __name__ == '__main__':
+    sizes = [50, 100, 200]
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(sizes))
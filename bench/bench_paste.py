@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Stress test for pasting large clipboards into nearly full maps.  Each
+# map is a full grid of rooms which is then "opened" (rebuilt from its
+# records, as happens when loading it or undoing an edit), with a square
+# hole cut out of its bottom-right corner and one room in every twenty
+# deleted elsewhere.  We then paste a clipboard the size of the hole,
+# once at the hole itself and once leaving the paste to search for a
+# spot, reporting the time for each paste and the highest room ID in use
+# afterwards.
+# Run from the top-level project directory:
+#
+#   $ python -m bench.bench_paste [size ...]
+
+import sys
+import time
+from advmap.data import Map, Clipboard, DIR_E, DIR_S
+
+def build_map(size):
+    """
+    Returns the records for a new `size` x `size` map full of rooms, each
+    connected to its neighbours to the east and south
+    """
+    mapobj = Map('Map')
+    mapobj.set_map_size(size, size)
+    for y in range(size):
+        for x in range(size):
+            mapobj.add_room_at(x, y, 'Room {}'.format(y*size + x))
+    for y in range(size):
+        for x in range(size):
+            room = mapobj.get_room_at(x, y)
+            if x < size - 1:
+                mapobj.connect(room, DIR_E, mapobj.get_room_at(x+1, y))
+            if y < size - 1:
+                mapobj.connect(room, DIR_S, mapobj.get_room_at(x, y+1))
+    return mapobj.to_records()
+
+def open_map(records, hole):
+    """
+    Rebuilds a map from `records`, and deletes rooms from it to leave a
+    `hole` x `hole` empty space in the bottom-right corner, plus scattered
+    single spaces elsewhere
+    """
+    mapobj = Map.from_records(records)
+    size = mapobj.w
+    for y in range(size):
+        for x in range(size):
+            if (x >= size - hole and y >= size - hole) or (y*size + x) % 20 == 7:
+                mapobj.del_room(mapobj.get_room_at(x, y))
+    return mapobj
+
+def time_paste(records, clip, hole, x, y, repeat):
+    """
+    Returns the fastest time it took to paste `clip` into a freshly-opened
+    map, plus the highest room ID in use after the paste
+    """
+    best = None
+    for i in range(repeat):
+        mapobj = open_map(records, hole)
+        start = time.perf_counter()
+        if not clip.paste(mapobj, x, y):
+            raise Exception('Paste failed')
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, max(mapobj.rooms))
+
+def run(size, repeat):
+    """
+    Prints paste timings for a map of the given size
+    """
+    hole = size // 5
+    records = build_map(size)
+    source = Map.from_records(records)
+    clip = Clipboard()
+    clip.copy(source, set([source.get_room_at(x, y) for y in range(hole) for x in range(hole)]))
+    (at_time, at_max) = time_paste(records, clip, hole, size - hole, size - hole, repeat)
+    (search_time, search_max) = time_paste(records, clip, hole, None, None, repeat)
+    print('{:>4}x{:<4} {:>6} rooms {:>9.2f}ms {:>9.2f}ms {:>8}'.format(
+        size, size, hole*hole, at_time*1000, search_time*1000, max(at_max, search_max)))
+
+def main(sizes):
+    print('{:<23} {:>11} {:>11} {:>8}'.format('Map / pasted', 'at hole', 'searching', 'max ID'))
+    for size in sizes:
+        run(size, 3)
+    return 0
+
+if __name__ == '__main__':
+    sizes = [50, 100, 200]
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(sizes))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import io
+import os
+import shutil
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+from advmap.data import Game, SAVEFILE_VER, DIR_N, DIR_S
+from advmap.batch import load_one, load_many, main
+from advmap.jsonfile import JSON_EXTENSION
+from advmap.sqlitefile import SQLITE_EXTENSION
+
+class BatchTests(unittest.TestCase):
+    """
+    Tests for loading lots of files at once
+    """
+
+    def setUp(self):
+        """
+        Writes out a couple of valid savefiles and one broken one
+        """
+        self.dirname = tempfile.mkdtemp()
+
+        g = Game('First')
+        (idx, m) = g.add_map('Map 1')
+        r1 = m.add_room_at(1, 1, 'Room 1')
+        r2 = m.add_room_at(1, 2, 'Room 2')
+        m.connect(r1, DIR_S, r2, DIR_N)
+        m.add_room_at(2, 2, 'Room 3')
+        m.group_rooms(r1, r2)
+        g.add_map('Map 2')
+        self.first = os.path.join(self.dirname, 'first.adv')
+        g.save(self.first)
+        self.first_json = os.path.join(self.dirname, 'first' + JSON_EXTENSION)
+        g.save(self.first_json)
+        self.first_sqlite = os.path.join(self.dirname, 'first' + SQLITE_EXTENSION)
+        g.save(self.first_sqlite)
+
+        g = Game('Second')
+        self.second = os.path.join(self.dirname, 'second.adv')
+        g.save(self.second)
+
+        self.broken = os.path.join(self.dirname, 'broken.adv')
+        with open(self.broken, 'wb') as df:
+            df.write(b'NOTAMAP')
+
+    def tearDown(self):
+        """
+        Clean up our savefiles
+        """
+        shutil.rmtree(self.dirname)
+
+    def test_load_one(self):
+        """
+        Test loading a single valid file
+        """
+        result = load_one(self.first)
+        self.assertEqual(result.ok(), True)
+        self.assertEqual(result.filename, self.first)
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.info.name, 'First')
+        self.assertEqual(result.info.format, 'binary')
+        self.assertEqual(result.info.version, SAVEFILE_VER)
+        self.assertEqual(len(result.info.maps), 2)
+        self.assertEqual(result.info.maps[0].name, 'Map 1')
+        self.assertEqual(result.info.maps[0].num_rooms, 3)
+        self.assertEqual(result.info.maps[0].num_conns, 1)
+        self.assertEqual(result.info.maps[0].num_groups, 1)
+        self.assertEqual(result.info.maps[1].name, 'Map 2')
+        self.assertEqual(result.info.maps[1].num_rooms, 0)
+
+    def test_load_one_other_formats(self):
+        """
+        Test loading JSON savefiles and SQLite databases
+        """
+        for (filename, format) in [(self.first_json, 'json'), (self.first_sqlite, 'sqlite')]:
+            with self.subTest(format=format):
+                result = load_one(filename)
+                self.assertEqual(result.ok(), True)
+                self.assertEqual(result.info.name, 'First')
+                self.assertEqual(result.info.format, format)
+                self.assertEqual(result.info.version, None)
+                self.assertEqual(len(result.info.maps), 2)
+                self.assertEqual(result.info.maps[0].num_rooms, 3)
+                self.assertEqual(result.info.maps[0].num_conns, 1)
+                self.assertEqual(result.info.maps[0].num_groups, 1)
+
+    def test_load_one_single_pass(self):
+        """
+        Test that loading a file doesn't read it twice just to find out
+        its version
+        """
+        with mock.patch.object(Game, 'peek', side_effect=AssertionError('peeked')):
+            result = load_one(self.first)
+        self.assertEqual(result.ok(), True)
+        self.assertEqual(result.info.version, SAVEFILE_VER)
+
+    def test_load_one_broken(self):
+        """
+        Test loading a file which isn't a savefile
+        """
+        result = load_one(self.broken)
+        self.assertEqual(result.ok(), False)
+        self.assertEqual(result.info, None)
+        self.assertIn('LoadException', result.error)
+
+    def test_load_one_missing(self):
+        """
+        Test loading a file which doesn't exist
+        """
+        result = load_one(os.path.join(self.dirname, 'missing.adv'))
+        self.assertEqual(result.ok(), False)
+        self.assertEqual(result.info, None)
+
+    def test_load_many_serial(self):
+        """
+        Test loading several files in our own process
+        """
+        results = load_many([self.second, self.broken, self.first], max_workers=1)
+        self.assertEqual(len(results), 3)
+        self.assertEqual([r.filename for r in results], [self.second, self.broken, self.first])
+        self.assertEqual([r.ok() for r in results], [True, False, True])
+        self.assertEqual(results[0].info.name, 'Second')
+        self.assertEqual(results[2].info.name, 'First')
+
+    def test_load_many_processes(self):
+        """
+        Test loading several files across a process pool
+        """
+        results = load_many([self.second, self.broken, self.first], max_workers=2)
+        self.assertEqual([r.filename for r in results], [self.second, self.broken, self.first])
+        self.assertEqual([r.ok() for r in results], [True, False, True])
+        self.assertEqual(results[0].info.name, 'Second')
+        self.assertEqual(results[2].info.name, 'First')
+        self.assertEqual(results[2].info.maps[0].num_rooms, 3)
+
+    def test_load_many_empty(self):
+        """
+        Test loading no files at all
+        """
+        self.assertEqual(load_many([]), [])
+
+    def test_main(self):
+        """
+        Test our commandline return codes
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(main(['-j', '1', self.first, self.second]), 0)
+            self.assertEqual(main(['-j', '1', self.first, self.broken]), 1)
+        self.assertIn('broken.adv: ERROR', output.getvalue())
+
+    def test_main_summary_formats(self):
+        """
+        Test that the summary labels each file with its format
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(main(['-j', '1', self.first, self.first_json, self.first_sqlite]), 0)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('{}: v{} "First", 2 maps, 3 rooms, 1 connections, 1 groups ('.format(
+            self.first, SAVEFILE_VER)))
+        self.assertTrue(lines[1].startswith('{}: json "First", 2 maps, 3 rooms, 1 connections, 1 groups ('.format(
+            self.first_json)))
+        self.assertTrue(lines[2].startswith('{}: sqlite "First", 2 maps, 3 rooms, 1 connections, 1 groups ('.format(
+            self.first_sqlite)))
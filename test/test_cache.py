@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from advmap.data import Game, Map, DIR_N, DIR_S
+from advmap.file import Savefile, BufferedSavefile, LoadException
+from advmap import cache
+from advmap.cache import GameCache
+
+class GameCacheTests(unittest.TestCase):
+    """
+    Tests for our on-disk cache of parsed games
+    """
+
+    def setUp(self):
+        """
+        Writes out a savefile, and sets up an empty cache
+        """
+        self.dirname = tempfile.mkdtemp()
+        self.cache = GameCache(os.path.join(self.dirname, 'cache'))
+        self.filename = os.path.join(self.dirname, 'game.adv')
+        self.write_game('Game')
+
+    def tearDown(self):
+        """
+        Clean up after ourselves
+        """
+        shutil.rmtree(self.dirname)
+
+    def write_game(self, name, filename=None):
+        """
+        Writes out a two-map game named `name` to our savefile (or to
+        `filename`, if specified)
+        """
+        if filename is None:
+            filename = self.filename
+        g = Game(name)
+        (idx, m) = g.add_map('Map 1')
+        r1 = m.add_room_at(1, 1, 'Room 1')
+        r2 = m.add_room_at(1, 2, 'Room 2')
+        r2.notes = 'Notes'
+        m.connect(r1, DIR_S, r2, DIR_N)
+        m.group_rooms(r1, r2)
+        g.add_map('Map 2')
+        g.save(filename)
+
+    def read_map_data(self, idx):
+        """
+        Returns the savefile data for map number `idx` in our savefile
+        """
+        with open(self.filename, 'rb') as df:
+            data = df.read()
+        (version, name, num_maps, index) = Game._read_header(BufferedSavefile('', data=data))
+        (map_name, offset, length) = index[idx]
+        return data[offset:offset+length]
+
+    def assert_game(self, game, name='Game'):
+        """
+        Checks that `game` is what `write_game` wrote out
+        """
+        self.assertEqual(game.name, name)
+        self.assertEqual([m.name for m in game.maps], ['Map 1', 'Map 2'])
+        m = game.maps[0]
+        self.assertEqual(len(m.rooms), 2)
+        self.assertEqual(m.get_room_at(1, 2).notes, 'Notes')
+        self.assertEqual(len(m.conns), 1)
+        self.assertEqual(len(m.groups), 1)
+        self.assertEqual(len(game.maps[1].rooms), 0)
+
+    def test_miss_then_hit(self):
+        """
+        The first load should parse the file and store it; the second
+        should come from the cache without parsing anything.
+        """
+        self.assert_game(self.cache.load(self.filename))
+        self.cache.flush()
+        self.assertEqual(os.path.exists(self.cache.entry_filename(self.filename)), True)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            game = self.cache.load(self.filename)
+            self.assertEqual(game.maps[0].is_loaded(), False)
+            self.assert_game(game)
+
+    def test_miss_stays_lazy(self):
+        """
+        A miss shouldn't parse any maps just to cache them; each map gets
+        cached once it's actually used
+        """
+        entry = self.cache.entry_filename(self.filename)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            game = self.cache.load(self.filename)
+        self.assertEqual([m.is_loaded() for m in game.maps], [False, False])
+        self.assertEqual(os.path.exists(entry), False)
+
+        self.assertEqual(len(game.maps[1].rooms), 0)
+        self.assertEqual(os.path.exists(entry), False)
+        self.cache.flush()
+        self.assertEqual(os.path.exists(entry), True)
+        game = self.cache.load(self.filename)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            self.assertEqual(len(game.maps[1].rooms), 0)
+        self.assertEqual(len(game.maps[0].rooms), 2)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            self.assert_game(self.cache.load(self.filename))
+
+    def test_header_read_once(self):
+        """
+        Opening a file should only read its header once, and a hit
+        shouldn't have to read it at all
+        """
+        for count in [1, 0]:
+            with mock.patch.object(Game, '_read_header', wraps=Game._read_header) as read_header:
+                self.assert_game(self.cache.load(self.filename))
+            self.assertEqual(read_header.call_count, count)
+
+    def test_hash_only_on_match(self):
+        """
+        The savefile should only be hashed when storing its entry, or when
+        its path and `file_key` match an entry we've got
+        """
+        with mock.patch.object(cache, 'hash_file', wraps=cache.hash_file) as hash_file:
+            self.assert_game(self.cache.load(self.filename))
+            self.assertEqual(hash_file.call_count, 0)
+            self.cache.flush()
+            self.assertEqual(hash_file.call_count, 1)
+            self.assert_game(self.cache.load(self.filename))
+            self.assertEqual(hash_file.call_count, 2)
+            self.write_game('Changed')
+            self.assert_game(self.cache.load(self.filename), 'Changed')
+            self.assertEqual(hash_file.call_count, 2)
+
+    def test_broken_map(self):
+        """
+        A broken map shouldn't stop the file from opening, or the rest of
+        it from being cached; it only fails once it's used
+        """
+        with open(self.filename, 'rb') as df:
+            data = bytearray(df.read())
+        (version, name, num_maps, index) = Game._read_header(BufferedSavefile('', data=bytes(data)))
+        (map_name, offset, length) = index[0]
+        # Not a LoadException; this comes out of decoding the map's name
+        data[offset+3:offset+length] = b'\xff'*(length-3)
+        with open(self.filename, 'wb') as df:
+            df.write(data)
+
+        game = self.cache.load(self.filename)
+        self.assertEqual(len(game.maps[1].rooms), 0)
+        with self.assertRaises(UnicodeDecodeError):
+            game.maps[0].materialize()
+        game = self.cache.load(self.filename)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            self.assertEqual(len(game.maps[1].rooms), 0)
+        with self.assertRaises(UnicodeDecodeError):
+            game.maps[0].materialize()
+
+    def test_readonly(self):
+        """
+        In readonly mode, maps should stay in the memory-mapped file until
+        they're used, whether or not they came from the cache
+        """
+        game = self.cache.load(self.filename, readonly=True)
+        self.assertEqual([type(m.savedata[1]) for m in game.maps], [memoryview, memoryview])
+        self.assert_game(game)
+        self.assertEqual([m.savedata for m in game.maps], [None, None])
+        self.assertEqual([m.is_dirty() for m in game.maps], [False, False])
+
+        # A hit doesn't open the savefile at all, but its maps can still
+        # find their data there
+        game = self.cache.load(self.filename, readonly=True)
+        self.assertEqual([m.savedata for m in game.maps], [None, None])
+        self.assertEqual([m.is_dirty() for m in game.maps], [False, False])
+        self.assertEqual(game.maps[1].get_savedata(), self.read_map_data(1))
+        self.assert_game(game)
+
+    def test_hit_is_clean(self):
+        """
+        Maps from the cache should still know their savefile data, so
+        saving them back out doesn't change anything
+        """
+        with open(self.filename, 'rb') as df:
+            original = df.read()
+        self.assert_game(self.cache.load(self.filename))
+        game = self.cache.load(self.filename)
+        game.maps[0].materialize()
+        self.assertEqual([m.is_dirty() for m in game.maps], [False, False])
+        game.save(self.filename)
+        with open(self.filename, 'rb') as df:
+            self.assertEqual(df.read(), original)
+
+    def test_hits_are_independent(self):
+        """
+        Changing a game loaded from the cache shouldn't affect the next
+        one loaded from it
+        """
+        self.assert_game(self.cache.load(self.filename))
+        game = self.cache.load(self.filename)
+        game.maps[0].name = 'Renamed'
+        game.maps[0].add_room_at(3, 3, 'Room 3')
+        self.assert_game(self.cache.load(self.filename))
+
+    def test_stale(self):
+        """
+        A file which has changed since it was cached should get parsed
+        again (and re-cached)
+        """
+        self.assert_game(self.cache.load(self.filename))
+        self.write_game('Changed')
+        self.assert_game(self.cache.load(self.filename), 'Changed')
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            self.assert_game(self.cache.load(self.filename), 'Changed')
+
+    def test_same_size_and_mtime(self):
+        """
+        Even if the size and mtime don't change, different contents
+        should be noticed
+        """
+        self.assert_game(self.cache.load(self.filename))
+        self.cache.flush()
+        stat = os.stat(self.filename)
+        with open(self.filename, 'r+b') as df:
+            data = df.read()
+            df.seek(0)
+            df.write(data.replace(b'Game', b'Gxme', 1))
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(cache.file_key(os.stat(self.filename)), cache.file_key(stat))
+        self.assert_game(self.cache.load(self.filename), 'Gxme')
+
+    def test_legacy_version(self):
+        """
+        Files from older savefile versions without a map index get parsed
+        all at once, so the whole game gets cached straight away
+        """
+        df = Savefile(self.filename)
+        df.open_w()
+        df.write(b'ADVMAP')
+        df.writeshort(9)
+        df.writestr('Old')
+        df.writeshort(1)
+        df.writestr('Map')
+        df.writeuchar(4)
+        df.writeuchar(4)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.close()
+        game = self.cache.load(self.filename)
+        self.assertEqual(game.name, 'Old')
+        self.assertEqual(os.path.exists(self.cache.entry_filename(self.filename)), True)
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            game = self.cache.load(self.filename)
+            self.assertEqual((game.name, game.version), ('Old', 9))
+            self.assertEqual(game.maps[0].is_dirty(), True)
+            self.assertEqual((game.maps[0].name, game.maps[0].w), ('Map', 4))
+
+    def test_v10(self):
+        """
+        Files from older savefile versions with a map index get cached
+        as their maps are used, just like current ones, but their maps
+        can't have their data reused
+        """
+        df = Savefile(self.filename)
+        df.open_w()
+        df.write(b'ADVMAP')
+        df.writeshort(10)
+        df.writestr('Old')
+        df.writeshort(2)
+        df.writestr('Map 1')
+        df.writeint(48)
+        df.writeint(16)
+        df.writestr('Map 2')
+        df.writeint(64)
+        df.writeint(16)
+        for name in ['Map 1', 'Map 2']:
+            df.writestr(name)
+            df.writeuchar(4)
+            df.writeuchar(4)
+            df.writeshort(0)
+            df.writeshort(0)
+            df.writeshort(0)
+        df.close()
+        game = self.cache.load(self.filename)
+        self.assertEqual(game.maps[0].w, 4)
+        game = self.cache.load(self.filename)
+        self.assertEqual((game.name, game.version), ('Old', 10))
+        self.assertEqual([m.is_dirty() for m in game.maps], [True, True])
+        with mock.patch.object(Map, 'load', side_effect=AssertionError('parsed')):
+            self.assertEqual(game.maps[0].w, 4)
+        self.assertEqual((game.maps[1].name, game.maps[1].w), ('Map 2', 4))
+
+    def test_changed_before_use(self):
+        """
+        A map from a hit which wasn't cached yet, and whose savefile has
+        changed since, should fail to load rather than read the wrong data
+        """
+        game = self.cache.load(self.filename)
+        self.assertEqual(len(game.maps[1].rooms), 0)
+        game = self.cache.load(self.filename)
+        self.write_game('Changed')
+        with self.assertRaises(LoadException):
+            game.maps[0].materialize()
+
+    def test_corrupt_entry(self):
+        """
+        A cache entry we can't read should just be ignored
+        """
+        self.assert_game(self.cache.load(self.filename))
+        self.cache.flush()
+        with open(self.cache.entry_filename(self.filename), 'wb') as df:
+            df.write(b'garbage')
+        self.assert_game(self.cache.load(self.filename))
+
+    def test_eviction(self):
+        """
+        Once the cache is too big, the least-recently-used entries
+        should be thrown away
+        """
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.dirname, 'game{}.adv'.format(i))
+            self.write_game('Game', filename)
+            self.assert_game(self.cache.load(filename))
+            self.cache.flush()
+            entry = self.cache.entry_filename(filename)
+            os.utime(entry, ns=(i*1000000000, i*1000000000))
+            filenames.append(filename)
+        entry_size = os.path.getsize(self.cache.entry_filename(filenames[0]))
+
+        # Using the first entry makes it the most recent one
+        self.cache.load(filenames[0])
+        self.cache.flush()
+        self.cache.max_bytes = entry_size * 2
+        self.cache.evict()
+        self.assertEqual([os.path.exists(self.cache.entry_filename(f)) for f in filenames],
+                [True, False, True])
+
+    def test_evict_only_when_full(self):
+        """
+        The cache directory should only be scanned once we know how big it
+        is, and after that only once it's too big
+        """
+        with mock.patch.object(self.cache, 'evict', wraps=self.cache.evict) as evict:
+            for i in range(3):
+                filename = os.path.join(self.dirname, 'game{}.adv'.format(i))
+                self.write_game('Game', filename)
+                self.assert_game(self.cache.load(filename))
+                self.cache.flush()
+            self.assertEqual(evict.call_count, 1)
+            entry_size = os.path.getsize(self.cache.entry_filename(filename))
+            self.assertEqual(self.cache.total_bytes, entry_size*3)
+            self.cache.max_bytes = entry_size*3 - 1
+            self.assert_game(self.cache.load(self.filename))
+            self.cache.flush()
+            self.assertEqual(evict.call_count, 2)
+            self.assertLessEqual(self.cache.total_bytes, self.cache.max_bytes)
+
+    def test_flush_once(self):
+        """
+        Using several maps should only write the entry out once
+        """
+        game = self.cache.load(self.filename)
+        with mock.patch.object(self.cache, '_store_entry', wraps=self.cache._store_entry) as store:
+            self.assert_game(game)
+            self.cache.flush()
+            self.cache.flush()
+        self.assertEqual(store.call_count, 1)
+
+    def test_clear(self):
+        """
+        Test clearing the whole cache
+        """
+        self.assert_game(self.cache.load(self.filename))
+        self.cache.flush()
+        self.assertEqual(os.path.exists(self.cache.entry_filename(self.filename)), True)
+        self.cache.clear()
+        self.assertEqual(os.path.exists(self.cache.entry_filename(self.filename)), False)
+
+    def test_json(self):
+        """
+        JSON savefiles get loaded, but not cached
+        """
+        filename = os.path.join(self.dirname, 'game.json.gz')
+        self.write_game('Game', filename)
+        self.assert_game(self.cache.load(filename))
+        self.assertEqual(os.path.exists(self.cache.entry_filename(filename)), False)
@@ -195,6 +195,8 @@ class ClipboardTests(unittest.TestCase):
         """
         self.clip.copy(self.m1, set([self.r1, self.r2, self.r3]))
         self.assertEqual(len(self.clip.conns), 2)
+        # Connections should be in the same order they were on the map
+        self.assertEqual([conn.dir1 for conn in self.clip.conns], [DIR_E, DIR_S])
 
     def test_copy_no_groups(self):
         """
@@ -212,6 +214,20 @@ class ClipboardTests(unittest.TestCase):
         self.assertEqual(self.clip.groups[0][0].style, self.initial_group_style)
         self.assertEqual(len(self.clip.groups[0][1]), 2)
 
+    def test_copy_group_order(self):
+        """
+        Copied groups, and the rooms within them, should be in the same
+        order as they were on the map
+        """
+        self.m1.remove_room_from_group(self.r2)
+        self.m1.group_rooms(self.r3, self.r1)
+        self.m1.group_rooms(self.r3, self.r2)
+        r5 = self.m1.add_room_at(7, 7, 'Room 5')
+        self.m1.group_rooms(self.r4, r5)
+        self.clip.copy(self.m1, set([self.r1, self.r2, self.r3, self.r4, r5]))
+        self.assertEqual([[room.name for room in rooms] for (group, rooms) in self.clip.groups],
+                [['Room 3', 'Room 1', 'Room 2'], ['Room 4', 'Room 5']])
+
     def test_will_fit_empty(self):
         """
         Tests will_fit when we don't have data.
@@ -257,6 +273,100 @@ class ClipboardTests(unittest.TestCase):
         self.clip.copy(self.m1, set([self.r1, self.r2, self.r3, self.r4]))
         self.assertEqual(self.clip.will_fit(self.m1, 90, 90), False)
 
+    def test_get_footprint_single_room(self):
+        """
+        Tests the footprint of a single room
+        """
+        self.clip.copy(self.m1, set([self.r1]))
+        self.assertEqual(self.clip.get_footprint(), [(0, 0, 1, 1)])
+
+    def test_get_footprint_square(self):
+        """
+        Tests the footprint of a full square of rooms, which is one rectangle
+        """
+        self.clip.copy(self.m1, set([self.r1, self.r2, self.r3, self.r4]))
+        self.assertEqual(self.clip.get_footprint(), [(0, 0, 2, 2)])
+
+    def test_get_footprint_diagonal(self):
+        """
+        Tests the footprint of two rooms on a diagonal
+        """
+        self.clip.copy(self.m1, set([self.r2, self.r4]))
+        self.assertEqual(self.clip.get_footprint(), [(1, 0, 1, 1), (0, 1, 1, 1)])
+
+    def test_get_footprint_ring(self):
+        """
+        Tests the footprint of a ring of rooms, with rows that get split
+        and joined back up again
+        """
+        mapobj = Map('Map')
+        rooms = set()
+        for y in range(4):
+            for x in range(4):
+                if x in (0, 3) or y in (0, 3):
+                    rooms.add(mapobj.add_room_at(x+1, y+2, 'Room'))
+        self.clip.copy(mapobj, rooms)
+        self.assertEqual(self.clip.get_footprint(), [
+            (0, 0, 4, 1),
+            (0, 1, 1, 2),
+            (3, 1, 1, 2),
+            (0, 3, 4, 1),
+            ])
+
+    def test_find_spot_no_data(self):
+        """
+        Tests finding a spot when we have no data
+        """
+        self.assertEqual(self.clip.find_spot(self.m2), None)
+
+    def test_find_spot_too_big(self):
+        """
+        Tests finding a spot when we're bigger than the map
+        """
+        self.m2.set_map_size(1, 3)
+        self.clip.copy(self.m1, set([self.r1, self.r2]))
+        self.assertEqual(self.clip.find_spot(self.m2), None)
+
+    def test_find_spot_interlocking(self):
+        """
+        Tests finding a spot where a sparse clipboard fits in between the
+        rooms already on the map, matching what trying `will_fit` at every
+        spot in turn would find
+        """
+        mapobj = Map('Map')
+        mapobj.set_map_size(9, 9)
+        for (x, y) in [(1, 0), (0, 2), (4, 4), (5, 5), (6, 4), (5, 6), (5, 3), (8, 8)]:
+            mapobj.add_room_at(x, y, 'Blocker')
+        source = Map('Source')
+        rooms = set()
+        for y in range(3):
+            for x in range(3):
+                if (x + y) % 2 == 0:
+                    rooms.add(source.add_room_at(x, y, 'Room'))
+        self.clip.copy(source, rooms)
+        expected = None
+        for y in range(mapobj.h - 2):
+            for x in range(mapobj.w - 2):
+                if expected is None and self.clip.will_fit(mapobj, x, y):
+                    expected = (x, y)
+        self.assertEqual(expected, (2, 0))
+        self.assertEqual(self.clip.find_spot(mapobj), expected)
+        mapobj.add_room_at(2, 0, 'Blocker')
+        self.assertEqual(self.clip.find_spot(mapobj), (3, 0))
+
+    def test_find_spot_full_rows(self):
+        """
+        Tests finding a spot below some completely full rows
+        """
+        mapobj = Map('Map')
+        mapobj.set_map_size(5, 5)
+        for y in range(3):
+            for x in range(5):
+                mapobj.add_room_at(x, y, 'Blocker')
+        mapobj.add_room_at(0, 4, 'Blocker')
+        self.clip.copy(self.m1, set([self.r1, self.r2, self.r3, self.r4]))
+        self.assertEqual(self.clip.find_spot(mapobj), (1, 3))
+
     def test_paste_no_data(self):
         """
         Tests pasting when there's nothing to paste
@@ -488,3 +598,18 @@ class ClipboardTests(unittest.TestCase):
         self.assertEqual(len(self.m2.groups), 0)
         self.assertNotEqual(self.m2.get_room_at(0, 1), None)
         self.assertNotEqual(self.m2.get_room_at(1, 1), None)
+
+    def test_paste_undo(self):
+        """
+        Tests that everything a paste adds can be undone (see `Map.restore`)
+        """
+        self.m2.set_map_size(4, 4)
+        self.m2.add_room_at(0, 0, 'Initial Room')
+        records = self.m2.to_records()
+        snapshot = self.m2.snapshot()
+        self.clip.copy(self.m1, set([self.r1, self.r2, self.r3]))
+        self.assertEqual(self.clip.paste(self.m2), True)
+        self.assertEqual(len(self.m2.conns), 2)
+        self.assertEqual(len(self.m2.groups), 1)
+        self.m2.restore(snapshot)
+        self.assertEqual(self.m2.to_records(), records)
@@ -4,7 +4,8 @@
 import unittest
 from advmap.data import ConnectionEnd, Connection, Room
 from advmap.data import DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW
-from advmap.file import Savefile
+from advmap.data import DIR_CW, DIR_CCW
+from advmap.file import Savefile, LoadException
 
 class ConnectionTests(unittest.TestCase):
     """
@@ -2231,18 +2232,18 @@ class ConnectionTests(unittest.TestCase):
         df = self.getSavefile()
         self.c.save(df)
         df.seek(0)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readuchar(), DIR_N)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readuchar(), DIR_S)
-        self.assertEqual(df.readuchar(), Connection.PASS_TWOWAY)
-        self.assertEqual(df.readuchar(), 1)
-        self.assertEqual(df.readuchar(), 1)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), DIR_N)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), DIR_S)
+        self.assertEqual(df.readvarint(), Connection.PASS_TWOWAY)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 1)
         self.assertEqual(df.readuchar(), DIR_N)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.STUB_REGULAR)
-        self.assertEqual(df.readuchar(), 1)
+        self.assertEqual(df.readvarint(), 1)
         self.assertEqual(df.readuchar(), DIR_S)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
@@ -2260,18 +2261,18 @@ class ConnectionTests(unittest.TestCase):
         df = self.getSavefile()
         self.c.save(df)
         df.seek(0)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readuchar(), DIR_N)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readuchar(), DIR_S)
-        self.assertEqual(df.readuchar(), Connection.PASS_TWOWAY)
-        self.assertEqual(df.readuchar(), 0)
-        self.assertEqual(df.readuchar(), 1)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), DIR_N)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), DIR_S)
+        self.assertEqual(df.readvarint(), Connection.PASS_TWOWAY)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), 1)
         self.assertEqual(df.readuchar(), DIR_N)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_MIDPOINT_A)
         self.assertEqual(df.readuchar(), ConnectionEnd.STUB_REGULAR)
-        self.assertEqual(df.readuchar(), 1)
+        self.assertEqual(df.readvarint(), 1)
         self.assertEqual(df.readuchar(), DIR_S)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_LADDER)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_MIDPOINT_A)
@@ -2291,13 +2292,13 @@ class ConnectionTests(unittest.TestCase):
         df = self.getSavefile()
         self.c.save(df)
         df.seek(0)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readuchar(), DIR_N)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readuchar(), DIR_S)
-        self.assertEqual(df.readuchar(), Connection.PASS_TWOWAY)
-        self.assertEqual(df.readuchar(), 1)
-        self.assertEqual(df.readuchar(), 2)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), DIR_N)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), DIR_S)
+        self.assertEqual(df.readvarint(), Connection.PASS_TWOWAY)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
         self.assertEqual(df.readuchar(), DIR_N)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
@@ -2306,7 +2307,7 @@ class ConnectionTests(unittest.TestCase):
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.STUB_REGULAR)
-        self.assertEqual(df.readuchar(), 2)
+        self.assertEqual(df.readvarint(), 2)
         self.assertEqual(df.readuchar(), DIR_S)
         self.assertEqual(df.readuchar(), ConnectionEnd.CONN_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
@@ -2316,3 +2317,213 @@ class ConnectionTests(unittest.TestCase):
         self.assertEqual(df.readuchar(), ConnectionEnd.RENDER_REGULAR)
         self.assertEqual(df.readuchar(), ConnectionEnd.STUB_REGULAR)
         self.assertEqual(df.eof(), True)
+
+    def test_skip(self):
+        """
+        Test skipping over a saved connection with extra ends
+        """
+        self.c.connect_extra(self.r1, DIR_NE)
+        df = self.getSavefile()
+        self.c.save(df)
+        df.writeuchar(42)
+        df.seek(0)
+        Connection.skip(df, 12)
+        self.assertEqual(df.readuchar(), 42)
+        self.assertEqual(df.eof(), True)
+
+    def test_skip_v5(self):
+        """
+        Test skipping over a pre-v7 connection
+        """
+        df = self.getSavefile()
+        df.writeshort(1)
+        df.writeuchar(DIR_N)
+        df.writeshort(2)
+        df.writeuchar(DIR_S)
+        for i in range(4):
+            df.writeuchar(0)
+        df.writeuchar(42)
+        df.seek(0)
+        Connection.skip(df, 5)
+        self.assertEqual(df.readuchar(), 42)
+        self.assertEqual(df.eof(), True)
+
+    def test_read_record_v4_midpoint_fix(self):
+        """
+        Reading a pre-v7 connection should fill in both primary ends from
+        the shared attributes, and pre-v9 connections get their midpoint
+        render types swapped when the room IDs are "backwards."
+        """
+        df = self.getSavefile()
+        df.writeshort(2)
+        df.writeuchar(DIR_S)
+        df.writeshort(1)
+        df.writeuchar(DIR_N)
+        df.writeuchar(ConnectionEnd.CONN_LADDER)
+        df.writeuchar(Connection.PASS_ONEWAY_A)
+        df.writeuchar(ConnectionEnd.RENDER_MIDPOINT_A)
+        df.seek(0)
+        (record, ends) = Connection.read_record(df, 4)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(record, (2, DIR_S, 1, DIR_N, Connection.PASS_ONEWAY_A, True, 1, 1))
+        self.assertEqual(ends, [
+            (2, DIR_S, ConnectionEnd.CONN_LADDER, ConnectionEnd.RENDER_MIDPOINT_B, ConnectionEnd.STUB_REGULAR),
+            (1, DIR_N, ConnectionEnd.CONN_LADDER, ConnectionEnd.RENDER_MIDPOINT_B, ConnectionEnd.STUB_REGULAR),
+            ])
+
+    def test_from_record(self):
+        """
+        Test building a connection straight out of the savefile tuples
+        """
+        r1 = Room(1, 1, 1)
+        r2 = Room(2, 2, 2)
+        record = (1, DIR_N, 2, DIR_S, Connection.PASS_ONEWAY_B, False, 2, 1)
+        ends = [
+                (1, DIR_N, ConnectionEnd.CONN_LADDER, ConnectionEnd.RENDER_MIDPOINT_A, 2),
+                (1, DIR_NE, ConnectionEnd.CONN_DOTTED, ConnectionEnd.RENDER_REGULAR, 3),
+                (2, DIR_S, ConnectionEnd.CONN_REGULAR, ConnectionEnd.RENDER_MIDPOINT_B, 1),
+                ]
+        c = Connection.from_record(r1, r2, record, ends)
+        self.assertEqual(c.r1, r1)
+        self.assertEqual(c.dir1, DIR_N)
+        self.assertEqual(c.r2, r2)
+        self.assertEqual(c.dir2, DIR_S)
+        self.assertEqual(c.passage, Connection.PASS_ONEWAY_B)
+        self.assertEqual(c.symmetric, False)
+        self.assertEqual(sorted(c.ends1.keys()), [DIR_N, DIR_NE])
+        self.assertEqual(list(c.ends2.keys()), [DIR_S])
+        self.assertEqual(c.ends1[DIR_N].room, r1)
+        self.assertEqual(c.ends1[DIR_N].render_type, ConnectionEnd.RENDER_MIDPOINT_A)
+        self.assertEqual(c.ends1[DIR_N].stub_length, 2)
+        self.assertEqual(c.ends1[DIR_NE].conn_type, ConnectionEnd.CONN_DOTTED)
+        self.assertEqual(c.ends2[DIR_S].room, r2)
+        self.assertEqual(c.ends2[DIR_S].render_type, ConnectionEnd.RENDER_MIDPOINT_B)
+        self.assertIs(r1.conns[DIR_N], c)
+        self.assertIs(r1.conns[DIR_NE], c)
+        self.assertIs(r2.conns[DIR_S], c)
+
+    def test_from_record_missing_primary_ends(self):
+        """
+        The primary ends should always exist, even if the data didn't
+        include them
+        """
+        r1 = Room(1, 1, 1)
+        r2 = Room(2, 2, 2)
+        c = Connection.from_record(r1, r2, (1, DIR_N, 2, DIR_S, 0, True, 0, 0), [])
+        self.assertEqual(list(c.ends1.keys()), [DIR_N])
+        self.assertEqual(list(c.ends2.keys()), [DIR_S])
+        self.assertIs(r1.conns[DIR_N], c)
+        self.assertIs(r2.conns[DIR_S], c)
+
+    def test_from_record_invalid_direction(self):
+        """
+        Directions which don't exist should be caught
+        """
+        r1 = Room(1, 1, 1)
+        r2 = Room(2, 2, 2)
+        with self.assertRaises(LoadException) as cm:
+            Connection.from_record(r1, r2, (1, 12, 2, DIR_S, 0, True, 1, 0), [(1, 12, 0, 0, 1)])
+        self.assertIn('invalid direction', cm.exception.text)
+
+    def test_to_record(self):
+        """
+        Test describing ourselves in the same form that `read_record`
+        returns, and building a connection back up out of that
+        """
+        r1 = Room(1, 1, 1)
+        r2 = Room(2, 2, 2)
+        c = Connection(r2, DIR_S, r1, DIR_N, passage=Connection.PASS_ONEWAY_A)
+        c.connect_extra(r1, DIR_NE)
+        c.symmetric = False
+        c.set_ladder(r2, DIR_S)
+        c.set_stub_length(r1, DIR_NE, 3)
+        (record, ends) = c.to_record()
+        self.assertEqual(record, (2, DIR_S, 1, DIR_N, Connection.PASS_ONEWAY_A, False, 1, 2))
+        self.assertEqual(ends, [
+            (2, DIR_S, ConnectionEnd.CONN_LADDER, ConnectionEnd.RENDER_REGULAR, 1),
+            (1, DIR_N, ConnectionEnd.CONN_REGULAR, ConnectionEnd.RENDER_REGULAR, 1),
+            (1, DIR_NE, ConnectionEnd.CONN_REGULAR, ConnectionEnd.RENDER_REGULAR, 3),
+            ])
+
+        r3 = Room(1, 1, 1)
+        r4 = Room(2, 2, 2)
+        c2 = Connection.from_record(r4, r3, record, ends)
+        self.assertEqual(c2.to_record(), (record, ends))
+
+    def test_remap_directions(self):
+        """
+        Changing the directions on just one of our rooms
+        """
+        r1 = Room(1, 0, 0)
+        r2 = Room(2, 1, 0)
+        c = r1.connect(DIR_E, r2)
+        c.connect_extra(r1, DIR_N)
+        c.remap_directions(r1, DIR_CW)
+        self.assertEqual((c.dir1, c.dir2), (DIR_S, DIR_W))
+        self.assertEqual(sorted(c.ends1.keys()), [DIR_E, DIR_S])
+        for (direction, end) in c.ends1.items():
+            self.assertEqual(end.direction, direction)
+        self.assertEqual(list(c.ends2.keys()), [DIR_W])
+
+    def test_remap_directions_loopback_room(self):
+        """
+        Changing directions on a connection between a room and itself
+        changes both ends
+        """
+        r1 = Room(1, 0, 0)
+        c = r1.connect(DIR_E, r1, DIR_N)
+        c.remap_directions(r1, DIR_CCW)
+        self.assertEqual((c.dir1, c.dir2), (DIR_N, DIR_W))
+        self.assertEqual(list(c.ends1.keys()), [DIR_N])
+        self.assertEqual(list(c.ends2.keys()), [DIR_W])
+
+    def test_get_record(self):
+        """
+        Our record is kept around until we change
+        """
+        r1 = Room(1, 0, 0)
+        r2 = Room(2, 1, 0)
+        c = r1.connect(DIR_E, r2)
+        c.connect_extra(r1, DIR_N)
+        (record, ends) = c.to_record()
+        kept = c.get_record()
+        self.assertEqual(kept, (record, tuple(ends)))
+        self.assertIs(c.get_record(), kept)
+        c.forget_record()
+        self.assertIsNot(c.get_record(), kept)
+        self.assertEqual(c.get_record(), kept)
+
+    def test_get_record_after_changes(self):
+        """
+        Anything which changes us has to throw away our old record
+        """
+        changes = [
+                ('set_symmetric', lambda c, r1, r2: c.set_symmetric(False)),
+                ('toggle_symmetric', lambda c, r1, r2: c.toggle_symmetric()),
+                ('connect_extra', lambda c, r1, r2: c.connect_extra(r1, DIR_S)),
+                ('move_end', lambda c, r1, r2: c.move_end(r2, DIR_W, r2, DIR_SW)),
+                ('set_primary', lambda c, r1, r2: c.set_primary(r1, DIR_N)),
+                ('set_ladder', lambda c, r1, r2: c.set_ladder(r1, DIR_E)),
+                ('set_dotted', lambda c, r1, r2: c.set_dotted(r1, DIR_E)),
+                ('cycle_conn_type', lambda c, r1, r2: c.cycle_conn_type(r1, DIR_E)),
+                ('cycle_render_type', lambda c, r1, r2: c.cycle_render_type(r1, DIR_E)),
+                ('set_stub_length', lambda c, r1, r2: c.set_stub_length(r1, DIR_E, 3)),
+                ('increment_stub_length', lambda c, r1, r2: c.increment_stub_length(r1, DIR_E)),
+                ('cycle_passage', lambda c, r1, r2: c.cycle_passage()),
+                ('set_oneway_b', lambda c, r1, r2: c.set_oneway_b()),
+                ('remap_directions', lambda c, r1, r2: c.remap_directions(r1, DIR_CW)),
+                ('detach', lambda c, r1, r2: r1.detach(DIR_N)),
+                ]
+        for (name, change) in changes:
+            with self.subTest(change=name):
+                r1 = Room(1, 0, 0)
+                r2 = Room(2, 1, 0)
+                c = r1.connect(DIR_E, r2)
+                c.connect_extra(r1, DIR_N)
+                c.set_regular(r1, DIR_E)
+                c.set_twoway()
+                before = c.get_record()
+                change(c, r1, r2)
+                (record, ends) = c.to_record()
+                self.assertNotEqual((record, tuple(ends)), before)
+                self.assertEqual(c.get_record(), (record, tuple(ends)))
@@ -2,7 +2,7 @@
 # vim: set expandtab tabstop=4 shiftwidth=4:
 
 import unittest
-from advmap.data import ConnectionEnd, Room
+from advmap.data import ConnectionEnd, Room, Connection, Group
 from advmap.data import DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW
 from advmap.file import Savefile
 
@@ -81,6 +81,40 @@ class ConnectionEndTests(unittest.TestCase):
         self.assertEqual(ce2.render_type, ConnectionEnd.RENDER_MIDPOINT_A)
         self.assertEqual(ce2.stub_length, 2)
 
+    def test_shared_style(self):
+        """
+        Ends with the same attributes should share one style tuple, and
+        changing one end shouldn't affect the others
+        """
+        r = Room(1, 1, 1)
+        ce = ConnectionEnd(r, DIR_N, conn_type=ConnectionEnd.CONN_DOTTED, stub_length=2)
+        ce2 = ConnectionEnd(r, DIR_S, conn_type=ConnectionEnd.CONN_DOTTED, stub_length=2)
+        self.assertEqual(ce.style, (ConnectionEnd.CONN_DOTTED, ConnectionEnd.RENDER_REGULAR, 2))
+        self.assertIs(ce.style, ce2.style)
+        self.assertIs(ce.copy_with_new_room(r).style, ce.style)
+        ce2.set_ladder()
+        ce2.increment_stub_length()
+        self.assertEqual(ce.conn_type, ConnectionEnd.CONN_DOTTED)
+        self.assertEqual(ce.stub_length, 2)
+        self.assertEqual(ce2.conn_type, ConnectionEnd.CONN_LADDER)
+        self.assertEqual(ce2.stub_length, 3)
+        self.assertIs(ce2.style, ConnectionEnd(r, DIR_E,
+            conn_type=ConnectionEnd.CONN_LADDER, stub_length=3).style)
+
+    def test_slots(self):
+        """
+        Our model objects shouldn't carry a per-instance dict around
+        """
+        r = Room(1, 1, 1)
+        r2 = Room(2, 2, 2)
+        conn = Connection(r, DIR_N, r2, DIR_S)
+        group = Group(r, r2)
+        for obj in [r, conn, conn.ends1[DIR_N], group]:
+            with self.subTest(obj=obj):
+                self.assertEqual(hasattr(obj, '__dict__'), False)
+                with self.assertRaises(AttributeError):
+                    obj.unknown_attribute = True
+
     def test_set_regular(self):
         """
         Make sure we can set to regular
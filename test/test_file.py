@@ -5,7 +5,8 @@ import io
 import os
 import tempfile
 import unittest
-from advmap.file import Savefile, LoadException
+from struct import Struct
+from advmap.file import Savefile, BufferedSavefile, MmapSavefile, LoadException
 
 class LoadExceptionTests(unittest.TestCase):
     """
@@ -291,7 +292,7 @@ class SavefileTests(unittest.TestCase):
         df = self.get_in_memory()
         df.close()
         for func in [df.readchar, df.readuchar, df.readshort, df.readint,
-                df.readfloat, df.readstr]:
+                df.readfloat, df.readstr, df.readvarint, df.readvarstr]:
             with self.subTest(func=func):
                 with self.assertRaises(IOError) as cm:
                     func()
@@ -304,7 +305,7 @@ class SavefileTests(unittest.TestCase):
         df = self.get_in_memory()
         df.close()
         for func in [df.writechar, df.writeuchar, df.writeshort, df.writeint,
-                df.writefloat, df.writestr]:
+                df.writefloat, df.writestr, df.writevarint, df.writevarstr]:
             with self.subTest(func=func):
                 with self.assertRaises(IOError) as cm:
                     func(3)
@@ -417,3 +418,462 @@ class SavefileTests(unittest.TestCase):
         df.seek(0)
         self.assertEqual(df.readstr(), '')
         self.assertEqual(df.tell(), 3)
+
+    def test_read_write_varint(self):
+        """
+        Tests reading and writing varints of various sizes
+        """
+        df = self.get_in_memory()
+        df.writevarint(0)
+        df.writevarint(127)
+        df.writevarint(128)
+        df.writevarints(300, 65536, 2**40)
+        self.assertEqual(df.tell(), 1+1+2+2+3+6)
+        df.seek(0)
+        self.assertEqual(df.read(4), b'\x00\x7f\x80\x01')
+        df.seek(0)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), 127)
+        self.assertEqual(df.readvarint(), 128)
+        self.assertEqual(df.readvarints(3), [300, 65536, 2**40])
+        self.assertEqual(df.eof(), True)
+
+    def test_write_varint_negative(self):
+        """
+        Tests writing a negative varint, which we don't support
+        """
+        df = self.get_in_memory()
+        with self.assertRaises(IOError) as cm:
+            df.writevarint(-1)
+        self.assertIn('Cannot write negative value', str(cm.exception))
+
+    def test_read_varint_not_complete(self):
+        """
+        Tests a varint which is cut off by the end of the file
+        """
+        df = self.get_in_memory()
+        df.write(b'\x80\x80')
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            df.readvarint()
+        self.assertIn('Error reading varint', cm.exception.text)
+
+    def test_read_write_varstr(self):
+        """
+        Tests reading and writing varint-prefixed strings, including one
+        longer than `writestr` allows
+        """
+        df = self.get_in_memory()
+        df.writevarstr('Testing')
+        self.assertEqual(df.tell(), 8)
+        df.writevarstr('')
+        df.writevarstr('a'*70000)
+        df.seek(0)
+        self.assertEqual(df.readvarstr(), 'Testing')
+        self.assertEqual(df.readvarstr(), '')
+        self.assertEqual(df.readvarstr(), 'a'*70000)
+        self.assertEqual(df.eof(), True)
+
+    def test_read_write_varbytes(self):
+        """
+        Tests reading and writing varint-prefixed strings as raw bytes
+        """
+        df = self.get_in_memory()
+        df.writevarbytes(b'\xff\xfe')
+        df.writevarstr('Ünïcödé')
+        df.writevarbytes(b'')
+        df.seek(0)
+        self.assertEqual(df.readvarbytes(), b'\xff\xfe')
+        self.assertEqual(df.readvarbytes(), 'Ünïcödé'.encode('utf-8'))
+        self.assertEqual(df.readvarbytes(), b'')
+        self.assertEqual(df.eof(), True)
+
+    def test_read_varstr_not_complete(self):
+        """
+        Tests a truncated varstr that's shorter than we expect it to be.
+        """
+        df = self.get_in_memory()
+        df.writevarint(10)
+        df.write(b'hi')
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            df.readvarstr()
+        self.assertIn('Error reading string, expected 10, read 2', cm.exception.text)
+
+    def test_skip(self):
+        """
+        Tests skipping over raw data and strings
+        """
+        df = self.get_in_memory()
+        df.write(b'abc')
+        df.writestr('Testing')
+        df.writevarstr('Testing')
+        df.writeuchar(42)
+        df.seek(0)
+        df.skip(3)
+        df.skipstr()
+        df.skipvarstr()
+        self.assertEqual(df.readuchar(), 42)
+        self.assertEqual(df.eof(), True)
+
+class BufferedSavefileTests(unittest.TestCase):
+    """
+    Tests of our BufferedSavefile object, which decodes out of an
+    in-memory copy of the file.
+    """
+
+    def get_buffered(self, populate):
+        """
+        Writes out data to an in-memory Savefile using the `populate`
+        function, and returns a BufferedSavefile wrapped around the result.
+        """
+        df = Savefile('', in_memory=True)
+        populate(df)
+        return BufferedSavefile('', data=df.df.getvalue())
+
+    def test_initialization_filename(self):
+        """
+        Tests initialization with a filename
+        """
+        df = BufferedSavefile('filename')
+        self.assertEqual(df.filename, 'filename')
+        self.assertEqual(df.buf, None)
+        self.assertEqual(df.opened_r, False)
+        self.assertEqual(df.opened_w, False)
+
+    def test_initialization_data(self):
+        """
+        Tests initialization with existing data
+        """
+        df = BufferedSavefile('', data=b'hello')
+        self.assertEqual(df.opened_r, True)
+        self.assertEqual(df.read(), b'hello')
+        self.assertEqual(df.eof(), True)
+
+    def test_open_r_and_close(self):
+        """
+        Tests opening a real file, which should get read into memory
+        """
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(filename, 'wb') as odf:
+                odf.write(b'0123456789')
+            df = BufferedSavefile(filename)
+            df.open_r()
+            self.assertEqual(df.opened_r, True)
+            with self.assertRaises(IOError) as cm:
+                df.open_r()
+            self.assertIn('File is already open', str(cm.exception))
+            self.assertEqual(df.read(3), b'012')
+            df.close()
+            self.assertEqual(df.opened_r, False)
+            self.assertEqual(df.buf, None)
+        finally:
+            os.unlink(filename)
+
+    def test_initialization_in_memory(self):
+        """
+        Tests initialization in-memory
+        """
+        df = BufferedSavefile('', in_memory=True)
+        self.assertEqual(df.opened_r, True)
+        self.assertEqual(df.opened_w, True)
+        df.write(b'hello')
+        self.assertEqual(df.tell(), 5)
+        self.assertEqual(df.getvalue(), b'hello')
+        df.seek(0)
+        self.assertEqual(df.read(), b'hello')
+        df.close()
+        self.assertEqual(df.opened_r, False)
+        self.assertEqual(df.opened_w, False)
+
+    def test_open_w_and_close(self):
+        """
+        Tests writing to a real file.  Nothing should hit the disk
+        until we close, and the file should keep its existing permissions.
+        """
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(filename, 'wb') as odf:
+                odf.write(b'original')
+            os.chmod(filename, 0o640)
+            df = BufferedSavefile(filename)
+            df.open_w()
+            self.assertEqual(df.opened_w, True)
+            with self.assertRaises(IOError) as cm:
+                df.open_w()
+            self.assertIn('File is already open', str(cm.exception))
+            df.write(b'new data')
+            with open(filename, 'rb') as odf:
+                self.assertEqual(odf.read(), b'original')
+            df.close()
+            self.assertEqual(df.opened_w, False)
+            with open(filename, 'rb') as odf:
+                self.assertEqual(odf.read(), b'new data')
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+            self.assertEqual(os.listdir(os.path.dirname(filename)).count(
+                os.path.basename(filename)), 1)
+        finally:
+            os.unlink(filename)
+
+    def test_write_values(self):
+        """
+        Tests writing all our basic datatypes; the result should be identical
+        to what a regular Savefile writes.
+        """
+        layout = Struct('<HBB')
+        def populate(df):
+            df.writechar(-4)
+            df.writeuchar(230)
+            df.writeshort(65500)
+            df.writeint(4294967200)
+            df.writefloat(123.456)
+            df.writestr('Testing')
+            df.writestr('')
+            df.writestr('Ünïcödé')
+            df.writestruct(layout, 1000, 2, 3)
+            df.writevarint(300)
+            df.writevarints(0, 2**40)
+            df.writevarstr('Ünïcödé')
+        orig = Savefile('', in_memory=True)
+        populate(orig)
+        df = BufferedSavefile('', in_memory=True)
+        populate(df)
+        self.assertEqual(df.getvalue(), orig.df.getvalue())
+        self.assertEqual(df.tell(), len(df.getvalue()))
+
+    def test_write_str_too_long(self):
+        """
+        Tests writing a string too long for our string encoding method
+        """
+        df = BufferedSavefile('', in_memory=True)
+        with self.assertRaises(IOError) as cm:
+            df.writestr('a'*65536)
+        self.assertIn('Maximum string length is currently 65535', str(cm.exception))
+
+    def test_seek_and_tell(self):
+        """
+        Tests seeking around the buffer
+        """
+        df = BufferedSavefile('', data=b'0123456789')
+        df.seek(5)
+        self.assertEqual(df.tell(), 5)
+        self.assertEqual(df.read(1), b'5')
+        df.seek(-2, os.SEEK_CUR)
+        self.assertEqual(df.read(1), b'4')
+        df.seek(-3, os.SEEK_END)
+        self.assertEqual(df.read(1), b'7')
+        self.assertEqual(df.eof(), False)
+        self.assertEqual(df.read(10), b'89')
+        self.assertEqual(df.eof(), True)
+
+    def test_read_values(self):
+        """
+        Tests reading all our basic datatypes
+        """
+        def populate(df):
+            df.writechar(-4)
+            df.writeuchar(230)
+            df.writeshort(65500)
+            df.writeint(4294967200)
+            df.writefloat(123.456)
+            df.writestr('Testing')
+            df.writestr('')
+            df.writestr('Ünïcödé')
+            df.writevarints(127, 128, 2**40)
+            df.writevarstr('')
+            df.writevarstr('Ünïcödé')
+            df.writevarbytes(b'\xff')
+        df = self.get_buffered(populate)
+        self.assertEqual(df.readchar(), -4)
+        self.assertEqual(df.readuchar(), 230)
+        self.assertEqual(df.readshort(), 65500)
+        self.assertEqual(df.readint(), 4294967200)
+        self.assertAlmostEqual(df.readfloat(), 123.456)
+        self.assertEqual(df.tell(), 16)
+        self.assertEqual(df.readstr(), 'Testing')
+        self.assertEqual(df.readstr(), '')
+        self.assertEqual(df.readstr(), 'Ünïcödé')
+        self.assertEqual(df.readvarint(), 127)
+        self.assertEqual(df.readvarints(2), [128, 2**40])
+        self.assertEqual(df.readvarstr(), '')
+        self.assertEqual(df.readvarstr(), 'Ünïcödé')
+        self.assertEqual(df.readvarbytes(), b'\xff')
+        self.assertEqual(df.eof(), True)
+
+    def test_readvarbytes(self):
+        """
+        Long strings should come back as views of our buffer rather than
+        copies, but short ones shouldn't
+        """
+        long_text = 'Ünïcödé'.encode('utf-8') * BufferedSavefile.VIEW_MIN_LENGTH
+        def populate(df):
+            df.writevarbytes(b'Short')
+            df.writevarbytes(long_text)
+        df = self.get_buffered(populate)
+        short = df.readvarbytes()
+        self.assertEqual(type(short), bytes)
+        self.assertEqual(short, b'Short')
+        view = df.readvarbytes()
+        self.assertEqual(type(view), memoryview)
+        self.assertEqual(view.readonly, True)
+        self.assertEqual(view, long_text)
+        self.assertEqual(df.eof(), True)
+
+    def test_readstruct(self):
+        """
+        Tests reading a precompiled struct, on both our Savefile types
+        """
+        layout = Struct('<HBB')
+        def populate(df):
+            df.writeshort(1000)
+            df.writeuchar(2)
+            df.writeuchar(3)
+        df = self.get_buffered(populate)
+        self.assertEqual(df.readstruct(layout), (1000, 2, 3))
+        self.assertEqual(df.eof(), True)
+
+        df = Savefile('', in_memory=True)
+        populate(df)
+        df.seek(0)
+        self.assertEqual(df.readstruct(layout), (1000, 2, 3))
+        self.assertEqual(df.eof(), True)
+
+    def test_read_str_not_complete(self):
+        """
+        Tests a truncated string that's shorter than we expect it to be.
+        """
+        def populate(df):
+            df.writeshort(10)
+            df.write(b'hi')
+        df = self.get_buffered(populate)
+        with self.assertRaises(LoadException) as cm:
+            df.readstr()
+        self.assertIn('Error reading string, expected', cm.exception.text)
+
+    def test_read_varint_not_complete(self):
+        """
+        Tests a varint which is cut off by the end of the buffer
+        """
+        df = BufferedSavefile('', data=b'\x80\x80')
+        with self.assertRaises(LoadException) as cm:
+            df.readvarint()
+        self.assertIn('Error reading varint', cm.exception.text)
+
+    def test_read_varstr_not_complete(self):
+        """
+        Tests a truncated varstr that's shorter than we expect it to be.
+        """
+        df = BufferedSavefile('', data=b'\x0ahi')
+        with self.assertRaises(LoadException) as cm:
+            df.readvarstr()
+        self.assertIn('Error reading string, expected 10, read 2', cm.exception.text)
+
+    def test_skip(self):
+        """
+        Tests skipping over raw data and strings
+        """
+        def populate(df):
+            df.write(b'abc')
+            df.writestr('Testing')
+            df.writestr('')
+            df.writevarstr('Testing')
+            df.writeuchar(42)
+        df = self.get_buffered(populate)
+        df.skip(3)
+        df.skipstr()
+        df.skipstr()
+        df.skipvarstr()
+        self.assertEqual(df.readuchar(), 42)
+        self.assertEqual(df.eof(), True)
+
+class MmapSavefileTests(unittest.TestCase):
+    """
+    Tests of our MmapSavefile object, which decodes out of a
+    memory-mapped file.
+    """
+
+    def setUp(self):
+        """
+        Gets a temp filename for each test
+        """
+        (handle, self.filename) = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        """
+        Cleans up our temp file
+        """
+        os.unlink(self.filename)
+
+    def test_open_r_and_close(self):
+        """
+        Tests opening and closing a file, and reading some data from it
+        """
+        df = Savefile(self.filename)
+        df.open_w()
+        df.writeshort(65500)
+        df.writestr('Testing')
+        df.writestr('Ünïcödé')
+        df.close()
+
+        df = MmapSavefile(self.filename)
+        df.open_r()
+        self.assertEqual(df.opened_r, True)
+        self.assertEqual(type(df.buf), memoryview)
+        with self.assertRaises(IOError) as cm:
+            df.open_r()
+        self.assertIn('File is already open', str(cm.exception))
+        self.assertEqual(df.readshort(), 65500)
+        self.assertEqual(df.readstr(), 'Testing')
+        self.assertEqual(df.readstr(), 'Ünïcödé')
+        self.assertEqual(df.eof(), True)
+        df.seek(0)
+        self.assertEqual(df.read(2), b'\xdc\xff')
+        df.close()
+        self.assertEqual(df.opened_r, False)
+        self.assertEqual(df.mmap, None)
+        self.assertEqual(df.buf, None)
+
+    def test_open_r_empty_file(self):
+        """
+        Tests opening a zero-length file, which mmap can't handle directly
+        """
+        df = MmapSavefile(self.filename)
+        df.open_r()
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(df.read(), b'')
+        df.close()
+        self.assertEqual(df.opened_r, False)
+
+    def test_readchunk(self):
+        """
+        Chunks are views straight into the file, which stay usable after
+        the file is closed
+        """
+        df = Savefile(self.filename)
+        df.open_w()
+        df.writestr('Testing')
+        df.close()
+
+        df = MmapSavefile(self.filename)
+        df.open_r()
+        df.seek(2)
+        chunk = df.readchunk(4)
+        self.assertEqual(type(chunk), memoryview)
+        self.assertEqual(df.tell(), 6)
+        df.close()
+        self.assertEqual(df.opened_r, False)
+        self.assertEqual(df.mmap, None)
+        self.assertEqual(bytes(chunk), b'Test')
+
+    def test_open_w(self):
+        """
+        Writing isn't supported
+        """
+        df = MmapSavefile(self.filename)
+        with self.assertRaises(IOError) as cm:
+            df.open_w()
+        self.assertIn('read-only', str(cm.exception))
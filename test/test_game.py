@@ -2,10 +2,16 @@
 # vim: set expandtab tabstop=4 shiftwidth=4:
 
 import os
+import shutil
+import asyncio
 import tempfile
 import unittest
-from advmap.data import Game, Map, SAVEFILE_VER
+from unittest import mock
+from advmap.data import Game, Map, SAVEFILE_VER, DIR_N, DIR_S
+from advmap.data import GameHeader, MapHeader, RoomRecord, ConnRecord, ConnEndRecord, GroupRecord
 from advmap.file import Savefile, LoadException
+from advmap.jsonfile import JsonSavefile, JSON_EXTENSION
+from advmap.sqlitefile import SqliteSavefile, SQLITE_EXTENSION
 
 class GameTests(unittest.TestCase):
     """
@@ -19,6 +25,15 @@ class GameTests(unittest.TestCase):
         """
         return Savefile('', in_memory=True)
 
+    def get_filename(self, name):
+        """
+        Returns the name of a file in a temporary directory, which will
+        be cleaned up after the test.
+        """
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        return os.path.join(dirname, name)
+
     def setUp(self):
         """
         Create a Game object for all our tests
@@ -31,6 +46,7 @@ class GameTests(unittest.TestCase):
         """
         self.assertEqual(self.g.name, 'Game')
         self.assertEqual(len(self.g.maps), 0)
+        self.assertEqual(self.g.version, None)
 
     def test_add_map_obj(self):
         """
@@ -78,7 +94,7 @@ class GameTests(unittest.TestCase):
         self.assertEqual(df.read(6), b'ADVMAP')
         self.assertEqual(df.readshort(), SAVEFILE_VER)
         self.assertEqual(df.readstr(), 'Game')
-        self.assertEqual(df.readshort(), 0)
+        self.assertEqual(df.readvarint(), 0)
         self.assertEqual(df.eof(), True)
 
     def test_save_single_map(self):
@@ -94,14 +110,20 @@ class GameTests(unittest.TestCase):
         self.assertEqual(df.read(6), b'ADVMAP')
         self.assertEqual(df.readshort(), SAVEFILE_VER)
         self.assertEqual(df.readstr(), 'Game')
-        self.assertEqual(df.readshort(), 1)
+        self.assertEqual(df.readvarint(), 1)
 
-        self.assertEqual(df.readstr(), 'Map')
-        self.assertEqual(df.readuchar(), 9)
-        self.assertEqual(df.readuchar(), 9)
-        self.assertEqual(df.readshort(), 0)
-        self.assertEqual(df.readshort(), 0)
-        self.assertEqual(df.readshort(), 0)
+        # Map index
+        self.assertEqual(df.readvarstr(), 'Map')
+        self.assertEqual(df.readvarint(), 10)
+        self.assertEqual(df.tell(), 21)
+
+        self.assertEqual(df.readvarstr(), 'Map')
+        self.assertEqual(df.readvarint(), 9)
+        self.assertEqual(df.readvarint(), 9)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), 0)
 
         self.assertEqual(df.eof(), True)
 
@@ -120,7 +142,7 @@ class GameTests(unittest.TestCase):
             self.assertEqual(df.read(6), b'ADVMAP')
             self.assertEqual(df.readshort(), SAVEFILE_VER)
             self.assertEqual(df.readstr(), 'Game')
-            self.assertEqual(df.readshort(), 0)
+            self.assertEqual(df.readvarint(), 0)
             self.assertEqual(df.eof(), True)
             df.close()
         finally:
@@ -134,21 +156,23 @@ class GameTests(unittest.TestCase):
         df.write(b'ADVMAP')
         df.writeshort(SAVEFILE_VER)
         df.writestr('Game')
-        df.writeshort(0)
+        df.writevarint(0)
         df.seek(0)
 
         game = Game._load(df)
         self.assertEqual(df.eof(), True)
         self.assertEqual(game.name, 'Game')
+        self.assertEqual(game.version, SAVEFILE_VER)
         self.assertEqual(len(game.maps), 0)
 
-    def test_load_single_map(self):
+    def test_load_single_map_v9(self):
         """
-        Test loading with a single map
+        Test loading with a single map, using the pre-v10 format
+        which doesn't have a map index
         """
         df = self.getSavefile()
         df.write(b'ADVMAP')
-        df.writeshort(SAVEFILE_VER)
+        df.writeshort(9)
         df.writestr('Game')
         df.writeshort(1)
 
@@ -164,8 +188,281 @@ class GameTests(unittest.TestCase):
         game = Game._load(df)
         self.assertEqual(df.eof(), True)
         self.assertEqual(game.name, 'Game')
+        self.assertEqual(game.version, 9)
         self.assertEqual(len(game.maps), 1)
         self.assertEqual(game.maps[0].name, 'Map')
+        self.assertEqual(game.maps[0].is_loaded(), True)
+
+    def write_two_map_file(self, df):
+        """
+        Writes a current-version savefile with two maps (and a map
+        index) to the given Savefile.
+        """
+        df.write(b'ADVMAP')
+        df.writeshort(SAVEFILE_VER)
+        df.writestr('Game')
+        df.writevarint(2)
+
+        # Index
+        df.writevarstr('Map 1')
+        df.writevarint(12)
+        df.writevarstr('Map 2')
+        df.writevarint(12)
+
+        # Maps
+        for (name, size) in [('Map 1', 4), ('Map 2', 5)]:
+            df.writevarstr(name)
+            df.writevarints(size, size, 0, 0, 0, 0)
+
+        df.seek(0)
+
+    def test_load_indexed_lazy(self):
+        """
+        Test loading a file with a map index.  Maps shouldn't actually
+        be loaded until something other than their name is requested.
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+
+        game = Game._load(df)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(game.name, 'Game')
+        self.assertEqual(len(game.maps), 2)
+        self.assertEqual(game.maps[0].name, 'Map 1')
+        self.assertEqual(game.maps[1].name, 'Map 2')
+        self.assertEqual(game.maps[0].is_loaded(), False)
+        self.assertEqual(game.maps[1].is_loaded(), False)
+
+        self.assertEqual(game.maps[1].w, 5)
+        self.assertEqual(game.maps[0].is_loaded(), False)
+        self.assertEqual(game.maps[1].is_loaded(), True)
+        self.assertEqual(game.maps[1].h, 5)
+        self.assertEqual(len(game.maps[1].rooms), 0)
+
+        game.maps[0].materialize()
+        self.assertEqual(game.maps[0].is_loaded(), True)
+        self.assertEqual(game.maps[0].w, 4)
+
+    def test_load_indexed_rename_before_load(self):
+        """
+        Renaming a lazy map before it's loaded should stick
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+
+        game = Game._load(df)
+        game.maps[0].name = 'Renamed'
+        self.assertEqual(game.maps[0].w, 4)
+        self.assertEqual(game.maps[0].name, 'Renamed')
+
+    def test_load_indexed_missing_attribute(self):
+        """
+        Loaded maps should still raise AttributeError for unknown attributes
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+
+        game = Game._load(df)
+        with self.assertRaises(AttributeError):
+            game.maps[0].nonexistent
+        self.assertEqual(game.maps[0].is_loaded(), True)
+        with self.assertRaises(AttributeError):
+            game.maps[0].nonexistent
+
+    def test_load_indexed_truncated(self):
+        """
+        Test loading an indexed file whose map data is cut short
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+        data = df.read()
+
+        df = self.getSavefile()
+        df.write(data[:-4])
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            Game._load(df)
+        self.assertIn('Error reading map "Map 2"', cm.exception.text)
+
+    def test_save_unloaded_maps(self):
+        """
+        Maps which were never loaded should be written back out exactly as
+        they were read in, and renamed maps should be rewritten.
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+        data = df.read()
+        df.seek(0)
+
+        game = Game._load(df)
+        df = self.getSavefile()
+        game._save(df)
+        df.seek(0)
+        self.assertEqual(df.read(), data)
+        self.assertEqual(game.maps[0].is_loaded(), False)
+        self.assertEqual(game.maps[1].is_loaded(), False)
+
+        game.maps[1].name = 'Renamed'
+        df = self.getSavefile()
+        game._save(df)
+        df.seek(0)
+        new_game = Game._load(df)
+        self.assertEqual(new_game.maps[1].name, 'Renamed')
+        self.assertEqual(new_game.maps[1].w, 5)
+        self.assertEqual(new_game.maps[0].w, 4)
+
+    def test_save_only_dirty_maps(self):
+        """
+        After a save, only maps which have changed should be re-encoded
+        on the next save.
+        """
+        filename = self.get_filename('game.adv')
+        g = Game('Game')
+        (idx, m1) = g.add_map('Map 1')
+        (idx, m2) = g.add_map('Map 2')
+        m1.add_room_at(1, 1, 'Room 1')
+        m2.add_room_at(1, 1, 'Room 2')
+        g.save(filename)
+        self.assertEqual(m1.is_dirty(), False)
+        self.assertEqual(m2.is_dirty(), False)
+        self.assertEqual(m1.savedata, None)
+
+        m2.get_room_at(1, 1).name = 'Renamed'
+        self.assertEqual(m1.is_dirty(), False)
+        self.assertEqual(m2.is_dirty(), True)
+        with mock.patch.object(Map, 'save', autospec=True, side_effect=Map.save) as save:
+            g.save(filename)
+        self.assertEqual([call.args[0] for call in save.call_args_list], [m2])
+        self.assertEqual(m2.is_dirty(), False)
+
+        new_game = Game.load(filename)
+        self.assertEqual(new_game.maps[0].get_room_at(1, 1).name, 'Room 1')
+        self.assertEqual(new_game.maps[1].get_room_at(1, 1).name, 'Renamed')
+
+    def test_save_clean_maps_from_changed_file(self):
+        """
+        If the file a clean map was loaded from has been changed by
+        something else since, the map should be re-encoded instead of
+        having its data read back in from the file.
+        """
+        filename = self.get_filename('game.adv')
+        g = Game('Game')
+        (idx, m1) = g.add_map('Map 1')
+        m1.add_room_at(1, 1, 'Room 1')
+        g.save(filename)
+        g = Game.load(filename)
+        self.assertEqual(g.maps[0].get_room_at(1, 1).name, 'Room 1')
+        data = g.maps[0].get_savedata()
+        with open(filename, 'wb') as df:
+            df.write(b'Something else entirely')
+        self.assertEqual(g.maps[0].read_source(), None)
+        self.assertEqual(g.maps[0].get_savedata(), data)
+        os.unlink(filename)
+        self.assertEqual(g.maps[0].get_savedata(), data)
+
+    def test_load_indexed_maps_clean(self):
+        """
+        Maps loaded from a current-version file should start out clean,
+        both before and after they're actually loaded.
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+        filename = self.get_filename('game.adv')
+        with open(filename, 'wb') as out:
+            out.write(df.df.getvalue())
+        game = Game.load(filename)
+        self.assertEqual(game.maps[0].is_dirty(), False)
+        game.maps[0].materialize()
+        self.assertEqual(game.maps[0].is_dirty(), False)
+        self.assertEqual(game.maps[0].savedata, None)
+        self.assertEqual(game.maps[0].get_savedata(), game.maps[0].read_source())
+        game.maps[0].add_room_at(1, 1, 'Room')
+        self.assertEqual(game.maps[0].is_dirty(), True)
+        self.assertEqual(game.maps[1].is_dirty(), False)
+
+        # Rooms in a map which was loaded lazily should still report
+        # their changes to it
+        game.save(filename)
+        self.assertEqual(game.maps[0].is_dirty(), False)
+        game = Game.load(filename)
+        game.maps[0].get_room_at(1, 1).name = 'Renamed'
+        self.assertEqual(game.maps[0].is_dirty(), True)
+
+    def test_load_v10_maps_dirty(self):
+        """
+        Maps loaded from a v10 file (indexed, but without string tables)
+        still load lazily, but can't have their data reused.
+        """
+        df = self.getSavefile()
+        df.write(b'ADVMAP')
+        df.writeshort(10)
+        df.writestr('Game')
+        df.writeshort(1)
+        df.writestr('Map')
+        df.writeint(31)
+        df.writeint(14)
+        df.writestr('Map')
+        df.writeuchar(4)
+        df.writeuchar(4)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.seek(0)
+        game = Game._load(df)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(game.maps[0].is_loaded(), False)
+        self.assertEqual(game.maps[0].is_dirty(), True)
+        self.assertEqual(game.maps[0].w, 4)
+        self.assertEqual(game.maps[0].is_dirty(), True)
+
+    def test_load_v11_maps_dirty(self):
+        """
+        Maps loaded from a v11 file (with a fixed-size map index and
+        string tables) still load lazily, but can't have their data
+        reused.
+        """
+        df = self.getSavefile()
+        df.write(b'ADVMAP')
+        df.writeshort(11)
+        df.writestr('Game')
+        df.writeshort(1)
+        df.writestr('Map')
+        df.writeint(31)
+        df.writeint(16)
+        df.writestr('Map')
+        df.writeuchar(4)
+        df.writeuchar(4)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.seek(0)
+        game = Game._load(df)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(game.maps[0].is_loaded(), False)
+        self.assertEqual(game.maps[0].is_dirty(), True)
+        self.assertEqual(game.maps[0].w, 4)
+        self.assertEqual(game.maps[0].is_dirty(), True)
+
+    def test_load_v9_maps_dirty(self):
+        """
+        Maps loaded from an older-version file can't have their data
+        reused, so should start out dirty.
+        """
+        df = self.getSavefile()
+        df.write(b'ADVMAP')
+        df.writeshort(9)
+        df.writestr('Game')
+        df.writeshort(1)
+        df.writestr('Map')
+        df.writeuchar(9)
+        df.writeuchar(9)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.seek(0)
+        game = Game._load(df)
+        self.assertEqual(game.maps[0].is_dirty(), True)
 
     def test_load_invalid_map_file(self):
         """
@@ -224,3 +521,531 @@ class GameTests(unittest.TestCase):
         finally:
             os.unlink(pathname)
 
+
+    def test_load_from_filename_readonly(self):
+        """
+        Test loading from a filename in readonly mode
+        """
+        (handle, pathname) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            g = Game('Game')
+            g.add_map('Map')
+            g.save(pathname)
+
+            g = Game.load(pathname, readonly=True)
+            self.assertEqual(g.name, 'Game')
+            self.assertEqual(len(g.maps), 1)
+            self.assertEqual(g.maps[0].name, 'Map')
+        finally:
+            os.unlink(pathname)
+
+    def test_load_readonly_lazy_maps_not_copied(self):
+        """
+        Lazy maps loaded in readonly mode should point straight into the
+        memory-mapped file until they're used, and then let go of it
+        """
+        (handle, pathname) = tempfile.mkstemp()
+        os.close(handle)
+        (handle, savename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            g = Game('Game')
+            (idx, m1) = g.add_map('Map 1')
+            (idx, m2) = g.add_map('Map 2')
+            m1.add_room_at(1, 1, 'Room 1')
+            m2.add_room_at(2, 2, 'Room 2')
+            g.save(pathname)
+
+            g = Game.load(pathname, readonly=True)
+            for mapobj in g.maps:
+                with self.subTest(map=mapobj.name):
+                    self.assertEqual(mapobj.is_loaded(), False)
+                    self.assertEqual(type(mapobj.savedata[1]), memoryview)
+
+            self.assertEqual(g.maps[0].get_room_at(1, 1).name, 'Room 1')
+            self.assertEqual(g.maps[0].is_dirty(), False)
+            self.assertEqual(g.maps[0].savedata, None)
+            self.assertEqual(type(g.maps[1].savedata[1]), memoryview)
+
+            # Maps which were never looked at are saved straight from the
+            # memory-mapped file; the others are read back in from it
+            g.save(savename)
+            g = Game.load(savename)
+            self.assertEqual(g.maps[0].get_room_at(1, 1).name, 'Room 1')
+            self.assertEqual(g.maps[1].get_room_at(2, 2).name, 'Room 2')
+        finally:
+            os.unlink(pathname)
+            os.unlink(savename)
+
+    def test_peek_indexed(self):
+        """
+        Peeking at an indexed file should read the counts out of each
+        map's header
+        """
+        g = Game('Game')
+        (idx, m1) = g.add_map('Map 1')
+        (idx, m2) = g.add_map('Map 2')
+        r1 = m1.add_room_at(1, 1, 'Room 1')
+        r2 = m1.add_room_at(2, 2, 'Room 2')
+        m1.connect(r1, DIR_N, r2)
+        m1.group_rooms(r1, r2)
+        m2.add_room_at(3, 3, 'Room 3')
+        df = self.getSavefile()
+        g._save(df)
+        df.seek(0)
+
+        info = Game._peek(df)
+        self.assertEqual(info.name, 'Game')
+        self.assertEqual(info.version, SAVEFILE_VER)
+        self.assertEqual(len(info.maps), 2)
+        self.assertEqual(info.maps[0].name, 'Map 1')
+        self.assertEqual(info.maps[0].w, 9)
+        self.assertEqual(info.maps[0].h, 9)
+        self.assertEqual(info.maps[0].num_rooms, 2)
+        self.assertEqual(info.maps[0].num_conns, 1)
+        self.assertEqual(info.maps[0].num_groups, 1)
+        self.assertEqual(info.maps[1].name, 'Map 2')
+        self.assertEqual(info.maps[1].num_rooms, 1)
+        self.assertEqual(info.maps[1].num_conns, 0)
+        self.assertEqual(info.maps[1].num_groups, 0)
+
+    def test_peek_v9(self):
+        """
+        Peeking at a pre-v10 file has to skip over each map to get to
+        the next one
+        """
+        df = self.getSavefile()
+        df.write(b'ADVMAP')
+        df.writeshort(9)
+        df.writestr('Game')
+        df.writeshort(2)
+
+        df.writestr('Map 1')
+        df.writeuchar(9)
+        df.writeuchar(9)
+        df.writeshort(2)
+        df.writeshort(1)
+        df.writeshort(1)
+        for (idnum, name) in [(1, 'Room 1'), (2, 'Room 2')]:
+            df.writeshort(idnum)
+            df.writeuchar(idnum)
+            df.writeuchar(idnum)
+            df.writestr(name)
+            df.writeuchar(0)
+            df.writeuchar(0)
+            for i in range(5):
+                df.writestr('Text')
+            df.writeuchar(0)
+            df.writeuchar(0)
+        df.writeshort(1)
+        df.writeuchar(DIR_N)
+        df.writeshort(2)
+        df.writeuchar(DIR_N)
+        df.writeuchar(0)
+        df.writeuchar(1)
+        for i in range(2):
+            df.writeuchar(1)
+            df.write(bytes([DIR_N, 0, 0, 1]))
+        df.writeshort(2)
+        df.writeuchar(0)
+        df.writeshort(1)
+        df.writeshort(2)
+
+        df.writestr('Map 2')
+        df.writeuchar(4)
+        df.writeuchar(5)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.seek(0)
+
+        info = Game._peek(df)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(info.name, 'Game')
+        self.assertEqual(info.version, 9)
+        self.assertEqual(len(info.maps), 2)
+        self.assertEqual(info.maps[0].name, 'Map 1')
+        self.assertEqual(info.maps[0].num_rooms, 2)
+        self.assertEqual(info.maps[0].num_conns, 1)
+        self.assertEqual(info.maps[0].num_groups, 1)
+        self.assertEqual(info.maps[1].name, 'Map 2')
+        self.assertEqual(info.maps[1].w, 4)
+        self.assertEqual(info.maps[1].h, 5)
+        self.assertEqual(info.maps[1].num_rooms, 0)
+
+        # Make sure that's consistent with actually loading it
+        df.seek(0)
+        game = Game._load(df)
+        self.assertEqual(len(game.maps[0].rooms), 2)
+        self.assertEqual(len(game.maps[0].conns), 1)
+        self.assertEqual(len(game.maps[0].groups), 1)
+
+    def test_peek_from_filename(self):
+        """
+        Test peeking at a game from a filename
+        """
+        (handle, pathname) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            g = Game('Game')
+            g.add_map('Map')
+            g.save(pathname)
+
+            info = Game.peek(pathname)
+            self.assertEqual(info.name, 'Game')
+            self.assertEqual(len(info.maps), 1)
+            self.assertEqual(info.maps[0].name, 'Map')
+        finally:
+            os.unlink(pathname)
+
+    def test_peek_invalid_map_file(self):
+        """
+        Peeking at something which isn't a map file should fail the
+        same way that loading does
+        """
+        df = self.getSavefile()
+        df.write(b'FOOBAR')
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            Game._peek(df)
+        self.assertIn('Invalid Map File specified', cm.exception.text)
+
+    def test_iter_records(self):
+        """
+        Test streaming the records out of a game
+        """
+        g = Game('Game')
+        (idx, m1) = g.add_map('Map 1')
+        (idx, m2) = g.add_map('Map 2')
+        r1 = m1.add_room_at(1, 1, 'Room 1')
+        r2 = m1.add_room_at(1, 2, 'Room 2')
+        r2.notes = 'Notes'
+        conn = m1.connect(r1, DIR_S, r2)
+        conn.set_ladder(r2, DIR_N)
+        m1.group_rooms(r1, r2)
+        df = self.getSavefile()
+        g._save(df)
+        df.seek(0)
+
+        records = list(Game._iter_records(df))
+        self.assertEqual(records, [
+            GameHeader('Game', SAVEFILE_VER, 2),
+            MapHeader('Map 1', 9, 9, 2, 1, 1),
+            RoomRecord(0, 1, 1, 'Room 1', 0, 0, '', '', '', '', '', 0, 0),
+            RoomRecord(1, 1, 2, 'Room 2', 0, 0, '', '', '', '', 'Notes', 0, 0),
+            ConnRecord(0, DIR_S, 1, DIR_N, 0, True, 1, 1),
+            ConnEndRecord(0, DIR_S, 1, 0, 1),
+            ConnEndRecord(1, DIR_N, 1, 0, 1),
+            GroupRecord(0, (0, 1)),
+            MapHeader('Map 2', 9, 9, 0, 0, 0),
+            ])
+
+    def test_iter_records_v9(self):
+        """
+        Test streaming the records out of a pre-v10 game
+        """
+        df = self.getSavefile()
+        df.write(b'ADVMAP')
+        df.writeshort(9)
+        df.writestr('Game')
+        df.writeshort(1)
+        df.writestr('Map')
+        df.writeuchar(4)
+        df.writeuchar(4)
+        df.writeshort(1)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(1)
+        df.writeuchar(2)
+        df.writeuchar(3)
+        df.writestr('Room')
+        df.writeuchar(0)
+        df.writeuchar(0)
+        for i in range(5):
+            df.writestr('')
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.seek(0)
+
+        records = list(Game._iter_records(df))
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(records, [
+            GameHeader('Game', 9, 1),
+            MapHeader('Map', 4, 4, 1, 0, 0),
+            RoomRecord(1, 2, 3, 'Room', 0, 0, '', '', '', '', '', 0, 0),
+            ])
+
+    def test_iter_records_from_filename(self):
+        """
+        Test streaming records from a filename
+        """
+        (handle, pathname) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            g = Game('Game')
+            g.add_map('Map')
+            g.save(pathname)
+            records = list(Game.iter_records(pathname))
+            self.assertEqual(records, [
+                GameHeader('Game', SAVEFILE_VER, 1),
+                MapHeader('Map', 9, 9, 0, 0, 0),
+                ])
+        finally:
+            os.unlink(pathname)
+
+    def write_json_game(self, pathname):
+        """
+        Saves a small game to `pathname` as gzipped JSON, and returns it
+        """
+        g = Game('Game')
+        (idx, m) = g.add_map('Map 1')
+        r1 = m.add_room_at(1, 1, 'Room 1')
+        r2 = m.add_room_at(1, 2, 'Room 2')
+        m.connect(r1, DIR_S, r2, DIR_N)
+        g.add_map('Map 2')
+        JsonSavefile(pathname).write(g.name, [mapobj.to_records() for mapobj in g.maps])
+        return g
+
+    def test_save_json_by_extension(self):
+        """
+        Saving to a filename with the JSON extension should write JSON
+        """
+        (handle, pathname) = tempfile.mkstemp(suffix=JSON_EXTENSION)
+        os.close(handle)
+        try:
+            g = Game('Game')
+            g.add_map('Map 1')
+            g.save(pathname)
+            self.assertEqual(JsonSavefile.is_json_file(pathname), True)
+            self.assertEqual(list(JsonSavefile(pathname).read()),
+                    ['Game', ('Map 1', 9, 9, [], [], [])])
+        finally:
+            os.unlink(pathname)
+
+    def test_save_json_unloaded_maps(self):
+        """
+        Saving lazy maps as JSON shouldn't leave them loaded
+        """
+        df = self.getSavefile()
+        self.write_two_map_file(df)
+        g = Game._load(df)
+        (handle, pathname) = tempfile.mkstemp(suffix=JSON_EXTENSION)
+        os.close(handle)
+        try:
+            g.save(pathname)
+            self.assertEqual([m.is_loaded() for m in g.maps], [False, False])
+            g2 = Game.load(pathname)
+            self.assertEqual([(m.name, m.w) for m in g2.maps], [('Map 1', 4), ('Map 2', 5)])
+        finally:
+            os.unlink(pathname)
+
+    def test_load_json_by_magic(self):
+        """
+        JSON savefiles should be recognized no matter what they're called
+        """
+        (handle, pathname) = tempfile.mkstemp(suffix='.adv')
+        os.close(handle)
+        try:
+            self.write_json_game(pathname)
+            g = Game.load(pathname)
+            self.assertEqual(g.name, 'Game')
+            self.assertEqual([m.name for m in g.maps], ['Map 1', 'Map 2'])
+            m = g.maps[0]
+            self.assertEqual(m.is_dirty(), True)
+            self.assertEqual(len(m.rooms), 2)
+            self.assertEqual(len(m.conns), 1)
+            self.assertEqual(m.get_room_at(1, 2).conns[DIR_N], m.conns[0])
+        finally:
+            os.unlink(pathname)
+
+    def test_load_json_validates(self):
+        """
+        JSON maps get validated, unless told otherwise
+        """
+        (handle, pathname) = tempfile.mkstemp(suffix=JSON_EXTENSION)
+        os.close(handle)
+        try:
+            conn = ((1, DIR_N, 1, DIR_N, 0, True, 1, 1), [(1, DIR_N, 0, 0, 1), (1, DIR_N, 0, 0, 1)])
+            rooms = [(1, 1, 1, 'Room', 0, 0, '', '', '', '', '', 0, 0)]
+            JsonSavefile(pathname).write('Game', [('Map', 9, 9, rooms, [conn], [])])
+            with self.assertRaises(LoadException):
+                Game.load(pathname)
+            g = Game.load(pathname, validate=False)
+            self.assertEqual(len(g.maps[0].conns), 1)
+        finally:
+            os.unlink(pathname)
+
+    def test_peek_json(self):
+        """
+        Test peeking at a JSON savefile
+        """
+        (handle, pathname) = tempfile.mkstemp(suffix=JSON_EXTENSION)
+        os.close(handle)
+        try:
+            self.write_json_game(pathname)
+            info = Game.peek(pathname)
+            self.assertEqual(info.name, 'Game')
+            self.assertEqual(info.version, None)
+            self.assertEqual(info.format, 'json')
+            self.assertEqual([(m.name, m.num_rooms, m.num_conns, m.num_groups) for m in info.maps],
+                    [('Map 1', 2, 1, 0), ('Map 2', 0, 0, 0)])
+        finally:
+            os.unlink(pathname)
+
+    def test_save_and_load_sqlite(self):
+        """
+        Saving to a filename with the SQLite extension should write a
+        database, which should load back up again
+        """
+        (handle, pathname) = tempfile.mkstemp(suffix=SQLITE_EXTENSION)
+        os.close(handle)
+        os.unlink(pathname)
+        try:
+            g = Game('Game')
+            (idx, m) = g.add_map('Map 1')
+            r1 = m.add_room_at(1, 1, 'Room 1')
+            r2 = m.add_room_at(1, 2, 'Room 2')
+            m.connect(r1, DIR_S, r2, DIR_N)
+            g.add_map('Map 2')
+            g.save(pathname)
+            self.assertEqual(SqliteSavefile.is_sqlite_file(pathname), True)
+
+            g2 = Game.load(pathname)
+            self.assertEqual(g2.name, 'Game')
+            self.assertEqual([m.name for m in g2.maps], ['Map 1', 'Map 2'])
+            self.assertEqual(len(g2.maps[0].conns), 1)
+            self.assertEqual(g2.maps[0].get_room_at(1, 2).conns[DIR_N], g2.maps[0].conns[0])
+
+            info = Game.peek(pathname)
+            self.assertEqual((info.name, info.version, info.format), ('Game', None, 'sqlite'))
+            self.assertEqual([(m.name, m.num_rooms, m.num_conns) for m in info.maps],
+                    [('Map 1', 2, 1), ('Map 2', 0, 0)])
+        finally:
+            if os.path.exists(pathname):
+                os.unlink(pathname)
+
+class GameAsyncTests(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests for loading and saving games from asyncio code
+    """
+
+    def setUp(self):
+        """
+        Set up a temporary directory, and a game to save into it
+        """
+        self.dirname = tempfile.mkdtemp()
+        self.g = Game('Game')
+        for i in range(3):
+            (idx, m) = self.g.add_map('Map {}'.format(i+1))
+            r1 = m.add_room_at(1, 1, 'Room 1')
+            r2 = m.add_room_at(1, 2, 'Room 2')
+            m.connect(r1, DIR_S, r2, DIR_N)
+
+    def tearDown(self):
+        """
+        Clean up our temporary directory
+        """
+        shutil.rmtree(self.dirname)
+
+    def assert_game(self, game):
+        """
+        Checks that `game` matches the one we set up, and is fully loaded
+        """
+        self.assertEqual(game.name, 'Game')
+        self.assertEqual([m.name for m in game.maps], ['Map 1', 'Map 2', 'Map 3'])
+        self.assertEqual([m.is_loaded() for m in game.maps], [True, True, True])
+        for m in game.maps:
+            self.assertEqual(m.get_room_at(1, 2).conns[DIR_N], m.conns[0])
+
+    async def test_save_and_load(self):
+        """
+        Test a trip through each of our formats, reporting progress
+        """
+        for (ext, total) in [('.adv', 3), (JSON_EXTENSION, None), (SQLITE_EXTENSION, None)]:
+            with self.subTest(ext=ext):
+                pathname = os.path.join(self.dirname, 'game' + ext)
+                saved = []
+                await self.g.save_async(pathname, lambda done, total: saved.append((done, total)))
+                self.assertEqual(saved, [(1, 3), (2, 3), (3, 3)])
+                loaded = []
+                game = await Game.load_async(pathname, progress=lambda done, total: loaded.append((done, total)))
+                self.assert_game(game)
+                self.assertEqual(loaded, [(1, total), (2, total), (3, total)])
+
+    async def test_load_v9(self):
+        """
+        Files without a map index get loaded a map at a time, too
+        """
+        pathname = os.path.join(self.dirname, 'game.adv')
+        df = Savefile(pathname)
+        df.open_w()
+        df.write(b'ADVMAP')
+        df.writeshort(9)
+        df.writestr('Game')
+        df.writeshort(2)
+        for name in ['Map 1', 'Map 2']:
+            df.writestr(name)
+            df.writeuchar(9)
+            df.writeuchar(9)
+            df.writeshort(0)
+            df.writeshort(0)
+            df.writeshort(0)
+        df.close()
+        loaded = []
+        game = await Game.load_async(pathname, progress=lambda done, total: loaded.append((done, total)))
+        self.assertEqual([m.name for m in game.maps], ['Map 1', 'Map 2'])
+        self.assertEqual(loaded, [(1, 2), (2, 2)])
+
+    async def test_awaitable_progress(self):
+        """
+        A progress callback which returns an awaitable should get awaited
+        """
+        pathname = os.path.join(self.dirname, 'game.adv')
+        await self.g.save_async(pathname)
+        loaded = []
+        async def progress(done, total):
+            await asyncio.sleep(0)
+            loaded.append(done)
+        await Game.load_async(pathname, progress=progress)
+        self.assertEqual(loaded, [1, 2, 3])
+
+    async def test_load_cancel(self):
+        """
+        Cancelling a load should stop it between maps
+        """
+        for ext in ['.adv', JSON_EXTENSION, SQLITE_EXTENSION]:
+            with self.subTest(ext=ext):
+                pathname = os.path.join(self.dirname, 'game' + ext)
+                self.g.save(pathname)
+                loaded = []
+                def progress(done, total):
+                    loaded.append(done)
+                    task.cancel()
+                task = asyncio.ensure_future(Game.load_async(pathname, progress=progress))
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertEqual(loaded, [1])
+
+    async def test_save_cancel(self):
+        """
+        Cancelling a save before it's written anything should leave the
+        file alone
+        """
+        pathname = os.path.join(self.dirname, 'game.adv')
+        def progress(done, total):
+            task.cancel()
+        task = asyncio.ensure_future(self.g.save_async(pathname, progress))
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(os.path.exists(pathname), False)
+
+    async def test_load_error(self):
+        """
+        Errors from the worker thread should get passed along
+        """
+        pathname = os.path.join(self.dirname, 'game.adv')
+        with open(pathname, 'wb') as df:
+            df.write(b'NOTAMAP')
+        with self.assertRaises(LoadException):
+            await Game.load_async(pathname)
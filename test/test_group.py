@@ -32,7 +32,7 @@ class GroupTests(unittest.TestCase):
         """
         Initialize a barebones group
         """
-        self.assertEqual(self.g.rooms, [self.r1, self.r2])
+        self.assertEqual(list(self.g.rooms), [self.r1, self.r2])
         self.assertEqual(self.g.style, Group.STYLE_NORMAL)
         self.assertEqual(self.r1.group, self.g)
         self.assertEqual(self.r2.group, self.g)
@@ -68,7 +68,7 @@ class GroupTests(unittest.TestCase):
         Make sure adding a new room works
         """
         self.g.add_room(self.r3)
-        self.assertEqual(self.g.rooms, [self.r1, self.r2, self.r3])
+        self.assertEqual(list(self.g.rooms), [self.r1, self.r2, self.r3])
         self.assertEqual(self.r3.group, self.g)
         self.assertEqual(self.g.has_room(self.r3), True)
 
@@ -77,7 +77,7 @@ class GroupTests(unittest.TestCase):
         Adding a room already in the group should do nothing
         """
         self.g.add_room(self.r1)
-        self.assertEqual(self.g.rooms, [self.r1, self.r2])
+        self.assertEqual(list(self.g.rooms), [self.r1, self.r2])
         self.assertEqual(self.r3.group, None)
 
     def test_del_room_should_remain(self):
@@ -87,7 +87,7 @@ class GroupTests(unittest.TestCase):
         self.g.add_room(self.r3)
         retval = self.g.del_room(self.r1)
         self.assertEqual(retval, False)
-        self.assertEqual(self.g.rooms, [self.r2, self.r3])
+        self.assertEqual(list(self.g.rooms), [self.r2, self.r3])
         self.assertEqual(self.r1.group, None)
         self.assertEqual(self.r2.group, self.g)
         self.assertEqual(self.r3.group, self.g)
@@ -99,7 +99,7 @@ class GroupTests(unittest.TestCase):
         """
         retval = self.g.del_room(self.r1)
         self.assertEqual(retval, True)
-        self.assertEqual(self.g.rooms, [self.r2])
+        self.assertEqual(list(self.g.rooms), [self.r2])
 
     def test_del_room_not_in_group(self):
         """
@@ -108,7 +108,7 @@ class GroupTests(unittest.TestCase):
         """
         retval = self.g.del_room(self.r3)
         self.assertEqual(retval, False)
-        self.assertEqual(self.g.rooms, [self.r1, self.r2])
+        self.assertEqual(list(self.g.rooms), [self.r1, self.r2])
 
     def test_increment_style(self):
         """
@@ -148,10 +148,10 @@ class GroupTests(unittest.TestCase):
         df = self.getSavefile()
         self.g.save(df)
         df.seek(0)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readuchar(), Group.STYLE_NORMAL)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readshort(), 2)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), Group.STYLE_NORMAL)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
         self.assertEqual(df.eof(), True)
 
     def test_save_three_rooms_and_incremented_style(self):
@@ -163,11 +163,11 @@ class GroupTests(unittest.TestCase):
         df = self.getSavefile()
         self.g.save(df)
         df.seek(0)
-        self.assertEqual(df.readshort(), 3)
-        self.assertEqual(df.readuchar(), Group.STYLE_RED)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readshort(), 3)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), Group.STYLE_RED)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 3)
         self.assertEqual(df.eof(), True)
 
     def test_load_v5(self):
@@ -262,3 +262,91 @@ class GroupTests(unittest.TestCase):
         with self.assertRaises(LoadException) as cm:
             new_g = Group.load(df, mapobj, 6)
         self.assertIn('Room 42 does not exist while loading group', cm.exception.text)
+
+    def test_load_v12_three_rooms(self):
+        """
+        Tests loading a v12 Group with three rooms, including one with
+        an ID which needs more than one byte as a varint.
+        """
+        mapobj = Map('Testing')
+        r1 = mapobj.add_room_at(0, 0, 'Room 1')
+        r2 = mapobj.add_room_at(1, 0, 'Room 2')
+        mapobj.cur_id = 300
+        r3 = mapobj.add_room_at(2, 0, 'Room 3')
+        df = self.getSavefile()
+        df.writevarints(3, Group.STYLE_BLUE, r1.idnum, r2.idnum, r3.idnum)
+        df.seek(0)
+        new_g = Group.load(df, mapobj, 12)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(new_g.style, Group.STYLE_BLUE)
+        self.assertEqual(list(new_g.rooms), [r1, r2, r3])
+
+    def test_load_v12_without_minimum_rooms(self):
+        """
+        Tests attempting to load a v12 group definition without at least two rooms.
+        """
+        df = self.getSavefile()
+        df.writevarints(1, Group.STYLE_NORMAL, 42)
+        df.seek(0)
+        mapobj = Map('Testing')
+        with self.assertRaises(LoadException) as cm:
+            new_g = Group.load(df, mapobj, 12)
+        self.assertIn('Group stated it had only 1 rooms', cm.exception.text)
+
+    def test_skip(self):
+        """
+        Tests skipping over groups saved in various versions
+        """
+        def write_v5(df):
+            df.writeshort(2)
+            df.writeshort(1)
+            df.writeshort(2)
+        def write_v6(df):
+            df.writeshort(3)
+            df.writeuchar(Group.STYLE_RED)
+            df.writeshort(1)
+            df.writeshort(2)
+            df.writeshort(3)
+        def write_current(df):
+            self.g.add_room(self.r3)
+            self.g.save(df)
+        for (version, writer) in [(5, write_v5), (6, write_v6), (12, write_current)]:
+            with self.subTest(version=version):
+                df = self.getSavefile()
+                writer(df)
+                df.writeuchar(42)
+                df.seek(0)
+                Group.skip(df, version)
+                self.assertEqual(df.readuchar(), 42)
+                self.assertEqual(df.eof(), True)
+
+    def test_to_record(self):
+        """
+        Test describing ourselves as a GroupRecord tuple
+        """
+        self.g.add_room(self.r3)
+        self.g.style = Group.STYLE_RED
+        self.assertEqual(self.g.to_record(), (Group.STYLE_RED, (1, 2, 3)))
+
+    def test_from_record(self):
+        """
+        Test building a group out of a GroupRecord tuple
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(0, 0, 'Room 1')
+        r2 = mapobj.add_room_at(0, 1, 'Room 2')
+        r3 = mapobj.add_room_at(0, 2, 'Room 3')
+        g = Group.from_record(mapobj, (Group.STYLE_RED, (r3.idnum, r1.idnum, r2.idnum)))
+        self.assertEqual(g.style, Group.STYLE_RED)
+        self.assertEqual(g.get_rooms(), [r3, r1, r2])
+        self.assertIs(r1.group, g)
+
+    def test_from_record_unknown_room(self):
+        """
+        Test building a group which refers to a room that doesn't exist
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(0, 0, 'Room 1')
+        with self.assertRaises(LoadException) as cm:
+            Group.from_record(mapobj, (Group.STYLE_NORMAL, (r1.idnum, 42)))
+        self.assertIn('Room 42 does not exist', cm.exception.text)
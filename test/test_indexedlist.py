@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import unittest
+from advmap.data import IndexedList, Room
+from advmap.data import DIR_N, DIR_E
+
+class IndexedListTests(unittest.TestCase):
+    """
+    Tests for our IndexedList objects
+    """
+
+    def get_conns(self, count):
+        """
+        Returns a list of `count` connections between pairs of rooms
+        """
+        return [Room(i*2, 0, 0).connect(DIR_N, Room(i*2+1, 0, 0)) for i in range(count)]
+
+    def test_initialization(self):
+        """
+        Basic object initialization
+        """
+        conns = self.get_conns(3)
+        self.assertEqual(len(IndexedList()), 0)
+        self.assertEqual(list(IndexedList()), [])
+        cl = IndexedList(conns)
+        self.assertEqual(len(cl), 3)
+        self.assertEqual(list(cl), conns)
+
+    def test_append(self):
+        """
+        Appending keeps things in order, and only once
+        """
+        (c1, c2) = self.get_conns(2)
+        cl = IndexedList()
+        cl.append(c2)
+        cl.append(c1)
+        self.assertEqual(list(cl), [c2, c1])
+        self.assertIn(c1, cl)
+        with self.assertRaises(ValueError):
+            cl.append(c1)
+        self.assertEqual(list(cl), [c2, c1])
+
+    def test_remove(self):
+        """
+        Removing from anywhere keeps everything else in order
+        """
+        conns = self.get_conns(4)
+        cl = IndexedList(conns)
+        cl.remove(conns[1])
+        self.assertEqual(list(cl), [conns[0], conns[2], conns[3]])
+        self.assertNotIn(conns[1], cl)
+        with self.assertRaises(ValueError):
+            cl.remove(conns[1])
+
+        # Adding something back puts it at the end
+        cl.append(conns[1])
+        self.assertEqual(list(cl), [conns[0], conns[2], conns[3], conns[1]])
+
+    def test_getitem(self):
+        """
+        Looking things up by position
+        """
+        conns = self.get_conns(3)
+        cl = IndexedList(conns)
+        cl.remove(conns[0])
+        self.assertEqual(cl[0], conns[1])
+        self.assertEqual(cl[-1], conns[2])
+        self.assertEqual(cl[:], conns[1:])
+        with self.assertRaises(IndexError):
+            cl[2]
+
+    def test_getitem_after_changes(self):
+        """
+        Looking things up by position shouldn't rebuild our list each
+        time, but has to keep up with appends and removals
+        """
+        conns = self.get_conns(4)
+        cl = IndexedList(conns[:3])
+        self.assertEqual([cl[i] for i in range(len(cl))], conns[:3])
+        items = cl.items
+        self.assertEqual(cl[1], conns[1])
+        self.assertIs(cl.items, items)
+        cl.append(conns[3])
+        self.assertIs(cl.items, items)
+        self.assertEqual(cl[3], conns[3])
+        cl.remove(conns[1])
+        self.assertEqual([cl[i] for i in range(len(cl))], [conns[0], conns[2], conns[3]])
+        cl.append(conns[1])
+        self.assertEqual(cl[-1], conns[1])
+
+    def test_sorted(self):
+        """
+        Putting some of our connections back into list order
+        """
+        conns = self.get_conns(5)
+        cl = IndexedList(conns)
+        cl.remove(conns[0])
+        cl.append(conns[0])
+        self.assertEqual(cl.sorted(set([conns[0], conns[3], conns[2]])), [conns[2], conns[3], conns[0]])
+        self.assertEqual(cl.sorted([]), [])
+        with self.assertRaises(KeyError):
+            cl.sorted([Room(20, 0, 0).connect(DIR_E, Room(21, 0, 0))])
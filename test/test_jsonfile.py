@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import io
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from advmap.jsonfile import JsonReader, JsonSavefile, JSON_VER
+from advmap.file import LoadException
+from advmap.data import Game
+
+class JsonReaderTests(unittest.TestCase):
+    """
+    Tests for reading JSON a piece at a time
+    """
+
+    def get_reader(self, text, chunk_size=3):
+        """
+        Returns a JsonReader over `text`, reading only a few characters
+        at a time so that values get split across reads
+        """
+        reader = JsonReader(io.StringIO(text))
+        reader.CHUNK_SIZE = chunk_size
+        return reader
+
+    def test_value(self):
+        """
+        Test reading plain values
+        """
+        reader = self.get_reader('  "some string"  12345 [1, 2, {"a": null}] true')
+        self.assertEqual(reader.value(), 'some string')
+        self.assertEqual(reader.value(), 12345)
+        self.assertEqual(reader.value(), [1, 2, {'a': None}])
+        self.assertEqual(reader.value(), True)
+        self.assertEqual(reader.peek(), '')
+
+    def test_value_large(self):
+        """
+        A value much bigger than our chunk size should still be read
+        """
+        data = {'text': 'x' * 10000, 'list': list(range(1000))}
+        reader = self.get_reader(json.dumps(data))
+        self.assertEqual(reader.value(), data)
+
+    def test_value_invalid(self):
+        """
+        Test reading something which isn't JSON
+        """
+        reader = self.get_reader('{"a": nope}')
+        with self.assertRaises(LoadException) as cm:
+            reader.value()
+        self.assertIn('Invalid JSON savefile', cm.exception.text)
+
+    def test_items_and_elements(self):
+        """
+        Test walking through an object and its arrays by hand
+        """
+        reader = self.get_reader('{"a": 1, "b": [{"c": 2}, 3, "four"], "e": [], "f": {}}')
+        found = []
+        for key in reader.items():
+            if key == 'b' or key == 'e':
+                found.append((key, list(reader.elements())))
+            elif key == 'f':
+                found.append((key, list(reader.items())))
+            else:
+                found.append((key, reader.value()))
+        self.assertEqual(found, [('a', 1), ('b', [{'c': 2}, 3, 'four']), ('e', []), ('f', [])])
+        self.assertEqual(reader.peek(), '')
+
+    def test_items_unexpected(self):
+        """
+        Test walking through something which isn't an object
+        """
+        reader = self.get_reader('[1, 2]')
+        with self.assertRaises(LoadException) as cm:
+            list(reader.items())
+        self.assertIn('expected one of "{"', cm.exception.text)
+
+    def test_elements_truncated(self):
+        """
+        Test walking through an array which never finishes
+        """
+        reader = self.get_reader('[1, 2')
+        with self.assertRaises(LoadException):
+            list(reader.elements())
+
+class JsonSavefileTests(unittest.TestCase):
+    """
+    Tests for our gzipped JSON savefiles
+    """
+
+    def setUp(self):
+        """
+        Set up a temporary directory to save into
+        """
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'game.json.gz')
+
+    def tearDown(self):
+        """
+        Clean up our temporary directory
+        """
+        shutil.rmtree(self.dirname)
+
+    def get_records(self, name):
+        """
+        Returns some map records
+        """
+        return (name, 5, 6,
+                [(1, 1, 2, 'Room 1', 1, 2, 'Up', '', '', 'Out', 'Notes', 0x2, 0x81),
+                    (2, 3, 4, 'Room 2', 0, 0, '', 'Down', 'In', '', '', 0x1, 0)],
+                [((1, 4, 2, 0, 1, False, 2, 1), [(1, 3, 1, 0, 1), (1, 4, 0, 2, 3), (2, 0, 0, 0, 1)])],
+                [(2, (1, 2))])
+
+    def write_raw(self, data):
+        """
+        Writes `data` out as our gzipped savefile
+        """
+        with gzip.open(self.filename, 'wt', encoding='utf-8') as df:
+            df.write(data)
+
+    def test_is_json_filename(self):
+        """
+        Test picking JSON by filename
+        """
+        self.assertEqual(JsonSavefile.is_json_filename('game.json.gz'), True)
+        self.assertEqual(JsonSavefile.is_json_filename('GAME.JSON.GZ'), True)
+        self.assertEqual(JsonSavefile.is_json_filename('game.adv'), False)
+        self.assertEqual(JsonSavefile.is_json_filename('game.json'), False)
+
+    def test_is_json_file(self):
+        """
+        Test picking JSON by its contents
+        """
+        JsonSavefile(self.filename).write('Game', [])
+        self.assertEqual(JsonSavefile.is_json_file(self.filename), True)
+        other = os.path.join(self.dirname, 'game.adv')
+        with open(other, 'wb') as df:
+            df.write(b'ADVMAP')
+        self.assertEqual(JsonSavefile.is_json_file(other), False)
+
+    def test_write(self):
+        """
+        Test the layout of what we write out
+        """
+        JsonSavefile(self.filename).write('Game', [self.get_records('Map 1')])
+        with gzip.open(self.filename, 'rt', encoding='utf-8') as df:
+            text = df.read()
+        self.assertEqual(len(text.splitlines()), 3)
+        data = json.loads(text)
+        self.assertEqual(data['format'], 'advmap')
+        self.assertEqual(data['version'], JSON_VER)
+        self.assertEqual(data['name'], 'Game')
+        self.assertEqual(len(data['maps']), 1)
+        m = data['maps'][0]
+        self.assertEqual((m['name'], m['w'], m['h']), ('Map 1', 5, 6))
+        self.assertEqual(m['rooms'][0], {'id': 1, 'x': 1, 'y': 2, 'name': 'Room 1',
+            'type': 1, 'color': 2, 'up': 'Up', 'down': '', 'in': '', 'out': 'Out',
+            'notes': 'Notes', 'offset_x': True, 'offset_y': False, 'loopbacks': [0, 7]})
+        self.assertEqual(m['connections'][0], {'room1': 1, 'dir1': 4, 'room2': 2, 'dir2': 0,
+            'passage': 1, 'symmetric': False,
+            'ends1': [{'dir': 3, 'type': 1, 'render': 0, 'stub': 1},
+                {'dir': 4, 'type': 0, 'render': 2, 'stub': 3}],
+            'ends2': [{'dir': 0, 'type': 0, 'render': 0, 'stub': 1}]})
+        self.assertEqual(m['groups'], [{'style': 2, 'rooms': [1, 2]}])
+
+    def test_write_and_read(self):
+        """
+        Test that records survive a trip through JSON
+        """
+        maps = [self.get_records('Map 1'), self.get_records('Map 2'), ('Empty', 9, 9, [], [], [])]
+        JsonSavefile(self.filename).write('Gâme', maps)
+        self.assertEqual(list(JsonSavefile(self.filename).read()), ['Gâme'] + maps)
+
+    def test_read_any_key_order(self):
+        """
+        Keys after the map list should still be checked
+        """
+        self.write_raw('{"name": "Game", "maps": [], "version": 1, "format": "advmap"}')
+        self.assertEqual(list(JsonSavefile(self.filename).read()), ['Game'])
+
+    def test_read_errors(self):
+        """
+        Test various broken JSON savefiles
+        """
+        for (data, error) in [
+                ('{"format": "other", "version": 1, "name": "Game", "maps": []}', 'Invalid Map File'),
+                ('{"format": "advmap", "version": 99, "name": "Game", "maps": []}', 'version 99'),
+                ('{"format": "advmap", "version": 1, "maps": [], "name": "Game"}', '"name" must come before'),
+                ('{"format": "advmap", "version": 1, "name": "Game"}', 'missing "maps"'),
+                ('{"format": "advmap", "name": "Game", "maps": []}', 'missing "version"'),
+                ('{"format": "advmap", "version": 1, "name": "Game", "maps": [{"name": "Map"}]}', 'missing \'rooms\''),
+                ('{"format": "advmap", "version": 1, "name": "Game", "maps": []} []', 'extra data'),
+                ('{"format": "advmap", "version": 1, "name": "Game", "maps": [', 'Invalid JSON savefile'),
+                ]:
+            with self.subTest(data=data):
+                self.write_raw(data)
+                with self.assertRaises(LoadException) as cm:
+                    list(JsonSavefile(self.filename).read())
+                self.assertIn(error, cm.exception.text)
+
+    def test_load_bad_records(self):
+        """
+        Records which don't make a valid map should fail to load with a
+        LoadException
+        """
+        (name, w, h, rooms, conns, groups) = self.get_records('Map')
+        for (records, error) in [
+                ((name, 2, 2, rooms, conns, groups), 'Room 1 is off the map, at (2, 3)'),
+                ((name, w, h, [rooms[0][:1] + ('1',) + rooms[0][2:]], [], []), 'Invalid records for map "Map"'),
+                ((name, w, h, rooms, conns, [(2, (1,))]), 'Group stated it had only 1 rooms'),
+                ]:
+            with self.subTest(records=records):
+                JsonSavefile(self.filename).write('Game', [records])
+                with self.assertRaises(LoadException) as cm:
+                    Game.load(self.filename)
+                self.assertIn(error, cm.exception.text)
+
+    def test_read_not_gzip(self):
+        """
+        Test reading something which isn't gzipped at all
+        """
+        with open(self.filename, 'wb') as df:
+            df.write(b'ADVMAP')
+        with self.assertRaises(LoadException) as cm:
+            list(JsonSavefile(self.filename).read())
+        self.assertIn('Error reading JSON savefile', cm.exception.text)
@@ -2,8 +2,9 @@
 # vim: set expandtab tabstop=4 shiftwidth=4:
 
 import unittest
+from unittest import mock
 from advmap.data import Map, Connection, ConnectionEnd, Room, Group
-from advmap.data import DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW
+from advmap.data import DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW, DIR_BIT
 from advmap.file import Savefile, LoadException
 
 class MapTests(unittest.TestCase):
@@ -18,6 +19,18 @@ class MapTests(unittest.TestCase):
         """
         return Savefile('', in_memory=True)
 
+    def assertMapSize(self, mapobj, w, h):
+        """
+        Checks that `mapobj` is `w` x `h`, and that looking up rooms
+        agrees with that
+        """
+        self.assertEqual((mapobj.w, mapobj.h), (w, h))
+        mapobj.get_room_at(w-1, h-1)
+        for (x, y) in [(w, 0), (0, h), (w, h), (-1, 0), (0, -1)]:
+            with self.subTest(x=x, y=y):
+                with self.assertRaises(IndexError):
+                    mapobj.get_room_at(x, y)
+
     def test_initialization(self):
         """
         Tests basic initialization
@@ -25,10 +38,7 @@ class MapTests(unittest.TestCase):
         mapobj = Map('Map')
         self.assertEqual(mapobj.name, 'Map')
         self.assertEqual(len(mapobj.rooms), 0)
-        self.assertEqual(len(mapobj.roomxy), 9)
-        for i in range(9):
-            with self.subTest(i=i):
-                self.assertEqual(len(mapobj.roomxy[i]), 9)
+        self.assertMapSize(mapobj, 9, 9)
         self.assertEqual(len(mapobj.conns), 0)
         self.assertEqual(len(mapobj.groups), 0)
         self.assertEqual(mapobj.cur_id, 0)
@@ -48,10 +58,7 @@ class MapTests(unittest.TestCase):
         mapobj.set_map_size(4, 4)
         self.assertEqual(mapobj.name, 'Map')
         self.assertEqual(len(mapobj.rooms), 0)
-        self.assertEqual(len(mapobj.roomxy), 4)
-        for i in range(4):
-            with self.subTest(i=i):
-                self.assertEqual(len(mapobj.roomxy[i]), 4)
+        self.assertMapSize(mapobj, 4, 4)
         self.assertEqual(len(mapobj.conns), 0)
         self.assertEqual(len(mapobj.groups), 0)
         self.assertEqual(mapobj.cur_id, 0)
@@ -86,7 +93,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(new_room.x, 1)
         self.assertEqual(new_room.y, 2)
         self.assertEqual(new_room.group, None)
-        self.assertEqual(new.roomxy[2][1], new_room)
+        self.assertEqual(new.get_room_at(1, 2), new_room)
         self.assertEqual(new.rooms[orig_room.idnum], new_room)
 
     def test_duplicate_two_rooms(self):
@@ -102,13 +109,13 @@ class MapTests(unittest.TestCase):
         self.assertNotEqual(orig_room1, new_room1)
         self.assertEqual(new_room1.name, 'Room1')
         self.assertEqual(new_room1.group, None)
-        self.assertEqual(new.roomxy[0][0], new_room1)
+        self.assertEqual(new.get_room_at(0, 0), new_room1)
         self.assertEqual(new.rooms[orig_room1.idnum], new_room1)
         new_room2 = new.get_room_at(1, 1)
         self.assertNotEqual(orig_room2, new_room2)
         self.assertEqual(new_room2.name, 'Room2')
         self.assertEqual(new_room2.group, None)
-        self.assertEqual(new.roomxy[1][1], new_room2)
+        self.assertEqual(new.get_room_at(1, 1), new_room2)
         self.assertEqual(new.rooms[orig_room2.idnum], new_room2)
 
     def test_duplicate_one_connection_symmetric_basic(self):
@@ -324,7 +331,7 @@ class MapTests(unittest.TestCase):
         r2 = original.add_room_at(1, 1, 'Room 2')
         c = original.connect(r1, DIR_N, r2, DIR_S)
         c.connect_extra(r1, DIR_NE)
-        r1.loopbacks[DIR_NE] = True
+        r1.loopback_mask |= DIR_BIT[DIR_NE]
 
         with self.assertRaises(Exception) as cm:
             original.duplicate()
@@ -435,28 +442,101 @@ class MapTests(unittest.TestCase):
         mapobj.cur_id = 0
         self.assertEqual(mapobj.grab_id(), 1)
 
-    def test_grab_id_loop(self):
+    def test_grab_id_past_short(self):
         """
-        Tests grabbing a new Room ID when the ID is due to
-        be looped around to zero again.
+        Tests grabbing a new Room ID past 65535.  Prior to v12 the
+        IDs looped back around to zero at that point, but room IDs
+        are varints now.
         """
         mapobj = Map('Map')
         mapobj.cur_id = 65535
         mapobj.add_room_at(1, 1, 'Room')
-        self.assertEqual(mapobj.grab_id(), 0)
+        self.assertEqual(mapobj.grab_id(), 65536)
 
-    def test_grab_loop_id_exhausted(self):
+    def test_grab_id_many_rooms(self):
         """
-        We support 65535 rooms.  (This test takes
-        about twice the time of all the other tests
-        combined.  Yay!)
+        We used to only support 65535 rooms; make sure that we can
+        grab an ID when all of those are taken.
         """
         mapobj = Map('Map')
         for i in range(65536):
             mapobj.rooms[i] = True
-        with self.assertRaises(Exception) as cm:
-            mapobj.grab_id()
-        self.assertIn('No free room IDs', str(cm.exception))
+        self.assertEqual(mapobj.grab_id(), 65536)
+
+    def test_grab_id_reuse(self):
+        """
+        IDs from deleted rooms should get handed out again, lowest first
+        """
+        mapobj = Map('Map')
+        rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(6)]
+        mapobj.del_room(rooms[4])
+        mapobj.del_room(rooms[1])
+        mapobj.del_room(rooms[2])
+        self.assertEqual(mapobj.free_ids[0], 1)
+        self.assertEqual(mapobj.grab_id(), 1)
+        self.assertEqual(mapobj.grab_id(), 1)
+        self.assertEqual(mapobj.add_room_at(1, 2, 'New 1').idnum, 1)
+        self.assertEqual(mapobj.add_room_at(2, 2, 'New 2').idnum, 2)
+
+        # An ID which was freed but has been used some other way since
+        # should be skipped
+        mapobj.inject_room_obj(Room(4, 3, 2))
+        self.assertEqual(mapobj.add_room_at(4, 2, 'New 3').idnum, 6)
+        self.assertEqual(mapobj.free_ids, [])
+
+    def test_grab_id_reuse_cycles(self):
+        """
+        Adding and deleting rooms over and over shouldn't keep queueing
+        up the same freed ID
+        """
+        mapobj = Map('Map')
+        mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 1, 'Room 2')
+        r3 = mapobj.add_room_at(3, 1, 'Room 3')
+        mapobj.del_room(r2)
+        for i in range(1000):
+            room = mapobj.add_room_at(5, 5, 'Churn')
+            self.assertEqual(room.idnum, 1)
+            self.assertEqual(mapobj.free_ids, [])
+            mapobj.del_room(room)
+            self.assertEqual(mapobj.free_ids, [1])
+
+        # Injecting a room with a freed ID further down the heap takes
+        # it out too
+        mapobj.del_room(r3)
+        mapobj.cur_id = 5
+        mapobj.release_id(2)
+        self.assertEqual(sorted(mapobj.free_ids), [1, 2])
+        mapobj.inject_room_obj(Room(2, 6, 6))
+        self.assertEqual(mapobj.free_ids, [1])
+        mapobj.del_room(mapobj.get_room(2))
+        self.assertEqual(sorted(mapobj.free_ids), [1, 2])
+
+    def test_grab_id_reuse_latest(self):
+        """
+        Deleting the most recently added room doesn't need to remember
+        its ID
+        """
+        mapobj = Map('Map')
+        mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 1, 'Room 2')
+        mapobj.del_room(r2)
+        self.assertEqual(mapobj.free_ids, [])
+        self.assertEqual(mapobj.grab_id(), 1)
+
+    def test_grab_id_duplicate(self):
+        """
+        A duplicated map should carry on handing out IDs where we left off
+        """
+        mapobj = Map('Map')
+        rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(4)]
+        mapobj.del_room(rooms[1])
+        new = mapobj.duplicate()
+        self.assertEqual(new.cur_id, mapobj.cur_id)
+        self.assertEqual(new.grab_id(), 1)
+        new.add_room_at(1, 1, 'New')
+        self.assertEqual(new.grab_id(), 4)
+        self.assertEqual(mapobj.grab_id(), 1)
 
     def test_inject_room_obj(self):
         """
@@ -468,7 +548,7 @@ class MapTests(unittest.TestCase):
         mapobj.inject_room_obj(r)
         self.assertEqual(len(mapobj.rooms), 1)
         self.assertEqual(mapobj.rooms[1], r)
-        self.assertEqual(mapobj.roomxy[3][2], r)
+        self.assertEqual(mapobj.get_room_at(2, 3), r)
 
     def test_inject_room_fail_duplicate_xy(self):
         """
@@ -504,18 +584,19 @@ class MapTests(unittest.TestCase):
         self.assertEqual(r.name, 'Room')
         self.assertEqual(len(mapobj.rooms), 1)
         self.assertEqual(mapobj.rooms[0], r)
-        self.assertEqual(mapobj.roomxy[2][1], r)
+        self.assertEqual(mapobj.get_room_at(1, 2), r)
 
-    def test_add_room_at_too_many_rooms(self):
+    def test_add_room_at_many_rooms(self):
         """
-        Test adding a room when we already have too many.
+        Test adding a room when we already have 65535 of them, which
+        used to be our limit.
         """
         mapobj = Map('Map')
         for i in range(65535):
             mapobj.rooms[i] = True
-        with self.assertRaises(Exception) as cm:
-            mapobj.add_room_at(1, 1, 'Room')
-        self.assertIn('Can only have 65535 rooms', str(cm.exception))
+        r = mapobj.add_room_at(1, 1, 'Room')
+        self.assertEqual(r.idnum, 65535)
+        self.assertEqual(len(mapobj.rooms), 65536)
 
     def test_add_room_at_coords_already_taken(self):
         """
@@ -569,6 +650,10 @@ class MapTests(unittest.TestCase):
         mapobj = Map('Map')
         with self.assertRaises(IndexError) as cm:
             mapobj.get_room_at(90, 90)
+        with self.assertRaises(IndexError) as cm:
+            mapobj.get_room_at(-1, 0)
+        with self.assertRaises(IndexError) as cm:
+            mapobj.get_room_at(0, 9)
 
     def test_connect_basic_no_direction_specified(self):
         """
@@ -737,19 +822,19 @@ class MapTests(unittest.TestCase):
             mapobj.connect_id(0, DIR_N, 1)
         self.assertIn('Must specify two valid rooms', str(cm.exception))
 
-    def test_connect_failed_too_many_connections(self):
+    def test_connect_many_connections(self):
         """
-        Our file format "only" supports 65535 connections per map.  Check
-        for that.
+        Our file format used to "only" support 65535 connections per map.
+        Make sure that's no longer a limit.
         """
         mapobj = Map('Map')
         r1 = mapobj.add_room_at(1, 1, 'Room 1')
         r2 = mapobj.add_room_at(2, 2, 'Room 2')
         for i in range(65535):
-            mapobj.conns.append(True)
-        with self.assertRaises(Exception) as cm:
-            mapobj.connect(r1, DIR_N, r2)
-        self.assertIn('Can only have 65535 connections', str(cm.exception))
+            mapobj.conns.append(object())
+        conn = mapobj.connect(r1, DIR_N, r2)
+        self.assertNotEqual(conn, None)
+        self.assertEqual(len(mapobj.conns), 65536)
 
     def test_detach_without_anything_to_do(self):
         """
@@ -895,10 +980,10 @@ class MapTests(unittest.TestCase):
         mapobj = Map('Map')
         r = mapobj.add_room_at(1, 1, 'Room 1')
         self.assertEqual(len(mapobj.rooms), 1)
-        self.assertEqual(mapobj.roomxy[1][1], r)
+        self.assertEqual(mapobj.get_room_at(1, 1), r)
         mapobj.del_room(r)
         self.assertEqual(len(mapobj.rooms), 0)
-        self.assertEqual(mapobj.roomxy[1][1], None)
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
 
     def test_del_room_single_connection(self):
         """
@@ -909,15 +994,15 @@ class MapTests(unittest.TestCase):
         r2 = mapobj.add_room_at(2, 2, 'Room 2')
         mapobj.connect(r1, DIR_N, r2)
         self.assertEqual(len(mapobj.rooms), 2)
-        self.assertEqual(mapobj.roomxy[1][1], r1)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), r1)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 1)
         self.assertIn(DIR_S, r2.conns)
 
         mapobj.del_room(r1)
         self.assertEqual(len(mapobj.rooms), 1)
-        self.assertEqual(mapobj.roomxy[1][1], None)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 0)
         self.assertNotIn(DIR_S, r2.conns)
 
@@ -931,11 +1016,11 @@ class MapTests(unittest.TestCase):
         r3 = mapobj.add_room_at(3, 3, 'Room 2')
         mapobj.connect(r1, DIR_N, r2)
         mapobj.connect(r1, DIR_S, r3)
-        mapobj.connect(r2, DIR_E, r3)
+        c3 = mapobj.connect(r2, DIR_E, r3)
         self.assertEqual(len(mapobj.rooms), 3)
-        self.assertEqual(mapobj.roomxy[1][1], r1)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
-        self.assertEqual(mapobj.roomxy[3][3], r3)
+        self.assertEqual(mapobj.get_room_at(1, 1), r1)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
+        self.assertEqual(mapobj.get_room_at(3, 3), r3)
         self.assertEqual(len(mapobj.conns), 3)
         self.assertIn(DIR_S, r2.conns)
         self.assertIn(DIR_E, r2.conns)
@@ -944,10 +1029,10 @@ class MapTests(unittest.TestCase):
 
         mapobj.del_room(r1)
         self.assertEqual(len(mapobj.rooms), 2)
-        self.assertEqual(mapobj.roomxy[1][1], None)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
-        self.assertEqual(mapobj.roomxy[3][3], r3)
-        self.assertEqual(len(mapobj.conns), 1)
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
+        self.assertEqual(mapobj.get_room_at(3, 3), r3)
+        self.assertEqual(list(mapobj.conns), [c3])
         self.assertNotIn(DIR_S, r2.conns)
         self.assertNotIn(DIR_N, r3.conns)
         self.assertIn(DIR_E, r2.conns)
@@ -964,15 +1049,15 @@ class MapTests(unittest.TestCase):
         c = mapobj.connect(r1, DIR_N, r2)
         c.connect_extra(r1, DIR_NE)
         self.assertEqual(len(mapobj.rooms), 2)
-        self.assertEqual(mapobj.roomxy[1][1], r1)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), r1)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 1)
         self.assertIn(DIR_S, r2.conns)
 
         mapobj.del_room(r1)
         self.assertEqual(len(mapobj.rooms), 1)
-        self.assertEqual(mapobj.roomxy[1][1], None)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 0)
         self.assertNotIn(DIR_S, r2.conns)
 
@@ -987,16 +1072,16 @@ class MapTests(unittest.TestCase):
         c = mapobj.connect(r1, DIR_N, r2)
         c.connect_extra(r2, DIR_SW)
         self.assertEqual(len(mapobj.rooms), 2)
-        self.assertEqual(mapobj.roomxy[1][1], r1)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), r1)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 1)
         self.assertIn(DIR_S, r2.conns)
         self.assertIn(DIR_SW, r2.conns)
 
         mapobj.del_room(r1)
         self.assertEqual(len(mapobj.rooms), 1)
-        self.assertEqual(mapobj.roomxy[1][1], None)
-        self.assertEqual(mapobj.roomxy[2][2], r2)
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
+        self.assertEqual(mapobj.get_room_at(2, 2), r2)
         self.assertEqual(len(mapobj.conns), 0)
         self.assertNotIn(DIR_S, r2.conns)
         self.assertNotIn(DIR_SW, r2.conns)
@@ -1122,8 +1207,8 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(result, True)
                 self.assertEqual(r.x, new_x)
                 self.assertEqual(r.y, new_y)
-                self.assertEqual(mapobj.roomxy[4][4], None)
-                self.assertEqual(mapobj.roomxy[new_y][new_x], r)
+                self.assertEqual(mapobj.get_room_at(4, 4), None)
+                self.assertEqual(mapobj.get_room_at(new_x, new_y), r)
 
     def test_move_room_blocked_by_other_room(self):
         """
@@ -1142,7 +1227,7 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(result, False)
                 self.assertEqual(rooms[4].x, 4)
                 self.assertEqual(rooms[4].y, 4)
-                self.assertEqual(mapobj.roomxy[4][4], rooms[4])
+                self.assertEqual(mapobj.get_room_at(4, 4), rooms[4])
 
     def test_move_room_blocked_by_map(self):
         """
@@ -1162,7 +1247,7 @@ class MapTests(unittest.TestCase):
                     self.assertEqual(rv, False)
                     self.assertEqual(room.x, cur_x)
                     self.assertEqual(room.y, cur_y)
-                    self.assertEqual(mapobj.roomxy[cur_y][cur_x], room)
+                    self.assertEqual(mapobj.get_room_at(cur_x, cur_y), room)
 
     def test_nudge_blocked(self):
         """
@@ -1191,11 +1276,11 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(r4.y, 0)
                 self.assertEqual(r5.x, 4)
                 self.assertEqual(r5.y, 4)
-                self.assertEqual(mapobj.roomxy[0][0], r1)
-                self.assertEqual(mapobj.roomxy[8][8], r2)
-                self.assertEqual(mapobj.roomxy[8][0], r3)
-                self.assertEqual(mapobj.roomxy[0][8], r4)
-                self.assertEqual(mapobj.roomxy[4][4], r5)
+                self.assertEqual(mapobj.get_room_at(0, 0), r1)
+                self.assertEqual(mapobj.get_room_at(8, 8), r2)
+                self.assertEqual(mapobj.get_room_at(0, 8), r3)
+                self.assertEqual(mapobj.get_room_at(8, 0), r4)
+                self.assertEqual(mapobj.get_room_at(4, 4), r5)
 
     def test_nudge_worked(self):
         """
@@ -1233,10 +1318,10 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(r3.y, 5+dir_mods[direction][1])
                 self.assertEqual(r4.x, 5+dir_mods[direction][0])
                 self.assertEqual(r4.y, 5+dir_mods[direction][1])
-                self.assertEqual(mapobj.roomxy[4+dir_mods[direction][1]][4+dir_mods[direction][0]], r1)
-                self.assertEqual(mapobj.roomxy[4+dir_mods[direction][1]][5+dir_mods[direction][0]], r2)
-                self.assertEqual(mapobj.roomxy[5+dir_mods[direction][1]][4+dir_mods[direction][0]], r3)
-                self.assertEqual(mapobj.roomxy[5+dir_mods[direction][1]][5+dir_mods[direction][0]], r4)
+                self.assertEqual(mapobj.get_room_at(4+dir_mods[direction][0], 4+dir_mods[direction][1]), r1)
+                self.assertEqual(mapobj.get_room_at(5+dir_mods[direction][0], 4+dir_mods[direction][1]), r2)
+                self.assertEqual(mapobj.get_room_at(4+dir_mods[direction][0], 5+dir_mods[direction][1]), r3)
+                self.assertEqual(mapobj.get_room_at(5+dir_mods[direction][0], 5+dir_mods[direction][1]), r4)
 
     def test_nudge_subset_blocked(self):
         """
@@ -1273,16 +1358,16 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(r4.y, 1)
                 self.assertEqual(r5.x, 4)
                 self.assertEqual(r5.y, 4)
-                self.assertEqual(mapobj.roomxy[1][1], r1)
-                self.assertEqual(mapobj.roomxy[7][7], r2)
-                self.assertEqual(mapobj.roomxy[7][1], r3)
-                self.assertEqual(mapobj.roomxy[1][7], r4)
-                self.assertEqual(mapobj.roomxy[4][4], r5)
+                self.assertEqual(mapobj.get_room_at(1, 1), r1)
+                self.assertEqual(mapobj.get_room_at(7, 7), r2)
+                self.assertEqual(mapobj.get_room_at(1, 7), r3)
+                self.assertEqual(mapobj.get_room_at(7, 1), r4)
+                self.assertEqual(mapobj.get_room_at(4, 4), r5)
                 for (idx, x, y, blocker) in blockers:
                     with self.subTest(x=x, y=y):
                         self.assertEqual(blocker.x, x)
                         self.assertEqual(blocker.y, y)
-                        self.assertEqual(mapobj.roomxy[y][x], blocker)
+                        self.assertEqual(mapobj.get_room_at(x, y), blocker)
 
     def test_nudge_subset_worked(self):
         """
@@ -1325,15 +1410,15 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(r3.y, 5+dir_mods[direction][1])
                 self.assertEqual(r4.x, 5+dir_mods[direction][0])
                 self.assertEqual(r4.y, 5+dir_mods[direction][1])
-                self.assertEqual(mapobj.roomxy[4+dir_mods[direction][1]][4+dir_mods[direction][0]], r1)
-                self.assertEqual(mapobj.roomxy[4+dir_mods[direction][1]][5+dir_mods[direction][0]], r2)
-                self.assertEqual(mapobj.roomxy[5+dir_mods[direction][1]][4+dir_mods[direction][0]], r3)
-                self.assertEqual(mapobj.roomxy[5+dir_mods[direction][1]][5+dir_mods[direction][0]], r4)
+                self.assertEqual(mapobj.get_room_at(4+dir_mods[direction][0], 4+dir_mods[direction][1]), r1)
+                self.assertEqual(mapobj.get_room_at(5+dir_mods[direction][0], 4+dir_mods[direction][1]), r2)
+                self.assertEqual(mapobj.get_room_at(4+dir_mods[direction][0], 5+dir_mods[direction][1]), r3)
+                self.assertEqual(mapobj.get_room_at(5+dir_mods[direction][0], 5+dir_mods[direction][1]), r4)
                 for (idx, x, y, blocker) in blockers:
                     with self.subTest(x=x, y=y):
                         self.assertEqual(blocker.x, x)
                         self.assertEqual(blocker.y, y)
-                        self.assertEqual(mapobj.roomxy[y][x], blocker)
+                        self.assertEqual(mapobj.get_room_at(x, y), blocker)
 
     def test_nudge_subset_empty(self):
         """
@@ -1363,11 +1448,243 @@ class MapTests(unittest.TestCase):
                 self.assertEqual(r4.y, 1)
                 self.assertEqual(r5.x, 4)
                 self.assertEqual(r5.y, 4)
-                self.assertEqual(mapobj.roomxy[1][1], r1)
-                self.assertEqual(mapobj.roomxy[7][7], r2)
-                self.assertEqual(mapobj.roomxy[7][1], r3)
-                self.assertEqual(mapobj.roomxy[1][7], r4)
-                self.assertEqual(mapobj.roomxy[4][4], r5)
+                self.assertEqual(mapobj.get_room_at(1, 1), r1)
+                self.assertEqual(mapobj.get_room_at(7, 7), r2)
+                self.assertEqual(mapobj.get_room_at(1, 7), r3)
+                self.assertEqual(mapobj.get_room_at(7, 1), r4)
+                self.assertEqual(mapobj.get_room_at(4, 4), r5)
+
+    def test_nudge_multiple_steps(self):
+        """
+        Tests nudging rooms by more than one space at once, jumping over
+        a room in the way
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 1, 'Room 2')
+        blocker = mapobj.add_room_at(3, 1, 'Blocker')
+        rv = mapobj.nudge(DIR_E, set([r1, r2]), 3)
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (4, 1))
+        self.assertEqual((r2.x, r2.y), (5, 1))
+        self.assertEqual(mapobj.get_room_at(1, 1), None)
+        self.assertEqual(mapobj.get_room_at(2, 1), None)
+        self.assertEqual(mapobj.get_room_at(3, 1), blocker)
+        self.assertEqual(mapobj.get_room_at(4, 1), r1)
+        self.assertEqual(mapobj.get_room_at(5, 1), r2)
+
+    def test_move_rooms_swap(self):
+        """
+        Tests moving rooms into spaces which other moving rooms are
+        leaving
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 1, 'Room 2')
+        mapobj.savedata = (mapobj.name, b'')
+        rv = mapobj.move_rooms([(r1, 2, 1), (r2, 1, 1)])
+        self.assertEqual(rv, True)
+        self.assertEqual(mapobj.is_dirty(), True)
+        self.assertEqual((r1.x, r1.y), (2, 1))
+        self.assertEqual((r2.x, r2.y), (1, 1))
+        self.assertEqual(mapobj.get_room_at(2, 1), r1)
+        self.assertEqual(mapobj.get_room_at(1, 1), r2)
+
+    def test_move_rooms_blocked(self):
+        """
+        Tests moving rooms where one of them can't go where it's told.
+        None of the rooms should move.
+        """
+        for (x, y) in [(3, 1), (-1, 1), (9, 1), (2, 1)]:
+            with self.subTest(x=x, y=y):
+                mapobj = Map('Map')
+                r1 = mapobj.add_room_at(1, 1, 'Room 1')
+                r2 = mapobj.add_room_at(4, 1, 'Room 2')
+                mapobj.add_room_at(3, 1, 'Blocker')
+                rv = mapobj.move_rooms([(r1, 2, 1), (r2, x, y)])
+                self.assertEqual(rv, False)
+                self.assertEqual((r1.x, r1.y), (1, 1))
+                self.assertEqual((r2.x, r2.y), (4, 1))
+                self.assertEqual(mapobj.get_room_at(1, 1), r1)
+                self.assertEqual(mapobj.get_room_at(4, 1), r2)
+                self.assertEqual(mapobj.get_room_at(2, 1), None)
+
+    def test_move_rooms_empty(self):
+        """
+        Tests moving no rooms at all
+        """
+        mapobj = Map('Map')
+        mapobj.add_room_at(1, 1, 'Room 1')
+        self.assertEqual(mapobj.move_rooms([]), False)
+
+    def test_mirror_horizontal(self):
+        """
+        Tests mirroring rooms left-to-right, along with their connections
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 2, 'Room 1')
+        r2 = mapobj.add_room_at(3, 3, 'Room 2')
+        r3 = mapobj.add_room_at(5, 2, 'Room 3')
+        outside = mapobj.add_room_at(1, 2, 'Outside')
+        c1 = mapobj.connect(r1, DIR_SE, r2)
+        c2 = mapobj.connect(r1, DIR_W, outside)
+        c3 = mapobj.connect(r2, DIR_NE, r3, DIR_S)
+        c3.connect_extra(r3, DIR_SW)
+        r3.set_loopback(DIR_E)
+        r1.offset_x = True
+
+        rv = mapobj.mirror(set([r1, r2, r3]))
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (5, 2))
+        self.assertEqual((r2.x, r2.y), (4, 3))
+        self.assertEqual((r3.x, r3.y), (2, 2))
+        self.assertEqual((outside.x, outside.y), (1, 2))
+        self.assertEqual(mapobj.get_room_at(3, 3), None)
+        self.assertEqual(mapobj.get_room_at(4, 3), r2)
+        self.assertEqual(r1.offset_x, True)
+
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_SW, DIR_NE))
+        self.assertEqual((c2.dir1, c2.dir2), (DIR_E, DIR_E))
+        self.assertEqual((c3.dir1, c3.dir2), (DIR_NW, DIR_S))
+        self.assertEqual(sorted(c3.ends2.keys()), [DIR_SE, DIR_S])
+        for (direction, end) in c3.ends2.items():
+            self.assertEqual(end.direction, direction)
+        self.assertEqual(r1.conns, {DIR_SW: c1, DIR_E: c2})
+        self.assertEqual(r2.conns, {DIR_NE: c1, DIR_NW: c3})
+        self.assertEqual(r3.conns, {DIR_S: c3, DIR_SE: c3})
+        self.assertEqual(outside.conns, {DIR_E: c2})
+        self.assertEqual(r3.loopbacks, {DIR_W: True})
+        self.assertEqual(r3.dir_in_use(DIR_W), True)
+        self.assertEqual(r3.dir_in_use(DIR_E), False)
+
+    def test_mirror_vertical(self):
+        """
+        Tests flipping rooms top-to-bottom, along with their connections
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 1, 'Room 1')
+        r2 = mapobj.add_room_at(3, 4, 'Room 2')
+        c1 = mapobj.connect(r1, DIR_SE, r2, DIR_N)
+        rv = mapobj.mirror(set([r1, r2]), True)
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (2, 4))
+        self.assertEqual((r2.x, r2.y), (3, 1))
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_NE, DIR_S))
+        self.assertEqual(r1.conns, {DIR_NE: c1})
+        self.assertEqual(r2.conns, {DIR_S: c1})
+
+    def test_mirror_single_room(self):
+        """
+        Tests mirroring a single room, which only turns its connections
+        around
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 2, 'Room 1')
+        r2 = mapobj.add_room_at(3, 2, 'Room 2')
+        c1 = mapobj.connect(r1, DIR_E, r2)
+        rv = mapobj.mirror(set([r1]))
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (2, 2))
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_W, DIR_W))
+
+    def test_mirror_empty(self):
+        """
+        Tests mirroring no rooms at all
+        """
+        mapobj = Map('Map')
+        self.assertEqual(mapobj.mirror(set()), False)
+        self.assertEqual(mapobj.mirror(set(), True), False)
+
+    def test_rotate_clockwise(self):
+        """
+        Tests rotating rooms clockwise, along with their connections
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 2, 'Room 1')
+        r2 = mapobj.add_room_at(3, 2, 'Room 2')
+        r3 = mapobj.add_room_at(4, 2, 'Room 3')
+        r4 = mapobj.add_room_at(2, 3, 'Room 4')
+        c1 = mapobj.connect(r1, DIR_E, r2)
+        c2 = mapobj.connect(r2, DIR_E, r3)
+        c3 = mapobj.connect(r1, DIR_S, r4)
+        r3.set_loopback(DIR_NE)
+        r1.offset_x = True
+
+        rv = mapobj.rotate(set([r1, r2, r3, r4]))
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (3, 2))
+        self.assertEqual((r2.x, r2.y), (3, 3))
+        self.assertEqual((r3.x, r3.y), (3, 4))
+        self.assertEqual((r4.x, r4.y), (2, 2))
+        self.assertEqual(mapobj.get_room_at(4, 2), None)
+        self.assertEqual(mapobj.get_room_at(3, 4), r3)
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_S, DIR_N))
+        self.assertEqual((c2.dir1, c2.dir2), (DIR_S, DIR_N))
+        self.assertEqual((c3.dir1, c3.dir2), (DIR_W, DIR_E))
+        self.assertEqual(r1.conns, {DIR_S: c1, DIR_W: c3})
+        self.assertEqual(r3.loopbacks, {DIR_SE: True})
+        self.assertEqual((r1.offset_x, r1.offset_y), (False, True))
+
+    def test_rotate_anticlockwise(self):
+        """
+        Tests rotating rooms anticlockwise, along with their connections
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 2, 'Room 1')
+        r2 = mapobj.add_room_at(3, 2, 'Room 2')
+        r3 = mapobj.add_room_at(4, 2, 'Room 3')
+        r4 = mapobj.add_room_at(2, 3, 'Room 4')
+        c1 = mapobj.connect(r1, DIR_E, r2)
+        c3 = mapobj.connect(r1, DIR_S, r4)
+
+        rv = mapobj.rotate(set([r1, r2, r3, r4]), False)
+        self.assertEqual(rv, True)
+        self.assertEqual((r1.x, r1.y), (2, 4))
+        self.assertEqual((r2.x, r2.y), (2, 3))
+        self.assertEqual((r3.x, r3.y), (2, 2))
+        self.assertEqual((r4.x, r4.y), (3, 4))
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_N, DIR_S))
+        self.assertEqual((c3.dir1, c3.dir2), (DIR_E, DIR_W))
+
+    def test_rotate_round_trip(self):
+        """
+        Tests that four rotations put everything back where it started
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(2, 2, 'Room 1')
+        r2 = mapobj.add_room_at(5, 3, 'Room 2')
+        c1 = mapobj.connect(r1, DIR_NE, r2, DIR_W)
+        rooms = set([r1, r2])
+        for clockwise in [True, False]:
+            with self.subTest(clockwise=clockwise):
+                for i in range(4):
+                    self.assertEqual(mapobj.rotate(rooms, clockwise), True)
+                self.assertEqual((r1.x, r1.y), (2, 2))
+                self.assertEqual((r2.x, r2.y), (5, 3))
+                self.assertEqual((c1.dir1, c1.dir2), (DIR_NE, DIR_W))
+
+    def test_rotate_blocked(self):
+        """
+        Tests rotating rooms where they'd end up off the map, or on top
+        of another room.  Nothing should change.
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(6, 8, 'Room 1')
+        r2 = mapobj.add_room_at(7, 8, 'Room 2')
+        r3 = mapobj.add_room_at(6, 6, 'Room 3')
+        r4 = mapobj.add_room_at(8, 6, 'Room 4')
+        c1 = mapobj.connect(r1, DIR_E, r2)
+        r1.offset_x = True
+        blocker = mapobj.add_room_at(7, 7, 'Blocker')
+        for (rooms, clockwise) in [(set([r1, r2]), True), (set([r3, r4]), True)]:
+            with self.subTest(rooms=len(rooms)):
+                self.assertEqual(mapobj.rotate(rooms, clockwise), False)
+        self.assertEqual((r1.x, r1.y), (6, 8))
+        self.assertEqual((r2.x, r2.y), (7, 8))
+        self.assertEqual((r4.x, r4.y), (8, 6))
+        self.assertEqual((c1.dir1, c1.dir2), (DIR_E, DIR_W))
+        self.assertEqual((r1.offset_x, r1.offset_y), (True, False))
+        self.assertEqual(mapobj.get_room_at(7, 7), blocker)
 
     def test_resize_invalid_direction(self):
         """
@@ -1389,9 +1706,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, True)
         self.assertEqual(mapobj.w, 10)
         self.assertEqual(mapobj.h, 9)
-        for y in range(9):
-            with self.subTest(y=y):
-                self.assertEqual(len(mapobj.roomxy[y]), 10)
+        self.assertMapSize(mapobj, 10, 9)
 
     def test_resize_w_success(self):
         """
@@ -1402,9 +1717,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, True)
         self.assertEqual(mapobj.w, 8)
         self.assertEqual(mapobj.h, 9)
-        for y in range(9):
-            with self.subTest(y=y):
-                self.assertEqual(len(mapobj.roomxy[y]), 8)
+        self.assertMapSize(mapobj, 8, 9)
 
     def test_resize_s_success(self):
         """
@@ -1415,7 +1728,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, True)
         self.assertEqual(mapobj.w, 9)
         self.assertEqual(mapobj.h, 10)
-        self.assertEqual(len(mapobj.roomxy), 10)
+        self.assertMapSize(mapobj, 9, 10)
 
     def test_resize_n_success(self):
         """
@@ -1426,22 +1739,20 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, True)
         self.assertEqual(mapobj.w, 9)
         self.assertEqual(mapobj.h, 8)
-        self.assertEqual(len(mapobj.roomxy), 8)
+        self.assertMapSize(mapobj, 9, 8)
 
-    def test_resize_e_fail_boundary(self):
+    def test_resize_e_past_byte(self):
         """
-        Resize to the east and fail due to boundary constraints
+        Resize to the east past 255, which used to be our limit
         """
         mapobj = Map('Map')
         while mapobj.w < 255:
             mapobj.resize(DIR_E)
         rv = mapobj.resize(DIR_E)
-        self.assertEqual(rv, False)
-        self.assertEqual(mapobj.w, 255)
+        self.assertEqual(rv, True)
+        self.assertEqual(mapobj.w, 256)
         self.assertEqual(mapobj.h, 9)
-        for y in range(9):
-            with self.subTest(y=y):
-                self.assertEqual(len(mapobj.roomxy[y]), 255)
+        self.assertMapSize(mapobj, 256, 9)
 
     def test_resize_w_fail_boundary(self):
         """
@@ -1454,22 +1765,20 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, False)
         self.assertEqual(mapobj.w, 1)
         self.assertEqual(mapobj.h, 9)
-        for y in range(9):
-            with self.subTest(y=y):
-                self.assertEqual(len(mapobj.roomxy[y]), 1)
+        self.assertMapSize(mapobj, 1, 9)
 
-    def test_resize_s_fail_boundary(self):
+    def test_resize_s_past_byte(self):
         """
-        Resize to the south and fail due to boundary constraints
+        Resize to the south past 255, which used to be our limit
         """
         mapobj = Map('Map')
         while mapobj.h < 255:
             mapobj.resize(DIR_S)
         rv = mapobj.resize(DIR_S)
-        self.assertEqual(rv, False)
+        self.assertEqual(rv, True)
         self.assertEqual(mapobj.w, 9)
-        self.assertEqual(mapobj.h, 255)
-        self.assertEqual(len(mapobj.roomxy), 255)
+        self.assertEqual(mapobj.h, 256)
+        self.assertMapSize(mapobj, 9, 256)
 
     def test_resize_n_fail_boundary(self):
         """
@@ -1482,7 +1791,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, False)
         self.assertEqual(mapobj.w, 9)
         self.assertEqual(mapobj.h, 1)
-        self.assertEqual(len(mapobj.roomxy), 1)
+        self.assertMapSize(mapobj, 9, 1)
 
     def test_resize_w_fail_room(self):
         """
@@ -1494,9 +1803,7 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, False)
         self.assertEqual(mapobj.w, 9)
         self.assertEqual(mapobj.h, 9)
-        for y in range(9):
-            with self.subTest(y=y):
-                self.assertEqual(len(mapobj.roomxy[y]), 9)
+        self.assertMapSize(mapobj, 9, 9)
 
     def test_resize_n_fail_room(self):
         """
@@ -1508,7 +1815,45 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, False)
         self.assertEqual(mapobj.w, 9)
         self.assertEqual(mapobj.h, 9)
-        self.assertEqual(len(mapobj.roomxy), 9)
+        self.assertMapSize(mapobj, 9, 9)
+
+    def test_resize_after_moving_room(self):
+        """
+        Resizing should notice rooms being moved out of the way
+        """
+        mapobj = Map('Map')
+        r = mapobj.add_room_at(8, 8, 'Room')
+        self.assertEqual(mapobj.resize(DIR_N), False)
+        self.assertEqual(mapobj.resize(DIR_W), False)
+        mapobj.move_room(r, DIR_NW)
+        self.assertEqual(mapobj.resize(DIR_N), True)
+        self.assertEqual(mapobj.resize(DIR_W), True)
+        self.assertMapSize(mapobj, 8, 8)
+        self.assertEqual(mapobj.get_room_at(7, 7), r)
+        mapobj.del_room(r)
+        self.assertEqual(mapobj.resize(DIR_N), True)
+        self.assertEqual(mapobj.resize(DIR_W), True)
+
+    def test_huge_sparse_map(self):
+        """
+        A huge map with just a few rooms on it shouldn't need much
+        """
+        mapobj = Map('Map')
+        mapobj.set_map_size(100000, 100000)
+        r1 = mapobj.add_room_at(0, 0, 'Room 1')
+        r2 = mapobj.add_room_at(99999, 99999, 'Room 2')
+        self.assertEqual(mapobj.get_room_at(0, 0), r1)
+        self.assertEqual(mapobj.get_room_at(99999, 99999), r2)
+        self.assertEqual(mapobj.get_room_at(50000, 50000), None)
+        self.assertEqual(len(mapobj.grid.rows), 2)
+        self.assertEqual(mapobj.resize(DIR_N), False)
+        mapobj.del_room(r2)
+        self.assertEqual(mapobj.resize(DIR_N), True)
+        self.assertEqual(mapobj.resize(DIR_E), True)
+        self.assertMapSize(mapobj, 100001, 99999)
+        new = mapobj.duplicate()
+        self.assertEqual(new.get_room_at(0, 0).name, 'Room 1')
+        self.assertEqual(len(new.grid.rows), 1)
 
     def test_remove_room_from_group_delete_group(self):
         """
@@ -1716,6 +2061,176 @@ class MapTests(unittest.TestCase):
         self.assertEqual(rv, False)
         self.assertEqual(len(mapobj.groups), 0)
 
+    def test_group_room_list_new_group(self):
+        """
+        Grouping a list of ungrouped rooms together
+        """
+        mapobj = Map('Map')
+        rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(4)]
+        self.assertEqual(mapobj.group_room_list(rooms[:1]), False)
+        self.assertEqual(len(mapobj.groups), 0)
+        self.assertEqual(mapobj.group_room_list(rooms), True)
+        self.assertEqual(len(mapobj.groups), 1)
+        g = mapobj.groups[0]
+        self.assertEqual(g.get_rooms(), rooms)
+        for room in rooms:
+            self.assertEqual(room.group, g)
+
+    def test_group_room_list_existing_group(self):
+        """
+        Adding a list of rooms to an existing group, skipping the ones
+        which are already in a group
+        """
+        mapobj = Map('Map')
+        rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(6)]
+        mapobj.group_rooms(rooms[0], rooms[1])
+        mapobj.group_rooms(rooms[4], rooms[5])
+        (g1, g2) = mapobj.groups
+        mapobj.mark_saved('Map.adv', None, 0, 0)
+        self.assertEqual(mapobj.group_room_list([rooms[0], rooms[4]], g1), False)
+        self.assertEqual(mapobj.is_dirty(), False)
+        self.assertEqual(mapobj.group_room_list(rooms[1:], g1), True)
+        self.assertEqual(mapobj.is_dirty(), True)
+        self.assertEqual(g1.get_rooms(), rooms[:4])
+        self.assertEqual(g2.get_rooms(), rooms[4:])
+        self.assertEqual(rooms[3].group, g1)
+
+    def test_group_removal_keeps_order(self):
+        """
+        Removing a group from the middle of the list keeps the others
+        in order
+        """
+        mapobj = Map('Map')
+        rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(6)]
+        for i in range(0, 6, 2):
+            mapobj.group_rooms(rooms[i], rooms[i+1])
+        (g1, g2, g3) = mapobj.groups
+        mapobj.remove_room_from_group(rooms[2])
+        self.assertEqual(list(mapobj.groups), [g1, g3])
+        self.assertEqual(rooms[3].group, None)
+        self.assertEqual([group.to_record() for group in mapobj.groups],
+                [(Group.STYLE_NORMAL, (0, 1)), (Group.STYLE_NORMAL, (4, 5))])
+
+    def get_clean_map(self):
+        """
+        Returns a map with a few rooms, a connection, and a group, which
+        has been flagged as not having changed since its last save.
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 2, 'Room 2')
+        r3 = mapobj.add_room_at(3, 3, 'Room 3')
+        mapobj.connect(r1, DIR_N, r2)
+        mapobj.group_rooms(r2, r3)
+        mapobj.mark_saved('Map.adv', None, 0, 0)
+        self.assertEqual(mapobj.is_dirty(), False)
+        return (mapobj, r1, r2, r3)
+
+    def test_dirty_new_map(self):
+        """
+        A brand new map has never been saved, so is dirty
+        """
+        mapobj = Map('Map')
+        self.assertEqual(mapobj.is_dirty(), True)
+        self.assertEqual(mapobj.savedata, None)
+
+    def test_dirty_get_savedata(self):
+        """
+        Getting our save data just encodes us; it shouldn't mark us clean,
+        or hang on to the data.
+        """
+        (mapobj, r1, r2, r3) = self.get_clean_map()
+        mapobj.mark_dirty()
+        data = mapobj.get_savedata()
+        df = self.getSavefile()
+        mapobj.save(df)
+        df.seek(0)
+        self.assertEqual(df.read(), data)
+        self.assertEqual(mapobj.is_dirty(), True)
+        self.assertEqual(mapobj.savedata, None)
+        self.assertIsNot(mapobj.get_savedata(), data)
+        self.assertEqual(mapobj.get_savedata(), data)
+
+    def test_dirty_room_changes(self):
+        """
+        Changing rooms, connections or groups directly (as the GUI does)
+        should mark the map dirty, without anyone calling `mark_dirty`
+        """
+        for (label, func) in [
+                ('name', lambda m, r1, r2, r3: setattr(r1, 'name', 'Renamed')),
+                ('notes', lambda m, r1, r2, r3: setattr(r1, 'notes', 'Notes')),
+                ('up', lambda m, r1, r2, r3: setattr(r1, 'up', 'Up')),
+                ('type', lambda m, r1, r2, r3: setattr(r1, 'type', Room.TYPE_DARK)),
+                ('color', lambda m, r1, r2, r3: setattr(r1, 'color', Room.COLOR_RED)),
+                ('offset_x', lambda m, r1, r2, r3: setattr(r1, 'offset_x', 1)),
+                ('loopback', lambda m, r1, r2, r3: r1.loopbacks.__setitem__(DIR_S, True)),
+                ('conn_type', lambda m, r1, r2, r3: r1.conns[DIR_N].set_ladder(r1, DIR_N)),
+                ('group_style', lambda m, r1, r2, r3: setattr(r2.group, 'style', Group.STYLE_FAINT)),
+                ]:
+            with self.subTest(label=label):
+                (mapobj, r1, r2, r3) = self.get_clean_map()
+                func(mapobj, r1, r2, r3)
+                self.assertEqual(mapobj.is_dirty(), True)
+
+    def test_dirty_removed_room(self):
+        """
+        Once a room has been taken off the map, changing it shouldn't
+        mark the map dirty any more
+        """
+        (mapobj, r1, r2, r3) = self.get_clean_map()
+        mapobj.del_room(r1)
+        mapobj.mark_saved('Map.adv', None, 0, 0)
+        r1.name = 'Renamed'
+        self.assertEqual(mapobj.is_dirty(), False)
+
+    def test_dirty_rename(self):
+        """
+        Renaming a map should make it dirty
+        """
+        (mapobj, r1, r2, r3) = self.get_clean_map()
+        mapobj.name = 'New Name'
+        self.assertEqual(mapobj.is_dirty(), True)
+
+    def test_dirty_mutators(self):
+        """
+        Every mutating method should mark the map dirty
+        """
+        for (label, func) in [
+                ('set_map_size', lambda m, r1, r2, r3: m.set_map_size(5, 5)),
+                ('inject_room_obj', lambda m, r1, r2, r3: m.inject_room_obj(Room(42, 5, 5))),
+                ('add_room_at', lambda m, r1, r2, r3: m.add_room_at(5, 5, 'Room')),
+                ('connect', lambda m, r1, r2, r3: m.connect(r2, DIR_E, r3)),
+                ('detach', lambda m, r1, r2, r3: m.detach(r1, DIR_N)),
+                ('del_room', lambda m, r1, r2, r3: m.del_room(r3)),
+                ('move_room', lambda m, r1, r2, r3: m.move_room(r1, DIR_W)),
+                ('nudge', lambda m, r1, r2, r3: m.nudge(DIR_E)),
+                ('resize', lambda m, r1, r2, r3: m.resize(DIR_E)),
+                ('remove_room_from_group', lambda m, r1, r2, r3: m.remove_room_from_group(r2)),
+                ('group_rooms', lambda m, r1, r2, r3: m.group_rooms(r1, r2)),
+                ]:
+            with self.subTest(label=label):
+                (mapobj, r1, r2, r3) = self.get_clean_map()
+                func(mapobj, r1, r2, r3)
+                self.assertEqual(mapobj.is_dirty(), True)
+
+    def test_dirty_failed_mutators(self):
+        """
+        Mutating methods which don't actually change anything shouldn't
+        mark the map dirty
+        """
+        for (label, func) in [
+                ('connect', lambda m, r1, r2, r3: m.connect(r1, DIR_N, r3)),
+                ('detach', lambda m, r1, r2, r3: m.detach(r3, DIR_N)),
+                ('move_room', lambda m, r1, r2, r3: m.move_room(r2, DIR_SE)),
+                ('resize', lambda m, r1, r2, r3: m.resize(DIR_NE)),
+                ('remove_room_from_group', lambda m, r1, r2, r3: m.remove_room_from_group(r1)),
+                ('group_rooms', lambda m, r1, r2, r3: m.group_rooms(r2, r3)),
+                ]:
+            with self.subTest(label=label):
+                (mapobj, r1, r2, r3) = self.get_clean_map()
+                func(mapobj, r1, r2, r3)
+                self.assertEqual(mapobj.is_dirty(), False)
+
     def test_save(self):
         """
         Tests saving a file.  Will have three rooms, two connections, and one group.
@@ -1731,27 +2246,73 @@ class MapTests(unittest.TestCase):
         df = self.getSavefile()
         mapobj.save(df)
         df.seek(0)
-        self.assertEqual(df.readstr(), 'Map')
-        self.assertEqual(df.readuchar(), 9)
-        self.assertEqual(df.readuchar(), 9)
-        self.assertEqual(df.readshort(), 3)
-        self.assertEqual(df.readshort(), 2)
-        self.assertEqual(df.readshort(), 1)
+        self.assertEqual(df.readvarstr(), 'Map')
+        self.assertEqual(df.readvarint(), 9)
+        self.assertEqual(df.readvarint(), 9)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 1)
+
+        # String table, in the order the strings were first seen
+        self.assertEqual(df.readvarint(), 4)
+        self.assertEqual(df.readvarstr(), 'Room 1')
+        self.assertEqual(df.readvarstr(), '')
+        self.assertEqual(df.readvarstr(), 'Room 2')
+        self.assertEqual(df.readvarstr(), 'Room 3')
 
         # Fudging quite a bit here because I don't want to bother
         # parsing out the actual room/conn/group structures, which
         # are all well-tested elsewhere.  Just counting up the room
-        # each structure takes.  Strings take three bytes plus the
-        # length of the string itself; our room names are all the
-        # same length so I can skip doing those dynamically.
+        # each structure takes.  All our values are small enough to
+        # fit into single-byte varints.
         for i in range(3):
-            df.read(34)
+            self.assertEqual(len(df.read(13)), 13)
         for i in range(2):
-            df.read(18)
-        df.read(7)
+            self.assertEqual(len(df.read(16)), 16)
+        self.assertEqual(len(df.read(4)), 4)
 
         self.assertEqual(df.eof(), True)
 
+    def test_save_loaded_text(self):
+        """
+        Text loaded from a v12 map shouldn't be decoded until it's used,
+        and should be saved back out byte-for-byte
+        """
+        df = self.getSavefile()
+        df.writevarstr('Map')
+        df.writevarints(9, 9, 2, 0, 0, 3)
+        df.writevarbytes(b'Room 1')
+        df.writevarbytes(b'')
+        df.writevarbytes(b'Bad \xff notes')
+        df.writevarints(1, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2)
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.writevarints(2, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1)
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.seek(0)
+        original = df.read()
+        df.seek(0)
+        mapobj = Map.load(df, 12)
+        r1 = mapobj.get_room(1)
+        self.assertEqual(r1._name, b'Room 1')
+        self.assertEqual(r1._notes, b'Bad \xff notes')
+        self.assertEqual(r1.notes, 'Bad \ufffd notes')
+
+        df = self.getSavefile()
+        mapobj.save(df)
+        df.seek(0)
+        self.assertEqual(df.read(), original)
+
+        # Changing a room gets its text re-encoded, but leaves the rest
+        mapobj.get_room(2).name = 'Room 2'
+        df = self.getSavefile()
+        mapobj.save(df)
+        df.seek(0)
+        mapobj = Map.load(df, 12)
+        self.assertEqual(mapobj.get_room(1).get_raw_strings()[5], b'Bad \xff notes')
+        self.assertEqual(mapobj.get_room(2).name, 'Room 2')
+
     def test_load_v1_blank_map(self):
         """
         Tests loading a very basic map without rooms, conections, or groups.
@@ -3339,3 +3900,509 @@ class MapTests(unittest.TestCase):
         self.assertEqual(ce2.conn_type, ConnectionEnd.CONN_LADDER)
         self.assertEqual(ce2.render_type, ConnectionEnd.RENDER_MIDPOINT_B)
         self.assertEqual(ce2.stub_length, ConnectionEnd.STUB_MAX)
+
+    def test_load_v12_large_map(self):
+        """
+        Tests loading a v12 map which is larger than the older formats
+        could store, with two rooms, a connection, and a group.
+        """
+        df = self.getSavefile()
+        df.writevarstr('Map')
+        df.writevarints(300, 4, 2, 1, 1, 2)
+
+        # String table
+        df.writevarstr('Room 1')
+        df.writevarstr('')
+
+        # Room 1 (>=v12 format)
+        df.writevarints(70000, 299, 1, 0, Room.TYPE_NORMAL, Room.COLOR_BW, 1, 1, 1, 1, 1)
+        df.writeuchar(0)
+        df.writeuchar(0)
+
+        # Room 2 (>=v12 format)
+        df.writevarints(2, 2, 2, 1, Room.TYPE_NORMAL, Room.COLOR_BW, 1, 1, 1, 1, 1)
+        df.writeuchar(0)
+        df.writeuchar(0)
+
+        # Connection (>=v12 format)
+        df.writevarints(70000, DIR_S, 2, DIR_N, Connection.PASS_ONEWAY_A, 1)
+        df.writevarint(1)
+        df.writeuchar(DIR_S)
+        df.writeuchar(ConnectionEnd.CONN_LADDER)
+        df.writeuchar(ConnectionEnd.RENDER_REGULAR)
+        df.writeuchar(ConnectionEnd.STUB_REGULAR)
+        df.writevarint(1)
+        df.writeuchar(DIR_N)
+        df.writeuchar(ConnectionEnd.CONN_LADDER)
+        df.writeuchar(ConnectionEnd.RENDER_REGULAR)
+        df.writeuchar(ConnectionEnd.STUB_REGULAR)
+
+        # Group (>=v12 format)
+        df.writevarints(2, Group.STYLE_RED, 70000, 2)
+
+        df.seek(0)
+        mapobj = Map.load(df, 12)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(mapobj.name, 'Map')
+        self.assertEqual(mapobj.w, 300)
+        self.assertEqual(mapobj.h, 4)
+        self.assertEqual(len(mapobj.rooms), 2)
+        self.assertEqual(len(mapobj.conns), 1)
+        self.assertEqual(len(mapobj.groups), 1)
+        r1 = mapobj.rooms[70000]
+        r2 = mapobj.rooms[2]
+        self.assertEqual(r1.name, 'Room 1')
+        self.assertEqual(r1.x, 299)
+        self.assertEqual(r2.name, '')
+        self.assertEqual(mapobj.get_room_at(299, 1), r1)
+        c = mapobj.conns[0]
+        self.assertEqual(c.r1, r1)
+        self.assertEqual(c.dir1, DIR_S)
+        self.assertEqual(c.r2, r2)
+        self.assertEqual(c.dir2, DIR_N)
+        self.assertEqual(c.symmetric, True)
+        self.assertEqual(c.passage, Connection.PASS_ONEWAY_A)
+        self.assertEqual(c.ends1[DIR_S].conn_type, ConnectionEnd.CONN_LADDER)
+        self.assertEqual(c.ends2[DIR_N].conn_type, ConnectionEnd.CONN_LADDER)
+        g = mapobj.groups[0]
+        self.assertEqual(g.style, Group.STYLE_RED)
+        self.assertEqual(list(g.rooms), [r1, r2])
+
+    def test_save_and_load_large_map(self):
+        """
+        Tests that a map which is bigger than the pre-v12 limits survives
+        a save and load.
+        """
+        mapobj = Map('Map')
+        while mapobj.w < 400:
+            mapobj.resize(DIR_E)
+        mapobj.cur_id = 100000
+        r1 = mapobj.add_room_at(350, 1, 'Room 1')
+        r2 = mapobj.add_room_at(1, 1, 'Room 2')
+        r2.notes = 'x' * 70000
+        mapobj.connect(r1, DIR_W, r2)
+
+        df = self.getSavefile()
+        mapobj.save(df)
+        df.seek(0)
+        loaded = Map.load(df, 12)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(loaded.w, 400)
+        self.assertEqual(loaded.get_room_at(350, 1).idnum, 100000)
+        self.assertEqual(loaded.rooms[100001].notes, 'x' * 70000)
+        self.assertEqual(len(loaded.conns), 1)
+
+    def write_v12_conflicting_map(self, df):
+        """
+        Writes a v12 map to `df` whose two connections both claim
+        the north side of Room 1.
+        """
+        df.writevarstr('Map')
+        df.writevarints(4, 4, 2, 2, 0, 1)
+        df.writevarstr('')
+        for (idnum, x, y) in [(1, 1, 1), (2, 2, 2)]:
+            df.writevarints(idnum, x, y, 0, Room.TYPE_NORMAL, Room.COLOR_BW, 0, 0, 0, 0, 0)
+            df.writeuchar(0)
+            df.writeuchar(0)
+        for (dir1, dir2) in [(DIR_N, DIR_S), (DIR_N, DIR_E)]:
+            df.writevarints(1, dir1, 2, dir2, Connection.PASS_TWOWAY, 1)
+            for direction in [dir1, dir2]:
+                df.writevarint(1)
+                df.writeuchar(direction)
+                df.writeuchar(ConnectionEnd.CONN_REGULAR)
+                df.writeuchar(ConnectionEnd.RENDER_REGULAR)
+                df.writeuchar(ConnectionEnd.STUB_REGULAR)
+        df.seek(0)
+
+    def test_load_v12_conflicting_connections(self):
+        """
+        Connections which conflict with each other should be caught by
+        the validation pass.
+        """
+        df = self.getSavefile()
+        self.write_v12_conflicting_map(df)
+        with self.assertRaises(LoadException) as cm:
+            Map.load(df, 12)
+        self.assertIn('Found an existing ConnectionEnd where we shouldn\'t', cm.exception.text)
+
+    def test_load_v12_without_validation(self):
+        """
+        Skipping validation means that conflicting connections won't
+        be noticed.
+        """
+        df = self.getSavefile()
+        self.write_v12_conflicting_map(df)
+        mapobj = Map.load(df, 12, validate=False)
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(len(mapobj.conns), 2)
+        self.assertIs(mapobj.rooms[1].conns[DIR_N], mapobj.conns[1])
+        with self.assertRaises(LoadException):
+            mapobj.validate()
+
+    def test_load_v12_connection_to_unknown_room(self):
+        """
+        A connection to a room which doesn't exist can't be built at all,
+        even without validation.
+        """
+        df = self.getSavefile()
+        df.writevarstr('Map')
+        df.writevarints(4, 4, 1, 1, 0, 1)
+        df.writevarstr('')
+        df.writevarints(1, 1, 1, 0, Room.TYPE_NORMAL, Room.COLOR_BW, 0, 0, 0, 0, 0)
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.writevarints(1, DIR_N, 5, DIR_S, Connection.PASS_TWOWAY, 1, 0, 0)
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            Map.load(df, 12, validate=False)
+        self.assertIn('Connection refers to room 5', cm.exception.text)
+
+    def test_validate_valid_map(self):
+        """
+        Validating a perfectly normal map shouldn't complain
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 2, 'Room 2')
+        r3 = mapobj.add_room_at(3, 3, 'Room 3')
+        conn = mapobj.connect(r1, DIR_E, r2)
+        conn.connect_extra(r1, DIR_NE)
+        mapobj.connect(r2, DIR_E, r3)
+        r3.set_loopback(DIR_N)
+        mapobj.validate()
+
+    def test_validate_loopback_conflict(self):
+        """
+        A loopback in the same direction as a connection end isn't valid
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 2, 'Room 2')
+        mapobj.connect(r1, DIR_E, r2)
+        r1.loopback_mask |= DIR_BIT[DIR_E]
+        with self.assertRaises(LoadException) as cm:
+            mapobj.validate()
+        self.assertIn('Found an existing ConnectionEnd where we shouldn\'t', cm.exception.text)
+
+    def test_validate_room_not_on_map(self):
+        """
+        Connections to rooms which aren't on the map aren't valid
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(2, 2, 'Room 2')
+        mapobj.connect(r1, DIR_E, r2)
+        del mapobj.rooms[r2.idnum]
+        with self.assertRaises(LoadException) as cm:
+            mapobj.validate()
+        self.assertIn('which is not on the map', cm.exception.text)
+
+    def test_to_records_and_from_records(self):
+        """
+        Tests that a map survives being flattened out into records and
+        built back up again, and that the records are plain enough to
+        be marshalled.
+        """
+        import marshal
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(1, 2, 'Room 2')
+        r3 = mapobj.add_room_at(2, 2, 'Room 3')
+        r1.notes = 'Notes'
+        r3.set_loopback(DIR_E)
+        conn = mapobj.connect(r1, DIR_S, r2, DIR_N)
+        conn.connect_extra(r2, DIR_NE)
+        mapobj.connect(r2, DIR_E, r3, DIR_W)
+        mapobj.group_rooms(r2, r3)
+
+        records = marshal.loads(marshal.dumps(mapobj.to_records()))
+        loaded = Map.from_records(records, validate=True)
+        self.assertEqual(loaded.name, 'Map')
+        self.assertEqual((loaded.w, loaded.h), (mapobj.w, mapobj.h))
+        self.assertEqual(sorted(loaded.rooms.keys()), sorted(mapobj.rooms.keys()))
+        self.assertEqual(loaded.get_room_at(1, 1).notes, 'Notes')
+        self.assertEqual(len(loaded.conns), 2)
+        self.assertEqual(sorted(loaded.rooms[r2.idnum].conns.keys()), [DIR_N, DIR_NE, DIR_E])
+        self.assertEqual(loaded.rooms[r3.idnum].get_loopback(DIR_E), True)
+        self.assertEqual(len(loaded.groups), 1)
+        self.assertEqual(loaded.to_records(), mapobj.to_records())
+
+        mapobj.mark_dirty()
+        loaded.mark_dirty()
+        self.assertEqual(loaded.get_savedata(), mapobj.get_savedata())
+
+    def test_from_records_unknown_room(self):
+        """
+        Connections in the records have to refer to rooms which exist
+        """
+        records = ('Map', 4, 4, [], [((1, DIR_N, 2, DIR_S, 0, True, 1, 1), [])], [])
+        with self.assertRaises(LoadException) as cm:
+            Map.from_records(records)
+        self.assertIn('Connection refers to room 1', cm.exception.text)
+
+    def test_from_records_invalid(self):
+        """
+        Bad coordinates and malformed records should raise a LoadException,
+        rather than whatever happens to go wrong while building the map
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(1, 2, 'Room 2')
+        mapobj.connect(r1, DIR_S, r2, DIR_N)
+        mapobj.group_rooms(r1, r2)
+        (name, w, h, rooms, conns, groups) = mapobj.to_records()
+        room = rooms[0]
+        for (records, message) in [
+                (None, 'Invalid map record'),
+                ((name, w, h, rooms), 'Invalid map record'),
+                ((name, w, h, [room[:1] + (9,) + room[2:]], [], []), 'Room 0 is off the map, at (10, 2)'),
+                ((name, w, h, [room[:2] + (-1,) + room[3:]], [], []), 'Room 0 is off the map, at (2, 0)'),
+                ((name, w, h, [room, room], [], []), 'Room ID 0 already exists'),
+                ((name, w, h, [room, (5,) + room[1:]], [], []), 'Room 5 overlaps another room at (2, 2)'),
+                ((name, w, h, [room[:5]], [], []), 'Invalid records for map "Map"'),
+                ((name, w, h, [room[:1] + ('1',) + room[2:]], [], []), 'Invalid records for map "Map"'),
+                ((name, w, h, rooms, [conns[0][0]], []), 'Invalid records for map "Map"'),
+                ((name, w, h, rooms, [(conns[0][0][:3], conns[0][1])], []), 'Invalid records for map "Map"'),
+                ((name, w, h, rooms, [(conns[0][0], [(0, 1)])], []), 'Invalid records for map "Map"'),
+                ((name, w, h, rooms, conns, [(0, (0,))]), 'Group stated it had only 1 rooms'),
+                ((name, w, h, rooms, conns, [(0,)]), 'Invalid records for map "Map"'),
+                ]:
+            with self.subTest(records=records):
+                with self.assertRaises(LoadException) as cm:
+                    Map.from_records(records)
+                self.assertIn(message, cm.exception.text)
+
+    def assert_same_records(self, records, expected):
+        """
+        Checks that two sets of `Map.to_records` match, apart from the
+        order things are in (which `Map.restore` doesn't keep for anything
+        it has to add back)
+        """
+        self.assertEqual(records[:3], expected[:3])
+        for (part, expected_part) in zip(records[3:], expected[3:]):
+            self.assertEqual(sorted(part), sorted(expected_part))
+
+    def get_snapshot_map(self):
+        """
+        Returns a map with a bit of everything on it, for snapshot tests
+        """
+        mapobj = Map('Map')
+        r1 = mapobj.add_room_at(1, 1, 'Room 1')
+        r2 = mapobj.add_room_at(1, 2, 'Room 2')
+        r3 = mapobj.add_room_at(2, 2, 'Room 3')
+        r4 = mapobj.add_room_at(3, 3, 'Room 4')
+        r1.notes = 'Notes'
+        r3.set_loopback(DIR_E)
+        conn = mapobj.connect(r1, DIR_S, r2, DIR_N)
+        conn.connect_extra(r2, DIR_NE)
+        conn.set_dotted(r1, DIR_S)
+        mapobj.connect(r2, DIR_E, r3, DIR_W)
+        mapobj.group_rooms(r2, r3)
+        mapobj.del_room(r4)
+        return (mapobj, r1, r2, r3, conn)
+
+    def test_snapshot_and_restore(self):
+        """
+        Tests that a map can be put back the way it was when a snapshot
+        was taken, and then forwards again with a snapshot taken just
+        before that
+        """
+        (mapobj, r1, r2, r3, conn) = self.get_snapshot_map()
+        records = mapobj.to_records()
+        next_id = mapobj.grab_id()
+        free_ids = list(mapobj.free_ids)
+
+        snapshot = mapobj.snapshot()
+        r1.name = 'Renamed'
+        conn.set_ladder(r1, DIR_S)
+        mapobj.move_room(r2, DIR_W)
+        mapobj.del_room(r3)
+        r5 = mapobj.add_room_at(5, 5, 'Room 5')
+        mapobj.connect(r1, DIR_E, r5)
+        mapobj.group_rooms(r1, r5)
+        mapobj.resize(DIR_E)
+        mapobj.name = 'Renamed Map'
+        changed = mapobj.to_records()
+
+        redo = mapobj.snapshot()
+        mapobj.restore(snapshot)
+        self.assert_same_records(mapobj.to_records(), records)
+        self.assertIs(mapobj.get_room_at(1, 1), r1)
+        self.assertEqual(r1.name, 'Room 1')
+        self.assertEqual(r1.notes, 'Notes')
+        self.assertIs(r1.get_conn(DIR_S), conn)
+        self.assertEqual(conn.ends1[DIR_S].is_dotted(), True)
+        self.assertEqual(mapobj.get_room_at(2, 2).get_loopback(DIR_E), True)
+        self.assertEqual(mapobj.get_room_at(2, 2).group, r2.group)
+        self.assertEqual(mapobj.get_room_at(5, 5), None)
+        self.assertEqual(mapobj.get_room_at(2, 2).name, 'Room 3')
+        self.assertEqual(r1.group, None)
+        self.assertEqual(mapobj.free_ids, free_ids)
+        self.assertEqual(mapobj.grab_id(), next_id)
+        self.assertEqual(mapobj.validate(), None)
+        self.assertEqual(mapobj.is_dirty(), True)
+
+        mapobj.restore(redo)
+        self.assert_same_records(mapobj.to_records(), changed)
+        self.assertEqual(mapobj.validate(), None)
+        mapobj.restore(snapshot)
+        self.assert_same_records(mapobj.to_records(), records)
+
+    def test_restore_across_snapshots(self):
+        """
+        Restoring a snapshot undoes the changes noted in every snapshot
+        taken since, not just its own
+        """
+        (mapobj, r1, r2, r3, conn) = self.get_snapshot_map()
+        records = mapobj.to_records()
+        first = mapobj.snapshot()
+        r1.name = 'Renamed'
+        mapobj.snapshot()
+        r1.name = 'Renamed Again'
+        mapobj.del_room(r2)
+        mapobj.snapshot()
+        mapobj.add_room_at(1, 2, 'New Room 2')
+        mapobj.restore(first)
+        self.assert_same_records(mapobj.to_records(), records)
+        self.assertEqual(mapobj.validate(), None)
+
+    def test_restore_other_map(self):
+        """
+        Restoring a snapshot from some other map isn't allowed
+        """
+        (mapobj, r1, r2, r3, conn) = self.get_snapshot_map()
+        other = mapobj.duplicate()
+        snapshot = other.snapshot()
+        mapobj.snapshot()
+        with self.assertRaises(ValueError):
+            mapobj.restore(snapshot)
+
+    def test_restore_set_map_size(self):
+        """
+        Wiping a map with `set_map_size` can be restored too
+        """
+        (mapobj, r1, r2, r3, conn) = self.get_snapshot_map()
+        records = mapobj.to_records()
+        snapshot = mapobj.snapshot()
+        mapobj.set_map_size(4, 4)
+        mapobj.add_room_at(1, 1, 'New Room')
+        mapobj.restore(snapshot)
+        self.assert_same_records(mapobj.to_records(), records)
+        self.assertEqual(mapobj.validate(), None)
+
+    def test_snapshot_only_notes_changes(self):
+        """
+        A snapshot only gets the records of things which change after it's
+        taken, and those are the same records the objects keep for
+        themselves
+        """
+        (mapobj, r1, r2, r3, conn) = self.get_snapshot_map()
+        r1_record = r1.get_record()
+        self.assertIs(r1.get_record(), r1_record)
+        conn_record = conn.get_record()
+
+        first = mapobj.snapshot()
+        self.assertEqual((first.rooms, first.conns, first.groups), ({}, {}, {}))
+        r1.type = Room.TYPE_DARK
+        r1.color = Room.COLOR_RED
+        conn.set_oneway_a()
+        r2.group.style = Group.STYLE_FAINT
+        self.assertEqual(first.rooms, {r1.idnum: r1_record})
+        self.assertIs(first.rooms[r1.idnum], r1_record)
+        self.assertEqual(first.conns, {conn: conn_record})
+        self.assertIs(first.conns[conn], conn_record)
+        self.assertEqual(first.groups, {r2.group: (Group.STYLE_NORMAL, (r2.idnum, r3.idnum))})
+        self.assertEqual(r1.get_record()[4:6], (Room.TYPE_DARK, Room.COLOR_RED))
+
+        second = mapobj.snapshot()
+        self.assertIs(first.next_snapshot, second)
+        r5 = mapobj.add_room_at(5, 5, 'Room 5')
+        r1.name = 'Renamed'
+        self.assertEqual(sorted(second.rooms), sorted([r1.idnum, r5.idnum]))
+        self.assertEqual(second.rooms[r5.idnum], None)
+        self.assertEqual(second.rooms[r1.idnum][3], 'Room 1')
+        self.assertEqual(list(first.rooms), [r1.idnum])
+
+    def test_snapshot_empty(self):
+        """
+        Tests snapshotting a map with nothing on it
+        """
+        mapobj = Map('Empty')
+        mapobj.set_map_size(4, 6)
+        snapshot = mapobj.snapshot()
+        self.assertEqual(snapshot.name, 'Empty')
+        self.assertEqual((snapshot.w, snapshot.h), (4, 6))
+        mapobj.resize(DIR_E)
+        mapobj.restore(snapshot)
+        self.assertEqual((mapobj.w, mapobj.h), (4, 6))
+        self.assertEqual(mapobj.to_records(), ('Empty', 4, 6, [], [], []))
+
+    def test_snapshot_cost(self):
+        """
+        Taking a snapshot, making a change and then undoing and redoing it
+        should cost the same however many rooms there are which haven't
+        been touched
+        """
+        counts = []
+        for num_rooms in (10, 1000):
+            mapobj = Map('Map')
+            mapobj.set_map_size(num_rooms+2, 3)
+            rooms = [mapobj.add_room_at(x, 1, 'Room %d' % (x)) for x in range(num_rooms)]
+            for (room, next_room) in zip(rooms, rooms[1:]):
+                mapobj.connect(room, DIR_E, next_room)
+            mapobj.group_rooms(rooms[0], rooms[1])
+            with mock.patch.object(Room, 'to_record', autospec=True, side_effect=Room.to_record) as room_records, \
+                    mock.patch.object(Connection, 'to_record', autospec=True, side_effect=Connection.to_record) as conn_records, \
+                    mock.patch.object(Room, 'from_record', side_effect=Room.from_record) as rooms_built:
+                undo = mapobj.snapshot()
+                rooms[0].name = 'Renamed'
+                mapobj.del_room(rooms[1])
+                redo = mapobj.snapshot()
+                mapobj.restore(undo)
+                self.assertEqual(rooms[0].name, 'Room 0')
+                undo = mapobj.snapshot()
+                mapobj.restore(redo)
+                self.assertEqual(rooms[0].name, 'Renamed')
+                counts.append((room_records.call_count, conn_records.call_count,
+                    rooms_built.call_count))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_deferred(self):
+        """
+        A deferred map should only get built once something other than
+        its name is looked at
+        """
+        built = Map('Built')
+        built.set_map_size(4, 5)
+        calls = []
+        def loader(arg):
+            calls.append(arg)
+            return built
+        mapobj = Map.deferred('Deferred', b'data', None, loader, 'arg')
+        self.assertEqual(mapobj.is_loaded(), False)
+        self.assertEqual(mapobj.name, 'Deferred')
+        self.assertEqual(mapobj.is_dirty(), False)
+        self.assertEqual(mapobj.get_savedata(), b'data')
+        self.assertEqual(calls, [])
+        self.assertEqual(mapobj.h, 5)
+        self.assertEqual(calls, ['arg'])
+        self.assertEqual(mapobj.is_loaded(), True)
+        self.assertEqual(mapobj.name, 'Deferred')
+        self.assertEqual(mapobj.savedata, None)
+        # With nowhere to read our data back in from, we have to be re-encoded
+        self.assertEqual(mapobj.is_dirty(), True)
+        built.name = 'Deferred'
+        self.assertEqual(mapobj.get_savedata(), built.get_savedata())
+
+    def test_deferred_failure(self):
+        """
+        If a deferred map fails to load, it should stay unloaded, so that
+        trying again reports the same problem
+        """
+        def loader():
+            raise LoadException('Broken')
+        mapobj = Map.deferred('Deferred', None, None, loader)
+        for i in range(2):
+            with self.assertRaises(LoadException):
+                mapobj.materialize()
+            self.assertEqual(mapobj.is_loaded(), False)
@@ -5,7 +5,8 @@ import unittest
 import operator
 from advmap.data import Room, Group, Map, Connection, ConnectionEnd
 from advmap.data import DIR_N, DIR_NE, DIR_E, DIR_SE, DIR_S, DIR_SW, DIR_W, DIR_NW
-from advmap.file import Savefile
+from advmap.data import DIR_LIST, DIR_BIT, DIR_CW, DIR_MIRROR_X
+from advmap.file import Savefile, LoadException
 
 class RoomTests(unittest.TestCase):
     """
@@ -143,6 +144,113 @@ class RoomTests(unittest.TestCase):
         r.name = 'Room Five'
         self.assertEqual(r.unexplored(), False)
 
+    def test_direction_masks(self):
+        """
+        Test keeping track of which directions are in use
+        """
+        r = Room(1, 0, 0)
+        r2 = Room(2, 1, 1)
+        self.assertIs(r.conn_array, Room.NO_CONNS)
+        self.assertIs(r2.conn_array, Room.NO_CONNS)
+        r.set_loopback(DIR_E)
+        c = r.connect(DIR_N, r2)
+        self.assertEqual(r.dir_mask, DIR_BIT[DIR_N] | DIR_BIT[DIR_E])
+        self.assertEqual(r.loopback_mask, DIR_BIT[DIR_E])
+        self.assertEqual(r2.dir_mask, DIR_BIT[DIR_S])
+        self.assertEqual(r.conn_array, [c, None, None, None, None, None, None, None])
+        self.assertEqual(Room.NO_CONNS, (None,)*8)
+        self.assertEqual([r.dir_in_use(d) for d in DIR_LIST],
+                [True, False, True, False, False, False, False, False])
+        self.assertEqual(dict(r.conns), {DIR_N: c})
+        self.assertEqual(dict(r.loopbacks), {DIR_E: True})
+        with self.assertRaises(TypeError):
+            r.conns[DIR_W] = c
+
+        r.detach(DIR_N)
+        r2.clear_conn(DIR_S)
+        self.assertEqual(r.dir_mask, DIR_BIT[DIR_E])
+        self.assertEqual(r2.dir_mask, 0)
+        r.detach(DIR_E)
+        self.assertEqual((r.dir_mask, r.loopback_mask), (0, 0))
+
+    def test_conns_and_loopbacks_views(self):
+        """
+        `conns` and `loopbacks` are live views, created once per room, and
+        loopbacks can still be set and removed through them
+        """
+        r = Room(1, 0, 0)
+        r2 = Room(2, 1, 1)
+        conns = r.conns
+        loopbacks = r.loopbacks
+        self.assertIs(r.conns, conns)
+        self.assertIs(r.loopbacks, loopbacks)
+        self.assertEqual((len(conns), len(loopbacks)), (0, 0))
+
+        c = r.connect(DIR_N, r2)
+        r.loopbacks[DIR_E] = True
+        self.assertEqual(r.get_loopback(DIR_E), True)
+        self.assertEqual(r.dir_in_use(DIR_E), True)
+        self.assertEqual(dict(conns), {DIR_N: c})
+        self.assertEqual(dict(loopbacks), {DIR_E: True})
+        self.assertEqual((len(conns), len(loopbacks)), (1, 1))
+        self.assertEqual(conns[DIR_N], c)
+        for key in [DIR_S, -1, 8, 'N']:
+            self.assertNotIn(key, conns)
+            self.assertNotIn(key, loopbacks)
+            with self.assertRaises(KeyError):
+                conns[key]
+            with self.assertRaises(KeyError):
+                loopbacks[key]
+        with self.assertRaises(KeyError):
+            loopbacks[-1] = True
+
+        del r.loopbacks[DIR_E]
+        self.assertEqual(r.dir_mask, DIR_BIT[DIR_N])
+        self.assertEqual(r.loopback_mask, 0)
+        with self.assertRaises(KeyError):
+            del r.loopbacks[DIR_E]
+
+    def test_get_conns(self):
+        """
+        Getting all the connections touching a room, once each
+        """
+        r = Room(1, 0, 0)
+        r2 = Room(2, 1, 1)
+        r3 = Room(3, 2, 2)
+        self.assertEqual(r.get_conns(), [])
+        c1 = r.connect(DIR_E, r2)
+        c2 = r.connect(DIR_N, r3)
+        c1.connect_extra(r, DIR_W)
+        r.set_loopback(DIR_S)
+        self.assertEqual(r.get_conns(), [c2, c1])
+        self.assertEqual(r2.get_conns(), [c1])
+
+    def test_remap_directions(self):
+        """
+        Moving our connections and loopbacks around to new directions
+        """
+        r = Room(1, 0, 0)
+        r2 = Room(2, 1, 1)
+        c1 = r.connect(DIR_E, r2)
+        r.set_loopback(DIR_NW)
+        r.remap_directions(DIR_CW)
+        self.assertEqual(r.conns, {DIR_S: c1})
+        self.assertEqual(r.loopbacks, {DIR_NE: True})
+        self.assertEqual(r.dir_mask, DIR_BIT[DIR_S] | DIR_BIT[DIR_NE])
+        self.assertEqual(r.loopback_mask, DIR_BIT[DIR_NE])
+        self.assertEqual(r.dir_in_use(DIR_E), False)
+
+    def test_remap_directions_no_conns(self):
+        """
+        Remapping a room which has never been connected leaves its shared
+        empty connection list alone
+        """
+        r = Room(1, 0, 0)
+        r.set_loopback(DIR_E)
+        r.remap_directions(DIR_MIRROR_X)
+        self.assertIs(r.conn_array, Room.NO_CONNS)
+        self.assertEqual(r.loopbacks, {DIR_W: True})
+
     def test_set_loopback_no_conns(self):
         """
         Setting a loopback where there isn't already a connection
@@ -292,7 +400,7 @@ class RoomTests(unittest.TestCase):
         """
         (r1, r2, c) = self.get_basic_connection()
         c.ends1[DIR_NE] = ConnectionEnd(r1, DIR_NE)
-        r1.conns[DIR_NE] = c
+        r1.set_conn(DIR_NE, c)
         self.assertEqual(len(r1.conns), 2)
         self.assertIn(DIR_NE, r1.conns)
         self.assertEqual(r1.conns[DIR_NE], c)
@@ -317,7 +425,7 @@ class RoomTests(unittest.TestCase):
         """
         (r1, r2, c) = self.get_basic_connection()
         c.ends1[DIR_NE] = ConnectionEnd(r1, DIR_NE)
-        r1.conns[DIR_NE] = c
+        r1.set_conn(DIR_NE, c)
         self.assertEqual(len(r1.conns), 2)
         self.assertIn(DIR_NE, r1.conns)
         self.assertEqual(r1.conns[DIR_NE], c)
@@ -353,7 +461,7 @@ class RoomTests(unittest.TestCase):
         self.assertEqual(r2.conns[DIR_S], c)
 
         c.ends2[DIR_NE] = ConnectionEnd(r1, DIR_NE)
-        r1.conns[DIR_NE] = c
+        r1.set_conn(DIR_NE, c)
         self.assertEqual(len(r1.conns), 2)
         self.assertIn(DIR_NE, r1.conns)
         self.assertEqual(r1.conns[DIR_NE], c)
@@ -377,7 +485,7 @@ class RoomTests(unittest.TestCase):
         """
         (r1, r2, c) = self.get_basic_connection()
         c.ends2[DIR_SW] = ConnectionEnd(r2, DIR_SW)
-        r2.conns[DIR_SW] = c
+        r2.set_conn(DIR_SW, c)
         self.assertEqual(len(r2.conns), 2)
         self.assertIn(DIR_SW, r2.conns)
         self.assertEqual(r2.conns[DIR_SW], c)
@@ -497,6 +605,58 @@ class RoomTests(unittest.TestCase):
                 r.increment_color()
                 self.assertEqual(r.color, result)
 
+    def get_strings(self):
+        """
+        Returns a string table dict which covers the strings used in
+        our save tests.
+        """
+        return {b'Room': 0, b'Up': 1, b'Down': 2, b'In': 3, b'Out': 4, b'Notes': 5}
+
+    def test_get_strings(self):
+        """
+        Test getting all our text fields
+        """
+        r = Room(1, 2, 3)
+        r.name = 'Room'
+        r.up = 'Up'
+        r.down = 'Down'
+        r.door_in = 'In'
+        r.door_out = 'Out'
+        r.notes = 'Notes'
+        self.assertEqual(r.get_strings(), ('Room', 'Up', 'Down', 'In', 'Out', 'Notes'))
+
+    def test_raw_strings(self):
+        """
+        Text given as bytes should be left alone until it's used
+        """
+        r = Room.from_record((1, 2, 3, 'Ünïcödé'.encode('utf-8'), 0, 0,
+            b'Up', b'', b'', b'', b'Notes', 0, 0))
+        self.assertEqual(r._name, 'Ünïcödé'.encode('utf-8'))
+        self.assertEqual(r.get_raw_strings(), ('Ünïcödé'.encode('utf-8'), b'Up', b'', b'', b'', b'Notes'))
+        self.assertEqual(r.name, 'Ünïcödé')
+        self.assertEqual(r._name, 'Ünïcödé')
+        self.assertEqual(r._notes, b'Notes')
+
+        # Duplicates shouldn't need to decode anything either
+        r2 = r.duplicate()
+        self.assertEqual(r2._up, b'Up')
+        self.assertEqual(r2.up, 'Up')
+
+        r.notes = 'Changed'
+        self.assertEqual(r.get_strings(), ('Ünïcödé', 'Up', '', '', '', 'Changed'))
+        self.assertEqual(r.get_raw_strings(), ('Ünïcödé'.encode('utf-8'), b'Up', b'', b'', b'', b'Changed'))
+
+    def test_raw_strings_invalid(self):
+        """
+        Text which isn't valid UTF-8 should still be readable, but should
+        be kept as it was unless it's changed
+        """
+        r = Room.from_record((1, 2, 3, b'R\xffm', 0, 0, b'', b'', b'', b'', b'', 0, 0))
+        self.assertEqual(r.name, 'R\ufffdm')
+        self.assertEqual(r.get_raw_strings()[0], b'R\xffm')
+        r.name = 'Room'
+        self.assertEqual(r.get_raw_strings()[0], b'Room')
+
     def test_save_basic_room_no_loopbacks_or_flags(self):
         """
         Test saving a basic room with no loopbacks or flags
@@ -512,19 +672,19 @@ class RoomTests(unittest.TestCase):
         r.door_in = 'In'
         r.door_out = 'Out'
         r.notes = 'Notes'
-        r.save(df)
+        r.save(df, self.get_strings())
         df.seek(0)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readuchar(), 2)
-        self.assertEqual(df.readuchar(), 3)
-        self.assertEqual(df.readstr(), 'Room')
-        self.assertEqual(df.readuchar(), Room.TYPE_FAINT)
-        self.assertEqual(df.readuchar(), Room.COLOR_GREEN)
-        self.assertEqual(df.readstr(), 'Up')
-        self.assertEqual(df.readstr(), 'Down')
-        self.assertEqual(df.readstr(), 'In')
-        self.assertEqual(df.readstr(), 'Out')
-        self.assertEqual(df.readstr(), 'Notes')
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), Room.TYPE_FAINT)
+        self.assertEqual(df.readvarint(), Room.COLOR_GREEN)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), 4)
+        self.assertEqual(df.readvarint(), 5)
         self.assertEqual(df.readuchar(), 0)
         self.assertEqual(df.readuchar(), 0)
         self.assertEqual(df.eof(), True)
@@ -549,19 +709,19 @@ class RoomTests(unittest.TestCase):
             r.set_loopback(direction)
         r.offset_x = True
         r.offset_y = True
-        r.save(df)
+        r.save(df, self.get_strings())
         df.seek(0)
-        self.assertEqual(df.readshort(), 1)
-        self.assertEqual(df.readuchar(), 2)
-        self.assertEqual(df.readuchar(), 3)
-        self.assertEqual(df.readstr(), 'Room')
-        self.assertEqual(df.readuchar(), Room.TYPE_FAINT)
-        self.assertEqual(df.readuchar(), Room.COLOR_BLUE)
-        self.assertEqual(df.readstr(), 'Up')
-        self.assertEqual(df.readstr(), 'Down')
-        self.assertEqual(df.readstr(), 'In')
-        self.assertEqual(df.readstr(), 'Out')
-        self.assertEqual(df.readstr(), 'Notes')
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), 0)
+        self.assertEqual(df.readvarint(), Room.TYPE_FAINT)
+        self.assertEqual(df.readvarint(), Room.COLOR_BLUE)
+        self.assertEqual(df.readvarint(), 1)
+        self.assertEqual(df.readvarint(), 2)
+        self.assertEqual(df.readvarint(), 3)
+        self.assertEqual(df.readvarint(), 4)
+        self.assertEqual(df.readvarint(), 5)
         self.assertEqual(df.readuchar(), 3)
         self.assertEqual(df.readuchar(), 255)
         self.assertEqual(df.eof(), True)
@@ -797,3 +957,178 @@ class RoomTests(unittest.TestCase):
         self.assertEqual(r.offset_x, False)
         self.assertEqual(r.offset_y, False)
         self.assertEqual(len(r.loopbacks), 0)
+
+    def test_load_v11_basic(self):
+        """
+        Tests loading a basic v11 room (with strings in a string table)
+        """
+        df = self.getSavefile()
+        df.writeshort(1)
+        df.writeuchar(2)
+        df.writeuchar(3)
+        df.writeshort(5)
+        df.writeuchar(Room.TYPE_DARK)
+        df.writeuchar(Room.COLOR_ORANGE)
+        df.writeshort(4)
+        df.writeshort(3)
+        df.writeshort(2)
+        df.writeshort(1)
+        df.writeshort(0)
+        df.writeuchar(3)
+        df.writeuchar(0x11)
+        df.seek(0)
+        r = Room.load(df, 11, ['Notes', 'Out', 'In', 'Down', 'Up', 'Room'])
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(r.idnum, 1)
+        self.assertEqual(r.x, 2)
+        self.assertEqual(r.y, 3)
+        self.assertEqual(r.name, 'Room')
+        self.assertEqual(r.notes, 'Notes')
+        self.assertEqual(r.up, 'Up')
+        self.assertEqual(r.down, 'Down')
+        self.assertEqual(r.door_in, 'In')
+        self.assertEqual(r.door_out, 'Out')
+        self.assertEqual(r.type, Room.TYPE_DARK)
+        self.assertEqual(r.color, Room.COLOR_ORANGE)
+        self.assertEqual(r.offset_x, True)
+        self.assertEqual(r.offset_y, True)
+        self.assertEqual(len(r.loopbacks), 2)
+        self.assertIn(DIR_N, r.loopbacks)
+        self.assertIn(DIR_S, r.loopbacks)
+
+    def test_load_v11_unknown_string(self):
+        """
+        Tests loading a v11 room which refers to a string which isn't
+        in the string table
+        """
+        df = self.getSavefile()
+        df.writeshort(1)
+        df.writeuchar(2)
+        df.writeuchar(3)
+        df.writeshort(0)
+        df.writeuchar(Room.TYPE_NORMAL)
+        df.writeuchar(Room.COLOR_BW)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(0)
+        df.writeshort(1)
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            Room.load(df, 11, [''])
+        self.assertIn('Room 1 refers to an unknown string', cm.exception.text)
+
+    def test_load_v12_basic(self):
+        """
+        Tests loading a basic v12 room (varints, with strings in a string
+        table), using values which don't fit in the older fixed-size fields
+        """
+        df = self.getSavefile()
+        df.writevarints(70000, 300, 400, 5, Room.TYPE_DARK, Room.COLOR_ORANGE,
+                4, 3, 2, 1, 0)
+        df.writeuchar(3)
+        df.writeuchar(0x11)
+        df.seek(0)
+        r = Room.load(df, 12, ['Notes', 'Out', 'In', 'Down', 'Up', 'Room'])
+        self.assertEqual(df.eof(), True)
+        self.assertEqual(r.idnum, 70000)
+        self.assertEqual(r.x, 300)
+        self.assertEqual(r.y, 400)
+        self.assertEqual(r.name, 'Room')
+        self.assertEqual(r.notes, 'Notes')
+        self.assertEqual(r.up, 'Up')
+        self.assertEqual(r.down, 'Down')
+        self.assertEqual(r.door_in, 'In')
+        self.assertEqual(r.door_out, 'Out')
+        self.assertEqual(r.type, Room.TYPE_DARK)
+        self.assertEqual(r.color, Room.COLOR_ORANGE)
+        self.assertEqual(r.offset_x, True)
+        self.assertEqual(r.offset_y, True)
+        self.assertEqual(len(r.loopbacks), 2)
+        self.assertIn(DIR_N, r.loopbacks)
+        self.assertIn(DIR_S, r.loopbacks)
+
+    def test_load_v12_unknown_string(self):
+        """
+        Tests loading a v12 room which refers to a string which isn't
+        in the string table
+        """
+        df = self.getSavefile()
+        df.writevarints(1, 2, 3, 0, Room.TYPE_NORMAL, Room.COLOR_BW,
+                0, 0, 0, 0, 200)
+        df.writeuchar(0)
+        df.writeuchar(0)
+        df.seek(0)
+        with self.assertRaises(LoadException) as cm:
+            Room.load(df, 12, [''])
+        self.assertIn('Room 1 refers to an unknown string', cm.exception.text)
+
+    def test_skip(self):
+        """
+        Tests skipping over rooms saved in various versions
+        """
+        def write_v2(df):
+            df.writeshort(1)
+            df.writeuchar(2)
+            df.writeuchar(3)
+            df.writestr('Room')
+            df.writeuchar(5)
+            for i in range(5):
+                df.writestr('Text')
+            df.writeuchar(0)
+        def write_v8(df):
+            df.writeshort(1)
+            df.writeuchar(2)
+            df.writeuchar(3)
+            df.writestr('Room')
+            df.writeuchar(Room.TYPE_FAINT)
+            df.writeuchar(Room.COLOR_BW)
+            for i in range(5):
+                df.writestr('Text')
+            df.writeuchar(0)
+            df.writeuchar(0)
+        def write_current(df):
+            r = Room(300, 2, 3)
+            r.name = 'Room'
+            r.up = 'Up'
+            r.down = 'Down'
+            r.door_in = 'In'
+            r.door_out = 'Out'
+            r.notes = 'Notes'
+            r.save(df, self.get_strings())
+        for (version, writer) in [(2, write_v2), (8, write_v8), (12, write_current)]:
+            with self.subTest(version=version):
+                df = self.getSavefile()
+                writer(df)
+                df.writeuchar(42)
+                df.seek(0)
+                Room.skip(df, version)
+                self.assertEqual(df.readuchar(), 42)
+                self.assertEqual(df.eof(), True)
+
+    def test_to_record(self):
+        """
+        Test describing ourselves as a RoomRecord tuple, and building
+        a room back up out of it
+        """
+        r = Room(300, 2, 3)
+        r.name = 'Room'
+        r.type = Room.TYPE_FAINT
+        r.color = Room.COLOR_BLUE
+        r.up = 'Up'
+        r.down = 'Down'
+        r.door_in = 'In'
+        r.door_out = 'Out'
+        r.notes = 'Notes'
+        r.offset_x = True
+        r.set_loopback(DIR_NE)
+        record = r.to_record()
+        self.assertEqual(record, (300, 2, 3, 'Room', Room.TYPE_FAINT, Room.COLOR_BLUE,
+            'Up', 'Down', 'In', 'Out', 'Notes', 0x2, 1 << DIR_NE))
+        r2 = Room.from_record(record)
+        self.assertEqual(r2.to_record(), record)
+        self.assertEqual(r2.offset_x, True)
+        self.assertEqual(r2.offset_y, False)
+        self.assertEqual(list(r2.loopbacks.keys()), [DIR_NE])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import unittest
+from advmap.data import RoomGrid, Room
+
+class RoomGridTests(unittest.TestCase):
+    """
+    Tests for our RoomGrid objects
+    """
+
+    def test_initialization(self):
+        """
+        Basic object initialization
+        """
+        grid = RoomGrid()
+        self.assertEqual(grid.rows, {})
+        self.assertEqual(grid.get(0, 0), None)
+        self.assertEqual(grid.get(1000000, 5), None)
+        self.assertEqual(grid.row_is_empty(0), True)
+        self.assertEqual(grid.col_is_empty(0), True)
+
+    def test_add_and_get(self):
+        """
+        Adding rooms, only storing the rows they're in
+        """
+        grid = RoomGrid()
+        rooms = [Room(1, 0, 0), Room(2, 7, 7), Room(3, 8, 7), Room(4, 7, 8), Room(5, 5000, 300)]
+        for room in rooms:
+            grid.add(room)
+        for room in rooms:
+            with self.subTest(room=room.idnum):
+                self.assertIs(grid.get(room.x, room.y), room)
+        self.assertEqual(grid.get(8, 8), None)
+        self.assertEqual(grid.get(0, 1), None)
+        self.assertEqual(sorted(grid.rows.keys()), [0, 7, 8, 300])
+        self.assertEqual(grid.rows[7], {7: rooms[1], 8: rooms[2]})
+
+    def test_remove(self):
+        """
+        Removing rooms, and dropping rows once they're empty
+        """
+        grid = RoomGrid()
+        r1 = Room(1, 1, 1)
+        r2 = Room(2, 2, 1)
+        grid.add(r1)
+        grid.add(r2)
+        grid.remove(r1)
+        self.assertEqual(grid.get(1, 1), None)
+        self.assertIs(grid.get(2, 1), r2)
+        self.assertEqual(list(grid.rows.keys()), [1])
+        grid.remove(r2)
+        self.assertEqual(grid.get(2, 1), None)
+        self.assertEqual(grid.rows, {})
+
+    def test_rows_and_columns(self):
+        """
+        Keeping track of which rows and columns have rooms
+        """
+        grid = RoomGrid()
+        r1 = Room(1, 3, 4)
+        r2 = Room(2, 3, 6)
+        grid.add(r1)
+        grid.add(r2)
+        self.assertEqual(grid.col_is_empty(3), False)
+        self.assertEqual(grid.col_is_empty(4), True)
+        self.assertEqual(grid.row_is_empty(4), False)
+        self.assertEqual(grid.row_is_empty(6), False)
+        self.assertEqual(grid.row_is_empty(3), True)
+        grid.remove(r1)
+        self.assertEqual(grid.col_is_empty(3), False)
+        self.assertEqual(grid.row_is_empty(4), True)
+        grid.remove(r2)
+        self.assertEqual(grid.col_is_empty(3), True)
+        self.assertEqual(grid.rows, {})
+        self.assertEqual(grid.col_counts, {})
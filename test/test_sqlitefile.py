@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from advmap.sqlitefile import SqliteSavefile, SQLITE_VER
+from advmap.file import LoadException
+
+class SqliteSavefileTests(unittest.TestCase):
+    """
+    Tests for storing games in SQLite databases
+    """
+
+    def setUp(self):
+        """
+        Set up a temporary directory to save into
+        """
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'game.sqlite')
+
+    def tearDown(self):
+        """
+        Clean up our temporary directory
+        """
+        shutil.rmtree(self.dirname)
+
+    def get_records(self, name):
+        """
+        Returns some map records
+        """
+        return (name, 5, 6,
+                [(3, 1, 2, 'Room 3', 1, 2, 'Up', '', '', 'Out', 'Notes', 0x2, 0x81),
+                    (1, 3, 4, 'Room 1', 0, 0, '', 'Down', 'In', '', '', 0x1, 0),
+                    (2, 4, 4, 'Room 2', 0, 0, '', '', '', '', '', 0, 0)],
+                [((3, 4, 1, 0, 1, False, 2, 1), [(3, 3, 1, 0, 1), (3, 4, 0, 2, 3), (1, 0, 0, 0, 1)]),
+                    ((1, 2, 2, 6, 0, True, 1, 1), [(1, 2, 0, 0, 1), (2, 6, 0, 0, 1)])],
+                [(2, (3, 1, 2))])
+
+    def count_changes(self, savefile, func):
+        """
+        Calls `func` with an open `savefile`, and returns the number of
+        rows it changed
+        """
+        savefile.open(create=True)
+        before = savefile.db.total_changes
+        func(savefile)
+        return savefile.db.total_changes - before
+
+    def test_is_sqlite_filename(self):
+        """
+        Test picking SQLite by filename
+        """
+        self.assertEqual(SqliteSavefile.is_sqlite_filename('game.sqlite'), True)
+        self.assertEqual(SqliteSavefile.is_sqlite_filename('GAME.SQLITE'), True)
+        self.assertEqual(SqliteSavefile.is_sqlite_filename('game.adv'), False)
+
+    def test_is_sqlite_file(self):
+        """
+        Test picking SQLite by its contents
+        """
+        SqliteSavefile(self.filename).write('Game', [])
+        self.assertEqual(SqliteSavefile.is_sqlite_file(self.filename), True)
+        other = os.path.join(self.dirname, 'game.adv')
+        with open(other, 'wb') as df:
+            df.write(b'ADVMAP')
+        self.assertEqual(SqliteSavefile.is_sqlite_file(other), False)
+
+    def test_write_and_read(self):
+        """
+        Test that records survive a trip through the database, in order
+        """
+        maps = [self.get_records('Map 1'), self.get_records('Map 2'), ('Empty', 9, 9, [], [], [])]
+        SqliteSavefile(self.filename).write('Game', maps)
+        self.assertEqual(list(SqliteSavefile(self.filename).read()), ['Game'] + maps)
+
+    def test_schema(self):
+        """
+        The database should be laid out so other tools can use it
+        """
+        SqliteSavefile(self.filename).write('Game', [self.get_records('Map 1')])
+        db = sqlite3.connect(self.filename)
+        try:
+            self.assertEqual(db.execute('PRAGMA user_version').fetchone()[0], SQLITE_VER)
+            self.assertEqual(db.execute('SELECT name FROM rooms WHERE map = 0 AND x = 4 AND y = 4').fetchall(),
+                    [('Room 2',)])
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM connection_ends WHERE map = 0 AND room = 3').fetchone(),
+                    (2,))
+            indexes = set([row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")])
+            self.assertIn('rooms_by_position', indexes)
+            self.assertIn('rooms_by_id', indexes)
+            plan = ' '.join([row[-1] for row in db.execute(
+                'EXPLAIN QUERY PLAN SELECT * FROM rooms WHERE map = 0 AND x = 1 AND y = 2')])
+            self.assertIn('rooms_by_position', plan)
+        finally:
+            db.close()
+
+    def test_get_room(self):
+        """
+        Test looking up single rooms
+        """
+        SqliteSavefile(self.filename).write('Game', [self.get_records('Map 1'), self.get_records('Map 2')])
+        with SqliteSavefile(self.filename) as savefile:
+            self.assertEqual(savefile.get_room(1, 3), self.get_records('Map 2')[3][0])
+            self.assertEqual(savefile.get_room(0, 1), self.get_records('Map 1')[3][1])
+            self.assertEqual(savefile.get_room(0, 42), None)
+            self.assertEqual(savefile.get_room_at(0, 4, 4), self.get_records('Map 1')[3][2])
+            self.assertEqual(savefile.get_room_at(0, 0, 0), None)
+            self.assertEqual(savefile.get_room(2, 1), None)
+
+    def test_peek(self):
+        """
+        Test getting a summary of the game
+        """
+        SqliteSavefile(self.filename).write('Game', [self.get_records('Map 1'), ('Empty', 9, 8, [], [], [])])
+        self.assertEqual(SqliteSavefile(self.filename).peek(),
+                ('Game', [('Map 1', 5, 6, 3, 2, 1), ('Empty', 9, 8, 0, 0, 0)]))
+
+    def test_rewrite_unchanged(self):
+        """
+        Writing the same game again shouldn't change anything but the
+        game's name
+        """
+        maps = [self.get_records('Map 1'), self.get_records('Map 2')]
+        savefile = SqliteSavefile(self.filename)
+        savefile.write('Game', maps)
+        self.assertEqual(self.count_changes(savefile, lambda s: s.write('Game', maps)), 1)
+        savefile.close()
+
+    def test_rewrite_one_room(self):
+        """
+        Changing a single room should only update that room's row
+        """
+        records = self.get_records('Map 1')
+        savefile = SqliteSavefile(self.filename)
+        savefile.write('Game', [records])
+        rooms = list(records[3])
+        rooms[1] = (1, 3, 4, 'Renamed', 0, 0, '', 'Down', 'In', '', '', 0x1, 0)
+        changed = records[:3] + (rooms,) + records[4:]
+        self.assertEqual(self.count_changes(savefile, lambda s: s.write_map(0, changed)), 1)
+        self.assertEqual(savefile.read_map(0), changed)
+        savefile.close()
+
+    def test_rewrite_removals_and_additions(self):
+        """
+        Removing and adding rooms and connections should keep everything
+        else in order, without renumbering the rows in between
+        """
+        records = self.get_records('Map 1')
+        savefile = SqliteSavefile(self.filename)
+        savefile.write('Game', [records])
+        (name, w, h, rooms, conns, groups) = records
+        rooms = rooms[1:] + [(7, 0, 0, 'Room 7', 0, 0, '', '', '', '', '', 0, 0)]
+        conns = [conns[1]]
+        changed = (name, w, h, rooms, conns, [])
+        # Room 3 + its connection and three ends out, Room 7 in, and
+        # the group (and its three members) out
+        self.assertEqual(self.count_changes(savefile, lambda s: s.write_map(0, changed)), 10)
+        self.assertEqual(savefile.read_map(0), changed)
+
+        # Reordering rooms should stick, too
+        rooms = [rooms[2], rooms[0], rooms[1]]
+        changed = (name, w, h, rooms, conns, [])
+        savefile.write_map(0, changed)
+        self.assertEqual(savefile.read_map(0), changed)
+        savefile.close()
+
+    def test_rewrite_connection_ends(self):
+        """
+        Changing a connection's ends should rewrite just those ends
+        """
+        records = self.get_records('Map 1')
+        savefile = SqliteSavefile(self.filename)
+        savefile.write('Game', [records])
+        (name, w, h, rooms, conns, groups) = records
+        conns = [((3, 4, 1, 0, 1, False, 1, 1), [(3, 4, 0, 2, 3), (1, 0, 0, 0, 2)]), conns[1]]
+        changed = (name, w, h, rooms, conns, groups)
+        # The connection row itself is untouched; three old ends out,
+        # two new ones in
+        self.assertEqual(self.count_changes(savefile, lambda s: s.write_map(0, changed)), 5)
+        self.assertEqual(savefile.read_map(0), changed)
+        savefile.close()
+
+    def test_write_fewer_maps(self):
+        """
+        Maps past the end of the game should be removed
+        """
+        SqliteSavefile(self.filename).write('Game', [self.get_records('Map 1'), self.get_records('Map 2')])
+        SqliteSavefile(self.filename).write('Renamed', [self.get_records('Map 2')])
+        self.assertEqual(list(SqliteSavefile(self.filename).read()), ['Renamed', self.get_records('Map 2')])
+        db = sqlite3.connect(self.filename)
+        try:
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM rooms').fetchone(), (3,))
+        finally:
+            db.close()
+
+    def test_write_rolls_back(self):
+        """
+        A write which fails partway through shouldn't change anything
+        """
+        SqliteSavefile(self.filename).write('Game', [self.get_records('Map 1')])
+        def maps():
+            yield self.get_records('Changed')
+            raise ValueError('Broken')
+        with self.assertRaises(ValueError):
+            SqliteSavefile(self.filename).write('Game', maps())
+        self.assertEqual(list(SqliteSavefile(self.filename).read()), ['Game', self.get_records('Map 1')])
+
+    def test_sequence(self):
+        """
+        Test working out row order
+        """
+        self.assertEqual(SqliteSavefile.sequence({}, ['a', 'b', 'c']), [0, 1, 2])
+        self.assertEqual(SqliteSavefile.sequence({'a': 0, 'c': 2}, ['a', 'c', 'd']), [0, 2, 3])
+        self.assertEqual(SqliteSavefile.sequence({'a': 0, 'b': 1, 'c': 2}, ['a', 'x', 'b', 'c']), [0, 1, 2, 3])
+        self.assertEqual(SqliteSavefile.sequence({'a': 0, 'b': 5, 'c': 9}, ['c', 'a', 'b']), [9, 10, 11])
+
+    def test_read_errors(self):
+        """
+        Test reading things which aren't our databases
+        """
+        db = sqlite3.connect(self.filename)
+        db.execute('CREATE TABLE other (x INTEGER)')
+        db.close()
+        with self.assertRaises(LoadException) as cm:
+            list(SqliteSavefile(self.filename).read())
+        self.assertIn('Invalid Map File', cm.exception.text)
+
+        db = sqlite3.connect(self.filename)
+        db.execute('PRAGMA user_version = %d' % (SQLITE_VER + 1))
+        db.close()
+        with self.assertRaises(LoadException) as cm:
+            list(SqliteSavefile(self.filename).read())
+        self.assertIn('version %d' % (SQLITE_VER + 1), cm.exception.text)
+
+        with open(self.filename, 'wb') as df:
+            df.write(b'ADVMAP' * 100)
+        with self.assertRaises(LoadException) as cm:
+            list(SqliteSavefile(self.filename).read())
+        self.assertIn('Error reading map database', cm.exception.text)
+
+    def test_read_missing_file(self):
+        """
+        Reading a file which doesn't exist shouldn't create it
+        """
+        with self.assertRaises(IOError):
+            list(SqliteSavefile(self.filename).read())
+        self.assertEqual(os.path.exists(self.filename), False)